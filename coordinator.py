@@ -1,9 +1,11 @@
+import argparse
 import threading
 import time, os, sys
 from pathlib import Path
 from datetime import datetime
 from modules.configLoader.config_loader import ConfigLoader, MONGO_KEY
 from modules.mqttModule.mqtt_client import Mqtt_Client
+from modules.mqttModule.mqtt_recorder import MqttRecorder
 from modules.commandsMultiplexer.commands_multiplexer import CommandsMultiplexer
 from modules.iperfCoordinator.iperf_coordinator import Iperf_Coordinator
 from modules.pingCoordinator.ping_coordinator import Ping_Coordinator 
@@ -12,6 +14,10 @@ from modules.energyCoordinator.energy_coordinator import EnergyCoordinator
 from modules.aoiCoordinator.aoi_coordinator import Age_of_Information_Coordinator
 from modules.udppingCoordinator.udpping_coordinator import UDPPing_Coordinator
 from modules.coexCoordinator.coex_coordinator import Coex_Coordinator
+from modules.matrixCoordinator.matrix_coordinator import Matrix_Coordinator
+from modules.campaignModule.campaign_scheduler import CampaignScheduler
+from modules.pipelineModule.pipeline_runner import PipelineRunner
+from modules.warmPoolModule.warm_servers import WarmServers
 
 from modules.restAPIModule.swagger_server.rest_server import RestServer
 
@@ -38,50 +44,21 @@ def update_measurements_collection_thread_body(mongo_db: MongoDB):
         time.sleep(SECONDS_OLD_MEASUREMENT / 2)
 
 
-def main():
-    """
-    Main function that initializes and runs the Measure-X coordinator.
-    
-    The coordinator performs the following tasks:
-    - Initializes MongoDB connection using configuration
-    - Starts a background thread to monitor measurement status
-    - Sets up command multiplexer for handling MQTT messages
-    - Initializes various measurement coordinators:
-        - iPerf coordinator
-        - Ping coordinator  
-        - Energy coordinator
-        - Age of Information coordinator
-        - UDP Ping coordinator
-        - Coexistence coordinator
-    - Starts REST API server
-    - Runs main loop waiting for exit command
-    
-    Returns:
-        None
-        
-    Notes:
-        The function will exit if MongoDB connection fails
+def init_measurement_coordinators(commands_multiplexer : CommandsMultiplexer, coordinator_mqtt : Mqtt_Client, mongo_db : MongoDB) -> list:
     """
-    try:
-        cl = ConfigLoader(base_path = Path(__file__).parent, file_name="coordinatorConfig.yaml", KEY = MONGO_KEY)
-        mongo_db = MongoDB(mongo_config = cl.config)
-    except Exception as e:
-        print(f"Coordinator: connection failed to connect to MongoDB. -> Exception info: \n{e}")
-        return
-    
+    Creates the coordinators of all the measurement types, registered on the commands multiplexer.
+    Shared by the coordinator main and by the MQTT replay benchmark.
 
-    measurement_collection_update_thread = threading.Thread(target=update_measurements_collection_thread_body, args=(mongo_db,))
-    measurement_collection_update_thread.daemon = True
-    measurement_collection_update_thread.start()
-
-    commands_multiplexer = CommandsMultiplexer(mongo_db)
-    coordinator_mqtt = Mqtt_Client(
-        status_handler_callback = commands_multiplexer.status_multiplexer, 
-        results_handler_callback = commands_multiplexer.result_multiplexer,
-        errors_handler_callback = commands_multiplexer.errors_multiplexer)
-    commands_multiplexer.set_mqtt_client(coordinator_mqtt)
+    Args:
+        commands_multiplexer (CommandsMultiplexer): The multiplexer of the probe messages
+        coordinator_mqtt (Mqtt_Client): The MQTT client of the coordinator
+        mongo_db (MongoDB): Instance of MongoDB class to interact with the database
 
+    Returns:
+        list: The measurement coordinators
+    """
     commands_multiplexer.add_status_callback(interested_status="root_service", handler=commands_multiplexer.root_service_default_handler)
+    commands_multiplexer.add_status_callback(interested_status="warm_pool", handler=WarmServers.get_instance().handler_received_status)
     
     iperf_coordinator = Iperf_Coordinator(
         mqtt = coordinator_mqtt,
@@ -140,10 +117,85 @@ def main():
         ask_probe_ip_mac_callback = commands_multiplexer.ask_probe_ip_mac,
         registration_measurement_stopper_callback = commands_multiplexer.add_measure_stopper_callback,
         mongo_db = mongo_db)
+
+    matrix_coordinator = Matrix_Coordinator(
+        registration_measure_preparer_callback = commands_multiplexer.add_probes_preparer_callback,
+        registration_measurement_stopper_callback = commands_multiplexer.add_measure_stopper_callback,
+        measure_preparer_callback = commands_multiplexer.prepare_probes_to_measure,
+        measurement_stopper_callback = commands_multiplexer.measurement_stop_by_msm_id,
+        mongo_db = mongo_db)
+
+    return [iperf_coordinator, ping_coordinator, energy_coordinator, aoi_coordinator, udpping_coordinator, coex_coordinator,
+            matrix_coordinator]
+
+
+def main():
+    """
+    Main function that initializes and runs the Measure-X coordinator.
+    
+    The coordinator performs the following tasks:
+    - Initializes MongoDB connection using configuration
+    - Starts a background thread to monitor measurement status
+    - Sets up command multiplexer for handling MQTT messages
+    - Initializes various measurement coordinators:
+        - iPerf coordinator
+        - Ping coordinator  
+        - Energy coordinator
+        - Age of Information coordinator
+        - UDP Ping coordinator
+        - Coexistence coordinator
+        - Matrix (full-mesh) coordinator
+    - Records the inbound MQTT messages, if started with -record PATH
+    - Starts the campaign scheduler and the pipeline runner
+    - Starts REST API server
+    - Runs main loop waiting for exit command
+    
+    Returns:
+        None
+        
+    Notes:
+        The function will exit if MongoDB connection fails
+    """
+    parser = argparse.ArgumentParser(description="Measure-X coordinator.")
+    parser.add_argument('-record', default=None, metavar='PATH',
+                        help="Record every inbound MQTT message in a gzip log, replayable with replay_benchmark.py.")
+    args = parser.parse_args()
+
+    try:
+        cl = ConfigLoader(base_path = Path(__file__).parent, file_name="coordinatorConfig.yaml", KEY = MONGO_KEY)
+        mongo_db = MongoDB(mongo_config = cl.config)
+    except Exception as e:
+        print(f"Coordinator: connection failed to connect to MongoDB. -> Exception info: \n{e}")
+        return
     
 
+    measurement_collection_update_thread = threading.Thread(target=update_measurements_collection_thread_body, args=(mongo_db,))
+    measurement_collection_update_thread.daemon = True
+    measurement_collection_update_thread.start()
+
+    recorder = MqttRecorder(args.record) if (args.record is not None) else None
+    commands_multiplexer = CommandsMultiplexer(mongo_db)
+    coordinator_mqtt = Mqtt_Client(
+        status_handler_callback = commands_multiplexer.status_multiplexer, 
+        results_handler_callback = commands_multiplexer.result_multiplexer,
+        errors_handler_callback = commands_multiplexer.errors_multiplexer,
+        recorder = recorder)
+    commands_multiplexer.set_mqtt_client(coordinator_mqtt)
+
+    init_measurement_coordinators(commands_multiplexer, coordinator_mqtt, mongo_db) # Kept alive by their callbacks registered on the multiplexer
+
+    campaign_scheduler = CampaignScheduler(admission_queue = commands_multiplexer.admission_queue,
+                                           measurement_stopper = commands_multiplexer.measurement_stop_by_msm_id,
+                                           mongo_db = mongo_db)
+    campaign_scheduler.start()
+    pipeline_runner = PipelineRunner(admission_queue = commands_multiplexer.admission_queue,
+                                     measurement_stopper = commands_multiplexer.measurement_stop_by_msm_id,
+                                     mongo_db = mongo_db)
+
     rest_server = RestServer(mongo_instance = mongo_db,
-                             commands_multiplexer_instance = commands_multiplexer)
+                             commands_multiplexer_instance = commands_multiplexer,
+                             campaign_scheduler_instance = campaign_scheduler,
+                             pipeline_runner_instance = pipeline_runner)
     rest_server.start_REST_API_server()
 
     while True:
@@ -152,6 +204,8 @@ def main():
         if command == "0":
             break
     coordinator_mqtt.disconnect()
+    if recorder is not None:
+        recorder.close()
 
 if __name__ == "__main__":
     main()
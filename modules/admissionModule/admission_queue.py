@@ -0,0 +1,573 @@
+"""
+admission_queue.py
+
+This module provides the AdmissionQueue class, the coordinator-side admission control of the new measurements.
+The queue knows which probes each active measurement holds: a request whose probes are all free is dispatched at once,
+while a request for a busy probe is accepted into the per-probe priority queues, and dispatched as soon as the
+holding measurement is completed or stopped (its state change on MongoDB), instead of being refused with "PROBE BUSY".
+The order in each probe queue is: priority (higher first), then the fair-share virtual time of the user (so that a user
+submitting many requests doesn't starve the others), then the arrival order. A request can carry a deadline, after
+which it is dropped if it has not been dispatched yet.
+A request doesn't hold its probes as a whole, but the resource classes that the probe controllers lock (see
+probesFirmware/shared_resources.py), each SHARED or EXCLUSIVE: the measurements with compatible classes run together on
+the same probe (e.g. a ping beside an energy measurement or an AoI flow), the conflicting ones wait.
+The probes behind the same gateway (interference group, from the gateway identity they announce) interfere when
+measured concurrently: a request also holds the groups of its probes, EXCLUSIVE if it saturates the NIC of a probe
+(e.g. iperf), SHARED otherwise, so the heavy measurements run serially within each group.
+A validator (the capability check of the probes) rejects the impossible requests before they are queued.
+The holds of a dispatched measurement are freed when it ends on MongoDB, when one of its probes goes OFFLINE, or after
+its expected duration plus HOLD_MARGIN_SECONDS (a stuck measurement doesn't block its probes forever: if it is still
+running, the probe refuses the next one with PROBE BUSY, and the queue retries it).
+"""
+
+import time
+import uuid
+import heapq
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from modules.mongoModule.mongoDB import MongoDB, COMPLETED_STATE, FAILED_STATE
+from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+from modules.metricsModule.metrics_registry import (MetricsRegistry, ADMISSION_QUEUE_DEPTH, ADMISSION_REQUESTS_TOTAL,
+                                                    ADMISSION_WAIT_SECONDS)
+
+QUEUED_STATE = "queued"
+DISPATCHING_STATE = "dispatching"
+DISPATCHED_STATE = "dispatched"
+FAILED_TICKET_STATE = "failed"
+EXPIRED_STATE = "expired"
+CANCELLED_STATE = "cancelled"
+REJECTED_STATE = "rejected"         # Refused at submission (impossible on its probes, or busy probes with queue_if_busy False)
+TERMINAL_TICKET_STATES = (DISPATCHED_STATE, FAILED_TICKET_STATE, EXPIRED_STATE, CANCELLED_STATE, REJECTED_STATE)
+
+DEFAULT_USER = "anonymous"
+DISPATCH_WORKERS = 8                # Preparers run concurrently: each one blocks on the probe ACKs for seconds
+BUSY_RETRY_SECONDS = 10             # Retry period of the requests refused by a probe busy for a measurement unknown to the queue
+TICKET_RETENTION_SECONDS = 3600     # Terminal tickets stay readable (GET /admissions/{id}) for this time
+IDLE_WAKE_UP_SECONDS = 60
+HOLD_MARGIN_SECONDS = 120           # Added to the expected duration of a measurement: preparation, stop and results round trips
+OPEN_ENDED_HOLD_SECONDS = 3600      # Hold timeout of the measurements that run until stopped (no expected duration)
+IPERF_TEST_SECONDS = 10             # Default length of an iperf3 test
+INTERFERENCE_FREE_TYPES = ("energy",) # Measurements that generate no traffic: they don't hold the interference groups
+MULTI_PROBE_TYPES = ("matrix",)        # Measurements that list their probes in parameters["probes"]
+GROUP_SLOT_PREFIX = "group:"           # Queue/hold slots of the interference groups, beside the ones of the probes
+
+# Resource classes of the probes, as named by the probe controllers: a slot <probe_id>/<resource> is held by many
+# tickets in SHARED mode, or by one in EXCLUSIVE mode. WHOLE_PROBE (unknown measurement types) conflicts with every
+# other class of the probe, which all hold it SHARED.
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+NIC_BANDWIDTH = "nic_bandwidth"
+INA219_SENSOR = "ina219_sensor"
+NTPSEC_SERVICE = "ntpsec_service"
+WHOLE_PROBE = "whole_probe"
+CLIENT_ROLE = "Client"  # The source probe of a measurement
+SERVER_ROLE = "Server"  # The dest probe of a measurement
+# Maps measurement type to {role: {resource: mode}}, as locked by the controller of the type on each role.
+# The ports are not listed: the PortAllocator already keeps the concurrent measurements on distinct ports.
+PROBE_RESOURCES = {
+    "ping": {CLIENT_ROLE: {NIC_BANDWIDTH: SHARED}, SERVER_ROLE: {NIC_BANDWIDTH: SHARED}},
+    "iperf": {CLIENT_ROLE: {NIC_BANDWIDTH: EXCLUSIVE}, SERVER_ROLE: {NIC_BANDWIDTH: EXCLUSIVE}},
+    "udpping": {CLIENT_ROLE: {NTPSEC_SERVICE: EXCLUSIVE, NIC_BANDWIDTH: SHARED}, SERVER_ROLE: {NTPSEC_SERVICE: SHARED, NIC_BANDWIDTH: SHARED}},
+    "aoi": {CLIENT_ROLE: {NTPSEC_SERVICE: EXCLUSIVE, NIC_BANDWIDTH: SHARED}, SERVER_ROLE: {NTPSEC_SERVICE: SHARED, NIC_BANDWIDTH: SHARED}},
+    "energy": {CLIENT_ROLE: {INA219_SENSOR: EXCLUSIVE}, SERVER_ROLE: {}},
+    "coex": {CLIENT_ROLE: {NIC_BANDWIDTH: SHARED}, SERVER_ROLE: {NIC_BANDWIDTH: SHARED}}
+}
+UNKNOWN_TYPE_RESOURCES = {WHOLE_PROBE: EXCLUSIVE}
+
+
+def resource_slot(probe, resource) -> str:
+    return f"{probe}/{resource}"
+
+
+def expected_duration_of(measurement : MeasurementModelMongo):
+    """
+    Returns the seconds a measurement is expected to run, from its type and requested parameters (with the defaults
+    of the coordinators), or None if it runs until stopped.
+    """
+    parameters = measurement.parameters if isinstance(measurement.parameters, dict) else {}
+    try:
+        match measurement.type:
+            case "ping":
+                return float(parameters.get("packets_number") or 4) * float(parameters.get("packets_interval") or 1)
+            case "udpping": # packets_interval in milliseconds
+                return float(parameters.get("packets_number") or 5000) * float(parameters.get("packets_interval") or 20) / 1000
+            case "iperf":
+                return float(parameters.get("repetitions") or 1) * max(IPERF_TEST_SECONDS, float(parameters.get("adaptive_max_seconds") or 0))
+            case "matrix":
+                probes_number = len(parameters.get("probes") or [])
+                return 2 * max(probes_number - 1, 1) * float(parameters.get("round_timeout") or 120)
+            case _:
+                duration = float(parameters.get("duration") or 0)
+                return duration if (duration > 0) else None
+    except (TypeError, ValueError):
+        return None
+
+
+class AdmissionTicket:
+    """
+    A measurement request accepted by the AdmissionQueue.
+    """
+    def __init__(self, measurement : MeasurementModelMongo, probes, user, priority, deadline, virtual_start, sequence,
+                 interference_groups = (), on_finished = None, slot_modes = None):
+        self.admission_id = uuid.uuid4().hex
+        self.measurement = measurement
+        self.probes = probes
+        self.interference_groups = interference_groups
+        self.slot_modes = slot_modes or {}  # Maps slot (probe resource or group:<group>) to its SHARED/EXCLUSIVE mode
+        self.user = user
+        self.priority = priority
+        self.deadline = deadline            # UNIX time, or None to wait forever
+        self.virtual_start = virtual_start  # Fair-share virtual time of the user
+        self.sequence = sequence
+        self.submitted_at = time.time()
+        self.state = QUEUED_STATE
+        self.retry_at = 0.0                 # Monotonic time before which a BUSY-refused ticket is not retried
+        self.enqueue_count = 0              # Heap entries of a previous enqueue of the same ticket are stale
+        self.msm_id = None
+        self.error_description = None
+        self.error_cause = None
+        self.finished_at = None
+        self.on_finished = on_finished      # Invoked with the ticket when it reaches a terminal state
+        self.hold_until = None              # Monotonic time after which the holds of the dispatched ticket are freed
+
+    @property
+    def slots(self) -> tuple:
+        # What the ticket waits for and holds: the resources of its probes and their interference groups
+        return tuple(self.slot_modes)
+
+    def sort_key(self):
+        return (-self.priority, self.virtual_start, self.sequence)
+
+    def to_dict(self, position = None) -> dict:
+        ticket_dict = {
+            "admission_id": self.admission_id,
+            "state": self.state,
+            "type": self.measurement.type,
+            "probes": list(self.probes),
+            "interference_groups": list(self.interference_groups),
+            "resources": dict(self.slot_modes),
+            "user": self.user,
+            "priority": self.priority,
+            "deadline": self.deadline,
+            "submitted_at": self.submitted_at,
+            "msm_id": self.msm_id,
+            "error_description": self.error_description,
+            "error_cause": self.error_cause
+        }
+        if position is not None:
+            ticket_dict["position"] = position
+        return ticket_dict
+
+
+class AdmissionQueue:
+    """
+    Conflict-aware admission of the new measurements. preparer is the CommandsMultiplexer.prepare_probes_to_measure
+    triad method, invoked once the probes of a request are free. interference_group_of maps a probe_id to its
+    interference group (None if unknown): without it, only the probes themselves are serialized.
+    validator maps a measurement to an ("Error", message, error_cause) triad if it can't run, or None.
+    """
+    def __init__(self, preparer, mongo_db : MongoDB, interference_group_of = None, validator = None):
+        self.preparer = preparer
+        self.mongo_db = mongo_db
+        self.interference_group_of = interference_group_of
+        self.validator = validator
+        self.condition = threading.Condition()
+        self.tickets = {}               # Maps admission_id to AdmissionTicket
+        self.probe_queues = {}          # Maps slot (<probe_id>/<resource> or group:<group>) to the heap of (sort_key, enqueue_count, ticket) waiting for it
+        self.held_slots = {}            # Maps slot to {admission_id: mode} of the tickets holding it
+        self.holders_by_msm_id = {}     # Maps msm_id to the dispatched ticket, until the measurement ends
+        self.user_virtual_time = {}     # Maps user to the virtual time of its next request
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+        self.metrics = MetricsRegistry.get_instance()
+        self.metrics.register_gauge_callback(ADMISSION_QUEUE_DEPTH, self.get_queue_depth_by_probe)
+        self.executor = ThreadPoolExecutor(max_workers = DISPATCH_WORKERS, thread_name_prefix = "admission")
+        self.mongo_db.add_state_change_listener(self.measurement_state_changed)
+        self.dispatcher_thread = threading.Thread(target = self.dispatcher_body, daemon = True)
+        self.dispatcher_thread.start()
+
+    # ------------------------------------------------- SUBMISSION -------------------------------------------------
+
+    @staticmethod
+    def probes_of(measurement : MeasurementModelMongo) -> tuple:
+        """
+        Returns the probes a measurement holds while it runs, including the ones of its coexisting application
+        and, for a matrix, all the probes of the mesh.
+        """
+        probes = [measurement.source_probe, measurement.dest_probe]
+        if (measurement.type in MULTI_PROBE_TYPES) and isinstance(measurement.parameters, dict):
+            probes += list(measurement.parameters.get("probes") or [])
+        coexisting_application = measurement.coexisting_application
+        if isinstance(coexisting_application, dict):
+            probes += [coexisting_application.get("source_probe"), coexisting_application.get("dest_probe")]
+        elif coexisting_application is not None:
+            probes += [getattr(coexisting_application, "source_probe", None), getattr(coexisting_application, "dest_probe", None)]
+        return tuple(dict.fromkeys(probe for probe in probes if probe)) # Ordered and without duplicates
+
+    @staticmethod
+    def resources_of(measurement : MeasurementModelMongo) -> dict:
+        """
+        Returns {<probe_id>/<resource>: mode} of the resources a measurement holds on its probes while it runs: the
+        ones of its type and role (source probe as client, dest probe as server), of its coexisting application and,
+        for a matrix, of its inner type on all the probes of the mesh (each one is both client and server).
+        """
+        claims = []
+        def claim(probe, measurement_type, roles):
+            for role in roles:
+                resources = PROBE_RESOURCES[measurement_type][role] if (measurement_type in PROBE_RESOURCES) else UNKNOWN_TYPE_RESOURCES
+                claims.extend((probe, resource, mode) for resource, mode in resources.items())
+        measurement_type = measurement.type
+        if (measurement_type in MULTI_PROBE_TYPES) and isinstance(measurement.parameters, dict):
+            for probe in [measurement.source_probe, measurement.dest_probe] + list(measurement.parameters.get("probes") or []):
+                claim(probe, measurement.parameters.get("inner_type"), (CLIENT_ROLE, SERVER_ROLE))
+        else:
+            claim(measurement.source_probe, measurement_type, (CLIENT_ROLE,))
+            claim(measurement.dest_probe, measurement_type, (SERVER_ROLE,))
+        coexisting_application = measurement.coexisting_application
+        if isinstance(coexisting_application, dict):
+            claim(coexisting_application.get("source_probe"), "coex", (CLIENT_ROLE,))
+            claim(coexisting_application.get("dest_probe"), "coex", (SERVER_ROLE,))
+        elif coexisting_application is not None:
+            claim(getattr(coexisting_application, "source_probe", None), "coex", (CLIENT_ROLE,))
+            claim(getattr(coexisting_application, "dest_probe", None), "coex", (SERVER_ROLE,))
+        resource_modes = {}
+        for probe, resource, mode in claims:
+            if not probe:
+                continue
+            slot = resource_slot(probe, resource)
+            resource_modes[slot] = EXCLUSIVE if (EXCLUSIVE in (mode, resource_modes.get(slot))) else SHARED
+            if resource != WHOLE_PROBE:
+                resource_modes.setdefault(resource_slot(probe, WHOLE_PROBE), SHARED)
+        return resource_modes
+
+    def slot_modes_of(self, measurement : MeasurementModelMongo, interference_groups) -> dict:
+        # The probe resources, plus the interference groups: EXCLUSIVE for a measurement saturating the NIC of a probe
+        slot_modes = self.resources_of(measurement)
+        saturating = any((mode == EXCLUSIVE) and slot.endswith(("/" + NIC_BANDWIDTH, "/" + WHOLE_PROBE))
+                         for slot, mode in slot_modes.items())
+        for group in interference_groups:
+            slot_modes[GROUP_SLOT_PREFIX + group] = EXCLUSIVE if saturating else SHARED
+        return slot_modes
+
+    def interference_groups_of(self, measurement : MeasurementModelMongo, probes) -> tuple:
+        """
+        Returns the interference groups of the probes, that the measurement holds while it runs.
+        The probes without a known group (e.g. offline, or running an old firmware) only hold themselves.
+        """
+        if (self.interference_group_of is None) or (measurement.type in INTERFERENCE_FREE_TYPES):
+            return ()
+        groups = [self.interference_group_of(probe) for probe in probes]
+        return tuple(dict.fromkeys(group for group in groups if group))
+
+    def submit(self, measurement : MeasurementModelMongo, user = None, priority = 0, deadline = None, queue_if_busy = True,
+               on_finished = None):
+        """
+        Admits a new measurement: it is dispatched at once (in the caller thread) if its probes are free and nobody is
+        waiting for them, else it is queued.
+        Args:
+            measurement (MeasurementModelMongo): The measurement to start.
+            user (str, optional): The requesting user, for the fair share.
+            priority (int): Higher priorities are dispatched first.
+            deadline (float, optional): UNIX time after which the request is dropped if still queued.
+            queue_if_busy (bool): If False, a request for busy probes is refused as before the admission queue.
+            on_finished (callable, optional): Invoked with the ticket once it is dispatched, failed, expired,
+                cancelled or rejected (also for a request refused by submit itself). It runs holding the queue lock:
+                it must not block, nor call the queue.
+        Returns:
+            tuple: ("OK", measurement_as_dict, None), ("QUEUED", ticket_as_dict, None) or ("Error", message, error_cause)
+        """
+        probes = self.probes_of(measurement)
+        user = user or DEFAULT_USER
+        if self.validator is not None:
+            validation_error = self.validator(measurement)
+            if validation_error is not None: # Impossible on its probes: refused now, instead of failing once dispatched
+                return self.reject(measurement, probes, user, priority, deadline, on_finished, validation_error)
+        interference_groups = self.interference_groups_of(measurement, probes)
+        slot_modes = self.slot_modes_of(measurement, interference_groups)
+        with self.condition:
+            busy_probes = [slot for slot, mode in slot_modes.items() if (not self.is_free(slot, mode)) or self.has_waiting_tickets(slot)]
+            if busy_probes and not queue_if_busy:
+                return self.reject(measurement, probes, user, priority, deadline, on_finished,
+                                   ("Error", f"Probes busy: {busy_probes}", "State BUSY"))
+            ticket = self.new_ticket(measurement, probes, user, priority, deadline, interference_groups, on_finished, slot_modes)
+            if busy_probes:
+                self.enqueue(ticket)
+                self.condition.notify()
+                print(f"AdmissionQueue: queued |{ticket.admission_id}| ({measurement.type}) of |{user}|, waiting for {busy_probes}")
+                self.metrics.inc_counter(ADMISSION_REQUESTS_TOTAL, {"outcome": "queued"})
+                return "QUEUED", ticket.to_dict(position = self.position_of(ticket)), None
+            self.reserve(ticket)
+        self.metrics.inc_counter(ADMISSION_REQUESTS_TOTAL, {"outcome": "immediate"})
+        success_message, info, error_cause = self.dispatch(ticket)
+        if ticket.state == QUEUED_STATE: # The probe was busy for a measurement the queue doesn't know: retried later
+            return "QUEUED", ticket.to_dict(position = self.position_of(ticket)), None
+        return success_message, info, error_cause
+
+    def reject(self, measurement, probes, user, priority, deadline, on_finished, error_triad) -> tuple:
+        """
+        Records a request refused by submit as a REJECTED ticket, so that on_finished is invoked as for any other
+        outcome (the campaigns and the pipelines wait for it). Returns the error triad.
+        """
+        _, error_description, error_cause = error_triad
+        ticket = AdmissionTicket(measurement, probes, user, priority, deadline, self.virtual_time, next(self.sequence),
+                                 on_finished = on_finished) # No fair-share cost: it never runs
+        with self.condition:
+            self.tickets[ticket.admission_id] = ticket
+            self.finish(ticket, REJECTED_STATE, error_description, error_cause)
+        return error_triad
+
+    def new_ticket(self, measurement, probes, user, priority, deadline, interference_groups = (), on_finished = None,
+                   slot_modes = None) -> AdmissionTicket:
+        # Start-time fair queuing: each request of a user costs one unit of its virtual time
+        virtual_start = max(self.virtual_time, self.user_virtual_time.get(user, 0.0))
+        self.user_virtual_time[user] = virtual_start + 1
+        ticket = AdmissionTicket(measurement, probes, user, priority, deadline, virtual_start, next(self.sequence),
+                                 interference_groups, on_finished, slot_modes)
+        self.tickets[ticket.admission_id] = ticket
+        return ticket
+
+    def enqueue(self, ticket : AdmissionTicket):
+        ticket.state = QUEUED_STATE
+        ticket.enqueue_count += 1
+        for probe in ticket.slots:
+            heapq.heappush(self.probe_queues.setdefault(probe, []), (ticket.sort_key(), ticket.enqueue_count, ticket))
+
+    @staticmethod
+    def is_live(entry) -> bool:
+        _, enqueue_count, ticket = entry
+        return (ticket.state == QUEUED_STATE) and (enqueue_count == ticket.enqueue_count)
+
+    # ------------------------------------------------- QUEUE INSPECTION -------------------------------------------------
+
+    def head_of(self, probe):
+        """
+        Returns the first queued ticket waiting for probe, dropping the stale heap entries (tickets no longer queued).
+        """
+        probe_queue = self.probe_queues.get(probe)
+        while probe_queue and not self.is_live(probe_queue[0]):
+            heapq.heappop(probe_queue)
+        if not probe_queue:
+            self.probe_queues.pop(probe, None)
+            return None
+        return probe_queue[0][2]
+
+    def has_waiting_tickets(self, probe) -> bool:
+        return self.head_of(probe) is not None
+
+    def position_of(self, ticket : AdmissionTicket):
+        # The worst position among the probe queues of the ticket (0 is the head)
+        if ticket.state != QUEUED_STATE:
+            return None
+        return max((sum(1 for entry in self.probe_queues.get(probe, []) if self.is_live(entry) and (entry[0] < ticket.sort_key()))
+                    for probe in ticket.slots), default = 0)
+
+    def get_queue_depth_by_probe(self) -> dict:
+        with self.condition:
+            return {MetricsRegistry.labels_key({"probe": probe}): sum(1 for entry in probe_queue if self.is_live(entry))
+                    for probe, probe_queue in self.probe_queues.items()}
+
+    def get_ticket(self, admission_id):
+        """
+        Returns the ticket as dict, or None if unknown (or expired from the retention).
+        """
+        with self.condition:
+            ticket = self.tickets.get(admission_id)
+            return None if (ticket is None) else ticket.to_dict(position = self.position_of(ticket))
+
+    def get_queues(self) -> dict:
+        """
+        Returns the held slots (probe resources as <probe_id>/<resource>, interference groups as group:<group>) with
+        the msm_id and mode of their holders and, for each slot, its queued tickets in dispatch order.
+        """
+        with self.condition:
+            queues = {}
+            for probe, probe_queue in self.probe_queues.items():
+                queued_entries = sorted(entry for entry in probe_queue if self.is_live(entry))
+                if queued_entries:
+                    queues[probe] = [ticket.to_dict() for _, _, ticket in queued_entries]
+            held_slots = {slot: [{"msm_id": self.tickets[admission_id].msm_id if admission_id in self.tickets else None, "mode": mode}
+                                 for admission_id, mode in holders.items()]
+                          for slot, holders in self.held_slots.items()}
+            return {"held_slots": held_slots, "queues": queues}
+
+    def cancel(self, admission_id):
+        """
+        Cancels a queued request.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        with self.condition:
+            ticket = self.tickets.get(admission_id)
+            if ticket is None:
+                return "Error", f"Unknown admission |{admission_id}|", "Wrong id?"
+            if ticket.state != QUEUED_STATE:
+                return "Error", f"Admission |{admission_id}| is not queued (state: {ticket.state})", "Already dispatched?"
+            self.finish(ticket, CANCELLED_STATE)
+            self.condition.notify()
+        return "OK", ticket.to_dict(), None
+
+    # ------------------------------------------------- DISPATCHING -------------------------------------------------
+
+    def is_free(self, slot, mode) -> bool:
+        # A slot can be taken EXCLUSIVE if nobody holds it, SHARED if nobody holds it EXCLUSIVE
+        holders = self.held_slots.get(slot)
+        return (not holders) or ((mode == SHARED) and (EXCLUSIVE not in holders.values()))
+
+    def reserve(self, ticket : AdmissionTicket):
+        ticket.state = DISPATCHING_STATE
+        self.virtual_time = max(self.virtual_time, ticket.virtual_start) # Users idle until now don't get credit for the past
+        for slot, mode in ticket.slot_modes.items():
+            self.held_slots.setdefault(slot, {})[ticket.admission_id] = mode
+
+    def release(self, ticket : AdmissionTicket):
+        for slot in ticket.slots:
+            holders = self.held_slots.get(slot)
+            if holders is not None:
+                holders.pop(ticket.admission_id, None)
+                if not holders:
+                    self.held_slots.pop(slot)
+        if ticket.msm_id is not None:
+            self.holders_by_msm_id.pop(ticket.msm_id, None)
+
+    def finish(self, ticket : AdmissionTicket, state, error_description = None, error_cause = None):
+        ticket.state = state
+        ticket.error_description = error_description
+        ticket.error_cause = error_cause
+        ticket.finished_at = time.time()
+        self.metrics.inc_counter(ADMISSION_REQUESTS_TOTAL, {"outcome": state})
+        if state == DISPATCHED_STATE:
+            self.metrics.observe(ADMISSION_WAIT_SECONDS, ticket.finished_at - ticket.submitted_at, {"type": ticket.measurement.type})
+        if ticket.on_finished is not None:
+            try:
+                ticket.on_finished(ticket)
+            except Exception as e:
+                print(f"AdmissionQueue: exception in the on_finished callback of |{ticket.admission_id}| -> {e}")
+
+    @staticmethod
+    def refused_for_busy_probe(info, error_cause) -> bool:
+        return (error_cause == "State BUSY") or ("PROBE BUSY" in str(info))
+
+    def dispatch(self, ticket : AdmissionTicket):
+        """
+        Runs the preparer of a reserved ticket and records its outcome. Returns the preparer triad.
+        """
+        try:
+            success_message, info, error_cause = self.preparer(ticket.measurement)
+        except Exception as e:
+            success_message, info, error_cause = "Error", f"Exception while preparing the probes -> {e}", "Coordinator error"
+        with self.condition:
+            if success_message == "OK":
+                ticket.msm_id = str(info["_id"])
+                expected_duration = expected_duration_of(ticket.measurement)
+                hold_seconds = OPEN_ENDED_HOLD_SECONDS if (expected_duration is None) else (expected_duration + HOLD_MARGIN_SECONDS)
+                ticket.hold_until = time.monotonic() + hold_seconds
+                self.finish(ticket, DISPATCHED_STATE)
+                self.holders_by_msm_id[ticket.msm_id] = ticket
+            else:
+                self.release(ticket)
+                if self.refused_for_busy_probe(info, error_cause) and not self.is_expired(ticket, time.time()):
+                    # A probe is busy for a measurement started outside the queue (e.g. before a coordinator restart)
+                    ticket.retry_at = time.monotonic() + BUSY_RETRY_SECONDS
+                    ticket.measurement._id = None
+                    self.enqueue(ticket)
+                    print(f"AdmissionQueue: |{ticket.admission_id}| refused by a busy probe, retry in {BUSY_RETRY_SECONDS}s")
+                else:
+                    self.finish(ticket, FAILED_TICKET_STATE, info, error_cause)
+            self.condition.notify()
+        if ticket.msm_id is not None:
+            # The measurement may have ended while its preparer was still returning
+            self.measurement_state_changed(ticket.msm_id)
+        return success_message, info, error_cause
+
+    def measurement_state_changed(self, msm_id):
+        """
+        MongoDB state change listener: frees the probes of the measurements that are completed or failed (stopped).
+        Invoked with None after bulk updates, which may have ended any of the held measurements.
+        """
+        with self.condition:
+            msm_ids = list(self.holders_by_msm_id) if (msm_id is None) else ([msm_id] if msm_id in self.holders_by_msm_id else [])
+        ended_msm_ids = [held_msm_id for held_msm_id in msm_ids
+                         if self.mongo_db.get_measurement_state(held_msm_id) in (COMPLETED_STATE, FAILED_STATE)]
+        if not ended_msm_ids:
+            return
+        with self.condition:
+            for ended_msm_id in ended_msm_ids:
+                ticket = self.holders_by_msm_id.get(ended_msm_id)
+                if ticket is not None:
+                    self.release(ticket)
+                    print(f"AdmissionQueue: measurement |{ended_msm_id}| ended, released probes {list(ticket.probes)}")
+            self.condition.notify()
+
+    def probe_offline(self, probe_id):
+        """
+        Frees the holds of the dispatched measurements running on a probe that went OFFLINE: they can't go on.
+        """
+        with self.condition:
+            for msm_id, ticket in list(self.holders_by_msm_id.items()):
+                if probe_id in ticket.probes:
+                    self.release(ticket)
+                    print(f"AdmissionQueue: probe |{probe_id}| offline, released the holds of measurement |{msm_id}|")
+            self.condition.notify()
+
+    def release_overdue_holds(self, now_monotonic):
+        for msm_id, ticket in list(self.holders_by_msm_id.items()):
+            if (ticket.hold_until is not None) and (now_monotonic > ticket.hold_until):
+                self.release(ticket)
+                print(f"AdmissionQueue: measurement |{msm_id}| still not ended after its expected duration, released its holds")
+
+    @staticmethod
+    def is_expired(ticket : AdmissionTicket, now) -> bool:
+        return (ticket.deadline is not None) and (now > ticket.deadline)
+
+    def find_ready_tickets(self) -> list:
+        # A ticket is ready when it is the head of the queues of all its slots (probe resources and groups), and it can take all of them
+        now = time.monotonic()
+        ready_tickets = []
+        for probe in list(self.probe_queues):
+            ticket = self.head_of(probe)
+            if (ticket is None) or (ticket in ready_tickets) or (ticket.retry_at > now):
+                continue
+            if all((self.head_of(slot) is ticket) and self.is_free(slot, mode) for slot, mode in ticket.slot_modes.items()):
+                ready_tickets.append(ticket)
+                self.reserve(ticket) # Also makes the ticket no longer head of its queues
+        return ready_tickets
+
+    def expire_and_prune(self):
+        now = time.time()
+        self.release_overdue_holds(time.monotonic())
+        for admission_id, ticket in list(self.tickets.items()):
+            if (ticket.state == QUEUED_STATE) and self.is_expired(ticket, now):
+                self.finish(ticket, EXPIRED_STATE, "Deadline reached before the probes were free", "Deadline expired")
+                print(f"AdmissionQueue: |{admission_id}| expired")
+            elif (ticket.state in TERMINAL_TICKET_STATES) and (ticket.msm_id not in self.holders_by_msm_id) \
+                    and ((now - ticket.finished_at) > TICKET_RETENTION_SECONDS):
+                self.tickets.pop(admission_id)
+
+    def next_wake_up(self) -> float:
+        # Seconds until the nearest deadline or BUSY retry of the queued tickets, or hold timeout of the dispatched ones
+        now_wall, now_monotonic = time.time(), time.monotonic()
+        wake_up = IDLE_WAKE_UP_SECONDS
+        for ticket in self.holders_by_msm_id.values():
+            if ticket.hold_until is not None:
+                wake_up = min(wake_up, ticket.hold_until - now_monotonic)
+        for ticket in self.tickets.values():
+            if ticket.state != QUEUED_STATE:
+                continue
+            if ticket.deadline is not None:
+                wake_up = min(wake_up, ticket.deadline - now_wall)
+            if ticket.retry_at > now_monotonic:
+                wake_up = min(wake_up, ticket.retry_at - now_monotonic)
+        return max(wake_up, 0.01)
+
+    def dispatcher_body(self):
+        while True:
+            with self.condition:
+                self.expire_and_prune()
+                ready_tickets = self.find_ready_tickets()
+                if not ready_tickets:
+                    self.condition.wait(timeout = self.next_wake_up())
+                    continue
+            for ticket in ready_tickets:
+                print(f"AdmissionQueue: dispatching |{ticket.admission_id}| ({ticket.measurement.type}) on {list(ticket.probes)}")
+                self.executor.submit(self.dispatch, ticket)
@@ -0,0 +1,140 @@
+"""
+Unit tests of the AdmissionQueue: dispatch order of the queued requests and rejection of the ones that can't run.
+Run from the repository root: python -m unittest modules.admissionModule.test_admission_queue
+"""
+
+import time
+import unittest
+import threading
+from modules.mongoModule.mongoDB import COMPLETED_STATE
+from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+from modules.admissionModule.admission_queue import (AdmissionQueue, QUEUED_STATE, DISPATCHED_STATE, REJECTED_STATE,
+                                                     CANCELLED_STATE, EXPIRED_STATE, resource_slot, NIC_BANDWIDTH)
+
+WAIT_SECONDS = 5
+
+
+class FakeMongo:
+    """
+    The state change listener registration and the measurement states, as read by the queue.
+    """
+    def __init__(self):
+        self.states = {}
+        self.listeners = []
+
+    def add_state_change_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_measurement_state(self, msm_id):
+        return self.states.get(msm_id)
+
+    def end_measurement(self, msm_id):
+        self.states[msm_id] = COMPLETED_STATE
+        for listener in self.listeners:
+            listener(msm_id)
+
+
+class RecordingPreparer:
+    """
+    Preparer that starts every measurement, recording the order of the dispatches.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prepared = []
+
+    def __call__(self, measurement):
+        with self.lock:
+            self.prepared.append(measurement)
+            msm_id = f"msm{len(self.prepared)}"
+        return "OK", {"_id": msm_id, "type": measurement.type}, None
+
+
+def new_measurement(msm_type, source_probe, dest_probe = None, description = None, parameters = None):
+    return MeasurementModelMongo(description = description, type = msm_type, source_probe = source_probe,
+                                 source_probe_ip = None, dest_probe_ip = None, dest_probe = dest_probe, parameters = parameters)
+
+
+class TestAdmissionQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = FakeMongo()
+        self.preparer = RecordingPreparer()
+        self.queue = AdmissionQueue(preparer = self.preparer, mongo_db = self.mongo)
+
+    def finished_event(self):
+        event = threading.Event()
+        return event, (lambda ticket: event.set())
+
+    def test_free_probes_dispatched_at_once(self):
+        success_message, info, error_cause = self.queue.submit(new_measurement("iperf", "p1", "p2"))
+        self.assertEqual(success_message, "OK")
+        self.assertEqual(info["_id"], "msm1")
+        self.assertIsNone(error_cause)
+
+    def test_compatible_measurements_share_a_probe(self):
+        self.assertEqual(self.queue.submit(new_measurement("ping", "p1", "p2"))[0], "OK")
+        self.assertEqual(self.queue.submit(new_measurement("energy", "p1"))[0], "OK")
+        self.assertEqual(len(self.preparer.prepared), 2)
+
+    def test_busy_probe_queued_until_the_holder_ends(self):
+        self.queue.submit(new_measurement("iperf", "p1", "p2"))
+        dispatched, on_finished = self.finished_event()
+        success_message, ticket, _ = self.queue.submit(new_measurement("iperf", "p1", "p3"), on_finished = on_finished)
+        self.assertEqual(success_message, "QUEUED")
+        self.assertEqual(ticket["state"], QUEUED_STATE)
+        self.assertEqual(ticket["position"], 0)
+        self.assertFalse(dispatched.wait(0.2))
+
+        self.mongo.end_measurement("msm1")
+        self.assertTrue(dispatched.wait(WAIT_SECONDS))
+        self.assertEqual(self.queue.get_ticket(ticket["admission_id"])["state"], DISPATCHED_STATE)
+        self.assertEqual(self.preparer.prepared[-1].dest_probe, "p3")
+
+    def test_queue_order_priority_then_fair_share(self):
+        self.queue.submit(new_measurement("iperf", "p1", "p2"))
+        submissions = [("alice", 0, "a1"), ("alice", 0, "a2"), ("bob", 0, "b1"), ("carol", 5, "c1")]
+        for user, priority, description in submissions:
+            self.queue.submit(new_measurement("iperf", "p1", description = description), user = user, priority = priority)
+
+        queued = self.queue.get_queues()["queues"][resource_slot("p1", NIC_BANDWIDTH)]
+        # Higher priority first, then the first request of each user before the second one of alice
+        self.assertEqual([ticket["user"] for ticket in queued], ["carol", "alice", "bob", "alice"])
+
+    def test_rejected_when_busy_and_not_queued(self):
+        self.queue.submit(new_measurement("iperf", "p1", "p2"))
+        finished = []
+        success_message, _, error_cause = self.queue.submit(new_measurement("iperf", "p2", "p3"), queue_if_busy = False,
+                                                            on_finished = finished.append)
+        self.assertEqual(success_message, "Error")
+        self.assertEqual(error_cause, "State BUSY")
+        self.assertEqual([ticket.state for ticket in finished], [REJECTED_STATE])
+        self.assertEqual(len(self.preparer.prepared), 1)
+
+    def test_rejected_by_the_validator(self):
+        queue = AdmissionQueue(preparer = self.preparer, mongo_db = self.mongo,
+                               validator = lambda measurement: ("Error", "No ping tool", "Missing capability"))
+        finished = []
+        triad = queue.submit(new_measurement("ping", "p1", "p2"), on_finished = finished.append)
+        self.assertEqual(triad, ("Error", "No ping tool", "Missing capability"))
+        self.assertEqual([ticket.state for ticket in finished], [REJECTED_STATE])
+        self.assertEqual(self.preparer.prepared, [])
+
+    def test_cancel_a_queued_request(self):
+        self.queue.submit(new_measurement("iperf", "p1", "p2"))
+        _, ticket, _ = self.queue.submit(new_measurement("iperf", "p1", "p3"))
+        self.assertEqual(self.queue.cancel(ticket["admission_id"])[0], "OK")
+        self.assertEqual(self.queue.get_ticket(ticket["admission_id"])["state"], CANCELLED_STATE)
+        self.assertEqual(self.queue.cancel(ticket["admission_id"])[0], "Error")
+        self.assertEqual(self.queue.cancel("unknown")[0], "Error")
+
+    def test_deadline_expires_a_queued_request(self):
+        self.queue.submit(new_measurement("iperf", "p1", "p2"))
+        expired, on_finished = self.finished_event()
+        _, ticket, _ = self.queue.submit(new_measurement("iperf", "p1", "p3"), deadline = time.time() + 0.2,
+                                         on_finished = on_finished)
+        self.assertTrue(expired.wait(WAIT_SECONDS))
+        self.assertEqual(self.queue.get_ticket(ticket["admission_id"])["state"], EXPIRED_STATE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,6 +12,11 @@ from modules.mqttModule.mqtt_client import Mqtt_Client
 from modules.configLoader.config_loader import ConfigLoader, AOI_KEY
 from modules.mongoModule.mongoDB import MongoDB, MeasurementModelMongo, ErrorModel
 from modules.mongoModule.models.age_of_information_model_mongo import AgeOfInformationResultModelMongo
+from modules.metricsModule.measurement_timings import TimingsTracker, MEASUREMENT_PHASE
+from modules.metricsModule.ack_timeouts import AckTimeouts
+from modules.portsModule.port_allocator import PortAllocator
+from modules.scheduledStartModule.scheduled_start import START_AT_KEY, DEFAULT_START_LEAD_SECONDS, check_requested_start_at, schedule_start_at
+from modules.prepareModule.prepare_round import PrepareRound, PREPARE_COMMAND
 
 class Age_of_Information_Coordinator:
     """
@@ -30,6 +35,10 @@ class Age_of_Information_Coordinator:
         self.queued_measurements = {}
         self.events_received_status_from_probe_sender = {}
         self.events_stop_probe_ack = {}
+        self.prepare_rounds = {} # Maps msm_id to the PrepareRound waiting for the probes replies
+        self.sender_stats = {} # Maps msm_id to the pacing stats of the client, received with its stop ACK
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.ack_timeouts = AckTimeouts.get_instance()
 
         # Requests to commands_multiplexer: handler STATUS registration
         registration_response = registration_handler_status_callback( interested_status = "aoi",
@@ -66,20 +75,20 @@ class Age_of_Information_Coordinator:
             print(f"AoI_Coordinator: registration measurement stopper failed. Reason -> {registration_response}")
 
 
-    def send_probe_aoi_measure_start(self, probe_sender, msm_id, packets_rate, payload_size):
+    def send_probe_aoi_prepare(self, probe_sender, msm_id, role, role_parameters : dict):
         """
-        Send a command to a probe to start an AoI measurement.
+        Send to a probe the combined prepare command: the whole configuration of its role (Server or Client).
         """
-        json_ping_start = {
+        json_aoi_prepare = {
             "handler": "aoi",
-            "command": "start",
+            "command": PREPARE_COMMAND,
             "payload": {
-                "msm_id":  msm_id,
-                "packets_rate": packets_rate,
-                "payload_size": payload_size
+                "msm_id": msm_id,
+                "role": role,
+                **role_parameters
             }
         }
-        self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_ping_start))
+        self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_aoi_prepare))
 
 
     def send_probe_aoi_measure_stop(self, probe_sender, msm_id):
@@ -96,23 +105,6 @@ class Age_of_Information_Coordinator:
         self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_ping_start))
 
     
-    def send_disable_ntp_service(self, probe_sender, probe_ntp_server, probe_server_aoi, msm_id, socket_port, role):
-        """
-        Send a command to a probe to disable the NTP service (for AoI measurement setup).
-        """
-        json_disable_ntp_service = {
-            "handler": "aoi",
-            "command": "disable_ntp_service",
-            "payload": {
-                "probe_ntp_server": probe_ntp_server,
-                "probe_server_aoi": probe_server_aoi,
-                "socket_port": socket_port,
-                "role": role,
-                "msm_id": msm_id }
-            }
-        self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_disable_ntp_service))
-
-
     def send_enable_ntp_service(self, probe_sender, msm_id, role, payload_size = None, socket_port = None):
         """
         Send a command to a probe to enable the NTP service (for AoI measurement teardown or setup).
@@ -162,6 +154,8 @@ class Age_of_Information_Coordinator:
                             self.events_received_status_from_probe_sender[msm_id][0].set()
                     case "stop":
                         print(f"AoI_Coordinator: ACK from probe |{probe_sender}|->|stop| , measurement_id -> |{msm_id}|")
+                        if "sender_stats" in payload: # The client stops first: its stats are stored with the server result
+                            self.sender_stats[msm_id] = payload["sender_stats"]
                         if msm_id in self.events_stop_probe_ack:
                             self.events_stop_probe_ack[msm_id][1] = "OK"
                             self.events_stop_probe_ack[msm_id][0].set()
@@ -175,6 +169,10 @@ class Age_of_Information_Coordinator:
                         if msm_id in self.events_received_status_from_probe_sender:
                             self.events_received_status_from_probe_sender[msm_id][1] = "OK"
                             self.events_received_status_from_probe_sender[msm_id][0].set()
+                    case "prepare":
+                        print(f"AoI_Coordinator: ACK from probe |{probe_sender}| , command: |{command_executed_on_probe}| , msm_id: |{msm_id}|")
+                        if msm_id in self.prepare_rounds:
+                            self.prepare_rounds[msm_id].set_reply(probe_sender, "OK")
                     case _:
                         print(f"AoI_Coordinator: ACK received for unkonwn AoI command -> {command_executed_on_probe}")
             case "NACK":
@@ -196,6 +194,10 @@ class Age_of_Information_Coordinator:
                         if msm_id in self.events_received_status_from_probe_sender:
                             self.events_received_status_from_probe_sender[msm_id][1] = reason
                             self.events_received_status_from_probe_sender[msm_id][0].set()
+                    case "prepare":
+                        print(f"AoI_Coordinator: received NACK for {failed_command} from |{probe_sender}| -> reason: {reason}")
+                        if msm_id in self.prepare_rounds:
+                            self.prepare_rounds[msm_id].set_reply(probe_sender, reason)
                     case "run":
                         print(f"AoI_Coordinator: received NACK for {failed_command} -> reason: {reason}")
                         if self.mongo_db.set_measurement_as_failed_by_id(measurement_id=msm_id):
@@ -215,66 +217,77 @@ class Age_of_Information_Coordinator:
         """
         new_measurement.assign_id()
         msm_id = str(new_measurement._id)
+        measurement_timings = self.timings_tracker.start(msm_id, "aoi")
 
         aoi_parameters = self.get_default_ping_parameters()
         aoi_parameters = self.override_default_parameters(aoi_parameters, new_measurement.parameters)
-
-        source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
+        start_at_check = check_requested_start_at(aoi_parameters.get(START_AT_KEY))
+        if start_at_check != "OK":
+            return "Error", start_at_check, "Wrong start_at"
+        # Both the probes bind the socket port: with 0 (the default) a port free on both is assigned
+        socket_port = PortAllocator.get_instance().assign(msm_id, (new_measurement.source_probe, new_measurement.dest_probe),
+                                                          aoi_parameters.get('socket_port'))
+        if socket_port is None:
+            return "Error", f"Socket port |{aoi_parameters.get('socket_port')}| not available on the probes", "Port already in use"
+        aoi_parameters['socket_port'] = socket_port
+
+        with measurement_timings.phase("ip_resolution"):
+            source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
         if source_probe_ip is None:
             return "Error", f"No response from client probe: {new_measurement.source_probe}", "Reponse Timeout"
-        dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe) # This call, will trigger the setting of Ip, (both the ip and the sync_clock_ip)
+        with measurement_timings.phase("ip_resolution"):
+            dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe) # This call, will trigger the setting of Ip, (both the ip and the sync_clock_ip)
         if dest_probe_ip is None: # This ip is only used to check if the probe is ONLINE. See later, the used ip is the "clock_sync_ip"
             return "Error", f"No response from client probe: {new_measurement.dest_probe}", "Reponse Timeout"
         new_measurement.source_probe_ip = source_probe_ip
         new_measurement.dest_probe_ip = dest_probe_ip
         new_measurement.parameters = aoi_parameters # This setting allow to store params in measurement object even if you don't have inserted them.
 
-        dest_probe_ip_for_clock_sync = self.ask_probe_ip_mac(new_measurement.dest_probe, sync_clock_ip = True)
+        with measurement_timings.phase("ip_resolution"):
+            dest_probe_ip_for_clock_sync = self.ask_probe_ip_mac(new_measurement.dest_probe, sync_clock_ip = True)
         
-        self.events_received_status_from_probe_sender[msm_id] = [threading.Event(), None]
-        self.send_enable_ntp_service(probe_sender=new_measurement.dest_probe, msm_id = msm_id,
-                                     socket_port = aoi_parameters['socket_port'], role="Server",
-                                     payload_size = aoi_parameters['payload_size'] + 100)
-        self.events_received_status_from_probe_sender[msm_id][0].wait(timeout = 5)        
-
-        event_enable_msg = self.events_received_status_from_probe_sender[msm_id][1]        
-        if event_enable_msg == "OK":     
-            self.events_received_status_from_probe_sender[msm_id] = [threading.Event(), None]
-            self.send_disable_ntp_service(probe_sender = new_measurement.source_probe, probe_ntp_server = dest_probe_ip_for_clock_sync,
-                                          probe_server_aoi=new_measurement.dest_probe_ip, 
-                                          msm_id = msm_id, socket_port = aoi_parameters['socket_port'], role = "Client")
-            self.events_received_status_from_probe_sender[msm_id][0].wait(5)
-
-            event_disable_msg = self.events_received_status_from_probe_sender[msm_id][1]
-            if event_disable_msg == "OK":
-                self.events_received_status_from_probe_sender[msm_id] = [threading.Event(), None]
-                self.send_probe_aoi_measure_start(probe_sender = new_measurement.source_probe, msm_id = msm_id, 
-                                                  packets_rate = aoi_parameters['packets_rate'], payload_size = aoi_parameters['payload_size'])
-                self.events_received_status_from_probe_sender[msm_id][0].wait(timeout = 5)
-
-                event_start_msg = self.events_received_status_from_probe_sender[msm_id][1]
-                if event_start_msg == "OK":
-                    self.queued_measurements[msm_id] = new_measurement
-                    inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
-                    if inserted_measurement_id is None:
-                        print(f"AoI_Coordinator: can't start aoi. Error while storing ping measurement on Mongo")
-                        return "Error", "Can't send start! Error while inserting measurement aoi in mongo", "MongoDB Down?"
-                    return "OK", new_measurement.to_dict(), None
-                
-                self.send_probe_aoi_measure_stop(probe_sender=new_measurement.dest_probe, msm_id=msm_id)
-                if event_start_msg is not None:
-                    print(f"Preparer AoI: awaked from server conf NACK -> {event_start_msg}")
-                    return "Error", f"Probe |{new_measurement.source_probe}| says: {event_start_msg}", ""
-                else:
-                    print(f"Preparer AoI: No response from probe -> |{new_measurement.source_probe}")
-                    return "Error", f"No response from Probe: {new_measurement.source_probe}" , "Reponse Timeout"   
-        elif event_enable_msg is not None:
-            print(f"Preparer AoI: awaked from server conf NACK -> {event_enable_msg}")
-            self.send_probe_aoi_measure_stop(probe_sender=new_measurement.source_probe, msm_id=msm_id)
-            return "Error", f"Probe |{new_measurement.dest_probe}| says: {event_enable_msg}", ""            
-        else:
-            print(f"Preparer AoI: No response from probe -> |{new_measurement.dest_probe}")
-            return "Error", f"No response from Probe: {new_measurement.dest_probe}" , "Reponse Timeout"
+        # One parallel round trip: the server starts listening, the client stops ntpsec, syncs its clock with the
+        # server and arms the sending for start_at. The client may ACK only at the end of the round: start_at is
+        # postponed of the whole round timeout, so that it's still ahead once the client is armed
+        prepare_round = PrepareRound((new_measurement.dest_probe, new_measurement.source_probe), handler = "aoi",
+                                     roles = {new_measurement.dest_probe: "Server", new_measurement.source_probe: "Client"})
+        aoi_parameters[START_AT_KEY] = schedule_start_at(aoi_parameters.get(START_AT_KEY), # Stored with the parameters
+                                                         lead = prepare_round.timeout() + DEFAULT_START_LEAD_SECONDS)
+        self.prepare_rounds[msm_id] = prepare_round
+        with measurement_timings.phase("prepare_ack_wait"):
+            self.send_probe_aoi_prepare(probe_sender = new_measurement.dest_probe, msm_id = msm_id, role = "Server",
+                                        role_parameters = {"socket_port": aoi_parameters['socket_port'],
+                                                           "payload_size": aoi_parameters['payload_size'] + 100})
+            self.send_probe_aoi_prepare(probe_sender = new_measurement.source_probe, msm_id = msm_id, role = "Client",
+                                        role_parameters = {"probe_ntp_server": dest_probe_ip_for_clock_sync,
+                                                           "probe_server_aoi": new_measurement.dest_probe_ip,
+                                                           "socket_port": aoi_parameters['socket_port'],
+                                                           "packets_rate": aoi_parameters['packets_rate'],
+                                                           "payload_size": aoi_parameters['payload_size'],
+                                                           START_AT_KEY: aoi_parameters[START_AT_KEY]})
+            failed_probe, failure_reason = prepare_round.wait()
+        self.prepare_rounds.pop(msm_id, None)
+
+        if failed_probe is None:
+            measurement_timings.start_phase(MEASUREMENT_PHASE)
+            self.queued_measurements[msm_id] = new_measurement
+            new_measurement.timings = measurement_timings.to_dict()
+            with measurement_timings.phase("db_insert"):
+                inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
+            if inserted_measurement_id is None:
+                print(f"AoI_Coordinator: can't start aoi. Error while storing ping measurement on Mongo")
+                return "Error", "Can't send start! Error while inserting measurement aoi in mongo", "MongoDB Down?"
+            return "OK", new_measurement.to_dict(), None
+
+        for probe_to_clean_up in prepare_round.probes_to_clean_up():
+            self.send_probe_aoi_measure_stop(probe_sender = probe_to_clean_up, msm_id = msm_id)
+            if probe_to_clean_up == new_measurement.source_probe: # Re-enabling the ntpsec service of the client
+                self.send_enable_ntp_service(probe_sender = probe_to_clean_up, msm_id = msm_id, role = "Client")
+        if failure_reason is not None:
+            print(f"Preparer AoI: awaked from prepare NACK of |{failed_probe}| -> {failure_reason}")
+            return "Error", f"Probe |{failed_probe}| says: {failure_reason}", ""
+        print(f"Preparer AoI: No response from probe -> |{failed_probe}")
+        return "Error", f"No response from Probe: {failed_probe}" , "Reponse Timeout"
         
     
     def aoi_measurement_stopper(self, msm_id_to_stop : str):
@@ -288,7 +301,7 @@ class Age_of_Information_Coordinator:
         self.events_stop_probe_ack[msm_id_to_stop] = [threading.Event(), None]
         # Stop sending to the Server-AoI-Probe
         self.send_probe_aoi_measure_stop(probe_sender = measurement_to_stop.source_probe, msm_id = msm_id_to_stop)
-        self.events_stop_probe_ack[msm_id_to_stop][0].wait(5)
+        self.ack_timeouts.wait_for_ack(self.events_stop_probe_ack[msm_id_to_stop][0], measurement_to_stop.source_probe, "aoi", "stop", default_timeout = 5)
         # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK OF STOP COMMAND FROM DEST PROBE (AoI-SERVER)
         stop_event_message = self.events_stop_probe_ack[msm_id_to_stop][1]
         stop_client_message_error = stop_event_message if (stop_event_message != "OK") else None
@@ -298,7 +311,7 @@ class Age_of_Information_Coordinator:
 
         self.events_stop_probe_ack[msm_id_to_stop] = [threading.Event(), None]
         self.send_probe_aoi_measure_stop(probe_sender = measurement_to_stop.dest_probe, msm_id = msm_id_to_stop)
-        self.events_stop_probe_ack[msm_id_to_stop][0].wait(5)
+        self.ack_timeouts.wait_for_ack(self.events_stop_probe_ack[msm_id_to_stop][0], measurement_to_stop.dest_probe, "aoi", "stop", default_timeout = 5)
         stop_event_message = self.events_stop_probe_ack[msm_id_to_stop][1]
 
         # Renabling the ntp_sec service on client probe
@@ -360,7 +373,9 @@ class Age_of_Information_Coordinator:
             msm_id = ObjectId(msm_id),
             aois=aois,
             aoi_min = result["aoi_min"],
-            aoi_max = result["aoi_max"]
+            aoi_max = result["aoi_max"],
+            sender_stats = self.sender_stats.pop(msm_id, None),
+            receiver_stats = result.get("receiver_stats")
         )
 
         result_id = self.mongo_db.insert_result(result = mongo_aoi_result)
@@ -407,4 +422,6 @@ class Age_of_Information_Coordinator:
                 json_overrided_config['packets_rate'] = packets_rate if (packets_rate != 0) else json_config['packets_rate']
             if ('payload_size' in measurement_parameters):
                 json_overrided_config['payload_size'] = measurement_parameters['payload_size']
+            if (START_AT_KEY in measurement_parameters):
+                json_overrided_config[START_AT_KEY] = measurement_parameters[START_AT_KEY]
         return json_overrided_config
\ No newline at end of file
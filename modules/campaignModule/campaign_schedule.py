@@ -0,0 +1,143 @@
+"""
+campaign_schedule.py
+
+This module provides the schedules of the measurement campaigns: CronSchedule, for the classic 5-field cron
+expressions ("minute hour day-of-month month day-of-week", in the coordinator local time), and IntervalSchedule, for
+fixed periods. Both compute the next run time after a given UNIX time; build_schedule creates one from the
+"schedule" object of a campaign: {"cron": "0 * * * *"} or {"interval": 3600, "start_at": <UNIX time, optional>}.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+CRON_FIELDS = (  # (name, min, max)
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day of month", 1, 31),
+    ("month", 1, 12),
+    ("day of week", 0, 6)  # 0 is Sunday, 7 is accepted as Sunday too
+)
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *"
+}
+MAX_SEARCH_YEARS = 5  # An expression without matches in this span (e.g. "0 0 31 2 *") is refused
+
+
+class CronSchedule:
+    """
+    Next-run computation for a 5-field cron expression. Each field accepts "*", numbers, ranges "a-b",
+    steps "*/n" or "a-b/n", and comma separated lists of them. As in cron, when both day of month and day of week
+    are restricted, a day matches if either of them matches.
+    """
+    def __init__(self, expression : str):
+        self.expression = CRON_ALIASES.get(expression.strip(), expression.strip())
+        fields = self.expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"cron expression |{expression}| must have {len(CRON_FIELDS)} fields")
+        parsed = [self.parse_field(field, name, low, high) for field, (name, low, high) in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days_of_month, self.months, days_of_week = parsed
+        self.days_of_week = {0 if (day == 7) else day for day in days_of_week}
+        self.day_of_month_restricted = (fields[2] != "*")
+        self.day_of_week_restricted = (fields[4] != "*")
+        if self.next_after(time.time()) is None:
+            raise ValueError(f"cron expression |{expression}| never matches")
+
+    @staticmethod
+    def parse_field(field : str, name, low, high) -> set:
+        values = set()
+        max_value = 7 if (name == "day of week") else high
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_text = part.split("/", 1)
+                step = int(step_text)
+                if step <= 0:
+                    raise ValueError(f"cron {name}: step must be positive")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start_text, end_text = part.split("-", 1)
+                start, end = int(start_text), int(end_text)
+            else:
+                start = int(part)
+                end = high if (step != 1) else start
+            if (start < low) or (end > max_value) or (start > end):
+                raise ValueError(f"cron {name}: |{part}| out of [{low}, {max_value}]")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, day : datetime) -> bool:
+        day_of_week = (day.weekday() + 1) % 7  # datetime: Monday is 0, cron: Sunday is 0
+        day_of_month_match = day.day in self.days_of_month
+        day_of_week_match = day_of_week in self.days_of_week
+        if self.day_of_month_restricted and self.day_of_week_restricted:
+            return day_of_month_match or day_of_week_match
+        return day_of_month_match and day_of_week_match
+
+    def next_after(self, timestamp : float):
+        """
+        Returns the UNIX time of the first match strictly after timestamp, or None if there is none.
+        """
+        current = datetime.fromtimestamp(timestamp).replace(second = 0, microsecond = 0) + timedelta(minutes = 1)
+        limit = current + timedelta(days = 366 * MAX_SEARCH_YEARS)
+        while current < limit:
+            if current.month not in self.months:
+                # Jump to the first day of the next month
+                current = (current.replace(day = 1) + timedelta(days = 32)).replace(day = 1, hour = 0, minute = 0)
+                continue
+            if not self.day_matches(current):
+                current = (current + timedelta(days = 1)).replace(hour = 0, minute = 0)
+                continue
+            if current.hour not in self.hours:
+                current = (current + timedelta(hours = 1)).replace(minute = 0)
+                continue
+            if current.minute not in self.minutes:
+                current += timedelta(minutes = 1)
+                continue
+            return current.timestamp()
+        return None
+
+    def to_dict(self) -> dict:
+        return {"cron": self.expression}
+
+
+class IntervalSchedule:
+    """
+    Runs every interval seconds, aligned to start_at (by default, the creation time of the schedule).
+    """
+    def __init__(self, interval : float, start_at : float = None):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.interval = float(interval)
+        self.start_at = float(start_at) if (start_at is not None) else time.time()
+
+    def next_after(self, timestamp : float):
+        if timestamp < self.start_at:
+            return self.start_at
+        elapsed_periods = int((timestamp - self.start_at) // self.interval) + 1
+        return self.start_at + elapsed_periods * self.interval
+
+    def to_dict(self) -> dict:
+        return {"interval": self.interval, "start_at": self.start_at}
+
+
+def build_schedule(schedule_spec : dict):
+    """
+    Creates the schedule of a campaign.
+    Args:
+        schedule_spec (dict): {"cron": expression} or {"interval": seconds, "start_at": UNIX time (optional)}.
+    Returns:
+        CronSchedule | IntervalSchedule
+    Raises:
+        ValueError: If the spec is malformed.
+    """
+    if not isinstance(schedule_spec, dict):
+        raise ValueError("schedule must be an object with a cron or an interval field")
+    if schedule_spec.get("cron"):
+        return CronSchedule(str(schedule_spec["cron"]))
+    if schedule_spec.get("interval") is not None:
+        return IntervalSchedule(float(schedule_spec["interval"]), schedule_spec.get("start_at"))
+    raise ValueError("schedule must have a cron or an interval field")
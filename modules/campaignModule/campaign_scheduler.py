@@ -0,0 +1,427 @@
+"""
+campaign_scheduler.py
+
+This module provides the CampaignScheduler class, which runs the recurring measurement campaigns stored on MongoDB.
+The next run of each enabled campaign is kept in a heap, ordered by run time; a dispatcher thread waits for the
+earliest one and hands the run to a worker, that expands the measurement templates of the campaign and submits
+them to the AdmissionQueue (so they still wait for busy probes), at most max_concurrency at a time.
+The runs missed while the coordinator was down are skipped or coalesced in one run, as set by the campaign
+misfire_policy. Each run updates the campaign stats (runs, measurements, duration, throughput) on MongoDB
+and in the MetricsRegistry.
+"""
+
+import copy
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules.admissionModule.admission_queue import AdmissionQueue, AdmissionTicket, DISPATCHED_STATE
+from modules.campaignModule.campaign_schedule import build_schedule
+from modules.metricsModule.metrics_registry import (MetricsRegistry, CAMPAIGN_RUNS_TOTAL, CAMPAIGN_MEASUREMENTS_TOTAL,
+                                                    CAMPAIGN_RUN_DURATION_SECONDS)
+from modules.mongoModule.mongoDB import MongoDB, COMPLETED_STATE, FAILED_STATE
+from modules.mongoModule.models.campaign_model_mongo import CampaignModelMongo, MISFIRE_POLICIES, COALESCE_MISFIRE_POLICY
+from modules.mongoModule.models.error_model import ErrorModel
+from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+
+RUN_WORKERS = 4                 # Campaign runs in progress at the same time (each one waits for its measurements)
+IDLE_WAKE_UP_SECONDS = 60
+RUN_POLL_SECONDS = 30           # Period of the state check of the running measurements, in case of a lost notification
+MAX_COUNTED_MISFIRES = 10000    # Stops counting the runs missed during a very long downtime
+CAMPAIGN_RUN_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0)
+CAMPAIGN_USER_PREFIX = "campaign:"  # Admission queue user of the campaign measurements, for the fair share
+
+
+def expand_measurements(campaign : CampaignModelMongo) -> list:
+    """
+    Creates the measurements of a campaign run from its templates.
+    Returns:
+        list[tuple]: (MeasurementModelMongo, duration) pairs. duration is None for the measurements that end by themselves.
+    """
+    measurements = []
+    for template in campaign.measurements:
+        source_probes = template.get("source_probes") or []
+        dest_probes = template.get("dest_probes") or []
+        pairs = [(source, dest) for source in source_probes for dest in dest_probes if source != dest] if dest_probes \
+                else [(source, None) for source in source_probes]
+        for source_probe, dest_probe in pairs:
+            measurement = MeasurementModelMongo.cast_dict_in_MeasurementModelMongo({
+                "type": template["type"],
+                "source_probe": source_probe,
+                "dest_probe": dest_probe,
+                "description": template.get("description") or f"Campaign {campaign.name}",
+                "parameters": copy.deepcopy(template.get("parameters")),
+                "coexisting_application": copy.deepcopy(template.get("coexisting_application"))
+            })
+            measurements.append((measurement, template.get("duration")))
+    return measurements
+
+
+class CampaignScheduler:
+    """
+    Scheduler of the measurement campaigns. measurement_stopper is the CommandsMultiplexer.measurement_stop_by_msm_id
+    triad method, used to stop the measurements of the templates with a duration.
+    """
+    def __init__(self, admission_queue : AdmissionQueue, measurement_stopper, mongo_db : MongoDB):
+        self.admission_queue = admission_queue
+        self.measurement_stopper = measurement_stopper
+        self.mongo_db = mongo_db
+        self.condition = threading.Condition()
+        self.stats_lock = threading.Lock()  # Guards the campaign.stats, updated by the dispatcher and the run threads
+        self.campaigns = {}             # Maps campaign_id to CampaignModelMongo
+        self.schedules = {}             # Maps campaign_id to its CronSchedule or IntervalSchedule
+        self.generations = {}           # Maps campaign_id to its generation: heap entries of older generations are stale
+        self.run_heap = []              # Heap of (run_at, sequence, campaign_id, generation, scheduled_at)
+        self.sequence = itertools.count()
+        self.active_runs = set()        # campaign_id of the runs in progress
+        self.run_events_by_msm_id = {}  # Maps msm_id to the event queue of the run waiting for it
+        self.metrics = MetricsRegistry.get_instance()
+        self.executor = ThreadPoolExecutor(max_workers = RUN_WORKERS, thread_name_prefix = "campaign")
+        self.dispatcher_thread = None
+        self.mongo_db.add_state_change_listener(self.measurement_state_changed)
+
+    def start(self):
+        """
+        Loads the campaigns from MongoDB, applying their misfire policy, and starts the dispatcher thread.
+        """
+        for campaign in self.mongo_db.find_all_campaigns() or []:
+            try:
+                schedule = build_schedule(campaign.schedule)
+            except ValueError as e:
+                print(f"CampaignScheduler: campaign |{campaign.name}| ignored, invalid schedule -> {e}")
+                continue
+            with self.condition:
+                self.register(campaign, schedule)
+                if campaign.enabled:
+                    self.schedule_after_downtime(campaign, schedule)
+            self.store_run_state(campaign)
+        self.dispatcher_thread = threading.Thread(target = self.dispatcher_body, daemon = True)
+        self.dispatcher_thread.start()
+        print(f"CampaignScheduler: started with {len(self.campaigns)} campaigns")
+
+    # ------------------------------------------------- SCHEDULING -------------------------------------------------
+
+    def register(self, campaign : CampaignModelMongo, schedule):
+        # Must be invoked holding the condition
+        campaign_id = str(campaign._id)
+        self.campaigns[campaign_id] = campaign
+        self.schedules[campaign_id] = schedule
+        self.generations[campaign_id] = self.generations.get(campaign_id, 0) + 1
+
+    def push_run(self, campaign : CampaignModelMongo, scheduled_at):
+        # Must be invoked holding the condition
+        campaign_id = str(campaign._id)
+        run_at = scheduled_at + (random.uniform(0, campaign.jitter) if campaign.jitter else 0)
+        campaign.next_run_at = scheduled_at
+        heapq.heappush(self.run_heap, (run_at, next(self.sequence), campaign_id, self.generations[campaign_id], scheduled_at))
+        self.condition.notify()
+
+    def schedule_after_downtime(self, campaign : CampaignModelMongo, schedule):
+        """
+        Schedules the next run of a loaded campaign. The runs missed since its stored next_run_at are skipped,
+        or coalesced in one run now.
+        """
+        # Must be invoked holding the condition
+        now = time.time()
+        if (campaign.next_run_at is None) or (campaign.next_run_at > now):
+            next_run_at = campaign.next_run_at if (campaign.next_run_at is not None) else schedule.next_after(now)
+            if next_run_at is not None:
+                self.push_run(campaign, next_run_at)
+            return
+        missed_runs = 0
+        missed_run_at = campaign.next_run_at
+        while (missed_run_at is not None) and (missed_run_at <= now) and (missed_runs < MAX_COUNTED_MISFIRES):
+            missed_runs += 1
+            missed_run_at = schedule.next_after(missed_run_at)
+        if campaign.misfire_policy == COALESCE_MISFIRE_POLICY:
+            self.count_runs(campaign, "coalesced", missed_runs - 1)
+            self.push_run(campaign, now)
+            print(f"CampaignScheduler: |{campaign.name}| missed {missed_runs} runs, coalesced in one run now")
+        else:
+            self.count_runs(campaign, "skipped", missed_runs)
+            next_run_at = schedule.next_after(now)
+            if next_run_at is not None:
+                self.push_run(campaign, next_run_at)
+            print(f"CampaignScheduler: |{campaign.name}| missed {missed_runs} runs, skipped")
+
+    def count_runs(self, campaign : CampaignModelMongo, outcome, count = 1):
+        if count <= 0:
+            return
+        stats_key = f"{outcome}_runs"
+        with self.stats_lock:
+            campaign.stats[stats_key] = campaign.stats.get(stats_key, 0) + count
+        self.metrics.inc_counter(CAMPAIGN_RUNS_TOTAL, {"campaign": campaign.name, "outcome": outcome}, count)
+
+    def next_wake_up(self) -> float:
+        # Must be invoked holding the condition
+        if not self.run_heap:
+            return IDLE_WAKE_UP_SECONDS
+        return min(max(self.run_heap[0][0] - time.time(), 0.0), IDLE_WAKE_UP_SECONDS)
+
+    def pop_due_runs(self) -> list:
+        # Must be invoked holding the condition
+        due_runs = []
+        now = time.time()
+        while self.run_heap and (self.run_heap[0][0] <= now):
+            _, _, campaign_id, generation, scheduled_at = heapq.heappop(self.run_heap)
+            campaign = self.campaigns.get(campaign_id)
+            if (campaign is None) or (generation != self.generations.get(campaign_id)) or (not campaign.enabled):
+                continue
+            # The next run is scheduled at once: a long run doesn't delay the following ones
+            next_run_at = self.schedules[campaign_id].next_after(max(scheduled_at, now))
+            if next_run_at is not None:
+                self.push_run(campaign, next_run_at)
+            else:
+                campaign.next_run_at = None
+            if campaign_id in self.active_runs:
+                self.count_runs(campaign, "overlapped")
+                print(f"CampaignScheduler: |{campaign.name}| run skipped, the previous one is still in progress")
+                continue
+            self.active_runs.add(campaign_id)
+            due_runs.append((campaign, scheduled_at))
+        return due_runs
+
+    def dispatcher_body(self):
+        while True:
+            with self.condition:
+                due_runs = self.pop_due_runs()
+                while not due_runs:
+                    self.condition.wait(timeout = self.next_wake_up())
+                    due_runs = self.pop_due_runs()
+            for campaign, scheduled_at in due_runs:
+                self.store_run_state(campaign)
+                self.executor.submit(self.run_campaign, campaign, scheduled_at)
+
+    # ------------------------------------------------- RUNS -------------------------------------------------
+
+    def run_campaign(self, campaign : CampaignModelMongo, scheduled_at):
+        """
+        Submits the measurements of a run, at most max_concurrency at a time, and waits for all of them to end.
+        """
+        campaign_id = str(campaign._id)
+        started_at = time.time()
+        print(f"CampaignScheduler: |{campaign.name}| run started ({started_at - scheduled_at:.1f}s after schedule)")
+        outcomes = {}
+        try:
+            outcomes = self.execute_run(campaign, scheduled_at)
+        except Exception as e:
+            print(f"CampaignScheduler: exception in the run of |{campaign.name}| -> {e}")
+        finally:
+            with self.condition:
+                self.active_runs.discard(campaign_id)
+        duration = time.time() - started_at
+        dispatched = outcomes.get(DISPATCHED_STATE, 0)
+        self.count_runs(campaign, "completed")
+        self.metrics.observe(CAMPAIGN_RUN_DURATION_SECONDS, duration, {"campaign": campaign.name}, CAMPAIGN_RUN_BUCKETS)
+        with self.stats_lock:
+            stats = campaign.stats
+            stats["measurements_dispatched"] = stats.get("measurements_dispatched", 0) + dispatched
+            stats["measurements_not_dispatched"] = stats.get("measurements_not_dispatched", 0) + sum(outcomes.values()) - dispatched
+            stats["total_run_seconds"] = stats.get("total_run_seconds", 0.0) + duration
+            stats["last_run_outcomes"] = outcomes
+            stats["last_run_duration"] = duration
+            stats["last_run_throughput"] = (dispatched / duration) if duration > 0 else None # Measurements per second
+            stats["throughput"] = (stats["measurements_dispatched"] / stats["total_run_seconds"]) if stats["total_run_seconds"] > 0 else None
+        campaign.last_run_at = started_at
+        self.store_run_state(campaign)
+        print(f"CampaignScheduler: |{campaign.name}| run ended in {duration:.1f}s -> {outcomes}")
+
+    def execute_run(self, campaign : CampaignModelMongo, scheduled_at) -> dict:
+        """
+        Returns the count of the run measurements by outcome: the admission ticket terminal state, or "error"
+        if the submission raised.
+        """
+        events = queue.Queue()  # ("ticket", AdmissionTicket) from the admission queue, ("state", msm_id) from MongoDB
+        pending = expand_measurements(campaign)
+        max_concurrency = max(int(campaign.max_concurrency or 1), 1)
+        deadline = (scheduled_at + campaign.run_timeout) if campaign.run_timeout else None
+        durations = {}          # Maps admission_id to the duration of its measurement
+        submitted = 0           # Tickets not yet in a terminal state
+        running = {}            # Maps msm_id to its stop timer (None for the measurements that end by themselves)
+        outcomes = {}
+        try:
+            while pending or submitted or running:
+                while pending and (submitted + len(running)) < max_concurrency:
+                    measurement, duration = pending.pop(0)
+                    try:
+                        _, info, _ = self.admission_queue.submit(measurement, user = CAMPAIGN_USER_PREFIX + campaign.name,
+                                                                 priority = campaign.priority, deadline = deadline,
+                                                                 on_finished = lambda ticket: events.put(("ticket", ticket)))
+                    except Exception as e:
+                        print(f"CampaignScheduler: exception while submitting a |{campaign.name}| measurement -> {e}")
+                        self.count_measurement(campaign, outcomes, "error")
+                        continue
+                    submitted += 1
+                    if isinstance(info, dict) and info.get("admission_id"):
+                        durations[info["admission_id"]] = duration
+                    elif isinstance(info, dict) and info.get("_id"):
+                        durations[str(info["_id"])] = duration
+                try:
+                    kind, value = events.get(timeout = RUN_POLL_SECONDS)
+                except queue.Empty:
+                    kind, value = "state", None
+                if kind == "ticket":
+                    submitted -= 1
+                    ticket : AdmissionTicket = value
+                    self.count_measurement(campaign, outcomes, ticket.state)
+                    if ticket.state == DISPATCHED_STATE:
+                        duration = durations.pop(ticket.admission_id, None) or durations.pop(ticket.msm_id, None)
+                        with self.condition:
+                            self.run_events_by_msm_id[ticket.msm_id] = events
+                        running[ticket.msm_id] = self.start_stop_timer(ticket.msm_id, duration)
+                        events.put(("state", ticket.msm_id)) # It may have ended before the registration
+                elif kind == "state":
+                    for msm_id in ([value] if (value is not None) else list(running)):
+                        if (msm_id in running) and (self.mongo_db.get_measurement_state(msm_id) in (COMPLETED_STATE, FAILED_STATE)):
+                            stop_timer = running.pop(msm_id)
+                            if stop_timer is not None:
+                                stop_timer.cancel()
+                            with self.condition:
+                                self.run_events_by_msm_id.pop(msm_id, None)
+        finally:
+            with self.condition:
+                for msm_id, stop_timer in running.items():
+                    if stop_timer is not None:
+                        stop_timer.cancel()
+                    self.run_events_by_msm_id.pop(msm_id, None)
+        return outcomes
+
+    def count_measurement(self, campaign : CampaignModelMongo, outcomes : dict, outcome):
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        self.metrics.inc_counter(CAMPAIGN_MEASUREMENTS_TOTAL, {"campaign": campaign.name, "outcome": outcome})
+
+    def start_stop_timer(self, msm_id, duration):
+        if not duration:
+            return None
+        stop_timer = threading.Timer(float(duration), self.stop_measurement, args = (msm_id,))
+        stop_timer.daemon = True
+        stop_timer.start()
+        return stop_timer
+
+    def stop_measurement(self, msm_id):
+        success_message, info, error_cause = self.measurement_stopper(msm_id)
+        if success_message != "OK":
+            print(f"CampaignScheduler: the stop of |{msm_id}| failed -> {info} ({error_cause})")
+
+    def measurement_state_changed(self, msm_id):
+        """
+        MongoDB state change listener: wakes up the run waiting for the measurement (all the runs, if msm_id is None).
+        """
+        with self.condition:
+            if msm_id is None:
+                targets = list({id(events): events for events in self.run_events_by_msm_id.values()}.values())
+            else:
+                targets = [self.run_events_by_msm_id[msm_id]] if (msm_id in self.run_events_by_msm_id) else []
+        for events in targets:
+            events.put(("state", msm_id))
+
+    def store_run_state(self, campaign : CampaignModelMongo):
+        with self.stats_lock: # A copy: the stats may change while they are encoded
+            stats = dict(campaign.stats)
+        if self.mongo_db.update_campaign_run_state(campaign._id, campaign.last_run_at, campaign.next_run_at, stats) is False:
+            print(f"CampaignScheduler: run state of |{campaign.name}| not stored")
+
+    # ------------------------------------------------- MANAGEMENT -------------------------------------------------
+
+    @staticmethod
+    def validate(campaign : CampaignModelMongo):
+        """
+        Returns the schedule of the campaign, or raises ValueError if the campaign is malformed.
+        """
+        schedule = build_schedule(campaign.schedule)
+        if campaign.misfire_policy not in MISFIRE_POLICIES:
+            raise ValueError(f"misfire_policy must be one of {list(MISFIRE_POLICIES)}")
+        if (campaign.jitter is None) or (float(campaign.jitter) < 0):
+            raise ValueError("jitter must be a non-negative number of seconds")
+        for template in campaign.measurements:
+            if (not isinstance(template, dict)) or (not template.get("type")) or (not template.get("source_probes")):
+                raise ValueError("each measurement template needs a type and a list of source_probes")
+        return schedule
+
+    def create_campaign(self, campaign_as_dict : dict):
+        """
+        Stores a new campaign and schedules its first run.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        campaign = CampaignModelMongo.cast_dict_in_CampaignModelMongo(campaign_as_dict)
+        if campaign is None:
+            return "Error", "There is at least one missing campaign field (name, schedule, measurements)", "Missing field"
+        campaign._id = None
+        campaign.last_run_at = campaign.next_run_at = None
+        campaign.stats = {}
+        try:
+            schedule = self.validate(campaign)
+        except (ValueError, TypeError) as e:
+            return "Error", f"Invalid campaign -> {e}", "Wrong campaign"
+        campaign.schedule = schedule.to_dict() # The interval start_at is fixed at creation
+        campaign.assign_id()
+        with self.condition:
+            self.register(campaign, schedule)
+            if campaign.enabled:
+                next_run_at = schedule.next_after(time.time())
+                if next_run_at is not None:
+                    self.push_run(campaign, next_run_at)
+        if self.mongo_db.insert_campaign(campaign) is None:
+            self.forget(str(campaign._id))
+            return "Error", "Error while storing the campaign on MongoDB", "MongoDB error"
+        return "OK", campaign.to_dict(), None
+
+    def forget(self, campaign_id):
+        with self.condition:
+            self.campaigns.pop(campaign_id, None)
+            self.schedules.pop(campaign_id, None)
+            self.generations[campaign_id] = self.generations.get(campaign_id, 0) + 1 # Invalidates its heap entries
+            self.condition.notify()
+
+    def delete_campaign(self, campaign_id):
+        """
+        Deletes a campaign. A run in progress completes, the next ones are cancelled.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        with self.condition:
+            campaign = self.campaigns.get(campaign_id)
+        if campaign is None:
+            return "Error", f"Unknown campaign |{campaign_id}|", "Wrong id?"
+        if not self.mongo_db.delete_campaign_by_id(campaign_id):
+            return "Error", "Error while deleting the campaign from MongoDB", "MongoDB error"
+        self.forget(campaign_id)
+        return "OK", campaign.to_dict(), None
+
+    def run_now(self, campaign_id):
+        """
+        Runs a campaign at once, out of its schedule (e.g. to check its templates).
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        with self.condition:
+            campaign = self.campaigns.get(campaign_id)
+            if campaign is None:
+                return "Error", f"Unknown campaign |{campaign_id}|", "Wrong id?"
+            if campaign_id in self.active_runs:
+                return "Error", f"A run of |{campaign.name}| is in progress", "Campaign BUSY"
+            self.active_runs.add(campaign_id)
+        self.executor.submit(self.run_campaign, campaign, time.time())
+        return "OK", campaign.to_dict(), None
+
+    def get_campaign(self, campaign_id):
+        with self.condition:
+            campaign = self.campaigns.get(campaign_id)
+            if campaign is None:
+                return ErrorModel(object_ref_id = campaign_id, object_ref_type = "campaign",
+                                  error_description = "Campaign not found", error_cause = "Unknown campaign_id")
+            return self.campaign_status(campaign_id, campaign)
+
+    def get_campaigns(self) -> list:
+        with self.condition:
+            return [self.campaign_status(campaign_id, campaign) for campaign_id, campaign in self.campaigns.items()]
+
+    def campaign_status(self, campaign_id, campaign : CampaignModelMongo) -> dict:
+        # Must be invoked holding the condition
+        with self.stats_lock: # A copy: the stats of a running campaign change while the response is encoded
+            stats = dict(campaign.stats)
+        return dict(campaign.to_dict(), stats = stats, running = (campaign_id in self.active_runs))
@@ -0,0 +1,111 @@
+"""
+capability_check.py
+
+This module checks a measurement against the capabilities its probes announce in the ONLINE/UPDATE state messages
+(registered handlers, sensors, tool availability and versions, interfaces). A measurement that can't run on its probes
+is rejected at once, instead of failing on the NACK of the probe or on an ACK timeout.
+The probes that didn't announce their capabilities (old firmware, or not yet registered) are not checked.
+"""
+
+from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+from modules.admissionModule.admission_queue import MULTI_PROBE_TYPES
+
+INA219_SENSOR = "ina219_sensor"
+NO_CLOCK_SYNC_IP = "0.0.0.0" # Announced by the probes without the ethernet interface used by the AoI/UDP-PING clock sync
+MISSING_CAPABILITIES_CAUSE = "Missing capabilities"
+
+# What each role of a measurement type needs on its probe. "clock_sync": the probe is the NTP server of its counterpart.
+# "any_tools": one of them is enough (e.g. the ICMP socket of the in-process engine, or the ping of an older firmware)
+MEASUREMENT_REQUIREMENTS = {
+    "ping": {"source": {"handler": "ping", "any_tools": ("icmp_socket", "ping")}},
+    "iperf": {"source": {"handler": "iperf", "tools": ("iperf3",)},
+              "dest": {"handler": "iperf", "tools": ("iperf3",)}},
+    "energy": {"source": {"handler": "energy", "sensors": (INA219_SENSOR,)}},
+    "aoi": {"source": {"handler": "aoi", "tools": ("ntpdate",)},
+            "dest": {"handler": "aoi", "clock_sync": True}},
+    "udpping": {"source": {"handler": "udpping", "tools": ("udpClient", "ntpdate")},
+                "dest": {"handler": "udpping", "tools": ("udpServer",), "clock_sync": True}},
+    "coex": {"source": {"handler": "coex"},
+             "dest": {"handler": "coex"}},
+}
+COEX_TRACE_TOOLS = ("tcprewrite", "tcpreplay") # Needed by the coex client to replay a trace (trace_name)
+UDP_PROTOCOL = "udp" # A ping with protocol udp sends UDP echoes: it needs no ICMP socket
+
+
+def requirements_of(measurement : MeasurementModelMongo) -> list:
+    """
+    Returns the (probe, requirement, measurement_type) to check for a measurement, including its coexisting application
+    and, for a matrix, all the probes of the mesh (each one is both source and dest of the inner measurement).
+    """
+    requirements = []
+    parameters = measurement.parameters if isinstance(measurement.parameters, dict) else {}
+    if measurement.type in MULTI_PROBE_TYPES:
+        inner_type = parameters.get("inner_type")
+        for probe in parameters.get("probes") or []:
+            for requirement in MEASUREMENT_REQUIREMENTS.get(inner_type, {}).values():
+                requirements.append((probe, requirement, inner_type))
+    else:
+        type_requirements = MEASUREMENT_REQUIREMENTS.get(measurement.type, {})
+        for role, probe in (("source", measurement.source_probe), ("dest", measurement.dest_probe)):
+            if probe and (role in type_requirements):
+                requirement = type_requirements[role]
+                if (measurement.type == "ping") and (parameters.get("protocol") == UDP_PROTOCOL):
+                    requirement = {key: value for key, value in requirement.items() if key != "any_tools"}
+                requirements.append((probe, requirement, measurement.type))
+
+    coexisting_application = measurement.coexisting_application
+    if coexisting_application is not None:
+        if not isinstance(coexisting_application, dict):
+            coexisting_application = coexisting_application.to_dict()
+        coex_requirements = MEASUREMENT_REQUIREMENTS["coex"]
+        source_requirement = dict(coex_requirements["source"])
+        if coexisting_application.get("trace_name") is not None:
+            source_requirement["tools"] = COEX_TRACE_TOOLS
+        requirements.append((coexisting_application.get("source_probe"), source_requirement, "coex"))
+        requirements.append((coexisting_application.get("dest_probe"), coex_requirements["dest"], "coex"))
+    return [(probe, requirement, measurement_type) for probe, requirement, measurement_type in requirements if probe]
+
+
+def missing_capabilities(requirement : dict, capabilities : dict, clock_sync_ip) -> list:
+    """
+    Returns the descriptions of what the probe misses to satisfy the requirement (empty if it can run it).
+    Args:
+        requirement (dict): {"handler", "tools", "any_tools", "sensors", "clock_sync"} of a role.
+        capabilities (dict): The capabilities announced by the probe, or None if unknown.
+        clock_sync_ip (str): The clock sync IP announced by the probe, or None if unknown.
+    """
+    missing = []
+    if requirement.get("clock_sync") and (clock_sync_ip == NO_CLOCK_SYNC_IP):
+        missing.append("no ethernet interface for the clock sync")
+    if capabilities is None:
+        return missing
+    if requirement["handler"] not in capabilities.get("handlers", []):
+        missing.append(f"no |{requirement['handler']}| handler")
+    for sensor in requirement.get("sensors", ()):
+        if sensor not in capabilities.get("sensors", []):
+            missing.append(f"no |{sensor}|")
+    tools = capabilities.get("tools", {})
+    for tool in requirement.get("tools", ()):
+        if not tools.get(tool, {}).get("available", False):
+            missing.append(f"|{tool}| not available")
+    any_tools = requirement.get("any_tools", ())
+    if any_tools and not any(tools.get(tool, {}).get("available", False) for tool in any_tools):
+        missing.append(f"none of {', '.join(f'|{tool}|' for tool in any_tools)} available")
+    return missing
+
+
+def check_measurement(measurement : MeasurementModelMongo, capabilities_of, clock_sync_ip_of):
+    """
+    Checks that the probes of a measurement can run it.
+    Args:
+        measurement (MeasurementModelMongo): The measurement to check.
+        capabilities_of (callable): Maps a probe_id to its announced capabilities (None if unknown).
+        clock_sync_ip_of (callable): Maps a probe_id to its announced clock sync IP (None if unknown).
+    Returns:
+        tuple or None: ("Error", message, error_cause) if a probe can't run the measurement, else None.
+    """
+    for probe, requirement, measurement_type in requirements_of(measurement):
+        missing = missing_capabilities(requirement, capabilities_of(probe), clock_sync_ip_of(probe))
+        if missing:
+            return "Error", f"Probe |{probe}| can't run the {measurement_type} measurement: {', '.join(missing)}", MISSING_CAPABILITIES_CAUSE
+    return None
@@ -14,6 +14,13 @@ from modules.configLoader.config_loader import ConfigLoader, COEX_KEY
 from bson import ObjectId
 from modules.mongoModule.mongoDB import MongoDB, SECONDS_OLD_MEASUREMENT, ErrorModel
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo, CoexistingApplicationModelMongo
+from modules.metricsModule.measurement_timings import TimingsTracker, MeasurementTimings
+from modules.metricsModule.ack_timeouts import AckTimeouts
+from modules.portsModule.port_allocator import PortAllocator
+from modules.scheduledStartModule.scheduled_start import START_AT_KEY, DEFAULT_START_LEAD_SECONDS, schedule_start_at
+from modules.prepareModule.prepare_round import PrepareRound, PREPARE_COMMAND
+
+COEX_PREPARE_TIMEOUT = 60 # Seconds. The client ACKs once armed, and the preparation of a trace replay may take long
 
 class Coex_Coordinator:
     """
@@ -31,10 +38,12 @@ class Coex_Coordinator:
         self.mqtt_client = mqtt_client
         self.mongo_db = mongo_db
         self.ask_probe_ip_mac = ask_probe_ip_mac_callback
-        self.events_received_ack_from_probe_sender = {}
+        self.prepare_rounds = {} # Maps msm_id to the PrepareRound waiting for the probes replies
         self.events_stop_probe_ack = {}
         self.queued_measurements = {}
         self.coex_stop_ack_number = {} # IF it is received an ACK or NACK, also the other probe is stopped
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.ack_timeouts = AckTimeouts.get_instance()
 
         registration_response = registration_handler_error_callback( interested_error = "coex",
                                                              handler = self.handler_received_error)
@@ -78,10 +87,9 @@ class Coex_Coordinator:
         command = payload["command"] if ("command" in payload) else None
         match type:
             case "ACK":                
-                if (command == "conf") or (command == "start"):
-                    if msm_id in self.events_received_ack_from_probe_sender:
-                        self.events_received_ack_from_probe_sender[msm_id][1] = "OK"
-                        self.events_received_ack_from_probe_sender[msm_id][0].set()
+                if command == "prepare":
+                    if msm_id in self.prepare_rounds:
+                        self.prepare_rounds[msm_id].set_reply(probe_sender, "OK")
                 elif command == "stop":
                     if msm_id is None:
                         print(f"Coex_Coordinator: received |stop| ACK from probe |{probe_sender}| wihout measure_id")
@@ -111,15 +119,10 @@ class Coex_Coordinator:
             case "NACK":
                 reason = payload['reason']
                 print(f"Coex_Coordinator: WARNING --> NACK from |{probe_sender}| , command: |{command}| , reason: |{reason}|")
-                if command == "conf":
-                    if msm_id in self.events_received_ack_from_probe_sender:
-                        self.events_received_ack_from_probe_sender[msm_id][1] = reason
-                        self.events_received_ack_from_probe_sender[msm_id][0].set()
-                elif command == "start":
-                    if msm_id in self.events_received_ack_from_probe_sender:
-                        self.events_received_ack_from_probe_sender[msm_id][1] = reason
-                        self.events_received_ack_from_probe_sender[msm_id][0].set()
-                    else:
+                if (command == "prepare") or (command == "start"):
+                    if msm_id in self.prepare_rounds:
+                        self.prepare_rounds[msm_id].set_reply(probe_sender, reason)
+                    else: # NACK of an armed client, while the traffic was running
                         if msm_id in self.queued_measurements: # If the coordinator has been rebooted in the while...
                             source_probe = self.queued_measurements[msm_id].source_probe
                             if probe_sender == source_probe:
@@ -156,15 +159,17 @@ class Coex_Coordinator:
                 error_probe_is_server = (probe_sender == referred_measure.dest_probe) # Verifying if the probe_sender is the measurement server.
                 if error_probe_is_server:
                     self.send_probe_coex_stop(probe_id=referred_measure.source_probe, msm_id_to_stop=msm_id)
-                    self.events_received_ack_from_probe_sender[msm_id][1] = reason
+                    if msm_id in self.prepare_rounds:
+                        self.prepare_rounds[msm_id].set_reply(probe_sender, reason)
                     print(f"Coex_Coordinator: stopped probe |{referred_measure.source_probe}| involved in error relative measure -> |{msm_id}|")
         else:
             print(f"Coex_Coordinator: error unknown command -> {error_command}")
 
-    def send_probe_coex_conf(self, probe_sender, msm_id, role, parameters : CoexistingApplicationModelMongo, 
-                             counterpart_probe_mac, counterpart_probe_ip = None):
+    def send_probe_coex_prepare(self, probe_sender, msm_id, role, parameters : CoexistingApplicationModelMongo, 
+                                counterpart_probe_mac, counterpart_probe_ip = None, start_at = None):
         """
-        Send a configuration command to a probe for COEX measurement setup.
+        Send the combined prepare command to a probe: the whole COEX configuration of its role and, for the client,
+        the UNIX time start_at at which the traffic begins.
         """
         json_conf_payload = {
             "msm_id": msm_id,
@@ -176,31 +181,18 @@ class Coex_Coordinator:
             "trace_name" : parameters.trace_name,
             "counterpart_probe_ip": counterpart_probe_ip,
             "counterpart_probe_mac": counterpart_probe_mac,
-            "duration": parameters.duration
+            "duration": parameters.duration,
+            START_AT_KEY: start_at
         }
         
         json_coex_conf = {
             "handler": "coex",
-            "command": "conf",
+            "command": PREPARE_COMMAND,
             "payload": json_conf_payload
         }
         self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_coex_conf))
 
 
-    def send_probe_coex_start(self, probe_id, msm_id):
-        """
-        Send a command to a probe to start a COEX measurement.
-        """
-        json_coex_start = {
-            "handler": "coex",
-            "command": "start",
-            "payload": {
-                "msm_id": msm_id
-            }
-        }
-        self.mqtt_client.publish_on_command_topic(probe_id=probe_id, complete_command=json.dumps(json_coex_start))
-
-
     def send_probe_coex_stop(self, probe_id, msm_id_to_stop, silent = False):
         """
         Send a command to a probe to stop a COEX measurement.
@@ -224,27 +216,49 @@ class Coex_Coordinator:
         if new_measurement._id is None:
             new_measurement.assign_id()
         measurement_id = str(new_measurement._id)
+        # The coex traffic belongs to the measurement it runs beside: its phases are stamped on that timings (if any)
+        measurement_timings = self.timings_tracker.get(measurement_id) or MeasurementTimings(measurement_id, "coex")
+        # The coex traffic begins delay_start seconds after the scheduled start of its measurement (if the measurement
+        # type has one), otherwise after now. The probe fires it at that time, whatever the latency of the commands below,
+        # unless that time would be past before the coex prepare round ends: the coex traffic is then postponed.
+        primary_start_at = new_measurement.parameters.get(START_AT_KEY) if isinstance(new_measurement.parameters, dict) else None
+        coex_base_time = primary_start_at if (primary_start_at is not None) else time.time()
 
         coex_parameters = self.get_default_coex_parameters()
         coex_parameters = self.override_default_parameters(coex_parameters, new_measurement.coexisting_application)
         if coex_parameters is None:
             return None, None, None
         coexisting_application = CoexistingApplicationModelMongo.cast_dict_in_CoexistingApplicationModelMongo(coex_parameters.copy())
-
-        source_coex_probe_ip, source_coex_probe_mac = self.ask_probe_ip_mac(coexisting_application.source_probe)
+        # The coex traffic shares the msm_id of its measurement, so its port is allocated under the "coex" purpose
+        socket_port = PortAllocator.get_instance().assign(measurement_id, (coexisting_application.source_probe, coexisting_application.dest_probe),
+                                                          coexisting_application.socket_port, purpose = "coex")
+        if socket_port is None:
+            return "Error", f"Socket port |{coexisting_application.socket_port}| not available on the coex probes", "Port already in use"
+        coexisting_application.socket_port = socket_port
+
+        with measurement_timings.phase("coex_ip_resolution"):
+            source_coex_probe_ip, source_coex_probe_mac = self.ask_probe_ip_mac(coexisting_application.source_probe)
         if (source_coex_probe_ip is None):
             print(f"Coex_Coordinator: Warning -> No response from coex client probe: {coexisting_application.source_probe}. -> NO COEXISTING APPLICATION TRAFFIC")
             return "Error", f"No response from client probe: {coexisting_application.source_probe}", "Reponse Timeout"
         
-        dest_coex_probe_ip, dest_coex_probe_mac = self.ask_probe_ip_mac(coexisting_application.dest_probe)
+        with measurement_timings.phase("coex_ip_resolution"):
+            dest_coex_probe_ip, dest_coex_probe_mac = self.ask_probe_ip_mac(coexisting_application.dest_probe)
         if dest_coex_probe_ip is None:
             print(f"Coex_Coordinator: No response from coex server probe: {coexisting_application.dest_probe}. -> NO COEXISTING APPLICATION TRAFFIC")
             return "Error", f"No response from server probe: {new_measurement.dest_probe}", "Reponse Timeout"
         
-        if coexisting_application.delay_start != 0: # IF HAS BEEN SETTED A DELAY_START... then, we must wait
+        # One parallel round trip: both the probes get their whole configuration, the client is armed for coex_start_at
+        prepare_round = PrepareRound((coexisting_application.dest_probe, coexisting_application.source_probe), handler = "coex",
+                                     roles = {coexisting_application.dest_probe: "Server", coexisting_application.source_probe: "Client"})
+        requested_coex_start_at = coex_base_time + (coexisting_application.delay_start or 0)
+        coex_start_at = schedule_start_at(requested_coex_start_at,
+                                          lead = prepare_round.timeout(COEX_PREPARE_TIMEOUT) + DEFAULT_START_LEAD_SECONDS)
+        if coexisting_application.delay_start != 0:
             print(f"Coex_Coordinator: coex traffic delayed of {str(coexisting_application.delay_start)}s")
-            time.sleep(coexisting_application.delay_start) # I can do this, because all of this code is run by another thread respect to the main
-        
+        if coex_start_at > requested_coex_start_at:
+            print(f"Coex_Coordinator: coex traffic postponed of {coex_start_at - requested_coex_start_at:.3f}s, to be armed in time")
+
         coexisting_application.source_probe_ip = source_coex_probe_ip
         coexisting_application.dest_probe_ip = dest_coex_probe_ip
 
@@ -253,63 +267,34 @@ class Coex_Coordinator:
         new_measurement.coexisting_application = coexisting_application.to_dict() #CoexistingApplicationModelMongo.cast_dict_in_CoexistingApplicationModelMongo(coex_parameters.copy())
         self.queued_measurements[measurement_id] = new_measurement
         
-        self.events_received_ack_from_probe_sender[measurement_id] = [threading.Event(), None]
-        self.send_probe_coex_conf(probe_sender = coexisting_application.dest_probe, msm_id = measurement_id, role="Server",
-                                  parameters = coexisting_application, counterpart_probe_ip=coexisting_application.source_probe_ip,
-                                  counterpart_probe_mac = source_coex_probe_mac)
-
-        self.events_received_ack_from_probe_sender[measurement_id][0].wait(timeout = 5)
-        # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK FROM DEST_PROBE (COEX INITIATOR)
-
-        probe_server_conf_message = self.events_received_ack_from_probe_sender[measurement_id][1]
-        if probe_server_conf_message == "OK":
-            self.events_received_ack_from_probe_sender[measurement_id] = [threading.Event(), None]
-            self.send_probe_coex_conf(probe_sender = coexisting_application.source_probe, msm_id = measurement_id, role="Client",
-                                      parameters = coexisting_application, counterpart_probe_ip = coexisting_application.dest_probe_ip,
-                                      counterpart_probe_mac = dest_coex_probe_mac)
-            self.events_received_ack_from_probe_sender[measurement_id][0].wait(timeout = 5)
-            # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK FROM SOURCE_PROBE (COEX INITIATOR)
-            probe_client_conf_message = self.events_received_ack_from_probe_sender[measurement_id][1]
-            if probe_client_conf_message == "OK":
-                self.queued_measurements[measurement_id] = new_measurement
-                self.events_received_ack_from_probe_sender[measurement_id] = [threading.Event(), None]
-                self.send_probe_coex_start(probe_id = coexisting_application.source_probe, msm_id = measurement_id)
-                self.events_received_ack_from_probe_sender[measurement_id][0].wait(timeout = 60)
-                # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK START FROM SOURCE_PROBE (COEX INITIATOR)
-                probe_client_start_message = self.events_received_ack_from_probe_sender[measurement_id][1]
-                if probe_client_start_message == "OK":
-                    #inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
-                    measure_has_been_updated = self.mongo_db.replace_measurement(measurement_id = measurement_id, measure = new_measurement)
-                    if measure_has_been_updated is None:
-                        print(f"Coex_Coordinator: can't update coex. Error while updating coex measurement on Mongo")
-                    return "OK", new_measurement.to_dict(), None
-                
-                # Sending stop to the server probe, otherwise it will remain BUSY
-                self.send_probe_coex_stop(probe_id=coexisting_application.dest_probe, msm_id_to_stop=measurement_id) 
-                if probe_client_start_message is not None:
-                    print(f"Preparer coex: awaked from client start NACK -> {probe_client_start_message}")
-                    return "Error", f"Probe |{coexisting_application.source_probe}| says: {probe_server_conf_message}", ""      
-                else:
-                    print(f"Preparer coex: No response from probe -> |{coexisting_application.source_probe}")
-                    return "Error", f"No response from Probe: {coexisting_application.source_probe}" , "Response Timeout"
-            
-            # Sending stop to the server probe, otherwise it will remain BUSY
-            self.send_probe_coex_stop(probe_id=coexisting_application.dest_probe, msm_id_to_stop=measurement_id)
-            if probe_client_conf_message is not None:
-                print(f"Preparer coex: awaked from client conf NACK -> {probe_client_conf_message}")
-                
-                return "Error", f"Probe |{coexisting_application.source_probe}| says: {probe_client_conf_message}", ""      
-            else:
-                print(f"Preparer coex: No response from probe -> |{coexisting_application.source_probe}")
-                # Sending stop to the server probe, otherwise it will remain BUSY
-                self.send_probe_coex_stop(probe_id=coexisting_application.dest_probe, msm_id_to_stop=measurement_id) 
-                return "Error", f"No response from Probe: {coexisting_application.source_probe}" , "Response Timeout"
-        elif probe_server_conf_message is not None:
-            print(f"Preparer coex: awaked from server conf NACK -> {probe_server_conf_message}")
-            return "Error", f"Probe |{coexisting_application.dest_probe}| says: {probe_server_conf_message}", ""            
-        else:
-            print(f"Preparer coex: No response from probe -> |{coexisting_application.dest_probe}")
-            return "Error", f"No response from Probe: {coexisting_application.dest_probe}" , "Response Timeout"
+        self.prepare_rounds[measurement_id] = prepare_round
+        with measurement_timings.phase("coex_prepare_ack_wait"):
+            self.send_probe_coex_prepare(probe_sender = coexisting_application.dest_probe, msm_id = measurement_id, role="Server",
+                                         parameters = coexisting_application, counterpart_probe_ip=coexisting_application.source_probe_ip,
+                                         counterpart_probe_mac = source_coex_probe_mac)
+            self.send_probe_coex_prepare(probe_sender = coexisting_application.source_probe, msm_id = measurement_id, role="Client",
+                                         parameters = coexisting_application, counterpart_probe_ip = coexisting_application.dest_probe_ip,
+                                         counterpart_probe_mac = dest_coex_probe_mac, start_at = coex_start_at)
+            failed_probe, failure_reason = prepare_round.wait(default_timeout = COEX_PREPARE_TIMEOUT)
+        # ------------------------------- YOU MUST WAIT (AT MOST THE ESTIMATED ACK TIMEOUT) FOR AN ACK/NACK FROM BOTH THE COEX PROBES
+        self.prepare_rounds.pop(measurement_id, None)
+
+        if failed_probe is None:
+            #inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
+            new_measurement.timings = measurement_timings.to_dict()
+            measure_has_been_updated = self.mongo_db.replace_measurement(measurement_id = measurement_id, measure = new_measurement)
+            if measure_has_been_updated is None:
+                print(f"Coex_Coordinator: can't update coex. Error while updating coex measurement on Mongo")
+            return "OK", new_measurement.to_dict(), None
+
+        # Sending stop to the probes that may be configured, otherwise they will remain BUSY
+        for probe_to_clean_up in prepare_round.probes_to_clean_up():
+            self.send_probe_coex_stop(probe_id = probe_to_clean_up, msm_id_to_stop = measurement_id)
+        if failure_reason is not None:
+            print(f"Preparer coex: awaked from prepare NACK of |{failed_probe}| -> {failure_reason}")
+            return "Error", f"Probe |{failed_probe}| says: {failure_reason}", ""
+        print(f"Preparer coex: No response from probe -> |{failed_probe}")
+        return "Error", f"No response from Probe: {failed_probe}" , "Response Timeout"
 
 
     def coex_measurement_stopper(self, msm_id_to_stop : str):
@@ -336,14 +321,17 @@ class Coex_Coordinator:
 
         self.events_stop_probe_ack[msm_id_to_stop] = [threading.Event(), None]
         self.send_probe_coex_stop(probe_id = coexisting_application.dest_probe, msm_id_to_stop = msm_id_to_stop)
-        self.events_stop_probe_ack[msm_id_to_stop][0].wait(5)
+        self.ack_timeouts.wait_for_ack(self.events_stop_probe_ack[msm_id_to_stop][0], coexisting_application.dest_probe, "coex", "stop", default_timeout = 5)
         # ------------------------------- WAIT FOR RECEIVE AN ACK/NACK -------------------------------
         stop_event_message = self.events_stop_probe_ack[msm_id_to_stop][1]
         if stop_event_message == "OK":
             self.events_stop_probe_ack[msm_id_to_stop] = [threading.Event(), None]
             already_received_stop_ack_from_source_probe = self.coex_stop_ack_number.get(msm_id_to_stop, False)
             self.send_probe_coex_stop(probe_id = coexisting_application.source_probe, msm_id_to_stop = msm_id_to_stop, silent = already_received_stop_ack_from_source_probe)
-            self.events_stop_probe_ack[msm_id_to_stop][0].wait(5)
+            if already_received_stop_ack_from_source_probe: # A silent stop may stay unanswered: it isn't a missed ACK
+                self.events_stop_probe_ack[msm_id_to_stop][0].wait(self.ack_timeouts.timeout(coexisting_application.source_probe, "coex", "stop", default_timeout = 5))
+            else:
+                self.ack_timeouts.wait_for_ack(self.events_stop_probe_ack[msm_id_to_stop][0], coexisting_application.source_probe, "coex", "stop", default_timeout = 5)
             stop_event_message = self.events_stop_probe_ack[msm_id_to_stop][1]
             if (stop_event_message == "OK") or (self.coex_stop_ack_number.get(msm_id_to_stop, False)):
                 #if self.mongo_db.set_measurement_as_completed(msm_id_to_stop):
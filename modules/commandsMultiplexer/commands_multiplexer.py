@@ -11,6 +11,13 @@ import threading
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
 from modules.mongoModule.mongoDB import MongoDB, ErrorModel, STARTED_STATE, FAILED_STATE, COMPLETED_STATE
 from modules.mqttModule.mqtt_client import Mqtt_Client
+from modules.metricsModule.metrics_registry import MetricsRegistry, HANDLER_LATENCY_SECONDS, SPOOL_DEPTH, ACTIVE_MEASUREMENTS, PROBES_ONLINE
+from modules.metricsModule.measurement_timings import TimingsTracker
+from modules.metricsModule.ack_timeouts import AckTimeouts
+from modules.admissionModule.admission_queue import AdmissionQueue
+from modules.portsModule.port_allocator import PortAllocator
+from modules.warmPoolModule.warm_servers import WarmServers
+from modules.capabilitiesModule.capability_check import check_measurement
 
 from concurrent.futures import ThreadPoolExecutor
 
@@ -35,10 +42,39 @@ class CommandsMultiplexer:
         self.probe_ip_lock = threading.Lock()  # Lock for thread-safe probe IP/MAC access
         self.probe_ip_mac = {}  # Maps probe_id to (ip, mac)
         self.probe_ip_for_clock_sync = {}  # Maps probe_id to clock sync IP
+        self.probe_gateway = {}  # Maps probe_id to its default gateway identity {"ip", "mac", "nic"}
+        self.probe_capabilities = {}  # Maps probe_id to its announced capabilities {"handlers", "sensors", "tools", "interfaces"}
         self.event_ask_probe_ip = {}  # Maps probe_id to threading.Event for IP requests
         self.event_ask_probe_ip_for_clock_sync = {}  # Maps probe_id to threading.Event for clock sync IP requests
         self.coordinator_ip = self.get_coordinator_ip()  # Coordinator's IP address
         self.started_measurement = {}  # Maps measurement_id to measurement type
+        self.metrics = MetricsRegistry.get_instance()
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.timings_tracker.watch_measurement_states(self.mongo_db) # The timings of the ended measurements are stored, then dropped
+        self.ack_timeouts = AckTimeouts.get_instance() # Fed with every command/ACK pair, it drives the ACK waits of the coordinators
+        self.metrics.register_gauge_callback(PROBES_ONLINE, self.get_online_probes_count)
+        self.metrics.register_gauge_callback(ACTIVE_MEASUREMENTS, self.get_active_measurements_by_type)
+        self.metrics.register_gauge_callback(SPOOL_DEPTH, self.mongo_db.get_spool_depth)
+        self.admission_queue = AdmissionQueue(preparer = self.prepare_probes_to_measure, mongo_db = self.mongo_db, # Entry point of the REST measurement requests
+                                              interference_group_of = self.get_interference_group,
+                                              validator = self.check_probe_capabilities)
+        self.port_allocator = PortAllocator.get_instance()
+        self.port_allocator.watch_measurement_states(self.mongo_db) # The ports of the ended measurements return to the pool
+        self.warm_servers = WarmServers.get_instance() # Warm iperf/udpServer ports announced by the probes
+
+    def get_online_probes_count(self) -> int:
+        """
+        Returns the number of probes currently online (the ones with a known IP/MAC).
+        """
+        with self.probe_ip_lock:
+            return len(self.probe_ip_mac)
+
+    def get_active_measurements_by_type(self) -> dict:
+        """
+        Returns the number of started measurements grouped by type, keyed as metrics labels.
+        """
+        active_measurements = self.mongo_db.count_measurements_by_type(state = STARTED_STATE)
+        return {MetricsRegistry.labels_key({"type": msm_type}): count for msm_type, count in active_measurements.items()}
 
     def set_mqtt_client(self, mqtt_client : Mqtt_Client):
         """
@@ -95,6 +131,79 @@ class CommandsMultiplexer:
         with self.probe_ip_lock:
             self.probe_ip_mac.pop(probe_id, None)
 
+    def set_probe_gateway(self, probe_id, gateway):
+        """
+        Set the default gateway identity announced by a probe. Probes with an old firmware don't announce it.
+        Args:
+            probe_id (str): The probe identifier.
+            gateway (dict): {"ip", "mac", "nic"} of the probe's default gateway, or None.
+        """
+        with self.probe_ip_lock:
+            if isinstance(gateway, dict) and (gateway.get("mac") or gateway.get("ip")):
+                self.probe_gateway[probe_id] = gateway
+            else:
+                self.probe_gateway.pop(probe_id, None)
+
+    def set_probe_capabilities(self, probe_id, capabilities):
+        """
+        Set the capabilities announced by a probe. Probes with an old firmware don't announce them (not checked).
+        Args:
+            probe_id (str): The probe identifier.
+            capabilities (dict): {"handlers", "sensors", "tools", "interfaces"} of the probe, or None.
+        """
+        with self.probe_ip_lock:
+            if isinstance(capabilities, dict):
+                self.probe_capabilities[probe_id] = capabilities
+            else:
+                self.probe_capabilities.pop(probe_id, None)
+
+    def get_probe_capabilities(self, probe_id):
+        with self.probe_ip_lock:
+            return self.probe_capabilities.get(probe_id)
+
+    def check_probe_capabilities(self, measurement : MeasurementModelMongo):
+        """
+        Checks the measurement against the cached capabilities of its probes, without any command to them.
+        Returns:
+            tuple or None: ("Error", message, error_cause) if a probe can't run the measurement, else None.
+        """
+        return check_measurement(measurement, capabilities_of = self.get_probe_capabilities,
+                                 clock_sync_ip_of = self.get_probe_ip_for_clock_sync_if_present)
+
+    def get_interference_group(self, probe_id):
+        """
+        Get the interference group of a probe: the probes behind the same gateway share their first hop, so they
+        interfere when measured concurrently. The group is the gateway MAC or, only on the point-to-point links without
+        ARP (e.g. the cellular ones), the gateway IP: the probes behind the same carrier gateway are grouped. The IP of a
+        gateway whose MAC is not (yet) resolved is not used, as unrelated sites can have the same private gateway IP.
+        Args:
+            probe_id (str): The probe identifier.
+        Returns:
+            str or None: The group, or None if the probe didn't announce an identity of its gateway.
+        """
+        with self.probe_ip_lock:
+            gateway = self.probe_gateway.get(probe_id)
+        if gateway is None:
+            return None
+        if gateway.get("mac"):
+            return f"mac/{gateway['mac'].lower()}"
+        if gateway.get("point_to_point") and gateway.get("ip"):
+            return f"ip/{gateway['ip']}"
+        return None
+
+    def get_interference_groups(self) -> dict:
+        """
+        Returns the known interference groups, each one with its probes.
+        """
+        with self.probe_ip_lock:
+            probe_ids = list(self.probe_gateway)
+        interference_groups = {}
+        for probe_id in probe_ids:
+            group = self.get_interference_group(probe_id)
+            if group is not None:
+                interference_groups.setdefault(group, []).append(probe_id)
+        return interference_groups
+
     def get_probe_ip_for_clock_sync_if_present(self, probe_id):
         """
         Get the clock sync IP for a probe if present.
@@ -252,7 +361,22 @@ class CommandsMultiplexer:
             handler = nested_json_result['handler']
             result = nested_json_result['payload']
             if handler in self.results_handler_callback:
-                self.results_handler_callback[handler](probe_sender, result) # Multiplexing 
+                received_at = time.time()
+                handler_start = time.monotonic()
+                measurement_timings = self.timings_tracker.get(result.get("msm_id")) if isinstance(result, dict) else None
+                if measurement_timings is not None:
+                    measurement_timings.begin_result(handler_start)
+                try:
+                    with self.metrics.time_block(HANDLER_LATENCY_SECONDS, {"handler": handler, "topic_type": "results"}):
+                        self.results_handler_callback[handler](probe_sender, result) # Multiplexing 
+                finally:
+                    if measurement_timings is not None:
+                        measurement_timings.add_probe_result(probe_id = probe_sender, probe_timestamps = result.get("timestamps"),
+                                                             coordinator_received_at = received_at, commit_duration = time.monotonic() - handler_start)
+                        # A measurement may send many results (repetitions, interval batches, targets): the timings are
+                        # stored once, when it's completed (by this result, or by a stop)
+                        if measurement_timings.end_result(handler_start):
+                            self.timings_tracker.store(measurement_timings)
             else:
                 print(f"CommandsMultiplexer: result_multiplexer: no registered handler for |{handler}|")
         except json.JSONDecodeError as e:
@@ -271,8 +395,16 @@ class CommandsMultiplexer:
             handler = nested_json_status['handler']
             type = nested_json_status['type']  # This is the type of status message
             payload = nested_json_status['payload']
+            if (type == "ACK" or type == "NACK") and isinstance(payload, dict):
+                ack_rtt = self.metrics.command_acknowledged(probe_sender, handler, payload.get("command"), payload.get("msm_id"))
+                self.ack_timeouts.add_sample(probe_sender, handler, payload.get("command"), ack_rtt, payload.get("timestamps"), payload.get("role"))
+                measurement_timings = self.timings_tracker.get(payload.get("msm_id"))
+                if measurement_timings is not None:
+                    measurement_timings.add_probe_ack(probe_id = probe_sender, command = payload.get("command"),
+                                                      probe_timestamps = payload.get("timestamps"), coordinator_rtt = ack_rtt)
             if handler in self.status_handler_callback:
-                self.status_handler_callback[handler](probe_sender, type, payload) # Multiplexing
+                with self.metrics.time_block(HANDLER_LATENCY_SECONDS, {"handler": handler, "topic_type": "status"}):
+                    self.status_handler_callback[handler](probe_sender, type, payload) # Multiplexing
             else:
                 print(f"CommandsMultiplexer: status_multiplexer: no registered handler for |{handler}|. TYPE: {type}|\n-> PRINT: -> {payload}")
         except json.JSONDecodeError as e:
@@ -292,16 +424,18 @@ class CommandsMultiplexer:
             error_command = nested_error_json['command']
             error_payload = nested_error_json['payload']
             if error_handler in self.error_handler_callback:
-                self.error_handler_callback[error_handler](probe_sender, error_command, error_payload)
+                with self.metrics.time_block(HANDLER_LATENCY_SECONDS, {"handler": error_handler, "topic_type": "errors"}):
+                    self.error_handler_callback[error_handler](probe_sender, error_command, error_payload)
             else:
                 print(f"CommandsMultiplexer: default error hanlder -> msg from |{probe_sender}| --> {nested_error}")
         except json.JSONDecodeError as e:
             print(f"CommandsMultiplexer: error_multiplexer: json exception -> {e}")
     
 
-    def prepare_probes_to_measure(self, new_measurement : MeasurementModelMongo):  # invoked by REST module
+    def prepare_probes_to_measure(self, new_measurement : MeasurementModelMongo):  # invoked by the AdmissionQueue
         """
         Prepare probes for a new measurement by invoking the registered preparer callback.
+        The REST requests reach this method through the admission_queue, once the probes of the measurement are free.
         Args:
             new_measurement (MeasurementModelMongo): The measurement to prepare.
         Returns:
@@ -309,6 +443,14 @@ class CommandsMultiplexer:
         """
         measurement_type = new_measurement.type
         if measurement_type in self.probes_preparer_callback:
+            # The capabilities may have changed while the request was queued (the matrix pairs are checked here too)
+            capabilities_error = self.check_probe_capabilities(new_measurement)
+            if capabilities_error is not None:
+                if new_measurement._id is not None:
+                    self.timings_tracker.discard(new_measurement._id)
+                    self.port_allocator.release(new_measurement._id)
+                return capabilities_error
+
             # *** Ensure that all "preparer" methods return exactly three values (triad). ***
             success_message, measurement_as_dict, error_cause = self.probes_preparer_callback[measurement_type](new_measurement)
             
@@ -324,6 +466,10 @@ class CommandsMultiplexer:
                 msm_type = measurement_as_dict["type"]
                 self.started_measurement[msm_id] = msm_type
                 print(f"CommandsMultiplexer: stored msm_id |{msm_id}| , type: |{msm_type}|")
+            elif new_measurement._id is not None:
+                # The measurement never started: no ACK/result will ever close its timings, nor release its ports
+                self.timings_tracker.discard(new_measurement._id)
+                self.port_allocator.release(new_measurement._id)
             return success_message, measurement_as_dict, error_cause
         else:
             return "Error", "Check the measurement type", f"Unkown measure type: {measurement_type}"
@@ -397,6 +543,9 @@ class CommandsMultiplexer:
                 case "ONLINE":
                     self.set_probe_ip_mac(probe_id = probe_sender, probe_ip = probe_ip, probe_mac=probe_mac)
                     self.set_probe_ip_for_clock_sync(probe_id = probe_sender, probe_ip_for_clock_sync = probe_ip_for_clock_sync)
+                    self.set_probe_gateway(probe_id = probe_sender, gateway = payload.get("gateway"))
+                    self.set_probe_capabilities(probe_id = probe_sender, capabilities = payload.get("capabilities"))
+                    self.warm_servers.set_probe_warm_servers(probe_id = probe_sender, warm_servers = payload.get("warm_servers"))
                     if probe_ip in self.event_ask_probe_ip: # if this message is triggered by an "ask_probe_ip", then signal it (MAY BE THERE IS "SOMEONE" WAITING)
                         self.event_ask_probe_ip[probe_ip].set()
                     json_set_coordinator_ip = {"coordinator_ip": self.coordinator_ip}
@@ -405,11 +554,18 @@ class CommandsMultiplexer:
                 case "UPDATE":
                     self.set_probe_ip_mac(probe_id = probe_sender, probe_ip = probe_ip, probe_mac=probe_mac)
                     self.set_probe_ip_for_clock_sync(probe_id = probe_sender, probe_ip_for_clock_sync = probe_ip_for_clock_sync)
+                    self.set_probe_gateway(probe_id = probe_sender, gateway = payload.get("gateway"))
+                    self.set_probe_capabilities(probe_id = probe_sender, capabilities = payload.get("capabilities"))
+                    self.warm_servers.set_probe_warm_servers(probe_id = probe_sender, warm_servers = payload.get("warm_servers"))
                     if probe_ip in self.event_ask_probe_ip: # if this message is triggered by an "ask_probe_ip", then signal it (MAY BE THERE IS "SOMEONE" WAITING)
                         self.event_ask_probe_ip[probe_ip].set()
                 case "OFFLINE":
                     self.pop_probe_ip(probe_id=probe_sender)
                     self.pop_probe_ip_for_clock_sync(probe_id = probe_sender)
+                    self.set_probe_gateway(probe_id = probe_sender, gateway = None)
+                    self.set_probe_capabilities(probe_id = probe_sender, capabilities = None)
+                    self.warm_servers.set_probe_warm_servers(probe_id = probe_sender, warm_servers = None)
+                    self.admission_queue.probe_offline(probe_id = probe_sender)
                     print(f"CommandsMultiplexer: root_service -> probe [{probe_sender}] -> state [{state_info}]")
                 case _:
                     print(f"CommandsMultiplexer: root_service -> received unknown state_info -> |{state_info}| , from probe -> |{probe_sender}|")
@@ -10,6 +10,7 @@ PING_KEY = 'ping'
 AOI_KEY = 'aoi'
 UDPPING_KEY = 'udpping'
 COEX_KEY = "coex"
+MATRIX_KEY = "matrix"
 
 class ConfigLoader:
     def __init__(self, base_path, file_name, KEY):
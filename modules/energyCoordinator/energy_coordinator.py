@@ -10,6 +10,8 @@ from modules.mongoModule.mongoDB import MongoDB, ErrorModel
 from modules.mqttModule.mqtt_client import Mqtt_Client
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
 from modules.mongoModule.models.energy_result_model_mongo import EnergyResultModelMongo
+from modules.metricsModule.measurement_timings import TimingsTracker, MEASUREMENT_PHASE
+from modules.metricsModule.ack_timeouts import AckTimeouts
 
 class EnergyCoordinator:
     """
@@ -42,6 +44,8 @@ class EnergyCoordinator:
         self.queued_measurements = {}
         self.events_received_start_ack = {}
         self.events_received_stop_ack = {}
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.ack_timeouts = AckTimeouts.get_instance()
 
         # Register status handler for energy measurements
         registration_response = registration_handler_status_callback(
@@ -205,8 +209,10 @@ class EnergyCoordinator:
         """
         new_measurement.assign_id()
         measurement_id = str(new_measurement._id)
+        measurement_timings = self.timings_tracker.start(measurement_id, "energy")
 
-        source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
+        with measurement_timings.phase("ip_resolution"):
+            source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
         if (source_probe_ip is None):
             print(f"EnergyCoordinator: No response from probe: {new_measurement.source_probe}")
             return "Error", f"No response from probe: {new_measurement.source_probe}", "Reponse Timeout"
@@ -223,12 +229,16 @@ class EnergyCoordinator:
             }
         }
         self.events_received_start_ack[measurement_id] = [threading.Event(), None]
-        self.mqtt_client.publish_on_command_topic(probe_id = new_measurement.source_probe, complete_command = json.dumps(json_iperf_start))
-        self.events_received_start_ack[measurement_id][0].wait(timeout = 5)
+        with measurement_timings.phase("start_ack_wait"):
+            self.mqtt_client.publish_on_command_topic(probe_id = new_measurement.source_probe, complete_command = json.dumps(json_iperf_start))
+            self.ack_timeouts.wait_for_ack(self.events_received_start_ack[measurement_id][0], new_measurement.source_probe, "energy", "start", default_timeout = 5)
         # Wait (at most 5s) for an ACK/NACK from the source probe
         probe_event_message = self.events_received_start_ack[measurement_id][1]
         if probe_event_message == "OK":
-            measurement_id = self.mongo_db.insert_measurement(new_measurement)
+            measurement_timings.start_phase(MEASUREMENT_PHASE)
+            new_measurement.timings = measurement_timings.to_dict()
+            with measurement_timings.phase("db_insert"):
+                measurement_id = self.mongo_db.insert_measurement(new_measurement)
             if (measurement_id is None):
                 return "Error", "Can't store measure in Mongo! Error while inserting measurement energy in mongo", "MongoDB Down?"
             return "OK", new_measurement.to_dict(), None # By returning these arguments, it's possible to see them in the HTTP response
@@ -267,7 +277,7 @@ class EnergyCoordinator:
         self.events_received_stop_ack[msm_id_to_stop] = [threading.Event(), None]
         self.mqtt_client.publish_on_command_topic(probe_id = queued_measurement.source_probe,
                                                   complete_command=json.dumps(json_energy_stop))
-        self.events_received_stop_ack[msm_id_to_stop][0].wait(timeout = 5)
+        self.ack_timeouts.wait_for_ack(self.events_received_stop_ack[msm_id_to_stop][0], queued_measurement.source_probe, "energy", "stop", default_timeout = 5)
         # Wait (at most 5s) for an ACK/NACK from the source probe
         stop_event_message = self.events_received_stop_ack[msm_id_to_stop][1]
         if stop_event_message == "OK":
@@ -16,7 +16,19 @@ from bson import ObjectId
 from modules.mongoModule.mongoDB import MongoDB, ErrorModel, SECONDS_OLD_MEASUREMENT
 from modules.configLoader.config_loader import ConfigLoader, IPERF_CLIENT_KEY, IPERF_SERVER_KEY
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
-from modules.mongoModule.models.iperf_result_model_mongo import IperfResultModelMongo
+from modules.mongoModule.models.iperf_result_model_mongo import IperfResultModelMongo, IperfIntervalsResultModelMongo
+from modules.metricsModule.measurement_timings import TimingsTracker, MEASUREMENT_PHASE
+from modules.metricsModule.ack_timeouts import AckTimeouts
+from modules.scheduledStartModule.scheduled_start import START_AT_KEY, check_requested_start_at, schedule_start_at
+from modules.prepareModule.prepare_round import PrepareRound, PREPARE_COMMAND
+from modules.warmPoolModule.warm_servers import WarmServers, WARM_SERVER_KEY
+
+# UDP capacity search of the client: the mode and its settings, overridable by the measurement parameters
+CAPACITY_SEARCH_KEYS = ("capacity_search", "capacity_min_mbps", "capacity_start_mbps", "capacity_max_mbps", "capacity_probe_seconds",
+                        "capacity_loss_percent", "capacity_jitter_ms", "capacity_tolerance_percent", "capacity_max_probes")
+# Adaptive duration of the client tests: the mode and its settings, overridable by the measurement parameters
+ADAPTIVE_DURATION_KEYS = ("adaptive_duration", "adaptive_tolerance_percent", "adaptive_confidence", "adaptive_min_seconds",
+                          "adaptive_max_seconds", "adaptive_warmup_seconds")
 
 class Iperf_Coordinator:
     """
@@ -49,9 +61,11 @@ class Iperf_Coordinator:
         self.ask_probe_ip_mac = ask_probe_ip_mac_callback
         self.mongo_db = mongo_db
         self.queued_measurements = {}
-        self.events_received_server_ack = {}
-        self.events_received_client_ack = {}
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.ack_timeouts = AckTimeouts.get_instance()
+        self.prepare_rounds = {} # Maps msm_id to the PrepareRound waiting for the probes replies
         self.events_stop_server_ack = {}
+        self.warm_servers = WarmServers.get_instance()
 
         # Requests to commands_multiplexer: handler STATUS registration
         registration_response = registration_handler_status_callback(
@@ -121,19 +135,16 @@ class Iperf_Coordinator:
             case "ACK":
                 command_executed_on_probe = payload["command"]
                 match command_executed_on_probe:
-                    case "conf":
+                    case "prepare":
                         measurement_id = payload["msm_id"]
                         if "port" in payload: # if the 'port' key is in the payload, then it's the ACK comes from iperf-server
                             probe_port = payload["port"]
                             self.probes_server_port[probe_sender] = probe_port
                             print(f"Iperf_Coordinator: probe |{probe_sender}|->|Listening port: {probe_port}|->|ACK|")
-                            self.events_received_server_ack[measurement_id][1] = "OK"
-                            self.events_received_server_ack[measurement_id][0].set() # Set the event ACK RECEIVER FROM SERVER
-                        # the else statement, means that the ACK is sent from the client.
                         else:
-                            self.events_received_client_ack[measurement_id][1] = "OK"
-                            self.events_received_client_ack[measurement_id][0].set()
-                            print(f"Iperf_Coordinator: probe |{probe_sender}|->|conf|-> client |ACK|")
+                            print(f"Iperf_Coordinator: probe |{probe_sender}|->|prepare|-> client |ACK|")
+                        if measurement_id in self.prepare_rounds:
+                            self.prepare_rounds[measurement_id].set_reply(probe_sender, "OK")
                     case "stop":
                         measurement_id = payload["msm_id"]
                         if measurement_id is None:
@@ -157,16 +168,14 @@ class Iperf_Coordinator:
                         if self.mongo_db.set_measurement_as_failed_by_id(measurement_id = measurement_id):
                             print(f"Iperf_Coordinator: measurement |{measurement_id}| setted as failed")
                         if role_conf_failed == "Client":
-                            if measurement_id is not None: # I must stop the iperf server on the probe
-                                if measurement_id not in self.events_stop_server_ack:
+                            if measurement_id is not None: # I must stop the iperf server on the probe (a warm one is recycled)
+                                if self.uses_warm_server(measurement_id):
+                                    self.send_warm_server_recycle(self.queued_measurements[measurement_id])
+                                elif measurement_id not in self.events_stop_server_ack:
                                     self.send_probe_iperf_stop(self.queued_measurements[measurement_id].dest_probe, measurement_id)
-                    case "conf":
-                        if role_conf_failed == "Server":
-                            self.events_received_server_ack[measurement_id][1] = reason
-                            self.events_received_server_ack[measurement_id][0].set()
-                        elif role_conf_failed == "Client":
-                            self.events_received_client_ack[measurement_id][1] = reason
-                            self.events_received_client_ack[measurement_id][0].set()
+                    case "prepare":
+                        if measurement_id in self.prepare_rounds:
+                            self.prepare_rounds[measurement_id].set_reply(probe_sender, reason)
                     case "stop":
                         if measurement_id is None:
                             print(f"Iperf_Coordinator: probe |{probe_sender}|->|Iperf stopped|->|NACK| : None measure")
@@ -180,12 +189,12 @@ class Iperf_Coordinator:
                 print(f"Iperf_Coordinator: received unkown type message -> |{type}|")
 
         
-    def send_probe_iperf_start(self, new_measurement : MeasurementModelMongo):
+    def store_prepared_measurement(self, new_measurement : MeasurementModelMongo):
         """
-        Send a start command to the probe to begin an iperf measurement.
-        Inserts the measurement into MongoDB before sending the command.
+        Insert into MongoDB a measurement whose probes ACKed the prepare command: the client is already armed.
+        If the insertion fails, both the probes are stopped.
         Args:
-            new_measurement (MeasurementModelMongo): The measurement to start.
+            new_measurement (MeasurementModelMongo): The prepared measurement.
         Returns:
             tuple: (status, message, error_cause)
         """
@@ -194,33 +203,34 @@ class Iperf_Coordinator:
         new_measurement.parameters.pop("verbose", None)
         new_measurement.parameters.pop("result_measurement_filename", None)
         new_measurement.parameters.pop("role", None)
-        
-        
 
-        inserted_measurement_id = self.mongo_db.insert_measurement(new_measurement)
+        measurement_timings = self.timings_tracker.get(new_measurement._id)
+        if measurement_timings is not None:
+            new_measurement.timings = measurement_timings.to_dict()
+            with measurement_timings.phase("db_insert"):
+                inserted_measurement_id = self.mongo_db.insert_measurement(new_measurement)
+        else:
+            inserted_measurement_id = self.mongo_db.insert_measurement(new_measurement)
         if (inserted_measurement_id is None):
-            return "Error", "Can't send start! Error while inserting measurement iperf in mongo", "MongoDB Down?"
+            self.send_probe_iperf_stop(new_measurement.source_probe, str(new_measurement._id))
+            if not new_measurement.parameters.get(WARM_SERVER_KEY):
+                self.send_probe_iperf_stop(new_measurement.dest_probe, str(new_measurement._id))
+            return "Error", "Can't start! Error while inserting measurement iperf in mongo", "MongoDB Down?"
 
-        json_iperf_start = {
-            "handler": "iperf",
-            "command": "start",
-            "payload": {
-                "msm_id": str(new_measurement._id)
-            }
-        }
-        self.mqtt.publish_on_command_topic(probe_id = new_measurement.source_probe, complete_command = json.dumps(json_iperf_start))
+        if measurement_timings is not None:
+            measurement_timings.start_phase(MEASUREMENT_PHASE)
         return "OK", new_measurement.to_dict(), None # By returning these arguments, it's possible to see them in the HTTP response
 
-    def send_probe_iperf_conf(self, probe_id, json_config):
+    def send_probe_iperf_prepare(self, probe_id, json_config):
         """
-        Send a configuration command to a probe for iperf setup.
+        Send the combined prepare command to a probe: its whole iperf configuration (role included) in one message.
         Args:
-            probe_id (str): The probe to configure.
-            json_config (dict): The configuration payload.
+            probe_id (str): The probe to prepare.
+            json_config (dict): The configuration payload (for the Client, start_at included).
         """
         json_command = {
             "handler": 'iperf',
-            "command": "conf",
+            "command": PREPARE_COMMAND,
             "payload": json_config
         }        
         self.mqtt.publish_on_command_topic(probe_id = probe_id, complete_command=json.dumps(json_command))
@@ -257,6 +267,24 @@ class Iperf_Coordinator:
         else:
             return sys.getsizeof(obj)
 
+    def store_intervals_result(self, probe_sender, result : json):
+        """
+        Store a batch of interval samples of a running iperf repetition in MongoDB.
+        Args:
+            probe_sender (str): The probe sending the batch.
+            result (json): The result message payload, with the "intervals" list.
+        """
+        mongo_result = IperfIntervalsResultModelMongo(
+            msm_id = ObjectId(result["msm_id"]),
+            repetition_number = result["repetition_number"],
+            start_timestamp = result["start_timestamp"],
+            transport_protocol = result["transport_protocol"],
+            intervals = result["intervals"]
+        )
+        result_id = self.mongo_db.insert_result(result = mongo_result)
+        if result_id is None:
+            print(f"Iperf_Coordinator: error while storing the intervals of |{probe_sender}|, measurement -> {result['msm_id']}")
+
     def store_measurement_result(self, probe_sender, result : json):
         """
         Store the result of an iperf measurement in MongoDB and update measurement state.
@@ -269,6 +297,9 @@ class Iperf_Coordinator:
         if msm_id is None:
             print(f"Iperf_Coordinator: received result from probe |{probe_sender}| -> No measure_id provided. IGNORE.")
             return
+        if "intervals" in result: # A batch of interval samples (stream_intervals): the repetition is still running
+            self.store_intervals_result(probe_sender, result)
+            return
         full_result_c_b64 = result["full_result_c_b64"] if ("full_result_c_b64" in result) else None # Full Result Compressed and 64Based
         if full_result_c_b64 is not None:
             c_full_result = base64.b64decode(full_result_c_b64)
@@ -289,7 +320,10 @@ class Iperf_Coordinator:
             bytes_received = result["bytes_received"],
             duration = result["duration"],
             avg_speed = result["avg_speed"] / 10**6, # Speed in Mbps
-            full_result = full_result
+            full_result = full_result,
+            process_usage = result.get("process_usage"),
+            capacity_search = result.get("capacity_search"),
+            precision = result.get("precision")
         )
 
         #size_1 = self.get_size(full_result)
@@ -313,7 +347,10 @@ class Iperf_Coordinator:
                 print(f"Iperf_Coordinator: updated document linking in measure: |{measurement_id}|")
             if self.mongo_db.set_measurement_as_completed(measurement_id):
                 print(f"Iperf_Coordinator: measurement |{measurement_id}| completed ")
-            self.send_probe_iperf_stop(self.queued_measurements[measurement_id].dest_probe, measurement_id)
+            if self.uses_warm_server(measurement_id): # The warm iperf3 server is not stopped, but relaunched for the next measurement
+                self.send_warm_server_recycle(self.queued_measurements[measurement_id])
+            else:
+                self.send_probe_iperf_stop(self.queued_measurements[measurement_id].dest_probe, measurement_id)
 #        else:
 #            print("Iperf_Coordinator: result not last")
 
@@ -363,6 +400,13 @@ class Iperf_Coordinator:
                     json_overrided_config['repetitions'] = measurement_parameters['repetitions']
                 if ('save_result_on_flash' in measurement_parameters):
                     json_overrided_config['save_result_on_flash'] = measurement_parameters['save_result_on_flash']
+                if ('stream_intervals' in measurement_parameters):
+                    json_overrided_config['stream_intervals'] = measurement_parameters['stream_intervals']
+                if ('interval_batch_size' in measurement_parameters):
+                    json_overrided_config['interval_batch_size'] = measurement_parameters['interval_batch_size']
+                for mode_key in (CAPACITY_SEARCH_KEYS + ADAPTIVE_DURATION_KEYS): # capacity_search, adaptive_duration and their settings
+                    if mode_key in measurement_parameters:
+                        json_overrided_config[mode_key] = measurement_parameters[mode_key]
             elif role == "Server":
                 if 'listen_port' in measurement_parameters:
                     json_overrided_config['listen_port'] = measurement_parameters['listen_port']
@@ -382,6 +426,7 @@ class Iperf_Coordinator:
         """
         new_measurement.assign_id()
         measurement_id = str(new_measurement._id)
+        measurement_timings = self.timings_tracker.start(measurement_id, "iperf")
 
         if new_measurement.source_probe is None:
             return "Error", f"No source probe id provided", "Missing source_probe parameter"
@@ -389,71 +434,79 @@ class Iperf_Coordinator:
         if new_measurement.dest_probe is None:
             return "Error", f"No destination probe id provided", "Missing dest_probe parameter"
 
-        source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
+        requested_start_at = new_measurement.parameters.get(START_AT_KEY) if isinstance(new_measurement.parameters, dict) else None
+        start_at_check = check_requested_start_at(requested_start_at)
+        if start_at_check != "OK":
+            return "Error", start_at_check, "Wrong start_at"
+
+        with measurement_timings.phase("ip_resolution"):
+            source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
         if source_probe_ip is None:
             return "Error", f"No response from client probe: {new_measurement.source_probe}", "Reponse Timeout"
 
-        dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe)
+        with measurement_timings.phase("ip_resolution"):
+            dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe)
         if dest_probe_ip is None:
             return "Error", f"No response from client probe: {new_measurement.dest_probe}", "Reponse Timeout"
 
         new_measurement.source_probe_ip = source_probe_ip
         new_measurement.dest_probe_ip = dest_probe_ip
-
-        self.events_received_server_ack[measurement_id] = [threading.Event(), None]
-        self.queued_measurements[str(new_measurement._id)] = new_measurement
+        self.queued_measurements[measurement_id] = new_measurement
 
         json_server_config = self.get_default_iperf_parameters(role="Server")
         json_server_config = self.override_default_parameters(json_server_config, new_measurement.parameters, role="Server")
         json_server_config["msm_id"] = measurement_id
-
-        
-        self.send_probe_iperf_conf(probe_id = new_measurement.dest_probe, json_config = json_server_config) # Sending server configuration
-        print("preparer iperf: sent conf server")
-        self.events_received_server_ack[measurement_id][0].wait(timeout = 5) # Wait for the ACK server
-        
-        # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK FROM DEST_PROBE (IPERF-SERVER)
-
-        server_event_message = self.events_received_server_ack[measurement_id][1]
-        if server_event_message == "OK": # If the iperf-server configuration went good, then...
-            print("preparer iperf: awake from server ACK ")
-            
-            json_client_config = self.get_default_iperf_parameters(role="Client")
-            json_client_config = self.override_default_parameters(json_client_config, new_measurement.parameters, role = "Client")
-
-            # -----------------------------------------------------------------------------------------
-            parameters_to_store_in_measurement = json_client_config.copy()
-            parameters_to_store_in_measurement['listen_port'] = json_server_config['listen_port']
-            new_measurement.parameters = parameters_to_store_in_measurement
-            # This line above ensures that all parameters are included in the measurement object,
-            # even those that are not explicitly specified in measurement-subscription phase.
-
-            json_client_config['msm_id'] = measurement_id
-            json_client_config['destination_server_ip'] = dest_probe_ip
-            json_client_config['destination_server_port'] = self.probes_server_port[new_measurement.dest_probe]
-            # The upper line code is a mechanism to automatic set the client port equal to the chosen server port.
-
-            self.send_probe_iperf_conf(probe_id = new_measurement.source_probe, json_config = json_client_config) # Sending client configuration
-            self.events_received_client_ack[measurement_id] = [threading.Event(), None]
-            self.events_received_client_ack[measurement_id][0].wait(timeout = 5)
-            
-            # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK FROM SOURCE_PROBE (IPERF-CLIENT)
-
-            client_event_message = self.events_received_client_ack[measurement_id][1]
-            if client_event_message == "OK":
-                return self.send_probe_iperf_start(new_measurement)
-            
-            self.send_probe_iperf_stop(new_measurement.dest_probe, measurement_id)
-            if client_event_message is not None:
-                return "Error", f"Probe |{new_measurement.source_probe}| says: {client_event_message}", "State BUSY"
-            else:
-                return "Error", f"No response from client probe: {new_measurement.source_probe}", "Reponse Timeout"
-        elif server_event_message is not None:
-            print(f"Preparer iperf: awaked from server conf NACK -> {server_event_message}")
-            return "Error", f"Probe |{new_measurement.dest_probe}| says: {server_event_message}", "State BUSY"
-        else:
-            print(f"Preparer iperf: No response from server probe -> |{new_measurement.dest_probe}")
-            return "Error", f"No response from Probe: {new_measurement.dest_probe}" , "Response Timeout"
+        # Without an explicit listen_port, a free warm iperf3 server of the dest probe skips its configuration
+        warm_port = None
+        if (not isinstance(new_measurement.parameters, dict)) or ('listen_port' not in new_measurement.parameters):
+            warm_port = self.warm_servers.lease(measurement_id, new_measurement.dest_probe, "iperf", new_measurement.parameters)
+        if warm_port is not None:
+            json_server_config['listen_port'] = warm_port
+
+        json_client_config = self.get_default_iperf_parameters(role="Client")
+        json_client_config = self.override_default_parameters(json_client_config, new_measurement.parameters, role = "Client")
+
+        # -----------------------------------------------------------------------------------------
+        parameters_to_store_in_measurement = json_client_config.copy()
+        parameters_to_store_in_measurement['listen_port'] = json_server_config['listen_port']
+        parameters_to_store_in_measurement[WARM_SERVER_KEY] = (warm_port is not None)
+        # The client runs the first repetition at start_at: the measurement stores it with its parameters
+        parameters_to_store_in_measurement[START_AT_KEY] = schedule_start_at(requested_start_at)
+        new_measurement.parameters = parameters_to_store_in_measurement
+        # This line above ensures that all parameters are included in the measurement object,
+        # even those that are not explicitly specified in measurement-subscription phase.
+
+        json_client_config['msm_id'] = measurement_id
+        json_client_config['destination_server_ip'] = dest_probe_ip
+        json_client_config['destination_server_port'] = json_server_config['listen_port']
+        json_client_config[START_AT_KEY] = parameters_to_store_in_measurement[START_AT_KEY]
+        # The client is configured together with the server, so its port is the configured listen port.
+
+        # One parallel round trip: the server launches iperf3 -s, the client is armed for start_at.
+        # With a warm server, only the client is prepared.
+        prepared_probes = (new_measurement.source_probe,) if (warm_port is not None) else (new_measurement.dest_probe, new_measurement.source_probe)
+        prepare_round = PrepareRound(prepared_probes, handler = "iperf",
+                                     roles = {new_measurement.dest_probe: "Server", new_measurement.source_probe: "Client"})
+        self.prepare_rounds[measurement_id] = prepare_round
+        with measurement_timings.phase("prepare_ack_wait"):
+            if warm_port is None:
+                self.send_probe_iperf_prepare(probe_id = new_measurement.dest_probe, json_config = json_server_config)
+            self.send_probe_iperf_prepare(probe_id = new_measurement.source_probe, json_config = json_client_config)
+            print(f"preparer iperf: sent prepare to {'client, warm server port ' + str(warm_port) if (warm_port is not None) else 'server and client'}")
+            failed_probe, failure_reason = prepare_round.wait()
+        self.prepare_rounds.pop(measurement_id, None)
+
+        if failed_probe is None:
+            print("preparer iperf: awake from server and client ACK")
+            return self.store_prepared_measurement(new_measurement)
+
+        for probe_to_clean_up in prepare_round.probes_to_clean_up():
+            self.send_probe_iperf_stop(probe_to_clean_up, measurement_id)
+        if failure_reason is not None:
+            print(f"Preparer iperf: awaked from prepare NACK of |{failed_probe}| -> {failure_reason}")
+            return "Error", f"Probe |{failed_probe}| says: {failure_reason}", "State BUSY"
+        print(f"Preparer iperf: No response from probe -> |{failed_probe}")
+        return "Error", f"No response from Probe: {failed_probe}" , "Response Timeout"
 
     def iperf_measurement_stopper(self, msm_id_to_stop : str):
         """
@@ -471,20 +524,34 @@ class Iperf_Coordinator:
             self.queued_measurements[msm_id_to_stop] = measure_from_db
         
         measurement_to_stop : MeasurementModelMongo = self.queued_measurements[msm_id_to_stop]
+        # A warm server is not configured for the measurement: the client is stopped, and the server is recycled
+        probe_to_stop = measurement_to_stop.source_probe if self.uses_warm_server(msm_id_to_stop) else measurement_to_stop.dest_probe
+        if self.uses_warm_server(msm_id_to_stop):
+            self.send_warm_server_recycle(measurement_to_stop)
         self.events_stop_server_ack[msm_id_to_stop] = [threading.Event(), None]
-        self.send_probe_iperf_stop(probe_id=measurement_to_stop.dest_probe, msm_id=msm_id_to_stop)
-        self.events_stop_server_ack[msm_id_to_stop][0].wait(5)
+        self.send_probe_iperf_stop(probe_id=probe_to_stop, msm_id=msm_id_to_stop)
+        self.ack_timeouts.wait_for_ack(self.events_stop_server_ack[msm_id_to_stop][0], probe_to_stop, "iperf", "stop", default_timeout = 5)
         # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK OF STOP COMMAND FROM DEST PROBE (IPERF-SERVER)
         stop_event_message = self.events_stop_server_ack[msm_id_to_stop][1]
         if stop_event_message == "OK":
             return "OK", f"Measurement {msm_id_to_stop} stopped.", None
         if stop_event_message is not None:
-            return "Error", f"Probe |{measurement_to_stop.dest_probe}| says: |{stop_event_message}|", ""
-        return "Error", f"Can't stop the measurement -> |{msm_id_to_stop}|", f"No response from probe server |{measurement_to_stop.dest_probe}|"
+            return "Error", f"Probe |{probe_to_stop}| says: |{stop_event_message}|", ""
+        return "Error", f"Can't stop the measurement -> |{msm_id_to_stop}|", f"No response from probe |{probe_to_stop}|"
         
         
         
     
+    def uses_warm_server(self, msm_id) -> bool:
+        """
+        Returns True if the measurement runs against a warm iperf3 server of its dest probe.
+        """
+        measurement = self.queued_measurements.get(msm_id)
+        return (measurement is not None) and isinstance(measurement.parameters, dict) and bool(measurement.parameters.get(WARM_SERVER_KEY))
+
+    def send_warm_server_recycle(self, measurement : MeasurementModelMongo):
+        self.warm_servers.send_recycle(self.mqtt, measurement.dest_probe, "iperf", measurement.parameters['listen_port'], str(measurement._id))
+
     # NOT USED BUT USEFULL FOR TESTING
     def print_summary_result(self, measurement_result : json):
         """
@@ -0,0 +1,325 @@
+"""
+matrix_coordinator.py
+
+This module defines the Matrix_Coordinator class, which runs the "matrix" measurements: a ping or iperf measurement
+between all the pairs of a set of probes (full mesh). The pairs are scheduled as a round-robin tournament (circle
+method), so that each probe is in at most one pair per round: the pairs of a round run in parallel, and N probes need
+N-1 rounds per direction instead of N*(N-1) serial measurements. The per-pair results are summarized in a single
+matrix result document, linked to the matrix measurement.
+"""
+
+import os
+import time
+import threading
+from pathlib import Path
+from bson import ObjectId
+from modules.configLoader.config_loader import ConfigLoader, MATRIX_KEY
+from modules.mongoModule.mongoDB import MongoDB, COMPLETED_STATE, FAILED_STATE
+from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+from modules.mongoModule.models.matrix_result_model_mongo import MatrixResultModelMongo
+
+MATRIX_INNER_TYPES = ("ping", "iperf")
+STOP_WAIT_SECONDS = 10  # Max wait for the stopped pair measurements to be closed on MongoDB
+# Fields of the pair results reported in the matrix, by inner type. The iperf ones are averaged over the repetitions
+SUMMARY_FIELDS = {
+    "ping": ("rtt_avg", "rtt_min", "rtt_max", "rtt_mdev", "packets_loss_rate"),
+    "iperf": ("avg_speed", "bytes_received", "duration")
+}
+
+
+def round_robin_rounds(probes : list, directed = True) -> list:
+    """
+    Schedules all the pairs of probes in rounds where each probe appears at most once (circle method).
+    Args:
+        probes (list): The probe ids.
+        directed (bool): If True, each pair is measured in both directions: the second half of the rounds
+            repeats the first one with source and destination swapped.
+    Returns:
+        list[list[tuple]]: The rounds, each one a list of (source_probe, dest_probe).
+    """
+    players = list(probes) + ([None] if (len(probes) % 2) else []) # None is the bye of the odd rounds
+    size = len(players)
+    rounds = []
+    for round_index in range(size - 1):
+        pairs = []
+        for index in range(size // 2):
+            first, second = players[index], players[size - 1 - index]
+            if (first is None) or (second is None):
+                continue
+            # Alternating the orientation balances the source role across the probes in the undirected case
+            pairs.append((first, second) if ((round_index + index) % 2 == 0) else (second, first))
+        rounds.append(pairs)
+        players = [players[0], players[-1]] + players[1:-1] # Rotation around the first player
+    if directed:
+        rounds += [[(dest, source) for source, dest in pairs] for pairs in rounds]
+    return rounds
+
+
+class Matrix_Coordinator:
+    """
+    Coordinates the matrix measurements. The pair measurements are started through measure_preparer_callback
+    (CommandsMultiplexer.prepare_probes_to_measure), bypassing the admission queue: the matrix measurement already
+    holds all its probes there, until it is completed.
+    """
+
+    def __init__(self, registration_measure_preparer_callback, registration_measurement_stopper_callback,
+                 measure_preparer_callback, measurement_stopper_callback, mongo_db : MongoDB):
+        """
+        Initialize the Matrix_Coordinator and register its preparer and stopper.
+        Args:
+            registration_measure_preparer_callback (callable): Callback to register measurement preparer.
+            registration_measurement_stopper_callback (callable): Callback to register measurement stopper.
+            measure_preparer_callback (callable): Triad preparer of the pair measurements, of any type.
+            measurement_stopper_callback (callable): Triad stopper of the pair measurements, by msm_id.
+            mongo_db (MongoDB): MongoDB interface for storing measurements and results.
+        """
+        self.mongo_db = mongo_db
+        self.prepare_pair_measurement = measure_preparer_callback
+        self.stop_pair_measurement = measurement_stopper_callback
+        self.lock = threading.Lock()
+        self.stop_events = {}           # Maps the msm_id of the running matrices to their stop Event
+        self.pair_events = {}           # Maps the msm_id of the running pair measurements to the Event set when they end
+        self.running_pairs = {}         # Maps the msm_id of the running matrices to the msm_ids of their running pairs
+        self.mongo_db.add_state_change_listener(self.measurement_state_changed)
+
+        registration_response = registration_measure_preparer_callback(
+            interested_measurement_type = "matrix",
+            preparer_callback = self.probes_preparer_to_measurements)
+        if registration_response == "OK" :
+            print(f"Matrix_Coordinator: registered prepaper for measurements type -> matrix")
+        else:
+            print(f"Matrix_Coordinator: registration preparer failed. Reason -> {registration_response}")
+
+        registration_response = registration_measurement_stopper_callback(
+            interested_measurement_type = "matrix",
+            stopper_method_callback = self.matrix_measurement_stopper)
+        if registration_response == "OK" :
+            print(f"Matrix_Coordinator: registered measurement stopper for measurements type -> matrix")
+        else:
+            print(f"Matrix_Coordinator: registration measurement stopper failed. Reason -> {registration_response}")
+
+
+    def probes_preparer_to_measurements(self, new_measurement : MeasurementModelMongo):
+        """
+        Validates the matrix, stores it as started and runs its rounds in a background thread.
+        Args:
+            new_measurement (MeasurementModelMongo): The matrix measurement. Its parameters list the probes
+                (source_probe is added if missing), the inner type and the inner parameters.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        matrix_parameters = self.override_default_parameters(self.get_default_matrix_parameters(), new_measurement.parameters)
+        probes = list(dict.fromkeys([new_measurement.source_probe] + list(matrix_parameters.get("probes") or [])))
+        if len(probes) < 2:
+            return "Error", "A matrix needs at least two probes", "Missing probes"
+        if matrix_parameters["inner_type"] not in MATRIX_INNER_TYPES:
+            return "Error", f"Matrix inner type must be one of {list(MATRIX_INNER_TYPES)}", "Wrong inner type"
+        matrix_parameters["probes"] = probes
+        new_measurement.parameters = matrix_parameters
+        new_measurement.dest_probe = None
+
+        new_measurement.assign_id()
+        measurement_id = str(new_measurement._id)
+        if self.mongo_db.insert_measurement(measure = new_measurement) is None:
+            return "Error", "Can't start the matrix! Error while inserting measurement matrix in mongo", "MongoDB Down?"
+        rounds = round_robin_rounds(probes, matrix_parameters["directed"])
+        with self.lock:
+            self.stop_events[measurement_id] = threading.Event()
+            self.running_pairs[measurement_id] = set()
+        matrix_thread = threading.Thread(target = self.run_matrix, args = (new_measurement, rounds), daemon = True)
+        matrix_thread.start()
+        print(f"Matrix_Coordinator: matrix |{measurement_id}| of {len(probes)} probes started, {len(rounds)} rounds")
+        return "OK", new_measurement.to_dict(), None
+
+
+    def run_matrix(self, matrix_measurement : MeasurementModelMongo, rounds : list):
+        """
+        Runs the rounds one after the other, the pairs of each round in parallel, then stores the matrix result.
+        """
+        measurement_id = str(matrix_measurement._id)
+        matrix_parameters = matrix_measurement.parameters
+        stop_event = self.stop_events[measurement_id]
+        pair_outcomes = []  # (round_index, source_probe, dest_probe, msm_id, state, error)
+        for round_index, pairs in enumerate(rounds):
+            if stop_event.is_set():
+                break
+            round_start = time.monotonic()
+            pair_outcomes += self.run_round(measurement_id, round_index, pairs, matrix_parameters)
+            print(f"Matrix_Coordinator: matrix |{measurement_id}| round {round_index + 1}/{len(rounds)} "
+                  f"({len(pairs)} pairs) ended in {time.monotonic() - round_start:.1f}s")
+        self.store_matrix_result(matrix_measurement, rounds, pair_outcomes, complete = not stop_event.is_set())
+        with self.lock:
+            self.stop_events.pop(measurement_id, None)
+            self.running_pairs.pop(measurement_id, None)
+
+
+    def run_round(self, measurement_id, round_index, pairs, matrix_parameters) -> list:
+        """
+        Starts the pair measurements of a round in parallel, and waits until all of them are completed or failed
+        (at most round_timeout seconds: the late ones are stopped).
+        """
+        started = {}        # Maps (source, dest) to the preparer triad
+        preparer_threads = []
+        def prepare_pair(source_probe, dest_probe):
+            pair_measurement = MeasurementModelMongo(
+                description = f"Matrix {measurement_id}, round {round_index + 1}: {source_probe} -> {dest_probe}",
+                type = matrix_parameters["inner_type"], source_probe = source_probe, dest_probe = dest_probe,
+                source_probe_ip = None, dest_probe_ip = None, parameters = dict(matrix_parameters.get("inner_parameters") or {}))
+            try:
+                started[(source_probe, dest_probe)] = self.prepare_pair_measurement(pair_measurement)
+            except Exception as e:
+                started[(source_probe, dest_probe)] = ("Error", f"Exception while preparing the pair -> {e}", "Coordinator error")
+        for source_probe, dest_probe in pairs:
+            preparer_thread = threading.Thread(target = prepare_pair, args = (source_probe, dest_probe), daemon = True)
+            preparer_thread.start()
+            preparer_threads.append(preparer_thread)
+        for preparer_thread in preparer_threads:
+            preparer_thread.join()
+
+        pair_events = {}
+        outcomes = []
+        for (source_probe, dest_probe), (success_message, info, error_cause) in started.items():
+            if success_message != "OK":
+                outcomes.append((round_index, source_probe, dest_probe, None, FAILED_STATE, f"{info} ({error_cause})"))
+                continue
+            pair_msm_id = str(info["_id"])
+            with self.lock:
+                pair_events[(source_probe, dest_probe)] = self.pair_events.setdefault(pair_msm_id, threading.Event())
+                self.running_pairs[measurement_id].add(pair_msm_id)
+            self.measurement_state_changed(pair_msm_id) # It may have ended before the registration
+
+        deadline = time.monotonic() + matrix_parameters["round_timeout"]
+        for (source_probe, dest_probe), pair_event in pair_events.items():
+            pair_msm_id = str(started[(source_probe, dest_probe)][1]["_id"])
+            if not pair_event.wait(timeout = max(deadline - time.monotonic(), 0)):
+                print(f"Matrix_Coordinator: pair |{pair_msm_id}| ({source_probe} -> {dest_probe}) still running at the round timeout, stopping it")
+                self.stop_pair_measurement(pair_msm_id)
+                pair_event.wait(timeout = STOP_WAIT_SECONDS)
+            with self.lock:
+                self.pair_events.pop(pair_msm_id, None)
+                self.running_pairs[measurement_id].discard(pair_msm_id)
+            state = self.mongo_db.get_measurement_state(pair_msm_id)
+            outcomes.append((round_index, source_probe, dest_probe, pair_msm_id, state,
+                             None if (state == COMPLETED_STATE) else "Round timeout or stopped"))
+        return outcomes
+
+
+    def measurement_state_changed(self, msm_id):
+        """
+        MongoDB state change listener: wakes up the rounds waiting for the pair measurements that ended.
+        """
+        with self.lock:
+            msm_ids = list(self.pair_events) if (msm_id is None) else ([msm_id] if msm_id in self.pair_events else [])
+        for pair_msm_id in msm_ids:
+            if self.mongo_db.get_measurement_state(pair_msm_id) in (COMPLETED_STATE, FAILED_STATE):
+                with self.lock:
+                    pair_event = self.pair_events.get(pair_msm_id)
+                if pair_event is not None:
+                    pair_event.set()
+
+
+    def summarize_pair(self, inner_type, pair_msm_id) -> dict:
+        """
+        Extracts the SUMMARY_FIELDS of the results of a pair measurement (averaged over the iperf repetitions).
+        """
+        results = self.mongo_db.find_all_results_by_measurement_id(pair_msm_id)
+        if (not isinstance(results, list)) or (not results):
+            return {}
+        summary = {}
+        for field in SUMMARY_FIELDS[inner_type]:
+            values = [result[field] for result in results if isinstance(result.get(field), (int, float))]
+            if values:
+                summary[field] = sum(values) / len(values)
+        return summary
+
+
+    def store_matrix_result(self, matrix_measurement : MeasurementModelMongo, rounds, pair_outcomes, complete):
+        measurement_id = str(matrix_measurement._id)
+        matrix_parameters = matrix_measurement.parameters
+        inner_type = matrix_parameters["inner_type"]
+        probes = matrix_parameters["probes"]
+        cells = []
+        for round_index, source_probe, dest_probe, pair_msm_id, state, error in pair_outcomes:
+            summary = self.summarize_pair(inner_type, pair_msm_id) if (state == COMPLETED_STATE) else {}
+            cells.append({"source_probe": source_probe, "dest_probe": dest_probe, "round": round_index,
+                          "msm_id": pair_msm_id, "state": state, "error": error, "summary": summary})
+        # One N x N matrix per summary field, rows are sources and columns destinations, in the probes order
+        index_of = {probe_id: index for index, probe_id in enumerate(probes)}
+        matrices = {field: [[None] * len(probes) for _ in probes] for field in SUMMARY_FIELDS[inner_type]}
+        for cell in cells:
+            for field, value in cell["summary"].items():
+                matrices[field][index_of[cell["source_probe"]]][index_of[cell["dest_probe"]]] = value
+
+        matrix_result = MatrixResultModelMongo(
+            msm_id = ObjectId(measurement_id),
+            timestamp = time.time(),
+            inner_type = inner_type,
+            probes = probes,
+            directed = matrix_parameters["directed"],
+            rounds = [[[source_probe, dest_probe] for source_probe, dest_probe in pairs] for pairs in rounds],
+            cells = cells,
+            matrices = matrices,
+            complete = complete)
+        result_id = self.mongo_db.insert_result(result = matrix_result)
+        if result_id is not None:
+            print(f"Matrix_Coordinator: matrix result |{result_id}| stored in db")
+            if self.mongo_db.update_results_array_in_measurement(measurement_id):
+                if self.mongo_db.set_measurement_as_completed(measurement_id):
+                    completed_pairs = sum(1 for cell in cells if cell["state"] == COMPLETED_STATE)
+                    print(f"Matrix_Coordinator: matrix |{measurement_id}| completed, {completed_pairs}/{len(cells)} pairs measured")
+                    return True
+        print(f"Matrix_Coordinator: error while storing the result of the matrix |{measurement_id}|")
+        self.mongo_db.set_measurement_as_failed_by_id(measurement_id)
+        return False
+
+
+    def matrix_measurement_stopper(self, msm_id_to_stop : str):
+        """
+        Stops a running matrix: the next rounds are cancelled, the running pairs stopped, and the partial matrix stored.
+        Args:
+            msm_id_to_stop (str): The measurement ID to stop.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        with self.lock:
+            stop_event = self.stop_events.get(msm_id_to_stop)
+            running_pairs = list(self.running_pairs.get(msm_id_to_stop, ()))
+        if stop_event is None:
+            return "Error", f"Unknown matrix measurement |{msm_id_to_stop}|", "May be not started"
+        stop_event.set()
+        for pair_msm_id in running_pairs:
+            success_message, info, error_cause = self.stop_pair_measurement(pair_msm_id)
+            if success_message != "OK":
+                print(f"Matrix_Coordinator: can't stop the pair |{pair_msm_id}| -> {info} ({error_cause})")
+        return "OK", f"Matrix {msm_id_to_stop} stopped: the partial matrix will be stored.", None
+
+
+    def get_default_matrix_parameters(self) -> dict:
+        """
+        Load the default matrix parameters from configuration files.
+        Returns:
+            dict: The default configuration for matrix measurements.
+        """
+        base_path = os.path.join(Path(__file__).parent)
+        cl = ConfigLoader(base_path= base_path, file_name = "default_parameters.yaml", KEY = MATRIX_KEY)
+        json_default_config = cl.config if (cl.config is not None) else {}
+        return json_default_config
+
+    def override_default_parameters(self, json_config, measurement_parameters):
+        """
+        Override the default matrix parameters with those specified in the measurement parameters.
+        Args:
+            json_config (dict): The default configuration.
+            measurement_parameters (dict): The parameters to override.
+        Returns:
+            dict: The overridden configuration.
+        """
+        json_overrided_config = json_config
+        json_overrided_config.setdefault("inner_type", "ping")
+        json_overrided_config.setdefault("directed", True)
+        json_overrided_config.setdefault("round_timeout", 120)
+        if (measurement_parameters is not None) and (isinstance(measurement_parameters, dict)):
+            for parameter in ("probes", "inner_type", "inner_parameters", "directed", "round_timeout"):
+                if parameter in measurement_parameters:
+                    json_overrided_config[parameter] = measurement_parameters[parameter]
+        return json_overrided_config
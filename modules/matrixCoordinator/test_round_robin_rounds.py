@@ -0,0 +1,57 @@
+"""
+Unit tests of the round-robin schedule of the matrix pairs.
+Run from the repository root: python -m unittest modules.matrixCoordinator.test_round_robin_rounds
+"""
+
+import unittest
+from itertools import permutations, combinations
+from modules.matrixCoordinator.matrix_coordinator import round_robin_rounds
+
+
+class TestRoundRobinRounds(unittest.TestCase):
+
+    def assert_each_probe_once_per_round(self, rounds):
+        for pairs in rounds:
+            probes = [probe for pair in pairs for probe in pair]
+            self.assertEqual(len(probes), len(set(probes)), f"A probe is in two pairs of the round {pairs}")
+
+    def test_directed_covers_every_ordered_pair_once(self):
+        for probes_number in range(2, 9):
+            probes = [f"p{index}" for index in range(probes_number)]
+            rounds = round_robin_rounds(probes)
+            self.assertEqual(len(rounds), 2 * (probes_number - 1 + (probes_number % 2)))
+            self.assert_each_probe_once_per_round(rounds)
+            pairs = [pair for round_pairs in rounds for pair in round_pairs]
+            self.assertEqual(sorted(pairs), sorted(permutations(probes, 2)))
+
+    def test_undirected_covers_every_pair_once(self):
+        for probes_number in range(2, 9):
+            probes = [f"p{index}" for index in range(probes_number)]
+            rounds = round_robin_rounds(probes, directed = False)
+            self.assert_each_probe_once_per_round(rounds)
+            pairs = [tuple(sorted(pair)) for round_pairs in rounds for pair in round_pairs]
+            self.assertEqual(sorted(pairs), sorted(combinations(probes, 2)))
+
+    def test_even_mesh_rounds_are_full(self):
+        rounds = round_robin_rounds(["a", "b", "c", "d"], directed = False)
+        self.assertEqual(len(rounds), 3)
+        self.assertTrue(all(len(pairs) == 2 for pairs in rounds))
+
+    def test_odd_mesh_has_a_bye_per_round(self):
+        rounds = round_robin_rounds(["a", "b", "c"], directed = False)
+        self.assertEqual(len(rounds), 3)
+        self.assertTrue(all(len(pairs) == 1 for pairs in rounds))
+
+    def test_second_half_swaps_the_directions(self):
+        rounds = round_robin_rounds(["a", "b", "c", "d"])
+        half = len(rounds) // 2
+        for first_half_pairs, second_half_pairs in zip(rounds[:half], rounds[half:]):
+            self.assertEqual(second_half_pairs, [(dest, source) for source, dest in first_half_pairs])
+
+    def test_fewer_than_two_probes(self):
+        self.assertEqual(round_robin_rounds([]), [])
+        self.assertEqual([pair for pairs in round_robin_rounds(["a"]) for pair in pairs], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
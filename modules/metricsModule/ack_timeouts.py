@@ -0,0 +1,164 @@
+"""
+ack_timeouts.py
+
+This module provides AckTimeouts, the estimator of the time to wait for the ACK/NACK of a probe command.
+Each ACK is split in two parts, using the probe timestamps when they are present (see probe_processing_of):
+    - the network round trip, smoothed per probe as TCP does (RFC 6298): SRTT, RTTVAR;
+    - the probe processing time, smoothed per (handler, command, role), since some commands are slow on every probe
+      (e.g. enable_ntp_service runs systemctl, the coex client prepares a trace replay), and a combined command can be
+      much slower for a role (e.g. the AoI prepare: the client syncs its clock, the server just binds a socket).
+The timeout of a command is SRTT + max(G, K * RTTVAR) of its probe, plus the processing estimate of the command
+(mean + K * variation), at least MIN_ACK_TIMEOUT_SECONDS and at most MAX_ACK_TIMEOUT_SECONDS. Until both the estimates exist,
+the default timeout of the caller (the former fixed one) is used. A missed ACK doubles the timeouts of its probe
+(exponential backoff), until a new sample arrives.
+"""
+
+import threading
+from modules.metricsModule.metrics_registry import MetricsRegistry, ACK_SRTT_SECONDS, ACK_RTTVAR_SECONDS, ACK_TIMEOUT_BACKOFF, \
+    COMMAND_PROCESSING_SECONDS
+
+RTT_ALPHA = 1 / 8           # Gain of SRTT (RFC 6298)
+RTT_BETA = 1 / 4            # Gain of RTTVAR (RFC 6298)
+RTTVAR_FACTOR = 4           # K
+CLOCK_GRANULARITY_SECONDS = 0.1 # G: floor of the variation term, it absorbs the MQTT broker and handler jitter
+MIN_ACK_TIMEOUT_SECONDS = 1.0
+MAX_ACK_TIMEOUT_SECONDS = 120.0
+MAX_BACKOFF = 8
+
+
+def probe_processing_of(probe_timestamps):
+    """
+    Returns the seconds the probe took between the reception of a command and its ACK/NACK, or None if not reported.
+    The "processing" duration of the probe monotonic clock is preferred: the difference of its "received" and "ack"
+    wall-clock timestamps (older firmwares) is wrong if the clock is stepped meanwhile (e.g. by ntpdate).
+    """
+    if not isinstance(probe_timestamps, dict):
+        return None
+    if probe_timestamps.get("processing") is not None:
+        return probe_timestamps["processing"]
+    if ("received" in probe_timestamps) and ("ack" in probe_timestamps):
+        return probe_timestamps["ack"] - probe_timestamps["received"]
+    return None
+
+
+class SmoothedEstimate:
+    """
+    Exponentially smoothed mean and mean deviation of a series of samples (the SRTT/RTTVAR pair).
+    """
+    def __init__(self, first_sample : float):
+        self.mean = first_sample
+        self.variation = first_sample / 2
+        self.samples = 1
+
+    def add(self, sample : float):
+        self.variation = (1 - RTT_BETA) * self.variation + RTT_BETA * abs(self.mean - sample)
+        self.mean = (1 - RTT_ALPHA) * self.mean + RTT_ALPHA * sample
+        self.samples += 1
+
+
+class AckTimeouts:
+    """
+    Thread-safe, process-wide estimator of the ACK timeouts. Use AckTimeouts.get_instance() to obtain it.
+    It is fed by the CommandsMultiplexer with every command/ACK pair.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.network_rtt = {}       # Maps probe_id to its SmoothedEstimate of the network round trip
+        self.processing = {}        # Maps (handler, command, role) to the SmoothedEstimate of the probe processing time (role None: no role)
+        self.backoff = {}           # Maps probe_id to the multiplier of its timeouts (doubled on each missed ACK)
+        metrics = MetricsRegistry.get_instance()
+        metrics.register_gauge_callback(ACK_SRTT_SECONDS, lambda: self.probes_gauge(lambda estimate: estimate.mean))
+        metrics.register_gauge_callback(ACK_RTTVAR_SECONDS, lambda: self.probes_gauge(lambda estimate: estimate.variation))
+        metrics.register_gauge_callback(ACK_TIMEOUT_BACKOFF, self.backoff_gauge)
+        metrics.register_gauge_callback(COMMAND_PROCESSING_SECONDS, self.processing_gauge)
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = AckTimeouts()
+            return cls._instance
+
+    def add_sample(self, probe_id, handler, command, rtt, probe_timestamps = None, role = None):
+        """
+        Records a command/ACK pair.
+        Args:
+            probe_id (str): The probe that sent the ACK/NACK.
+            handler (str): The handler of the command.
+            command (str): The acknowledged command.
+            rtt (float): Monotonic time between the command publish and the ACK reception (None: unknown command).
+            probe_timestamps (dict): {"received", "ack", "processing"} reported by the probe, if any.
+            role (str): The role of the command (e.g. "Client", "Server"), if it had one.
+        """
+        if rtt is None:
+            return
+        probe_processing = probe_processing_of(probe_timestamps)
+        # Measured by the probe clock alone: it doesn't need clock synchronization
+        probe_processing = 0.0 if (probe_processing is None) else min(max(probe_processing, 0.0), rtt)
+        network = rtt - probe_processing
+        with self.lock:
+            if probe_id in self.network_rtt:
+                self.network_rtt[probe_id].add(network)
+            else:
+                self.network_rtt[probe_id] = SmoothedEstimate(network)
+            if (handler, command, role) in self.processing:
+                self.processing[(handler, command, role)].add(probe_processing)
+            else:
+                self.processing[(handler, command, role)] = SmoothedEstimate(probe_processing)
+            self.backoff.pop(probe_id, None) # As in TCP, a valid sample ends the backoff
+
+    def ack_missed(self, probe_id):
+        """
+        Records a timed out ACK: the next timeouts of the probe are doubled, up to MAX_BACKOFF times.
+        """
+        with self.lock:
+            self.backoff[probe_id] = min(self.backoff.get(probe_id, 1) * 2, MAX_BACKOFF)
+
+    def timeout(self, probe_id, handler, command, default_timeout : float, role = None) -> float:
+        """
+        Returns the seconds to wait for the ACK/NACK of a command sent to a probe.
+        Args:
+            probe_id (str): The probe the command is sent to.
+            handler (str): The handler of the command.
+            command (str): The command.
+            default_timeout (float): The timeout used until the probe and the command have estimates.
+            role (str): The role of the command, if it has one.
+        """
+        with self.lock:
+            network_rtt = self.network_rtt.get(probe_id)
+            processing = self.processing.get((handler, command, role))
+            backoff = self.backoff.get(probe_id, 1)
+            if (network_rtt is None) or (processing is None):
+                return default_timeout * backoff
+            network_timeout = network_rtt.mean + max(CLOCK_GRANULARITY_SECONDS, RTTVAR_FACTOR * network_rtt.variation)
+            processing_timeout = processing.mean + RTTVAR_FACTOR * processing.variation
+        timeout = max(network_timeout + processing_timeout, MIN_ACK_TIMEOUT_SECONDS) * backoff
+        return min(timeout, MAX_ACK_TIMEOUT_SECONDS)
+
+    def wait_for_ack(self, ack_event : threading.Event, probe_id, handler, command, default_timeout : float, role = None) -> bool:
+        """
+        Waits for ack_event (set by a status handler on the ACK/NACK of the command) for the estimated timeout.
+        Returns False, recording the missed ACK, if the event is not set in time.
+        """
+        if ack_event.wait(timeout = self.timeout(probe_id, handler, command, default_timeout, role)):
+            return True
+        self.ack_missed(probe_id)
+        return False
+
+    # ------------------------------------------------- METRICS -------------------------------------------------
+
+    def probes_gauge(self, value_of) -> dict:
+        with self.lock:
+            return {MetricsRegistry.labels_key({"probe": probe_id}): value_of(estimate) for probe_id, estimate in self.network_rtt.items()}
+
+    def backoff_gauge(self) -> dict:
+        with self.lock:
+            return {MetricsRegistry.labels_key({"probe": probe_id}): backoff for probe_id, backoff in self.backoff.items()}
+
+    def processing_gauge(self) -> dict:
+        with self.lock:
+            return {MetricsRegistry.labels_key({"handler": handler, "command": command, "role": role or ""}): estimate.mean
+                    for (handler, command, role), estimate in self.processing.items()}
@@ -0,0 +1,267 @@
+"""
+measurement_timings.py
+
+This module provides the per-measurement lifecycle timings of the coordinator.
+Each coordinator stamps its phases (IP resolution, NTP toggling, ACK waits, DB insert, measurement, result commit)
+on a MeasurementTimings object, using the monotonic clock. The CommandsMultiplexer adds the probe-side timestamps
+carried by ACKs and results, so that the network latency can be separated from the probe processing time.
+The TimingsTracker keeps the timings of a measurement until it's completed or failed: then the measurement phase is
+closed, and the resulting document is stored once in the "timings" field of the measurement. aggregate_phase_percentiles
+computes the phase percentiles per measurement type and probe.
+"""
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+from modules.metricsModule.ack_timeouts import probe_processing_of
+from modules.mongoModule.mongoDB import MongoDB, COMPLETED_STATE, FAILED_STATE
+
+# The timings are dropped from the tracker when the measurement ends. The ones of measurements never ended (e.g. a lost
+# result) are dropped after this age (same horizon of the failed-measurements check)
+TIMINGS_MAX_AGE_SECONDS = 24 * 3600
+
+ACK_NETWORK_PHASE = "ack_network"
+ACK_PROBE_PROCESSING_PHASE = "ack_probe_processing"
+RESULT_UPLOAD_PHASE = "result_upload"
+RESULT_COMMIT_PHASE = "result_commit"
+MEASUREMENT_PHASE = "measurement"
+
+PERCENTILES = (50, 90, 99)
+
+
+class MeasurementTimings:
+    """
+    Monotonic per-phase timings of a single measurement, plus the probe-side samples of ACKs and results.
+    A phase executed more than once (e.g. two ACK waits) accumulates its durations.
+    """
+    def __init__(self, msm_id, msm_type):
+        self.msm_id = msm_id
+        self.msm_type = msm_type
+        self.lock = threading.Lock()
+        self.created_at = time.monotonic()
+        self.phases = {}            # Maps phase name to the accumulated duration (seconds)
+        self.open_phases = {}       # Maps phase name to its monotonic start
+        self.acks = []
+        self.results = []
+        self.results_in_progress = []   # Monotonic receptions of the results being handled
+        self.ended = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase_duration(name, time.monotonic() - start)
+
+    def start_phase(self, name):
+        with self.lock:
+            self.open_phases[name] = time.monotonic()
+
+    def end_phase(self, name, at = None):
+        """
+        Closes a phase opened with start_phase, now or at the monotonic time at. Returns its duration, or None if the phase was not open.
+        """
+        with self.lock:
+            start = self.open_phases.pop(name, None)
+        if start is None:
+            return None
+        duration = max(((time.monotonic() if (at is None) else at) - start), 0.0)
+        self.add_phase_duration(name, duration)
+        return duration
+
+    def add_phase_duration(self, name, duration):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def add_probe_ack(self, probe_id, command, probe_timestamps, coordinator_rtt):
+        """
+        Records an ACK/NACK sample.
+        Args:
+            probe_id (str): The probe that sent the ACK.
+            command (str): The acknowledged command.
+            probe_timestamps (dict): {"received", "ack", "processing"} reported by the probe, if any.
+            coordinator_rtt (float): Monotonic time between the command publish and the ACK reception, if known.
+        """
+        sample = {"probe": probe_id, "command": command, "rtt": coordinator_rtt}
+        probe_processing = probe_processing_of(probe_timestamps)
+        if probe_processing is not None: # Measured by the probe clock alone: it doesn't need clock synchronization
+            sample["probe_processing"] = probe_processing
+            if coordinator_rtt is not None:
+                sample["network"] = max(coordinator_rtt - probe_processing, 0.0)
+        with self.lock:
+            self.acks.append(sample)
+
+    def add_probe_result(self, probe_id, probe_timestamps, coordinator_received_at, commit_duration):
+        """
+        Records a result sample.
+        Args:
+            probe_id (str): The probe that sent the result.
+            probe_timestamps (dict): {"published"} wall-clock timestamp taken by the probe, if any.
+            coordinator_received_at (float): Wall-clock reception time on the coordinator.
+            commit_duration (float): Time spent by the result handler (decode and DB commit).
+        """
+        sample = {"probe": probe_id, "commit": commit_duration}
+        if isinstance(probe_timestamps, dict) and ("published" in probe_timestamps):
+            # Cross-clock difference: meaningful only if the probe is NTP-synchronized with the coordinator
+            sample["upload"] = coordinator_received_at - probe_timestamps["published"]
+        with self.lock:
+            self.results.append(sample)
+        self.add_phase_duration(RESULT_COMMIT_PHASE, commit_duration)
+
+    def begin_result(self, received_at):
+        """
+        Called before a result is handled. received_at is its monotonic reception time.
+        """
+        with self.lock:
+            self.results_in_progress.append(received_at)
+
+    def end_result(self, received_at) -> bool:
+        """
+        Called after a result is handled (and add_probe_result). Returns True if the measurement has ended meanwhile
+        and this was the last result in progress: the caller stores the timings.
+        """
+        with self.lock:
+            self.results_in_progress.remove(received_at)
+            return self.ended and (not self.results_in_progress)
+
+    def end(self) -> bool:
+        """
+        Called when the measurement is completed or failed. The measurement phase ends at the reception of the result
+        being handled, if any (the one that completed the measurement), or now (e.g. a stop).
+        Returns True if no result is in progress: the caller stores the timings, otherwise end_result tells it later.
+        """
+        with self.lock:
+            self.ended = True
+            final_result_at = min(self.results_in_progress) if self.results_in_progress else None
+        self.end_phase(MEASUREMENT_PHASE, at = final_result_at)
+        with self.lock:
+            return not self.results_in_progress
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "phases": dict(self.phases),
+                "acks": list(self.acks),
+                "results": list(self.results)
+            }
+
+
+class TimingsTracker:
+    """
+    Process-wide map from msm_id to the MeasurementTimings of the measurements in progress.
+    Use TimingsTracker.get_instance() to obtain the shared tracker.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.mongo_db = None
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = TimingsTracker()
+            return cls._instance
+
+    def watch_measurement_states(self, mongo_db : MongoDB):
+        """
+        Registers the tracker as MongoDB state change listener, to drop the timings of the ended measurements.
+        """
+        with self.lock:
+            if self.mongo_db is not None:
+                return
+            self.mongo_db = mongo_db
+        mongo_db.add_state_change_listener(self.measurement_state_changed)
+
+    def measurement_state_changed(self, msm_id):
+        """
+        MongoDB state change listener: a completed or failed measurement gets no more samples. Its timings leave the
+        tracker, and are stored on its document (now, or when its last result has been handled).
+        Invoked with None after bulk updates, which may have ended any measurement.
+        """
+        with self.lock:
+            tracked_msm_ids = set(self.timings)
+        msm_ids = tracked_msm_ids if (msm_id is None) else ({str(msm_id)} & tracked_msm_ids)
+        for tracked_msm_id in msm_ids:
+            if self.mongo_db.get_measurement_state(tracked_msm_id) in (COMPLETED_STATE, FAILED_STATE):
+                with self.lock:
+                    measurement_timings = self.timings.pop(tracked_msm_id, None)
+                if (measurement_timings is not None) and measurement_timings.end(): # Popped once: stored once
+                    self.store(measurement_timings)
+
+    def store(self, measurement_timings : MeasurementTimings):
+        # The listener is notified again by this update: the timings are no longer tracked, so it's a no-op
+        self.mongo_db.set_measurement_timings(measurement_timings.msm_id, measurement_timings.to_dict())
+
+    def start(self, msm_id, msm_type) -> MeasurementTimings:
+        now = time.monotonic()
+        measurement_timings = MeasurementTimings(msm_id = str(msm_id), msm_type = msm_type)
+        with self.lock:
+            for expired_msm_id in [key for key, value in self.timings.items() if (now - value.created_at) > TIMINGS_MAX_AGE_SECONDS]:
+                self.timings.pop(expired_msm_id, None)
+            self.timings[str(msm_id)] = measurement_timings
+        return measurement_timings
+
+    def get(self, msm_id) -> MeasurementTimings:
+        with self.lock:
+            return self.timings.get(str(msm_id)) if (msm_id is not None) else None
+
+    def discard(self, msm_id):
+        with self.lock:
+            self.timings.pop(str(msm_id), None)
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def aggregate_phase_percentiles(measurements) -> dict:
+    """
+    Aggregates the timings of many measurements.
+    Args:
+        measurements (iterable): Measurement documents with "type", "source_probe" and "timings".
+    Returns:
+        dict: {measurement_type: {probe_id: {phase: {"count", "mean", "p50", "p90", "p99"}}}}.
+            The coordinator phases are attributed to the source probe, the ACK/result samples to the probe that sent them.
+    """
+    samples = {}
+
+    def add_sample(msm_type, probe_id, phase, value):
+        if value is None:
+            return
+        samples.setdefault(msm_type, {}).setdefault(str(probe_id), {}).setdefault(phase, []).append(value)
+
+    for measurement in measurements:
+        timings = measurement.get("timings")
+        if not isinstance(timings, dict):
+            continue
+        msm_type = measurement.get("type")
+        for phase, duration in (timings.get("phases") or {}).items():
+            add_sample(msm_type, measurement.get("source_probe"), phase, duration)
+        for ack in (timings.get("acks") or []):
+            add_sample(msm_type, ack.get("probe"), ACK_NETWORK_PHASE, ack.get("network"))
+            add_sample(msm_type, ack.get("probe"), ACK_PROBE_PROCESSING_PHASE, ack.get("probe_processing"))
+        for result in (timings.get("results") or []):
+            add_sample(msm_type, result.get("probe"), RESULT_UPLOAD_PHASE, result.get("upload"))
+
+    aggregated = {}
+    for msm_type, probes in samples.items():
+        for probe_id, phases in probes.items():
+            for phase, values in phases.items():
+                values.sort()
+                phase_summary = {"count": len(values), "mean": sum(values) / len(values)}
+                for p in PERCENTILES:
+                    phase_summary[f"p{p}"] = percentile(values, p)
+                aggregated.setdefault(msm_type, {}).setdefault(probe_id, {})[phase] = phase_summary
+    return aggregated
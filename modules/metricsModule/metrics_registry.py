@@ -0,0 +1,321 @@
+"""
+metrics_registry.py
+
+This module provides the MetricsRegistry class, the process-wide collection point of the coordinator runtime metrics.
+The hot paths (MQTT reception, handler dispatching, ACK waiting, MongoDB operations) update counters, gauges and
+histograms, while values that are cheaper to read on demand (spool depth, online probes, active measurements) are
+registered as gauge callbacks and evaluated only when a snapshot is requested.
+The same data can be exported in the Prometheus text exposition format or as a JSON-ready dict.
+"""
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Upper bounds (seconds) of the latency buckets. ACKs of the coex conf can take up to 60s.
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Pending commands older than this are considered lost: they are dropped without an RTT sample
+PENDING_COMMAND_MAX_AGE_SECONDS = 300
+
+MQTT_MESSAGES_TOTAL = "measurex_mqtt_messages_total"
+MQTT_DISPATCH_IN_FLIGHT = "measurex_mqtt_dispatch_in_flight"
+HANDLER_LATENCY_SECONDS = "measurex_handler_latency_seconds"
+ACK_RTT_SECONDS = "measurex_ack_rtt_seconds"
+ACK_TIMEOUTS_TOTAL = "measurex_ack_timeouts_total"
+ACK_SRTT_SECONDS = "measurex_ack_srtt_seconds"
+ACK_RTTVAR_SECONDS = "measurex_ack_rttvar_seconds"
+ACK_TIMEOUT_BACKOFF = "measurex_ack_timeout_backoff"
+COMMAND_PROCESSING_SECONDS = "measurex_command_processing_seconds"
+MONGO_OPERATION_LATENCY_SECONDS = "measurex_mongo_operation_latency_seconds"
+MONGO_OPERATION_ERRORS_TOTAL = "measurex_mongo_operation_errors_total"
+SPOOL_DEPTH = "measurex_spool_depth"
+ACTIVE_MEASUREMENTS = "measurex_active_measurements"
+PROBES_ONLINE = "measurex_probes_online"
+ADMISSION_QUEUE_DEPTH = "measurex_admission_queue_depth"
+ADMISSION_REQUESTS_TOTAL = "measurex_admission_requests_total"
+ADMISSION_WAIT_SECONDS = "measurex_admission_wait_seconds"
+CAMPAIGN_RUNS_TOTAL = "measurex_campaign_runs_total"
+CAMPAIGN_MEASUREMENTS_TOTAL = "measurex_campaign_measurements_total"
+CAMPAIGN_RUN_DURATION_SECONDS = "measurex_campaign_run_duration_seconds"
+PIPELINE_NODES_TOTAL = "measurex_pipeline_nodes_total"
+PIPELINE_NODE_START_DELAY_SECONDS = "measurex_pipeline_node_start_delay_seconds"
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Bucket counts are stored non-cumulative and made cumulative on export.
+    """
+    def __init__(self, buckets = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1) # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while (index < len(self.buckets)) and (value > self.buckets[index]):
+            index += 1
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates the q-quantile by linear interpolation inside the bucket that contains it (as Prometheus does).
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower_bound = 0.0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            upper_bound = self.buckets[index] if (index < len(self.buckets)) else math.inf
+            if (cumulative + bucket_count) >= rank and bucket_count > 0:
+                if upper_bound == math.inf:
+                    return lower_bound
+                return lower_bound + (upper_bound - lower_bound) * ((rank - cumulative) / bucket_count)
+            cumulative += bucket_count
+            lower_bound = upper_bound
+        return lower_bound
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": (self.sum / self.count) if self.count > 0 else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe, process-wide registry of counters, gauges and histograms.
+    Use MetricsRegistry.get_instance() to obtain the shared registry.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metric_descriptions = {}   # Maps metric name to (type, help)
+        self.metric_values = {}         # Maps metric name to {labels_tuple: value or Histogram}
+        self.gauge_callbacks = {}       # Maps metric name to a callable evaluated at snapshot time
+        self.pending_commands = {}      # Maps (probe_id, handler, command, msm_id) to the send time, for the ACK RTT
+
+        self.describe(MQTT_MESSAGES_TOTAL, COUNTER, "MQTT messages, by direction and topic type.")
+        self.describe(MQTT_DISPATCH_IN_FLIGHT, GAUGE, "MQTT messages being dispatched to their handler (the network loop dispatches one message at a time, so this is not a backlog).")
+        self.describe(HANDLER_LATENCY_SECONDS, HISTOGRAM, "Time spent in the coordinator handler of a probe message, by handler and topic type.")
+        self.describe(ACK_RTT_SECONDS, HISTOGRAM, "Time between a command publish and the related ACK/NACK, by probe.")
+        self.describe(ACK_TIMEOUTS_TOTAL, COUNTER, "Commands that never received an ACK/NACK, by probe.")
+        self.describe(ACK_SRTT_SECONDS, GAUGE, "Smoothed network round trip of the command/ACK pairs (SRTT), by probe.")
+        self.describe(ACK_RTTVAR_SECONDS, GAUGE, "Round trip variation of the command/ACK pairs (RTTVAR), by probe.")
+        self.describe(ACK_TIMEOUT_BACKOFF, GAUGE, "Multiplier of the ACK timeouts of the probes that missed an ACK, by probe.")
+        self.describe(COMMAND_PROCESSING_SECONDS, GAUGE, "Smoothed probe processing time of the commands, by handler and command.")
+        self.describe(MONGO_OPERATION_LATENCY_SECONDS, HISTOGRAM, "Latency of the MongoDB operations, by operation.")
+        self.describe(MONGO_OPERATION_ERRORS_TOTAL, COUNTER, "Failed MongoDB operations, by operation.")
+        self.describe(SPOOL_DEPTH, GAUGE, "Results stored locally because MongoDB was unreachable.")
+        self.describe(ACTIVE_MEASUREMENTS, GAUGE, "Measurements in started state, by measurement type.")
+        self.describe(PROBES_ONLINE, GAUGE, "Probes currently online.")
+        self.describe(ADMISSION_QUEUE_DEPTH, GAUGE, "Measurement requests waiting in the admission queue, by probe.")
+        self.describe(ADMISSION_REQUESTS_TOTAL, COUNTER, "Measurement requests handled by the admission queue, by outcome.")
+        self.describe(ADMISSION_WAIT_SECONDS, HISTOGRAM, "Time between the submission and the dispatch of a measurement request, by type.")
+        self.describe(CAMPAIGN_RUNS_TOTAL, COUNTER, "Scheduled runs of the measurement campaigns, by campaign and outcome.")
+        self.describe(CAMPAIGN_MEASUREMENTS_TOTAL, COUNTER, "Measurements submitted by the campaign runs, by campaign and outcome.")
+        self.describe(CAMPAIGN_RUN_DURATION_SECONDS, HISTOGRAM, "Time between the start of a campaign run and the end of its last measurement, by campaign.")
+        self.describe(PIPELINE_NODES_TOTAL, COUNTER, "Ended pipeline nodes, by outcome (completed, failed, skipped).")
+        self.describe(PIPELINE_NODE_START_DELAY_SECONDS, HISTOGRAM, "Time between the completion of the predecessors of a pipeline node and its dispatch, by type.")
+        self.metric_values[MQTT_DISPATCH_IN_FLIGHT][()] = 0
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = MetricsRegistry()
+            return cls._instance
+
+    def describe(self, name, metric_type, help_text):
+        with self.lock:
+            self.metric_descriptions[name] = (metric_type, help_text)
+            self.metric_values.setdefault(name, {})
+
+    @staticmethod
+    def labels_key(labels : dict):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    # ------------------------------------------------- UPDATE -------------------------------------------------
+
+    def inc_counter(self, name, labels : dict = None, amount = 1):
+        key = self.labels_key(labels)
+        with self.lock:
+            values = self.metric_values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set_gauge(self, name, value, labels : dict = None):
+        key = self.labels_key(labels)
+        with self.lock:
+            self.metric_values.setdefault(name, {})[key] = value
+
+    def add_to_gauge(self, name, delta, labels : dict = None):
+        self.inc_counter(name, labels, delta)
+
+    def observe(self, name, value, labels : dict = None, buckets = DEFAULT_LATENCY_BUCKETS):
+        key = self.labels_key(labels)
+        with self.lock:
+            values = self.metric_values.setdefault(name, {})
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time_block(self, name, labels : dict = None, error_counter = None):
+        """
+        Observes the duration of the with-block in the histogram name.
+        If error_counter is provided, it is incremented when the block raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if error_counter is not None:
+                self.inc_counter(error_counter, labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def register_gauge_callback(self, name, callback):
+        """
+        Registers a callable evaluated at snapshot time. It must return a number, or a dict {labels_dict_as_tuple: number}
+        built with labels_key.
+        """
+        with self.lock:
+            self.gauge_callbacks[name] = callback
+
+    # ------------------------------------------------- ACK RTT -------------------------------------------------
+
+    def command_sent(self, probe_id, handler, command, msm_id):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, sent_at in self.pending_commands.items() if (now - sent_at) > PENDING_COMMAND_MAX_AGE_SECONDS]
+            for key in expired:
+                self.pending_commands.pop(key, None)
+            self.pending_commands[(probe_id, handler, command, msm_id)] = now
+        for key in expired:
+            self.inc_counter(ACK_TIMEOUTS_TOTAL, {"probe": key[0]})
+
+    def command_acknowledged(self, probe_id, handler, command, msm_id):
+        """
+        Closes the RTT sample opened by command_sent. Returns the RTT in seconds, or None if the command is unknown.
+        """
+        with self.lock:
+            sent_at = self.pending_commands.pop((probe_id, handler, command, msm_id), None)
+        if sent_at is None:
+            return None
+        rtt = time.monotonic() - sent_at
+        self.observe(ACK_RTT_SECONDS, rtt, {"probe": probe_id})
+        return rtt
+
+    # ------------------------------------------------- EXPORT -------------------------------------------------
+
+    def _collect(self):
+        # Evaluates the gauge callbacks outside the lock (they may query MongoDB), then copies the stored values
+        callback_values = {}
+        with self.lock:
+            callbacks = list(self.gauge_callbacks.items())
+        for name, callback in callbacks:
+            try:
+                value = callback()
+                callback_values[name] = value if isinstance(value, dict) else {(): value}
+            except Exception as e:
+                print(f"MetricsRegistry: exception in gauge callback |{name}| -> {e}")
+        collected = {}
+        with self.lock:
+            for name, (metric_type, help_text) in self.metric_descriptions.items():
+                values = callback_values.get(name, self.metric_values.get(name, {}))
+                if metric_type == HISTOGRAM:
+                    values = {key: self._copy_histogram(histogram) for key, histogram in values.items()}
+                else:
+                    values = dict(values)
+                collected[name] = (metric_type, help_text, values)
+        return collected
+
+    @staticmethod
+    def _copy_histogram(histogram : Histogram):
+        copy = Histogram(histogram.buckets)
+        copy.bucket_counts = list(histogram.bucket_counts)
+        copy.count = histogram.count
+        copy.sum = histogram.sum
+        return copy
+
+    def get_values(self, name) -> dict:
+        """
+        Returns a copy of the stored values of a metric, {labels_tuple: number or Histogram}, without evaluating the gauge callbacks.
+        """
+        with self.lock:
+            values = self.metric_values.get(name, {})
+            return {key: (self._copy_histogram(value) if isinstance(value, Histogram) else value) for key, value in values.items()}
+
+    def snapshot(self) -> dict:
+        """
+        Returns all the metrics as a JSON-ready dict: {metric_name: {"type", "help", "values": [{"labels", ...}]}}.
+        """
+        snapshot = {}
+        for name, (metric_type, help_text, values) in self._collect().items():
+            samples = []
+            for labels, value in values.items():
+                sample = {"labels": dict(labels)}
+                if metric_type == HISTOGRAM:
+                    sample.update(value.to_dict())
+                else:
+                    sample["value"] = value
+                samples.append(sample)
+            snapshot[name] = {"type": metric_type, "help": help_text, "values": samples}
+        return snapshot
+
+    @staticmethod
+    def _format_labels(labels, extra_label = None):
+        items = list(labels)
+        if extra_label is not None:
+            items.append(extra_label)
+        if not items:
+            return ""
+        escaped = []
+        for label_name, label_value in items:
+            label_value = str(label_value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            escaped.append(f"{label_name}=\"{label_value}\"")
+        return "{" + ",".join(escaped) + "}"
+
+    @staticmethod
+    def _format_value(value):
+        if value == math.inf:
+            return "+Inf"
+        return repr(float(value))
+
+    def render_prometheus(self) -> str:
+        """
+        Returns all the metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        for name, (metric_type, help_text, values) in self._collect().items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in values.items():
+                if metric_type == HISTOGRAM:
+                    cumulative = 0
+                    for index, bucket_count in enumerate(value.bucket_counts):
+                        cumulative += bucket_count
+                        upper_bound = value.buckets[index] if (index < len(value.buckets)) else math.inf
+                        lines.append(f"{name}_bucket{self._format_labels(labels, ('le', self._format_value(upper_bound)))} {cumulative}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {self._format_value(value.sum)}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+        return "\n".join(lines) + "\n"
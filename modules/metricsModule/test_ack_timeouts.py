@@ -0,0 +1,102 @@
+"""
+Unit tests of the AckTimeouts estimator (RFC 6298 smoothing, processing split, backoff).
+Run from the repository root: python -m unittest modules.metricsModule.test_ack_timeouts
+"""
+
+import unittest
+import threading
+from modules.metricsModule.ack_timeouts import (AckTimeouts, SmoothedEstimate, probe_processing_of, RTT_ALPHA, RTT_BETA,
+                                                RTTVAR_FACTOR, CLOCK_GRANULARITY_SECONDS, MIN_ACK_TIMEOUT_SECONDS,
+                                                MAX_ACK_TIMEOUT_SECONDS, MAX_BACKOFF)
+
+
+class TestSmoothedEstimate(unittest.TestCase):
+
+    def test_first_sample(self):
+        # RFC 6298 2.2: SRTT <- R, RTTVAR <- R/2
+        estimate = SmoothedEstimate(0.4)
+        self.assertEqual(estimate.mean, 0.4)
+        self.assertEqual(estimate.variation, 0.2)
+
+    def test_next_samples(self):
+        # RFC 6298 2.3: RTTVAR is updated with the SRTT before the SRTT update
+        estimate = SmoothedEstimate(0.4)
+        estimate.add(0.8)
+        expected_variation = (1 - RTT_BETA) * 0.2 + RTT_BETA * abs(0.4 - 0.8)
+        expected_mean = (1 - RTT_ALPHA) * 0.4 + RTT_ALPHA * 0.8
+        self.assertAlmostEqual(estimate.variation, expected_variation)
+        self.assertAlmostEqual(estimate.mean, expected_mean)
+        self.assertEqual(estimate.samples, 2)
+
+
+class TestProbeProcessingOf(unittest.TestCase):
+
+    def test_monotonic_processing_preferred(self):
+        self.assertEqual(probe_processing_of({"received": 100.0, "ack": 90.0, "processing": 0.25}), 0.25)
+
+    def test_wall_clock_difference_of_older_firmwares(self):
+        self.assertAlmostEqual(probe_processing_of({"received": 100.0, "ack": 100.5}), 0.5)
+
+    def test_not_reported(self):
+        self.assertIsNone(probe_processing_of(None))
+        self.assertIsNone(probe_processing_of({"received": 100.0}))
+
+
+class TestAckTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.timeouts = AckTimeouts()
+
+    def test_default_until_estimates_exist(self):
+        self.assertEqual(self.timeouts.timeout("p1", "ping", "start", default_timeout = 5), 5)
+        self.timeouts.add_sample("p1", "ping", "start", rtt = None) # Unknown command: no sample
+        self.assertEqual(self.timeouts.timeout("p1", "ping", "start", default_timeout = 5), 5)
+
+    def test_timeout_from_network_and_processing(self):
+        self.timeouts.add_sample("p1", "iperf", "prepare", rtt = 1.0, probe_timestamps = {"processing": 0.6})
+        # Network 0.4 s: SRTT 0.4, RTTVAR 0.2. Processing 0.6 s: mean 0.6, variation 0.3
+        expected = (0.4 + max(CLOCK_GRANULARITY_SECONDS, RTTVAR_FACTOR * 0.2)) + (0.6 + RTTVAR_FACTOR * 0.3)
+        self.assertAlmostEqual(self.timeouts.timeout("p1", "iperf", "prepare", default_timeout = 5), expected)
+
+    def test_processing_per_command_and_role(self):
+        self.timeouts.add_sample("p1", "aoi", "prepare", rtt = 3.0, probe_timestamps = {"processing": 2.9}, role = "Client")
+        self.timeouts.add_sample("p1", "aoi", "prepare", rtt = 0.2, probe_timestamps = {"processing": 0.1}, role = "Server")
+        client_timeout = self.timeouts.timeout("p1", "aoi", "prepare", default_timeout = 5, role = "Client")
+        server_timeout = self.timeouts.timeout("p1", "aoi", "prepare", default_timeout = 5, role = "Server")
+        self.assertGreater(client_timeout, server_timeout)
+        # The network estimate is shared by the commands of the probe, the processing one is not
+        self.assertEqual(self.timeouts.timeout("p1", "aoi", "stop", default_timeout = 5), 5)
+
+    def test_processing_clamped_to_the_round_trip(self):
+        self.timeouts.add_sample("p1", "ping", "start", rtt = 0.5, probe_timestamps = {"processing": 2.0})
+        self.assertEqual(self.timeouts.processing[("ping", "start", None)].mean, 0.5)
+        self.assertEqual(self.timeouts.network_rtt["p1"].mean, 0.0)
+
+    def test_bounds(self):
+        self.timeouts.add_sample("p1", "ping", "start", rtt = 0.001)
+        self.assertEqual(self.timeouts.timeout("p1", "ping", "start", default_timeout = 5), MIN_ACK_TIMEOUT_SECONDS)
+        self.timeouts.add_sample("p2", "ping", "start", rtt = 100.0)
+        self.assertEqual(self.timeouts.timeout("p2", "ping", "start", default_timeout = 5), MAX_ACK_TIMEOUT_SECONDS)
+
+    def test_backoff_doubles_until_a_new_sample(self):
+        self.timeouts.add_sample("p1", "ping", "start", rtt = 0.5)
+        base_timeout = self.timeouts.timeout("p1", "ping", "start", default_timeout = 5)
+        self.timeouts.ack_missed("p1")
+        self.assertAlmostEqual(self.timeouts.timeout("p1", "ping", "start", default_timeout = 5), 2 * base_timeout)
+        for _ in range(10):
+            self.timeouts.ack_missed("p1")
+        self.assertEqual(self.timeouts.backoff["p1"], MAX_BACKOFF)
+        self.assertEqual(self.timeouts.timeout("p3", "ping", "start", default_timeout = 5), 5) # Other probes unaffected
+        self.timeouts.add_sample("p1", "ping", "start", rtt = 0.5)
+        self.assertNotIn("p1", self.timeouts.backoff)
+
+    def test_wait_for_ack(self):
+        ack_event = threading.Event()
+        ack_event.set()
+        self.assertTrue(self.timeouts.wait_for_ack(ack_event, "p1", "ping", "start", default_timeout = 0.05))
+        self.assertFalse(self.timeouts.wait_for_ack(threading.Event(), "p1", "ping", "start", default_timeout = 0.05))
+        self.assertEqual(self.timeouts.backoff["p1"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Unit tests of the measurement timings: the measurement phase, and a single store when the measurement ends.
+Run from the repository root: python -m unittest modules.metricsModule.test_measurement_timings
+"""
+
+import time
+import unittest
+from modules.metricsModule.measurement_timings import TimingsTracker, MEASUREMENT_PHASE, RESULT_COMMIT_PHASE
+from modules.mongoModule.mongoDB import STARTED_STATE, COMPLETED_STATE, FAILED_STATE
+
+
+class FakeMongoDB:
+    def __init__(self):
+        self.states = {}
+        self.listeners = []
+        self.stored_timings = []
+
+    def add_state_change_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify_state_change(self, msm_id):
+        for listener in self.listeners:
+            listener(msm_id)
+
+    def get_measurement_state(self, msm_id):
+        return self.states.get(msm_id)
+
+    def set_state(self, msm_id, state):
+        self.states[msm_id] = state
+        self.notify_state_change(msm_id)
+
+    def set_measurement_timings(self, msm_id, timings):
+        self.stored_timings.append((msm_id, timings))
+        self.notify_state_change(msm_id)
+        return True
+
+
+class TestMeasurementEnd(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo_db = FakeMongoDB()
+        self.tracker = TimingsTracker()
+        self.tracker.watch_measurement_states(self.mongo_db)
+        self.mongo_db.states["m1"] = STARTED_STATE
+        self.measurement_timings = self.tracker.start("m1", "iperf")
+        self.measurement_timings.start_phase(MEASUREMENT_PHASE)
+
+    def handle_result(self, completes = False):
+        # The same sequence of the CommandsMultiplexer result_multiplexer
+        received_at = time.monotonic()
+        measurement_timings = self.tracker.get("m1")
+        if measurement_timings is not None:
+            measurement_timings.begin_result(received_at)
+        if completes:
+            time.sleep(0.05) # The result commit
+            self.mongo_db.set_state("m1", COMPLETED_STATE)
+        if measurement_timings is not None:
+            measurement_timings.add_probe_result("probe1", None, time.time(), time.monotonic() - received_at)
+            if measurement_timings.end_result(received_at):
+                self.tracker.store(measurement_timings)
+        return received_at
+
+    def test_stored_once_by_the_final_result(self):
+        self.handle_result()
+        self.handle_result()
+        self.assertEqual(self.mongo_db.stored_timings, []) # Not on every repetition
+        final_result_at = self.handle_result(completes = True)
+
+        self.assertEqual(len(self.mongo_db.stored_timings), 1)
+        msm_id, timings = self.mongo_db.stored_timings[0]
+        self.assertEqual(msm_id, "m1")
+        self.assertEqual(len(timings["results"]), 3)
+        # The measurement phase ends at the final result reception, not after its commit
+        self.assertLess(timings["phases"][MEASUREMENT_PHASE], final_result_at - self.measurement_timings.created_at + 0.04)
+        self.assertGreaterEqual(timings["phases"][RESULT_COMMIT_PHASE], 0.05)
+        self.assertIsNone(self.tracker.get("m1"))
+
+    def test_stored_once_by_a_stop(self):
+        self.handle_result()
+        self.mongo_db.set_state("m1", COMPLETED_STATE)
+        self.assertEqual(len(self.mongo_db.stored_timings), 1)
+        self.assertIn(MEASUREMENT_PHASE, self.mongo_db.stored_timings[0][1]["phases"])
+        self.handle_result() # A late result: nothing else to store
+        self.assertEqual(len(self.mongo_db.stored_timings), 1)
+
+    def test_failed_before_the_measurement_phase(self):
+        self.measurement_timings.open_phases.clear()
+        self.mongo_db.set_state("m1", FAILED_STATE)
+        self.assertEqual(len(self.mongo_db.stored_timings), 1)
+        self.assertNotIn(MEASUREMENT_PHASE, self.mongo_db.stored_timings[0][1]["phases"])
+
+    def test_bulk_update(self):
+        self.mongo_db.states["m1"] = FAILED_STATE
+        self.mongo_db.notify_state_change(None)
+        self.assertEqual([msm_id for msm_id, _ in self.mongo_db.stored_timings], ["m1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
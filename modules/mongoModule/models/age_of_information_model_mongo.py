@@ -1,12 +1,14 @@
 from bson import ObjectId
 
 class AgeOfInformationResultModelMongo:
-    def __init__(self, msm_id : str, aois, aoi_min, aoi_max):
+    def __init__(self, msm_id : str, aois, aoi_min, aoi_max, sender_stats = None, receiver_stats = None):
         self._id = None
         self.msm_id = msm_id
         self.aois = aois
         self.aoi_min = aoi_min
         self.aoi_max = aoi_max
+        self.sender_stats = sender_stats # Achieved vs requested rate and send jitter of the client (None from an old firmware)
+        self.receiver_stats = receiver_stats # Lost/reordered/duplicated packets seen by the server (None from an old firmware)
 
 
     def to_dict(self):
@@ -14,5 +16,7 @@ class AgeOfInformationResultModelMongo:
             "msm_id": ObjectId(self.msm_id) if isinstance(self.msm_id, str) else self.msm_id,
             "aoi_min": self.aoi_min,
             "aoi_max": self.aoi_max,
-            "aois": self.aois
+            "aois": self.aois,
+            "sender_stats": self.sender_stats,
+            "receiver_stats": self.receiver_stats
         }
@@ -0,0 +1,76 @@
+import time
+from bson.objectid import ObjectId
+
+SKIP_MISFIRE_POLICY = "skip"         # The runs missed during a coordinator downtime are dropped
+COALESCE_MISFIRE_POLICY = "coalesce" # The runs missed during a coordinator downtime are merged in one run, at restart
+MISFIRE_POLICIES = (SKIP_MISFIRE_POLICY, COALESCE_MISFIRE_POLICY)
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class CampaignModelMongo:
+    """
+    A recurring measurement campaign. Each run expands the measurement templates: a template
+    {"type", "source_probes", "dest_probes", "parameters", "coexisting_application", "duration", "description"}
+    produces one measurement for each (source, dest) pair of different probes (or for each source, without dest_probes).
+    duration (seconds), if set, stops the measurements that don't end by themselves (e.g. AoI).
+    """
+    def __init__(self, name, schedule : dict, measurements : list, description = None, _id = None,
+                 jitter = 0, misfire_policy = SKIP_MISFIRE_POLICY, max_concurrency = DEFAULT_MAX_CONCURRENCY, priority = 0,
+                 run_timeout = None, enabled = True, created_at = None, last_run_at = None, next_run_at = None, stats = None):
+        self._id = _id
+        self.name = name
+        self.description = description
+        self.schedule = schedule            # {"cron": expression} or {"interval": seconds, "start_at": UNIX time}
+        self.measurements = measurements    # Measurement templates
+        self.jitter = jitter                # Max random delay (seconds) added to each run, to spread the load
+        self.misfire_policy = misfire_policy
+        self.max_concurrency = max_concurrency # Max measurements of a run being prepared at the same time
+        self.priority = priority            # Admission queue priority of the campaign measurements
+        self.run_timeout = run_timeout      # Seconds after which the measurements of a run still queued are dropped
+        self.enabled = enabled
+        self.created_at = created_at if (created_at is not None) else time.time()
+        self.last_run_at = last_run_at
+        self.next_run_at = next_run_at
+        self.stats = stats if (stats is not None) else {}
+
+    @staticmethod
+    def cast_dict_in_CampaignModelMongo(campaign_as_dict : dict):
+        try:
+            name = campaign_as_dict['name']
+            schedule = campaign_as_dict['schedule']
+            measurements = campaign_as_dict['measurements']
+        except Exception as e:
+            return None
+        if (not isinstance(measurements, list)) or (not measurements):
+            return None
+        return CampaignModelMongo(name = name, schedule = schedule, measurements = measurements,
+                                  description = campaign_as_dict.get('description'), _id = campaign_as_dict.get('_id'),
+                                  jitter = campaign_as_dict.get('jitter', 0),
+                                  misfire_policy = campaign_as_dict.get('misfire_policy', SKIP_MISFIRE_POLICY),
+                                  max_concurrency = campaign_as_dict.get('max_concurrency', DEFAULT_MAX_CONCURRENCY),
+                                  priority = campaign_as_dict.get('priority', 0), run_timeout = campaign_as_dict.get('run_timeout'),
+                                  enabled = campaign_as_dict.get('enabled', True), created_at = campaign_as_dict.get('created_at'),
+                                  last_run_at = campaign_as_dict.get('last_run_at'), next_run_at = campaign_as_dict.get('next_run_at'),
+                                  stats = campaign_as_dict.get('stats'))
+
+    def assign_id(self):
+        self._id = ObjectId()
+
+    def to_dict(self, to_store = False):
+        return {
+            '_id' : str(self._id) if not to_store else self._id,
+            'name': self.name,
+            'description': self.description,
+            'schedule': self.schedule,
+            'measurements': self.measurements,
+            'jitter': self.jitter,
+            'misfire_policy': self.misfire_policy,
+            'max_concurrency': self.max_concurrency,
+            'priority': self.priority,
+            'run_timeout': self.run_timeout,
+            'enabled': self.enabled,
+            'created_at': self.created_at,
+            'last_run_at': self.last_run_at,
+            'next_run_at': self.next_run_at,
+            'stats': self.stats
+        }
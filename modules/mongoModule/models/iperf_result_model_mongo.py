@@ -2,7 +2,8 @@ class IperfResultModelMongo:
     def __init__(self, 
                  msm_id, repetition_number, start_timestamp,
                  transport_protocol, source_ip, source_port, destination_ip,
-                 destination_port, bytes_received, duration, avg_speed, full_result):
+                 destination_port, bytes_received, duration, avg_speed, full_result, process_usage = None,
+                 capacity_search = None, precision = None):
         self._id = None
         self.msm_id = msm_id
         self.repetition_number = repetition_number
@@ -16,6 +17,9 @@ class IperfResultModelMongo:
         self.duration = duration
         self.avg_speed = avg_speed
         self.full_result = full_result
+        self.process_usage = process_usage # Resource usage of iperf3 on the probe (None from an old firmware)
+        self.capacity_search = capacity_search # Outcome of the UDP capacity search (None for a fixed rate test)
+        self.precision = precision # Confidence interval of the throughput of an adaptive duration test
 
     def to_dict(self):
         return {
@@ -28,5 +32,30 @@ class IperfResultModelMongo:
             'destination_port': self.destination_port,
             'duration': self.duration,
             'avg_speed': self.avg_speed,
-            'full_result': self.full_result
-        }
\ No newline at end of file
+            'full_result': self.full_result,
+            'process_usage': self.process_usage,
+            'capacity_search': self.capacity_search,
+            'precision': self.precision
+        }
+
+class IperfIntervalsResultModelMongo:
+    """
+    A batch of interval samples of a repetition, published by the probe while the test runs (stream_intervals mode).
+    """
+    def __init__(self, msm_id, repetition_number, start_timestamp, transport_protocol, intervals):
+        self._id = None
+        self.msm_id = msm_id
+        self.repetition_number = repetition_number
+        self.start_timestamp = start_timestamp
+        self.transport_protocol = transport_protocol
+        self.intervals = intervals
+
+    def to_dict(self):
+        return {
+            'msm_id': self.msm_id,
+            'kind': 'intervals',
+            'repetition_number': self.repetition_number,
+            'start_timestamp': self.start_timestamp,
+            'transport_protocol': self.transport_protocol,
+            'intervals': self.intervals
+        }
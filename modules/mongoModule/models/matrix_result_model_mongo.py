@@ -0,0 +1,28 @@
+
+
+class MatrixResultModelMongo:
+    def __init__(self, msm_id, timestamp, inner_type, probes, directed, rounds, cells, matrices, complete):
+        self._id = None
+        self.msm_id = msm_id
+        self.timestamp = timestamp
+        self.inner_type = inner_type    # Type of the pair measurements (ping, iperf)
+        self.probes = probes            # Order of the rows (sources) and columns (destinations) of the matrices
+        self.directed = directed
+        self.rounds = rounds            # Round-robin schedule: list of rounds, each a list of [source_probe, dest_probe]
+        self.cells = cells              # One per pair: source, dest, round, msm_id, state, error, summary
+        self.matrices = matrices        # Maps each summary field to its N x N matrix (None where not measured)
+        self.complete = complete        # False if the matrix was stopped before its last round
+
+
+    def to_dict(self) -> dict:
+        return {
+            'msm_id': self.msm_id,
+            'timestamp': self.timestamp,
+            'inner_type': self.inner_type,
+            'probes': self.probes,
+            'directed': self.directed,
+            'rounds': self.rounds,
+            'cells': self.cells,
+            'matrices': self.matrices,
+            'complete': self.complete
+        }
@@ -7,7 +7,7 @@ class MeasurementModelMongo:
     def __init__(self, description, type, source_probe, source_probe_ip : str, dest_probe_ip : str,
                  dest_probe = None, _id = None,
                  state = None, start_time = None, gps_source_probe = None, gps_dest_probe = None,
-                 coexisting_application = None, stop_time = None, results = None, parameters = None):
+                 coexisting_application = None, stop_time = None, results = None, parameters = None, timings = None):
         self._id = _id
         self.description = description
         self.type = type
@@ -23,6 +23,7 @@ class MeasurementModelMongo:
         self.stop_time = stop_time
         self.results = [] if results is None else results
         self.parameters = parameters
+        self.timings = timings # Per-phase lifecycle timings, see modules/metricsModule/measurement_timings.py
 
 
     @staticmethod
@@ -34,7 +35,7 @@ class MeasurementModelMongo:
             return None
         _id = state = dest_probe = source_probe_ip = dest_probe_ip = description = start_time = None
         gps_source_probe = gps_dest_probe = coexisting_application = stop_time = results = None
-        parameters = None
+        parameters = timings = None
         if ('_id' in measurement_as_dict):
             _id = measurement_as_dict['_id']
         if 'dest_probe' in measurement_as_dict:
@@ -61,11 +62,13 @@ class MeasurementModelMongo:
             results = measurement_as_dict['results']
         if 'parameters' in measurement_as_dict:
             parameters = measurement_as_dict['parameters']
+        if 'timings' in measurement_as_dict:
+            timings = measurement_as_dict['timings']
         measurement_to_return = MeasurementModelMongo(description=description, type=type, source_probe=source_probe, _id=_id,
                                                       dest_probe=dest_probe, source_probe_ip=source_probe_ip, dest_probe_ip=dest_probe_ip,
                                                       state=state, start_time=start_time, gps_source_probe=gps_source_probe, gps_dest_probe=gps_dest_probe,
                                                       coexisting_application=coexisting_application, stop_time=stop_time, results=results,
-                                                      parameters=parameters)
+                                                      parameters=parameters, timings=timings)
         return measurement_to_return
     
 
@@ -91,5 +94,6 @@ class MeasurementModelMongo:
                 self.coexisting_application.to_dict() if isinstance(self.coexisting_application, CoexistingApplicationModelMongo) else self.coexisting_application ,
             'stop_time': self.stop_time,
             'results': [str(result_id) for result_id in self.results],
-            'parameters': self.parameters
+            'parameters': self.parameters,
+            'timings': self.timings
         }
\ No newline at end of file
@@ -2,7 +2,7 @@
 
 class PingResultModelMongo:
     def __init__(self, msm_id, timestamp, rtt_avg, rtt_max, rtt_min, rtt_mdev,
-                packets_sent, packets_received, packets_loss_count, packets_loss_rate, icmp_replies):
+                packets_sent, packets_received, packets_loss_count, packets_loss_rate, icmp_replies, process_usage = None, rtt_vector = None, destination = None, error = None):
         self._id = None
         self.msm_id = msm_id
         self.timestamp = timestamp
@@ -15,6 +15,10 @@ class PingResultModelMongo:
         self.packets_loss_count = packets_loss_count
         self.packets_loss_rate = packets_loss_rate
         self.icmp_replies = icmp_replies
+        self.process_usage = process_usage # Resource usage of the ping process on the probe (None from an old firmware)
+        self.rtt_vector = rtt_vector # RTT (ms) of each request, None for the lost ones (None from an old firmware)
+        self.destination = destination # The pinged destination (several results per measurement with multi-target)
+        self.error = error # Why the destination was not pinged (e.g. name resolution failed), None if it was
         
 
 
@@ -30,5 +34,9 @@ class PingResultModelMongo:
             'packets_received': self.packets_received,
             'packets_loss_count': self.packets_loss_count,
             'packets_loss_rate': self.packets_loss_rate,
-            'icmp_replies': self.icmp_replies
+            'icmp_replies': self.icmp_replies,
+            'process_usage': self.process_usage,
+            'rtt_vector': self.rtt_vector,
+            'destination': self.destination,
+            'error': self.error
         }
\ No newline at end of file
@@ -1,14 +1,16 @@
 from bson import ObjectId
 
 class UDPPINGResultModelMongo:
-    def __init__(self, msm_id : str, udpping_result):
+    def __init__(self, msm_id : str, udpping_result, process_usage = None):
         self._id = None
         self.msm_id = msm_id
         self.udpping_result = udpping_result
+        self.process_usage = process_usage # Resource usage of udpClient on the probe (None from an old firmware)
 
 
     def to_dict(self):
         return {
             "msm_id": ObjectId(self.msm_id) if isinstance(self.msm_id, str) else self.msm_id,
-            "udpping_result": self.udpping_result
+            "udpping_result": self.udpping_result,
+            "process_usage": self.process_usage
         }
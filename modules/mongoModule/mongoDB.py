@@ -5,12 +5,15 @@ This module provides the MongoDB class for managing measurement and result data
 """
 
 import time, json, os
+import functools
 from pathlib import Path
 from bson import ObjectId
 from datetime import datetime
 from pymongo import MongoClient
 from modules.mongoModule.models.error_model import ErrorModel
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+from modules.mongoModule.models.campaign_model_mongo import CampaignModelMongo
+from modules.metricsModule.metrics_registry import MetricsRegistry, MONGO_OPERATION_LATENCY_SECONDS, MONGO_OPERATION_ERRORS_TOTAL
 """
 from modules.mongoModule.models.ping_result_model_mongo import PingResultModelMongo
 from modules.mongoModule.models.iperf_result_model_mongo import IperfResultModelMongo
@@ -24,6 +27,21 @@ SECONDS_OLD_MEASUREMENT = HOURS_OLD_MEASUREMENT * 3600
 STARTED_STATE = "started"
 FAILED_STATE = "failed"
 COMPLETED_STATE = "completed"
+LOCAL_SPOOL_FOLDER = os.path.join(Path(__file__).parent, "json") # Results that could not be stored on mongo
+DEFAULT_CAMPAIGNS_COLLECTION_NAME = "campaigns"
+
+
+def mongo_operation(method):
+    """
+    Decorator that observes the latency of a MongoDB method and counts the exceptions it raises.
+    The exceptions handled inside the method must be counted with record_operation_error.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with MetricsRegistry.get_instance().time_block(MONGO_OPERATION_LATENCY_SECONDS, {"operation": method.__name__},
+                                                      error_counter = MONGO_OPERATION_ERRORS_TOTAL):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class MongoDB:
@@ -45,9 +63,11 @@ class MongoDB:
         self.db_name = mongo_config.db_name
         self.measurements_collection_name = mongo_config.measurements_collection_name
         self.results_collection_name = mongo_config.results_collection_name
+        self.campaigns_collection_name = getattr(mongo_config, "campaigns_collection_name", DEFAULT_CAMPAIGNS_COLLECTION_NAME)
         self.client = MongoClient("mongodb://" + self.user + ":" + self.password + "@" + self.server_ip + ":" + str(self.server_port) + "/")
         self.measurements_collection = None
         self.results_collection = None
+        self.campaigns_collection = None
 
         db = self.client[self.db_name] # crea il db measurex
 
@@ -58,10 +78,36 @@ class MongoDB:
             db.create_collection(self.results_collection_name)
         
         self.measurements_collection = db[self.measurements_collection_name]
+        if self.campaigns_collection_name not in db.list_collection_names():
+            db.create_collection(self.campaigns_collection_name)
+
         self.results_collection = db[self.results_collection_name]
+        self.campaigns_collection = db[self.campaigns_collection_name]
+        self.state_change_listeners = []
+
+    def add_state_change_listener(self, listener):
+        """
+        Register a callback invoked with the measurement ID whenever a measurement document, or its results linking, changes.
+        The callback is invoked with None after bulk updates that may touch many measurements.
+        Args:
+            listener (callable): The callback, e.g. a cache invalidation function.
+        """
+        if listener not in self.state_change_listeners:
+            self.state_change_listeners.append(listener)
+
+    def record_operation_error(self, operation):
+        MetricsRegistry.get_instance().inc_counter(MONGO_OPERATION_ERRORS_TOTAL, {"operation": operation})
+
+    def notify_state_change(self, measurement_id):
+        for listener in self.state_change_listeners:
+            try:
+                listener(None if (measurement_id is None) else str(measurement_id))
+            except Exception as e:
+                print(f"MongoDB: exception in state change listener -> {e}")
 
     # ------------------------------------------------- MEASUREMENTS COLLECTION -------------------------------------------------
     
+    @mongo_operation
     def insert_measurement(self, measure : MeasurementModelMongo) -> str:
         """
         Insert a new measurement document into the measurements collection.
@@ -78,9 +124,11 @@ class MongoDB:
                 print(f"MongoDB: measurement stored in mongo. ID -> |{insert_result.inserted_id}|")
                 return insert_result.inserted_id
         except Exception as e:
+            self.record_operation_error("insert_measurement")
             print(f"MongoDB: Error while storing the measurment on mongo -> {e}")
             return None
         
+    @mongo_operation
     def replace_measurement(self, measurement_id, measure : MeasurementModelMongo):
         """
         Replace an existing measurement document by ID.
@@ -91,8 +139,10 @@ class MongoDB:
             bool: True if replaced, False otherwise.
         """
         result = self.measurements_collection.replace_one({"_id": ObjectId(measurement_id)}, measure.to_dict(to_store = True))
+        self.notify_state_change(measurement_id)
         return (result.matched_count > 0)
 
+    @mongo_operation
     def set_measurement_as_completed(self, measurement_id) -> bool:
         """
         Mark a measurement as completed and set its stop time.
@@ -106,9 +156,11 @@ class MongoDB:
                             {"_id": ObjectId(measurement_id)},
                             {"$set": {"stop_time": stop_time,
                                       "state": COMPLETED_STATE} })
+        self.notify_state_change(measurement_id)
         return (update_result.modified_count > 0)
 
 
+    @mongo_operation
     def set_measurement_as_failed_by_id(self, measurement_id : str) -> bool:
         """
         Mark a measurement as failed by its ID.
@@ -124,9 +176,11 @@ class MongoDB:
                                 "state": FAILED_STATE
                                 }
                             })
+        self.notify_state_change(measurement_id)
         return (replace_result.modified_count > 0)
     
     
+    @mongo_operation
     def update_results_array_in_measurement(self, msm_id, result_id = None):
     # This method is an automatic setting of the results doc-linking in measurements collection. 
     # It finds all the results with that msm_id, and store them _ids in the doc-link
@@ -142,8 +196,10 @@ class MongoDB:
                     {"_id": ObjectId(msm_id)},
                     {"$set": {"results": [str(result_id)]}}
                 )
+            self.notify_state_change(msm_id)
             return update_result
         except Exception as e:
+            self.record_operation_error("update_results_array_in_measurement")
             print(f"Motivo -> {e}")
             find_result = ErrorModel(object_ref_id = msm_id, object_ref_type="list of results", 
                                      error_description="It must be a 12-byte input or a 24-character hex string",
@@ -151,6 +207,7 @@ class MongoDB:
         return (find_result.to_dict())
     
 
+    @mongo_operation
     def delete_measurements_by_id(self, measurement_id: str) -> bool:
         """
         Delete a measurement document by its ID.
@@ -162,9 +219,11 @@ class MongoDB:
         # Da cancellare
         delete_result = self.measurements_collection.delete_one(
                             {"_id": ObjectId(measurement_id)})
+        self.notify_state_change(measurement_id)
         return (delete_result.deleted_count > 0)
 
 
+    @mongo_operation
     def find_measurement_by_id(self, measurement_id):
         """
         Find a measurement by its ID and return as a MeasurementModelMongo or ErrorModel.
@@ -187,6 +246,7 @@ class MongoDB:
                     dt = datetime.fromtimestamp(find_result.stop_time)
                     find_result.stop_time = dt.strftime("%H:%M:%S.%f %d/%m/%Y")
         except Exception as e:
+            self.record_operation_error("find_measurement_by_id")
             print(f"MongoDB: exception in find_measurement_by_id -> {e}")
             find_result = ErrorModel(object_ref_id=measurement_id, object_ref_type="measurement", 
                                      error_description="It must be a 12-byte input or a 24-character hex string",
@@ -194,6 +254,7 @@ class MongoDB:
         return find_result
 
 
+    @mongo_operation
     def get_measurement_state(self, measurement_id) -> str:
         """
         Get the state of a measurement by its ID.
@@ -202,12 +263,13 @@ class MongoDB:
         Returns:
             str: The state of the measurement, or None if not found.
         """
-        measurement_result : MeasurementModelMongo = self.measurements_collection.find_one({"_id": ObjectId(measurement_id)})
+        measurement_result = self.measurements_collection.find_one({"_id": ObjectId(measurement_id)}, {"state": 1})
         if measurement_result is None:
             return None
-        return (measurement_result.state)
+        return measurement_result.get("state")
     
     
+    @mongo_operation
     def get_old_measurements_not_yet_setted_as_failed(self) -> list[MeasurementModelMongo]:
         """
         Get a list of old measurements (older than 24 hours) that are still marked as started.
@@ -221,6 +283,7 @@ class MongoDB:
         return list(old_measurements)
     
     
+    @mongo_operation
     def set_old_measurements_as_failed(self) -> int:
         """
         Mark all old measurements (older than 24 hours) as failed.
@@ -235,6 +298,8 @@ class MongoDB:
                                 "state": FAILED_STATE
                                 }
                             })
+        if replace_result.modified_count > 0:
+            self.notify_state_change(None)
         return replace_result.modified_count
     
     def find_and_plot(self, msm_id, start_coex, stop_coex, series_name, time_field, value_field, granularity):
@@ -389,8 +454,68 @@ class MongoDB:
             previous_type = current_type
 
 
+    @mongo_operation
+    def set_measurement_timings(self, measurement_id, timings : dict) -> bool:
+        """
+        Store the per-phase lifecycle timings of a measurement in its "timings" sub-document.
+        Args:
+            measurement_id (str): The ID of the measurement to update.
+            timings (dict): The timings document (see MeasurementTimings.to_dict).
+        Returns:
+            bool: True if updated, False otherwise.
+        """
+        update_result = self.measurements_collection.update_one(
+                            {"_id": ObjectId(measurement_id)},
+                            {"$set": {"timings": timings}})
+        self.notify_state_change(measurement_id)
+        return (update_result.modified_count > 0)
+
+    @mongo_operation
+    def find_measurements_timings(self, measurement_type = None, probe_id = None, limit = 1000) -> list:
+        """
+        Find the timings of the most recent measurements, optionally filtered by type and probe.
+        Args:
+            measurement_type (str, optional): The measurement type.
+            probe_id (str, optional): The probe, either as source or as destination.
+            limit (int): The maximum number of measurements to read.
+        Returns:
+            list: Documents with type, source_probe, dest_probe and timings.
+        """
+        query = {"timings": {"$type": "object"}}
+        if measurement_type is not None:
+            query["type"] = measurement_type
+        if probe_id is not None:
+            query["$or"] = [{"source_probe": probe_id}, {"dest_probe": probe_id}]
+        cursor = self.measurements_collection.find(query, {"type": 1, "source_probe": 1, "dest_probe": 1, "timings": 1}).sort("start_time", -1).limit(limit)
+        return list(cursor)
+
+    @mongo_operation
+    def count_measurements_by_type(self, state = STARTED_STATE) -> dict:
+        """
+        Count the measurements in a given state, grouped by measurement type.
+        Args:
+            state (str): The measurement state to count.
+        Returns:
+            dict: Maps the measurement type to the number of measurements in that state.
+        """
+        cursor = self.measurements_collection.aggregate([
+                            {"$match": {"state": state}},
+                            {"$group": {"_id": "$type", "count": {"$sum": 1}}}])
+        return {str(group["_id"]): group["count"] for group in cursor}
+
+
     # ------------------------------------------------- RESULTS COLLECTION -------------------------------------------------
 
+    def get_spool_depth(self) -> int:
+        """
+        Get the number of results stored locally (in the spool folder) because mongo was unreachable.
+        Returns:
+            int: The number of spooled result files.
+        """
+        if not os.path.isdir(LOCAL_SPOOL_FOLDER):
+            return 0
+        return len([file_name for file_name in os.listdir(LOCAL_SPOOL_FOLDER) if file_name.endswith(".json")])
+
     def convert_objectid(self, obj):
         """
         Convert a BSON ObjectId to a string for JSON serialization.
@@ -405,6 +530,7 @@ class MongoDB:
             return str(obj)
         raise TypeError("Type not serializable")
 
+    @mongo_operation
     def insert_result(self, result) -> str:
         """
         Insert a result document into the results collection.
@@ -418,12 +544,14 @@ class MongoDB:
             insert_result = self.results_collection.insert_one(result.to_dict())
             if insert_result.inserted_id:
                 print(f"MongoDB: result stored in mongo. Result ID -> |{insert_result.inserted_id}|")
-            
+                self.notify_state_change(result.msm_id)
             return insert_result.inserted_id
         except Exception as e:
+            self.record_operation_error("insert_result")
             result._id = ObjectId()
             filename = f"{result.msm_id}.json"
-            base_path = os.path.join(Path(__file__).parent, "json", filename)
+            os.makedirs(LOCAL_SPOOL_FOLDER, exist_ok = True)
+            base_path = os.path.join(LOCAL_SPOOL_FOLDER, filename)
             with open(base_path, "w", encoding="utf-8") as file:
                 json.dump(result.to_dict(), file, indent=4, ensure_ascii=False, default=self.convert_objectid)
             
@@ -467,6 +595,7 @@ class MongoDB:
             return None
     """
 
+    @mongo_operation
     def delete_results_by_msm_id(self, msm_id) -> bool:
         """
         Delete all result documents associated with a measurement ID.
@@ -477,9 +606,11 @@ class MongoDB:
         """
         delete_result = self.results_collection.delete_many(
                             {"msm_id": ObjectId(msm_id)})
+        self.notify_state_change(msm_id)
         return (delete_result.deleted_count > 0)
     
 
+    @mongo_operation
     def delete_result_by_id(self, result_id : str) -> bool:
         """
         Delete a result document by its ID.
@@ -493,6 +624,7 @@ class MongoDB:
         return (delete_result.deleted_count > 0)
       
     
+    @mongo_operation
     def find_all_results_by_measurement_id(self, msm_id):
         """
         Find all result documents associated with a measurement ID.
@@ -506,8 +638,84 @@ class MongoDB:
             result_list = list() if (cursor is None) else list(cursor)
             return result_list
         except Exception as e:
+            self.record_operation_error("find_all_results_by_measurement_id")
             print(f"MongoDB: exception handled for find_all_result. Reason: {e}")
             find_result = ErrorModel(object_ref_id=msm_id, object_ref_type="results", 
                                      error_description="It must be a 12-byte input or a 24-character hex string",
                                      error_cause="measurement_id NOT VALID")
-        return (find_result.to_dict())
\ No newline at end of file
+        return (find_result.to_dict())
+
+
+    # ------------------------------------------------- CAMPAIGNS COLLECTION -------------------------------------------------
+
+    @mongo_operation
+    def insert_campaign(self, campaign : CampaignModelMongo) -> str:
+        """
+        Insert a new campaign document into the campaigns collection.
+        Args:
+            campaign (CampaignModelMongo): The campaign to insert.
+        Returns:
+            str: The inserted campaign's ID, or None on failure.
+        """
+        try:
+            if campaign._id is None:
+                campaign.assign_id()
+            insert_result = self.campaigns_collection.insert_one(campaign.to_dict(to_store = True))
+            return str(insert_result.inserted_id) if insert_result.inserted_id else None
+        except Exception as e:
+            self.record_operation_error("insert_campaign")
+            print(f"MongoDB: Error while storing the campaign on mongo -> {e}")
+            return None
+
+    @mongo_operation
+    def update_campaign_run_state(self, campaign_id, last_run_at = None, next_run_at = None, stats : dict = None) -> bool:
+        """
+        Update the run bookkeeping of a campaign: last and next run time, and its statistics.
+        Returns:
+            bool: True if updated, False otherwise.
+        """
+        fields = {"next_run_at": next_run_at}
+        if last_run_at is not None:
+            fields["last_run_at"] = last_run_at
+        if stats is not None:
+            fields["stats"] = stats
+        update_result = self.campaigns_collection.update_one({"_id": ObjectId(campaign_id)}, {"$set": fields})
+        return (update_result.matched_count > 0)
+
+    @mongo_operation
+    def find_campaign_by_id(self, campaign_id):
+        """
+        Find a campaign by its ID.
+        Returns:
+            CampaignModelMongo or ErrorModel: The found campaign or error info.
+        """
+        try:
+            find_result = self.campaigns_collection.find_one({"_id": ObjectId(campaign_id)})
+        except Exception as e:
+            return ErrorModel(object_ref_id=campaign_id, object_ref_type="campaign",
+                              error_description="It must be a 12-byte input or a 24-character hex string",
+                              error_cause="campaign_id NOT VALID")
+        if find_result is None:
+            return ErrorModel(object_ref_id=campaign_id, object_ref_type="campaign",
+                              error_description="Campaign not found in DB", error_cause="Unknown campaign_id")
+        return CampaignModelMongo.cast_dict_in_CampaignModelMongo(find_result)
+
+    @mongo_operation
+    def find_all_campaigns(self) -> list:
+        """
+        Find all the campaigns.
+        Returns:
+            list[CampaignModelMongo]: The campaigns.
+        """
+        campaigns = [CampaignModelMongo.cast_dict_in_CampaignModelMongo(document) for document in self.campaigns_collection.find()]
+        return [campaign for campaign in campaigns if campaign is not None]
+
+    @mongo_operation
+    def delete_campaign_by_id(self, campaign_id) -> bool:
+        """
+        Delete a campaign document by its ID. The measurements already run are kept.
+        Returns:
+            bool: True if deleted, False otherwise.
+        """
+        delete_result = self.campaigns_collection.delete_one({"_id": ObjectId(campaign_id)})
+        return (delete_result.deleted_count > 0)
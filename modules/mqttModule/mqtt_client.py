@@ -5,9 +5,11 @@ This module defines the Mqtt_Client class, which manages MQTT communication for
 """
 
 import os
+import json
 from pathlib import Path
 import paho.mqtt.client as mqtt
 from modules.configLoader.config_loader import ConfigLoader, MQTT_KEY
+from modules.metricsModule.metrics_registry import MetricsRegistry, MQTT_MESSAGES_TOTAL, MQTT_DISPATCH_IN_FLIGHT
 """
     ******************************************************* Class FOR THE MQTT CLIENT COORDINATOR *******************************************************
 """
@@ -20,13 +22,17 @@ class Mqtt_Client(mqtt.Client):
     Handles connection, subscription, message routing, and command publishing to probes.
     """
 
-    def __init__(self, status_handler_callback, results_handler_callback, errors_handler_callback):
+    def __init__(self, status_handler_callback, results_handler_callback, errors_handler_callback,
+                 recorder = None, config_path = None, connect_to_broker = True):
         """
         Initialize the MQTT client, load configuration, and set up callbacks.
         Args:
             status_handler_callback (callable): Handler for status messages.
             results_handler_callback (callable): Handler for result messages.
             errors_handler_callback (callable): Handler for error messages.
+            recorder (MqttRecorder, optional): If set, every inbound message is recorded in its log.
+            config_path (str, optional): Alternative MQTT yaml configuration. Defaults to mqttConfig.yaml.
+            connect_to_broker (bool): If False, the client is not connected (messages are injected with dispatch_message).
         """
         self.config = None
         self.mosquitto_certificate_path = None
@@ -37,15 +43,21 @@ class Mqtt_Client(mqtt.Client):
         #with open(yaml_dir) as file:
             #self.config = yaml.safe_load(file)
         base_path = Path(__file__).parent
-        cl = ConfigLoader(base_path= base_path, file_name = 'mqttConfig.yaml', KEY=MQTT_KEY)
+        if config_path is not None:
+            base_path = Path(config_path).resolve().parent
+        cl = ConfigLoader(base_path= base_path, file_name = Path(config_path).name if config_path else 'mqttConfig.yaml', KEY=MQTT_KEY)
 
         self.external_results_handler = results_handler_callback
         self.external_status_handler = status_handler_callback
         self.external_errors_handler = errors_handler_callback
+        self.metrics = MetricsRegistry.get_instance()
+        self.recorder = recorder
+        self.connected_to_broker = False
 
         self.config = cl.config
-        cert_path = self.config['mosquitto_certificate_path']
-        self.mosquitto_certificate_path = os.path.join(base_path, cert_path)
+        cert_path = self.config.get('mosquitto_certificate_path')
+        if cert_path: # A local broker (e.g. for the replay benchmark) may be plain, without TLS
+            self.mosquitto_certificate_path = os.path.join(base_path, cert_path)
 
         self.client_id = self.config['client_id']
         clean_session = self.config['clean_session']
@@ -62,9 +74,13 @@ class Mqtt_Client(mqtt.Client):
             self.username_pw_set(
                 self.config['credentials']['username'],
                 self.config['credentials']['password'])
+        if not connect_to_broker:
+            print(f"MqttClient: not connected to the broker, dispatching only injected messages")
+            return
         try:
-            self.tls_set( ca_certs = self.mosquitto_certificate_path,
-                       tls_version=mqtt.ssl.PROTOCOL_TLSv1_2)
+            if self.mosquitto_certificate_path is not None:
+                self.tls_set( ca_certs = self.mosquitto_certificate_path,
+                           tls_version=mqtt.ssl.PROTOCOL_TLSv1_2)
             self.connect(broker_ip, broker_port, keep_alive)
             self.loop_start()
         except Exception as e:
@@ -99,17 +115,35 @@ class Mqtt_Client(mqtt.Client):
         """
         # Invoked when a new message has arrived from the broker      
         print(f"MQTT: Received msg on topic -> | {message.topic} | ")
-        probe_sender = (str(message.topic).split('/'))[1]
-        if VERBOSE:
-            print(f"MqttClient: from topic |{str(message.topic)}| -> |{ message.payload.decode('utf-8')}|")
-        if str(message.topic).endswith("results"):
-            self.external_results_handler(probe_sender, message.payload.decode('utf-8'))
-        elif str(message.topic).endswith("status"):
-            self.external_status_handler(probe_sender, message.payload.decode('utf-8'))
-        elif str(message.topic).endswith("errors"):
-            self.external_errors_handler(probe_sender, message.payload.decode('utf-8'))
-        else:
-            print(f"MqttClient: topic registered but non handled -> {message.topic}")
+        if self.recorder is not None:
+            self.recorder.record(str(message.topic), message.payload)
+        self.dispatch_message(str(message.topic), message.payload.decode('utf-8'))
+
+    def dispatch_message(self, topic, payload):
+        """
+        Route an inbound message to the external handler of its topic type (results, status or errors).
+        Invoked for each broker message, and directly by the replay benchmark.
+        Args:
+            topic (str): The topic of the message (probes/PROBE_ID/TYPE).
+            payload (str): The decoded message payload.
+        """
+        probe_sender = topic.split('/')[1]
+        topic_type = topic.split('/')[-1]
+        self.metrics.inc_counter(MQTT_MESSAGES_TOTAL, {"direction": "in", "topic_type": topic_type})
+        self.metrics.add_to_gauge(MQTT_DISPATCH_IN_FLIGHT, 1)
+        try:
+            if VERBOSE:
+                print(f"MqttClient: from topic |{topic}| -> |{payload}|")
+            if topic.endswith("results"):
+                self.external_results_handler(probe_sender, payload)
+            elif topic.endswith("status"):
+                self.external_status_handler(probe_sender, payload)
+            elif topic.endswith("errors"):
+                self.external_errors_handler(probe_sender, payload)
+            else:
+                print(f"MqttClient: topic registered but non handled -> {topic}")
+        finally:
+            self.metrics.add_to_gauge(MQTT_DISPATCH_IN_FLIGHT, -1)
 
     def check_return_code(self, rc):
         """
@@ -146,12 +180,31 @@ class Mqtt_Client(mqtt.Client):
             complete_command (str): The command payload to send.
         """
         complete_command_topic = str(self.probes_command_topic).replace("PROBE_ID", probe_id)
+        self.track_command_for_ack_rtt(probe_id, complete_command)
         self.publish(
             topic = complete_command_topic, 
             payload = complete_command,
             qos = self.config['publishing']['qos'],
             retain = self.config['publishing']['retain'] )
         
+    def track_command_for_ack_rtt(self, probe_id, complete_command):
+        """
+        Count the outgoing command and start its ACK round-trip timer (closed by the CommandsMultiplexer on ACK/NACK).
+        Args:
+            probe_id (str): The probe identifier to target.
+            complete_command (str): The JSON command payload.
+        """
+        self.metrics.inc_counter(MQTT_MESSAGES_TOTAL, {"direction": "out", "topic_type": "commands"})
+        try:
+            json_command = json.loads(complete_command)
+            if json_command.get("handler") == "root_service": # root_service commands are answered by state messages, not by ACKs
+                return
+            payload = json_command.get("payload") or {}
+            msm_id = payload.get("msm_id") if isinstance(payload, dict) else None
+            self.metrics.command_sent(probe_id, json_command.get("handler"), json_command.get("command"), msm_id)
+        except (ValueError, AttributeError):
+            pass
+
     def disconnect(self):
         """
         Disconnect from the MQTT broker and stop the network loop.
@@ -0,0 +1,94 @@
+"""
+mqtt_recorder.py
+
+This module provides the MqttRecorder class, which captures every inbound MQTT message of the coordinator
+(reception timestamp, topic and payload) in a gzip-compressed JSON-lines log, and read_mqtt_log, which reads
+such a log back (e.g. for the replay benchmark of modules/replayModule).
+The messages are written by a background thread, so that recording doesn't slow down the MQTT dispatching.
+"""
+
+import gzip
+import json
+import time
+import queue
+import threading
+
+LOG_FORMAT = "measurex-mqtt-log"
+LOG_VERSION = 1
+FLUSH_EVERY_MESSAGES = 100
+
+
+class MqttRecorder:
+    """
+    Appends the inbound MQTT messages to a gzip JSON-lines file.
+    The first line is a header {"format", "version", "started_at"}, the others are {"t", "topic", "payload"}.
+    """
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.messages_queue = queue.Queue()
+        self.recorded_messages = 0
+        self.log_file = gzip.open(log_path, mode = "at", encoding = "utf-8")
+        self.write_line({"format": LOG_FORMAT, "version": LOG_VERSION, "started_at": time.time()})
+        self.writer_thread = threading.Thread(target = self.writer_body, daemon = True)
+        self.writer_thread.start()
+        print(f"MqttRecorder: recording inbound MQTT messages in |{log_path}|")
+
+    def record(self, topic, payload, timestamp = None):
+        """
+        Enqueues a message to be written. Invoked by the MQTT client on each inbound message.
+        Args:
+            topic (str): The MQTT topic.
+            payload (bytes | str): The message payload.
+            timestamp (float, optional): The reception time. Defaults to now.
+        """
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8", errors = "replace")
+        self.messages_queue.put({"t": time.time() if (timestamp is None) else timestamp, "topic": topic, "payload": payload})
+
+    def write_line(self, record):
+        self.log_file.write(json.dumps(record, separators = (",", ":")) + "\n")
+
+    def writer_body(self):
+        while True:
+            record = self.messages_queue.get()
+            if record is None:
+                break
+            try:
+                self.write_line(record)
+                self.recorded_messages += 1
+                if (self.recorded_messages % FLUSH_EVERY_MESSAGES) == 0 or self.messages_queue.empty():
+                    self.log_file.flush()
+            except Exception as e:
+                print(f"MqttRecorder: exception while writing the log -> {e}")
+        self.log_file.close()
+
+    def close(self):
+        """
+        Writes the pending messages and closes the log.
+        """
+        self.messages_queue.put(None)
+        self.writer_thread.join()
+        print(f"MqttRecorder: recorded {self.recorded_messages} messages in |{self.log_path}|")
+
+
+def read_mqtt_log(log_path):
+    """
+    Reads a log written by MqttRecorder. Logs appended by more recordings are read as one.
+    Args:
+        log_path (str): The log path.
+    Yields:
+        tuple: (timestamp, topic, payload) of each message, in recording order.
+    """
+    with gzip.open(log_path, mode = "rt", encoding = "utf-8") as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"read_mqtt_log: skipped malformed line -> {line[:80]}")
+                continue
+            if "topic" not in record: # Header line
+                continue
+            yield record["t"], record["topic"], record["payload"]
@@ -16,6 +16,8 @@ from bson import ObjectId
 from modules.mongoModule.mongoDB import MongoDB, SECONDS_OLD_MEASUREMENT
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
 from modules.mongoModule.models.ping_result_model_mongo import PingResultModelMongo
+from modules.metricsModule.measurement_timings import TimingsTracker, MEASUREMENT_PHASE
+from modules.metricsModule.ack_timeouts import AckTimeouts
 
 class Ping_Coordinator:
     """
@@ -45,6 +47,8 @@ class Ping_Coordinator:
         self.events_received_ack_from_probe_sender = {}
         self.events_received_stop_ack = {}
         self.queued_measurements = {}
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.ack_timeouts = AckTimeouts.get_instance()
 
         # Requests to commands_multiplexer: handler STATUS registration
         registration_response = registration_handler_status_callback( interested_status = "ping",
@@ -175,34 +179,47 @@ class Ping_Coordinator:
     def store_measurement_result(self, result : json) -> bool:
         """
         Store the result of a ping measurement in MongoDB and update measurement state.
+        A multi-target result ("results": one per destination) is stored as one result document per destination.
         Args:
             result (json): The result message payload.
         Returns:
             bool: True if stored and updated successfully, False otherwise.
         """
-        ping_result = PingResultModelMongo(
-            msm_id = ObjectId(result["msm_id"]),
-            timestamp = result["timestamp"],
-            rtt_avg = result["rtt_avg"],
-            rtt_max = result["rtt_max"],
-            rtt_min = result["rtt_min"],
-            rtt_mdev = result["rtt_mdev"], # The mean deviation of the RTT values.
-            packets_sent = result["packet_transmit"],
-            packets_received = result["packet_receive"],
-            packets_loss_count = result["packet_loss_count"],
-            packets_loss_rate = result["packet_loss_rate"],
-            icmp_replies = result["icmp_replies"]
-        )
-        result_id = str(self.mongo_db.insert_result(result = ping_result))
-        if result_id is not None:
-            msm_id = result["msm_id"]
-            print(f"Ping_Coordinator: result |{result_id}| stored in db")
-            if self.mongo_db.update_results_array_in_measurement(msm_id):
-                print(f"Ping_Coordinator: updated document linking in measure: |{msm_id}|")
-                if self.mongo_db.set_measurement_as_completed(msm_id):
-                    self.print_summary_result(measurement_result = result)
-                    return True
-        print(f"Ping_Coordinator: error while storing result |{result_id}|")
+        target_results = result["results"] if ("results" in result) else [result]
+        result_ids = []
+        for target_result in target_results:
+            ping_result = PingResultModelMongo(
+                msm_id = ObjectId(result["msm_id"]),
+                timestamp = result["timestamp"],
+                rtt_avg = target_result["rtt_avg"],
+                rtt_max = target_result["rtt_max"],
+                rtt_min = target_result["rtt_min"],
+                rtt_mdev = target_result["rtt_mdev"], # The mean deviation of the RTT values.
+                packets_sent = target_result["packet_transmit"],
+                packets_received = target_result["packet_receive"],
+                packets_loss_count = target_result["packet_loss_count"],
+                packets_loss_rate = target_result["packet_loss_rate"],
+                icmp_replies = target_result["icmp_replies"],
+                process_usage = result.get("process_usage"),
+                rtt_vector = target_result.get("rtt_vector"),
+                destination = target_result.get("destination"),
+                error = target_result.get("error")
+            )
+            result_id = self.mongo_db.insert_result(result = ping_result)
+            if result_id is None:
+                print(f"Ping_Coordinator: error while storing the result of |{target_result.get('destination')}|")
+                return False
+            result_ids.append(str(result_id))
+        msm_id = result["msm_id"]
+        print(f"Ping_Coordinator: results |{result_ids}| stored in db")
+        if self.mongo_db.update_results_array_in_measurement(msm_id):
+            print(f"Ping_Coordinator: updated document linking in measure: |{msm_id}|")
+            if self.mongo_db.set_measurement_as_completed(msm_id):
+                for target_result in target_results:
+                    self.print_summary_result(measurement_result = dict(target_result, msm_id = msm_id,
+                                                                        timestamp = result["timestamp"], source = result["source"]))
+                return True
+        print(f"Ping_Coordinator: error while updating measurement |{msm_id}|")
         return False
 
 
@@ -254,19 +271,28 @@ class Ping_Coordinator:
         """
         new_measurement.assign_id()
         measurement_id = str(new_measurement._id)
+        measurement_timings = self.timings_tracker.start(measurement_id, "ping")
 
         ping_parameters = self.get_default_ping_parameters()
         ping_parameters = self.override_default_parameters(ping_parameters, new_measurement.parameters)
         new_measurement.parameters = ping_parameters.copy()
 
         if new_measurement.source_probe_ip is None or new_measurement.source_probe_ip == "":
-            source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
+            with measurement_timings.phase("ip_resolution"):
+                source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
             if source_probe_ip is None:
                 return "Error", f"No response from probe: {new_measurement.source_probe}", "Reponse Timeout"
         
+        destinations = ping_parameters.get("destinations") # Multi-target: the destinations pinged concurrently
+        if (destinations is not None) and ((not isinstance(destinations, list)) or (not destinations) or
+                                           (not all(isinstance(destination, str) for destination in destinations))):
+            return "Error", "The ping destinations must be a non empty list of IPs or host names", "Invalid parameters"
         dest_probe_ip = None # This IP is that of the "machine" that receive the ping message, not the ping initiator!
-        if (new_measurement.dest_probe != None) and (new_measurement.dest_probe != ""): # If those are both false, then the ping dest is another probe
-            dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe)
+        if destinations is not None:
+            dest_probe_ip = ",".join(destinations) # Recorded in the measurement; the probe uses the destinations list
+        elif (new_measurement.dest_probe != None) and (new_measurement.dest_probe != ""): # If those are both false, then the ping dest is another probe
+            with measurement_timings.phase("ip_resolution"):
+                dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe)
         else:
             dest_probe_ip = new_measurement.dest_probe_ip
         if dest_probe_ip is None:
@@ -276,19 +302,28 @@ class Ping_Coordinator:
                 "destination_ip": dest_probe_ip,
                 "msm_id": measurement_id,
                 "packets_number": ping_parameters["packets_number"],
-                "packets_size": ping_parameters["packets_size"] }
+                "packets_size": ping_parameters["packets_size"],
+                "packets_interval": ping_parameters.get("packets_interval", 1),
+                "protocol": ping_parameters.get("protocol", "icmp"),
+                "udp_port": ping_parameters.get("udp_port") }
+        if destinations is not None:
+            json_start_payload["destinations"] = destinations
         
         self.events_received_ack_from_probe_sender[measurement_id] = [threading.Event(), None]
-        self.send_probe_ping_start(probe_sender = new_measurement.source_probe, json_payload=json_start_payload)
+        with measurement_timings.phase("start_ack_wait"):
+            self.send_probe_ping_start(probe_sender = new_measurement.source_probe, json_payload=json_start_payload)
 
-        self.events_received_ack_from_probe_sender[measurement_id][0].wait(timeout = 5)
+            self.ack_timeouts.wait_for_ack(self.events_received_ack_from_probe_sender[measurement_id][0], new_measurement.source_probe, "ping", "start", default_timeout = 5)
         # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK FROM SENDER_PROBE (PING INITIATOR)
 
         probe_sender_event_message = self.events_received_ack_from_probe_sender[measurement_id][1]
         if probe_sender_event_message == "OK": # If the ping start succeded, then...
+            measurement_timings.start_phase(MEASUREMENT_PHASE) # The probe is already pinging
             new_measurement.source_probe_ip = source_probe_ip
             new_measurement.dest_probe_ip = dest_probe_ip
-            inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
+            new_measurement.timings = measurement_timings.to_dict()
+            with measurement_timings.phase("db_insert"):
+                inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
             if inserted_measurement_id is None:
                 print(f"Ping_Coordinator: can't start ping. Error while storing ping measurement on Mongo")
                 return "Error", "Can't send start! Error while inserting measurement ping in mongo", "MongoDB Down?"
@@ -316,7 +351,7 @@ class Ping_Coordinator:
         measurement_to_stop : MeasurementModelMongo = self.queued_measurements[msm_id_to_stop]
         self.events_received_stop_ack[msm_id_to_stop] = [threading.Event(), None]
         self.send_probe_ping_stop(probe_id = measurement_to_stop.source_probe, msm_id_to_stop = msm_id_to_stop)
-        self.events_received_stop_ack[msm_id_to_stop][0].wait(5)
+        self.ack_timeouts.wait_for_ack(self.events_received_stop_ack[msm_id_to_stop][0], measurement_to_stop.source_probe, "ping", "stop", default_timeout = 5)
         # ------------------------------- WAIT FOR RECEIVE AN ACK/NACK -------------------------------
         if self.mongo_db.set_measurement_as_failed_by_id(msm_id_to_stop):
             print(f"Ping_Coordinator: measurement |{msm_id_to_stop}| setted as failed")
@@ -354,4 +389,7 @@ class Ping_Coordinator:
                 json_overrided_config['packets_number'] = measurement_parameters['packets_number']
             if ('packets_size' in measurement_parameters):
                 json_overrided_config['packets_size'] = measurement_parameters['packets_size']
+            for key in ('packets_interval', 'protocol', 'udp_port', 'destinations'):
+                if key in measurement_parameters:
+                    json_overrided_config[key] = measurement_parameters[key]
         return json_overrided_config
\ No newline at end of file
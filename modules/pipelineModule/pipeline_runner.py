@@ -0,0 +1,341 @@
+"""
+pipeline_runner.py
+
+This module provides the PipelineRunner class, which runs experiment pipelines: DAGs of measurements submitted at once,
+such as "energy baseline -> iperf -> AoI with coex" over several probe pairs. Each node is submitted to the AdmissionQueue
+as soon as all its predecessors are completed on MongoDB (their results are stored before the completed state), so
+independent branches run in parallel wherever their probes are disjoint, and wait for each other where they are not.
+A failed node skips all its descendants; the other branches go on.
+"""
+
+import copy
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from modules.admissionModule.admission_queue import AdmissionQueue, AdmissionTicket, DISPATCHED_STATE
+from modules.metricsModule.metrics_registry import MetricsRegistry, PIPELINE_NODES_TOTAL, PIPELINE_NODE_START_DELAY_SECONDS
+from modules.mongoModule.mongoDB import MongoDB, COMPLETED_STATE, FAILED_STATE
+from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo
+
+PENDING_NODE_STATE = "pending"
+SUBMITTED_NODE_STATE = "submitted"  # In the admission queue
+RUNNING_NODE_STATE = "running"
+COMPLETED_NODE_STATE = "completed"
+FAILED_NODE_STATE = "failed"
+SKIPPED_NODE_STATE = "skipped"      # A predecessor failed, or the pipeline was cancelled
+TERMINAL_NODE_STATES = (COMPLETED_NODE_STATE, FAILED_NODE_STATE, SKIPPED_NODE_STATE)
+
+RUNNING_PIPELINE_STATE = "running"
+COMPLETED_PIPELINE_STATE = "completed"  # All the nodes completed
+FAILED_PIPELINE_STATE = "failed"        # At least one node failed or was skipped
+CANCELLED_PIPELINE_STATE = "cancelled"
+
+PIPELINE_WORKERS = 4
+PIPELINE_RETENTION_SECONDS = 24 * 3600  # Ended pipelines stay readable (GET /pipelines/{id}) for this time
+PIPELINE_USER_PREFIX = "pipeline:"      # Default admission queue user of the pipeline measurements, for the fair share
+
+
+class PipelineNode:
+    """
+    A measurement of a pipeline. spec is the node object of the request: the measurement fields (type, source_probe,
+    dest_probe, parameters, coexisting_application, description), plus id, depends_on and duration.
+    """
+    def __init__(self, spec : dict):
+        self.node_id = str(spec["id"])
+        self.depends_on = [str(node_id) for node_id in (spec.get("depends_on") or [])]
+        self.duration = spec.get("duration")    # Seconds after which the measurement is stopped, for the ones that don't end by themselves
+        self.spec = copy.deepcopy(spec)
+        self.successors = []
+        self.state = PENDING_NODE_STATE
+        self.admission_id = None
+        self.msm_id = None
+        self.ready_at = None                    # When the last predecessor completed (or the pipeline was submitted)
+        self.started_at = None
+        self.ended_at = None
+        self.error_description = None
+        self.stop_timer = None
+
+    def build_measurement(self) -> MeasurementModelMongo:
+        return MeasurementModelMongo.cast_dict_in_MeasurementModelMongo({
+            field: copy.deepcopy(value) for field, value in self.spec.items()
+            if field in ("type", "source_probe", "dest_probe", "description", "parameters", "coexisting_application")
+        })
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.node_id,
+            "type": self.spec.get("type"),
+            "source_probe": self.spec.get("source_probe"),
+            "dest_probe": self.spec.get("dest_probe"),
+            "depends_on": self.depends_on,
+            "state": self.state,
+            "admission_id": self.admission_id,
+            "msm_id": self.msm_id,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "error_description": self.error_description
+        }
+
+
+class Pipeline:
+    """
+    A submitted DAG of measurements.
+    """
+    def __init__(self, name, nodes : dict, user, priority):
+        self.pipeline_id = uuid.uuid4().hex
+        self.name = name
+        self.nodes = nodes          # Maps node_id to PipelineNode
+        self.user = user
+        self.priority = priority
+        self.state = RUNNING_PIPELINE_STATE
+        self.submitted_at = time.time()
+        self.ended_at = None
+
+    def to_dict(self) -> dict:
+        return {
+            "pipeline_id": self.pipeline_id,
+            "name": self.name,
+            "state": self.state,
+            "user": self.user,
+            "priority": self.priority,
+            "submitted_at": self.submitted_at,
+            "ended_at": self.ended_at,
+            "nodes": [node.to_dict() for node in self.nodes.values()]
+        }
+
+
+def build_nodes(node_specs : list) -> dict:
+    """
+    Creates the nodes of a pipeline and links them to their successors.
+    Returns:
+        dict: Maps node_id to PipelineNode, in topological order.
+    Raises:
+        ValueError: If a node is malformed, an id is repeated, a dependency is unknown or the graph has a cycle.
+    """
+    if (not isinstance(node_specs, list)) or (not node_specs):
+        raise ValueError("nodes must be a non-empty list")
+    nodes = {}
+    for spec in node_specs:
+        if (not isinstance(spec, dict)) or (spec.get("id") is None) or (not spec.get("type")) or (not spec.get("source_probe")):
+            raise ValueError("each node needs an id, a type and a source_probe")
+        node = PipelineNode(spec)
+        if node.node_id in nodes:
+            raise ValueError(f"node id |{node.node_id}| is repeated")
+        nodes[node.node_id] = node
+    for node in nodes.values():
+        for predecessor_id in node.depends_on:
+            if predecessor_id not in nodes:
+                raise ValueError(f"node |{node.node_id}| depends on the unknown node |{predecessor_id}|")
+            nodes[predecessor_id].successors.append(node.node_id)
+    # Kahn's algorithm: the nodes left out of the order are on a cycle
+    missing_predecessors = {node_id: len(set(node.depends_on)) for node_id, node in nodes.items()}
+    order = [node_id for node_id, count in missing_predecessors.items() if count == 0]
+    for node_id in order:
+        for successor_id in dict.fromkeys(nodes[node_id].successors):
+            missing_predecessors[successor_id] -= 1
+            if missing_predecessors[successor_id] == 0:
+                order.append(successor_id)
+    if len(order) != len(nodes):
+        raise ValueError(f"the dependencies have a cycle among {sorted(set(nodes) - set(order))}")
+    return {node_id: nodes[node_id] for node_id in order}
+
+
+class PipelineRunner:
+    """
+    Runs the pipelines. measurement_stopper is the CommandsMultiplexer.measurement_stop_by_msm_id triad method,
+    used to stop the nodes with a duration, and the running nodes of a cancelled pipeline.
+    """
+    def __init__(self, admission_queue : AdmissionQueue, measurement_stopper, mongo_db : MongoDB):
+        self.admission_queue = admission_queue
+        self.measurement_stopper = measurement_stopper
+        self.mongo_db = mongo_db
+        self.lock = threading.RLock()
+        self.pipelines = {}         # Maps pipeline_id to Pipeline
+        self.nodes_by_msm_id = {}   # Maps msm_id to the (Pipeline, PipelineNode) running it
+        self.metrics = MetricsRegistry.get_instance()
+        self.executor = ThreadPoolExecutor(max_workers = PIPELINE_WORKERS, thread_name_prefix = "pipeline")
+        self.mongo_db.add_state_change_listener(self.measurement_state_changed)
+
+    def create_pipeline(self, pipeline_as_dict : dict):
+        """
+        Validates a pipeline and submits its root nodes.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        if not isinstance(pipeline_as_dict, dict):
+            return "Error", "The pipeline must be an object", "Wrong pipeline"
+        try:
+            nodes = build_nodes(pipeline_as_dict.get("nodes"))
+        except ValueError as e:
+            return "Error", f"Invalid pipeline -> {e}", "Wrong pipeline"
+        name = pipeline_as_dict.get("name") or "pipeline"
+        pipeline = Pipeline(name, nodes, pipeline_as_dict.get("user") or (PIPELINE_USER_PREFIX + name),
+                            pipeline_as_dict.get("priority", 0))
+        with self.lock:
+            self.prune()
+            self.pipelines[pipeline.pipeline_id] = pipeline
+        print(f"PipelineRunner: pipeline |{pipeline.name}| ({pipeline.pipeline_id}) submitted with {len(nodes)} nodes")
+        self.submit_ready_nodes(pipeline)
+        return "OK", self.get_pipeline(pipeline.pipeline_id), None
+
+    def submit_ready_nodes(self, pipeline : Pipeline):
+        """
+        Submits to the admission queue the pending nodes whose predecessors are all completed.
+        """
+        with self.lock:
+            if pipeline.state != RUNNING_PIPELINE_STATE:
+                return
+            ready_nodes = [node for node in pipeline.nodes.values() if (node.state == PENDING_NODE_STATE) and
+                           all(pipeline.nodes[predecessor_id].state == COMPLETED_NODE_STATE for predecessor_id in node.depends_on)]
+            now = time.time()
+            for node in ready_nodes:
+                node.state = SUBMITTED_NODE_STATE
+                node.ready_at = now
+        for node in ready_nodes:
+            try:
+                _, info, _ = self.admission_queue.submit(node.build_measurement(), user = pipeline.user, priority = pipeline.priority,
+                                                         on_finished = lambda ticket, node = node: self.executor.submit(self.ticket_finished, pipeline, node, ticket))
+            except Exception as e:
+                print(f"PipelineRunner: exception while submitting the node |{node.node_id}| -> {e}")
+                self.end_node(pipeline, node, FAILED_NODE_STATE, f"Submission error -> {e}")
+                continue
+            with self.lock:
+                if (node.admission_id is None) and isinstance(info, dict):
+                    node.admission_id = info.get("admission_id")
+
+    def ticket_finished(self, pipeline : Pipeline, node : PipelineNode, ticket : AdmissionTicket):
+        # Runs in the executor: the admission queue invokes on_finished holding its lock
+        with self.lock:
+            node.admission_id = ticket.admission_id
+            if ticket.state != DISPATCHED_STATE:
+                error_description = ticket.error_description or f"Admission {ticket.state}"
+            else:
+                error_description = None
+                node.msm_id = ticket.msm_id
+                node.state = RUNNING_NODE_STATE
+                node.started_at = time.time()
+                self.nodes_by_msm_id[ticket.msm_id] = (pipeline, node)
+                self.metrics.observe(PIPELINE_NODE_START_DELAY_SECONDS, node.started_at - node.ready_at, {"type": node.spec.get("type")})
+                if node.duration:
+                    node.stop_timer = threading.Timer(float(node.duration), self.stop_measurement, args = (ticket.msm_id,))
+                    node.stop_timer.daemon = True
+                    node.stop_timer.start()
+        if error_description is not None:
+            self.end_node(pipeline, node, FAILED_NODE_STATE, error_description)
+            return
+        print(f"PipelineRunner: |{pipeline.name}| node |{node.node_id}| running as |{ticket.msm_id}|")
+        if pipeline.state == CANCELLED_PIPELINE_STATE: # Dispatched while the pipeline was being cancelled
+            self.stop_measurement(ticket.msm_id)
+        self.measurement_state_changed(ticket.msm_id) # It may have ended before the registration
+
+    def stop_measurement(self, msm_id):
+        success_message, info, error_cause = self.measurement_stopper(msm_id)
+        if success_message != "OK":
+            print(f"PipelineRunner: the stop of |{msm_id}| failed -> {info} ({error_cause})")
+
+    def measurement_state_changed(self, msm_id):
+        """
+        MongoDB state change listener: ends the nodes whose measurement is completed or failed, and submits their
+        successors. Invoked with None after bulk updates, which may have ended any running node.
+        """
+        with self.lock:
+            msm_ids = list(self.nodes_by_msm_id) if (msm_id is None) else ([msm_id] if msm_id in self.nodes_by_msm_id else [])
+        for running_msm_id in msm_ids:
+            state = self.mongo_db.get_measurement_state(running_msm_id)
+            if state not in (COMPLETED_STATE, FAILED_STATE):
+                continue
+            with self.lock:
+                pipeline_and_node = self.nodes_by_msm_id.pop(running_msm_id, None)
+            if pipeline_and_node is None:
+                continue # Ended by a concurrent notification
+            pipeline, node = pipeline_and_node
+            if state == COMPLETED_STATE:
+                self.end_node(pipeline, node, COMPLETED_NODE_STATE)
+            else:
+                self.end_node(pipeline, node, FAILED_NODE_STATE, "Measurement failed")
+
+    def end_node(self, pipeline : Pipeline, node : PipelineNode, state, error_description = None):
+        with self.lock:
+            if node.state in TERMINAL_NODE_STATES:
+                return
+            node.state = state
+            node.error_description = error_description
+            node.ended_at = time.time()
+            if node.stop_timer is not None:
+                node.stop_timer.cancel()
+            self.metrics.inc_counter(PIPELINE_NODES_TOTAL, {"outcome": state})
+            if state == FAILED_NODE_STATE:
+                self.skip_descendants(pipeline, node)
+            self.update_pipeline_state(pipeline)
+        print(f"PipelineRunner: |{pipeline.name}| node |{node.node_id}| {state}" + (f" -> {error_description}" if error_description else ""))
+        if state == COMPLETED_NODE_STATE:
+            self.submit_ready_nodes(pipeline)
+
+    def skip_descendants(self, pipeline : Pipeline, node : PipelineNode):
+        # Must be invoked holding the lock
+        to_visit = list(node.successors)
+        while to_visit:
+            descendant = pipeline.nodes[to_visit.pop()]
+            if descendant.state == PENDING_NODE_STATE:
+                descendant.state = SKIPPED_NODE_STATE
+                descendant.error_description = f"Predecessor |{node.node_id}| failed"
+                descendant.ended_at = time.time()
+                self.metrics.inc_counter(PIPELINE_NODES_TOTAL, {"outcome": SKIPPED_NODE_STATE})
+                to_visit.extend(descendant.successors)
+
+    def update_pipeline_state(self, pipeline : Pipeline):
+        # Must be invoked holding the lock
+        if (pipeline.state != RUNNING_PIPELINE_STATE) or any(node.state not in TERMINAL_NODE_STATES for node in pipeline.nodes.values()):
+            return
+        all_completed = all(node.state == COMPLETED_NODE_STATE for node in pipeline.nodes.values())
+        pipeline.state = COMPLETED_PIPELINE_STATE if all_completed else FAILED_PIPELINE_STATE
+        pipeline.ended_at = time.time()
+        print(f"PipelineRunner: pipeline |{pipeline.name}| {pipeline.state} in {pipeline.ended_at - pipeline.submitted_at:.1f}s")
+
+    def cancel_pipeline(self, pipeline_id):
+        """
+        Cancels a running pipeline: its queued nodes are withdrawn, its running measurements stopped and its
+        pending nodes skipped.
+        Returns:
+            tuple: (status, message, error_cause)
+        """
+        with self.lock:
+            pipeline = self.pipelines.get(pipeline_id)
+            if pipeline is None:
+                return "Error", f"Unknown pipeline |{pipeline_id}|", "Wrong id?"
+            if pipeline.state != RUNNING_PIPELINE_STATE:
+                return "Error", f"Pipeline |{pipeline_id}| is not running (state: {pipeline.state})", "Already ended?"
+            pipeline.state = CANCELLED_PIPELINE_STATE
+            pipeline.ended_at = time.time()
+            queued_admission_ids = [node.admission_id for node in pipeline.nodes.values()
+                                    if (node.state == SUBMITTED_NODE_STATE) and (node.admission_id is not None)]
+            running_msm_ids = [node.msm_id for node in pipeline.nodes.values() if node.state == RUNNING_NODE_STATE]
+            for node in pipeline.nodes.values():
+                if node.state == PENDING_NODE_STATE:
+                    node.state = SKIPPED_NODE_STATE
+                    node.error_description = "Pipeline cancelled"
+                    node.ended_at = pipeline.ended_at
+        for admission_id in queued_admission_ids:
+            self.admission_queue.cancel(admission_id)
+        for msm_id in running_msm_ids:
+            self.stop_measurement(msm_id)
+        return "OK", self.get_pipeline(pipeline_id), None
+
+    def prune(self):
+        # Must be invoked holding the lock
+        now = time.time()
+        for pipeline_id, pipeline in list(self.pipelines.items()):
+            if (pipeline.ended_at is not None) and ((now - pipeline.ended_at) > PIPELINE_RETENTION_SECONDS) and \
+                    all(node.msm_id not in self.nodes_by_msm_id for node in pipeline.nodes.values()):
+                self.pipelines.pop(pipeline_id)
+
+    def get_pipeline(self, pipeline_id):
+        with self.lock:
+            pipeline = self.pipelines.get(pipeline_id)
+            return pipeline.to_dict() if (pipeline is not None) else None
+
+    def get_pipelines(self) -> list:
+        with self.lock:
+            self.prune()
+            return [pipeline.to_dict() for pipeline in self.pipelines.values()]
@@ -0,0 +1,163 @@
+"""
+port_allocator.py
+
+This module provides the PortAllocator class, which assigns the UDP ports of the measurements that open a socket on
+the probes (AoI, UDP-ping, coex), instead of the fixed default ports. A port is assigned per probe: two measurements
+can use the same port only if they don't share any probe. The allocations are released when the measurement is
+completed or failed (its state change on MongoDB), or when its preparation fails.
+"""
+
+import threading
+from modules.mongoModule.mongoDB import MongoDB, COMPLETED_STATE, FAILED_STATE
+
+DYNAMIC_PORT_RANGE_START = 40000
+DYNAMIC_PORT_RANGE_END = 49999  # Included. A bind failure on the probe (e.g. an ephemeral port in use) is NACKed anyway
+AUTO_PORT = 0                   # Port value of the measurement parameters that asks for a dynamic port
+
+
+class PortAllocator:
+    """
+    Process-wide allocator of the measurement ports.
+    Use PortAllocator.get_instance() to obtain the shared allocator.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, range_start = DYNAMIC_PORT_RANGE_START, range_end = DYNAMIC_PORT_RANGE_END):
+        self.lock = threading.Lock()
+        self.range_start = range_start
+        self.range_end = range_end
+        self.next_port = range_start
+        self.ports_by_probe = {}    # Maps probe_id to {port: allocation key}
+        self.allocations = {}       # Maps (msm_id, purpose) to (port, probes)
+        self.mongo_db = None
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = PortAllocator()
+            return cls._instance
+
+    def watch_measurement_states(self, mongo_db : MongoDB):
+        """
+        Registers the allocator as MongoDB state change listener, to release the ports of the ended measurements.
+        """
+        with self.lock:
+            if self.mongo_db is not None:
+                return
+            self.mongo_db = mongo_db
+        mongo_db.add_state_change_listener(self.measurement_state_changed)
+
+    def is_free(self, port, probes) -> bool:
+        # Must be invoked holding the lock
+        return all(port not in self.ports_by_probe.get(probe_id, {}) for probe_id in probes)
+
+    def bind(self, key, port, probes):
+        # Must be invoked holding the lock
+        for probe_id in probes:
+            self.ports_by_probe.setdefault(probe_id, {})[port] = key
+        self.allocations[key] = (port, tuple(probes))
+
+    def allocate(self, msm_id, probes, purpose = "") -> int:
+        """
+        Assigns a port free on all the probes, scanning the dynamic range from the last assigned port (next fit),
+        so that a just released port is not reused at once.
+        Args:
+            msm_id (str): The measurement that uses the port.
+            probes (iterable): The probe ids that open the port.
+            purpose (str, optional): Distinguishes more ports of the same measurement (e.g. "coex").
+        Returns:
+            int: The port, or None if the range is exhausted for these probes.
+        """
+        key = (str(msm_id), purpose)
+        probes = [probe_id for probe_id in probes if probe_id is not None]
+        range_size = self.range_end - self.range_start + 1
+        with self.lock:
+            if key in self.allocations:
+                return self.allocations[key][0]
+            for offset in range(range_size):
+                port = self.range_start + ((self.next_port - self.range_start + offset) % range_size)
+                if self.is_free(port, probes):
+                    self.bind(key, port, probes)
+                    self.next_port = port + 1 if (port < self.range_end) else self.range_start
+                    return port
+        print(f"PortAllocator: no free port in [{self.range_start}, {self.range_end}] for probes {probes}")
+        return None
+
+    def reserve(self, msm_id, probes, port, purpose = "") -> bool:
+        """
+        Records an explicit port, requested in the measurement parameters.
+        Returns False if another measurement uses that port on one of the probes.
+        """
+        key = (str(msm_id), purpose)
+        probes = [probe_id for probe_id in probes if probe_id is not None]
+        with self.lock:
+            if key in self.allocations:
+                return self.allocations[key][0] == port
+            if not self.is_free(port, probes):
+                print(f"PortAllocator: port |{port}| already in use on probes {probes}")
+                return False
+            self.bind(key, port, probes)
+            return True
+
+    def reserve_any(self, msm_id, probes, candidate_ports, purpose = "") -> int:
+        """
+        Records the first of candidate_ports free on all the probes (e.g. the warm server ports announced by a probe).
+        Returns:
+            int: The reserved port, or None if all of them are in use.
+        """
+        key = (str(msm_id), purpose)
+        probes = [probe_id for probe_id in probes if probe_id is not None]
+        with self.lock:
+            if key in self.allocations:
+                return self.allocations[key][0]
+            for port in candidate_ports:
+                if self.is_free(port, probes):
+                    self.bind(key, port, probes)
+                    return port
+        return None
+
+    def assign(self, msm_id, probes, requested_port, purpose = "") -> int:
+        """
+        Returns the port to use: a dynamic one if requested_port is AUTO_PORT (or None), else requested_port, if free.
+        Returns None if no port can be assigned.
+        """
+        if (requested_port is None) or (int(requested_port) == AUTO_PORT):
+            return self.allocate(msm_id, probes, purpose)
+        return int(requested_port) if self.reserve(msm_id, probes, int(requested_port), purpose) else None
+
+    def release(self, msm_id) -> list:
+        """
+        Releases all the ports of the measurement. Returns the released ports.
+        """
+        released_ports = []
+        with self.lock:
+            for key in [key for key in self.allocations if key[0] == str(msm_id)]:
+                port, probes = self.allocations.pop(key)
+                for probe_id in probes:
+                    probe_ports = self.ports_by_probe.get(probe_id, {})
+                    if probe_ports.get(port) == key:
+                        probe_ports.pop(port)
+                    if not probe_ports:
+                        self.ports_by_probe.pop(probe_id, None)
+                released_ports.append(port)
+        return released_ports
+
+    def get_allocations(self) -> dict:
+        with self.lock:
+            return {f"{msm_id}/{purpose}" if purpose else msm_id: {"port": port, "probes": list(probes)}
+                    for (msm_id, purpose), (port, probes) in self.allocations.items()}
+
+    def measurement_state_changed(self, msm_id):
+        """
+        MongoDB state change listener. Invoked with None after bulk updates, which may have ended any measurement.
+        """
+        with self.lock:
+            allocated_msm_ids = {key[0] for key in self.allocations}
+        msm_ids = allocated_msm_ids if (msm_id is None) else ({str(msm_id)} & allocated_msm_ids)
+        for allocated_msm_id in msm_ids:
+            if self.mongo_db.get_measurement_state(allocated_msm_id) in (COMPLETED_STATE, FAILED_STATE):
+                released_ports = self.release(allocated_msm_id)
+                if released_ports:
+                    print(f"PortAllocator: measurement |{allocated_msm_id}| ended, released ports {released_ports}")
@@ -0,0 +1,79 @@
+"""
+Unit tests of the PortAllocator.
+Run from the repository root: python -m unittest modules.portsModule.test_port_allocator
+"""
+
+import unittest
+from modules.mongoModule.mongoDB import COMPLETED_STATE, FAILED_STATE
+from modules.portsModule.port_allocator import PortAllocator, AUTO_PORT
+
+
+class FakeMongo:
+    def __init__(self):
+        self.states = {}
+        self.listeners = []
+
+    def add_state_change_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_measurement_state(self, msm_id):
+        return self.states.get(msm_id)
+
+    def set_state(self, msm_id, state):
+        self.states[msm_id] = state
+        for listener in self.listeners:
+            listener(msm_id)
+
+
+class TestPortAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = PortAllocator(range_start = 40000, range_end = 40003)
+
+    def test_distinct_ports_on_a_shared_probe(self):
+        first = self.allocator.allocate("m1", ("p1", "p2"))
+        second = self.allocator.allocate("m2", ("p2", "p3"))
+        self.assertEqual(first, 40000)
+        self.assertNotEqual(first, second)
+
+    def test_same_measurement_gets_the_same_port(self):
+        port = self.allocator.allocate("m1", ("p1",))
+        self.assertEqual(self.allocator.allocate("m1", ("p1",)), port)
+        self.assertNotEqual(self.allocator.allocate("m1", ("p1",), purpose = "coex"), port)
+
+    def test_next_fit_does_not_reuse_a_released_port_at_once(self):
+        port = self.allocator.allocate("m1", ("p1",))
+        self.assertEqual(self.allocator.release("m1"), [port])
+        self.assertNotEqual(self.allocator.allocate("m2", ("p1",)), port)
+
+    def test_range_exhausted(self):
+        for index in range(4):
+            self.assertIsNotNone(self.allocator.allocate(f"m{index}", ("p1",)))
+        self.assertIsNone(self.allocator.allocate("m4", ("p1",)))
+        self.assertIsNotNone(self.allocator.allocate("m4", ("p2",))) # The ports are per probe
+
+    def test_explicit_port(self):
+        self.assertEqual(self.allocator.assign("m1", ("p1", "p2"), 5201), 5201)
+        self.assertIsNone(self.allocator.assign("m2", ("p2",), 5201))
+        self.assertEqual(self.allocator.assign("m3", ("p3",), 5201), 5201)
+        self.assertEqual(self.allocator.assign("m4", ("p2",), AUTO_PORT), 40000)
+
+    def test_reserve_any_of_the_candidates(self):
+        self.assertEqual(self.allocator.reserve_any("m1", ("p1",), [5201, 5202]), 5201)
+        self.assertEqual(self.allocator.reserve_any("m2", ("p1",), [5201, 5202]), 5202)
+        self.assertIsNone(self.allocator.reserve_any("m3", ("p1",), [5201, 5202]))
+
+    def test_released_when_the_measurement_ends(self):
+        mongo = FakeMongo()
+        self.allocator.watch_measurement_states(mongo)
+        self.allocator.allocate("m1", ("p1",))
+        self.allocator.allocate("m2", ("p1",))
+        mongo.set_state("m1", "started")
+        self.assertIn("m1", self.allocator.get_allocations())
+        mongo.set_state("m1", COMPLETED_STATE)
+        mongo.set_state("m2", FAILED_STATE)
+        self.assertEqual(self.allocator.get_allocations(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
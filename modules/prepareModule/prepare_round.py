@@ -0,0 +1,79 @@
+"""
+prepare_round.py
+
+This module provides PrepareRound, which collects the replies of the probes of a measurement to the combined "prepare"
+command. Instead of configuring the probes one after the other (e.g. iperf: conf server, conf client, start client,
+three serial round trips over the probe links), a preparer sends to each probe the whole configuration of its role at
+once, so the measurement is ready after one parallel round trip. The server probe ACKs when listening, the client
+probe when armed: it begins at the start_at of the command (see modules/scheduledStartModule).
+"""
+
+import threading
+from modules.metricsModule.ack_timeouts import AckTimeouts
+
+PREPARE_COMMAND = "prepare"
+DEFAULT_PREPARE_TIMEOUT = 10 # Seconds, until the ACK timeouts are estimated. It covers the slowest role (the AoI/UDP-ping client stops ntpsec and syncs its clock)
+
+
+class PrepareRound:
+    """
+    Replies of the probes of a measurement to the prepare command: "OK" for an ACK, the reason for a NACK.
+    The round is completed when every probe has replied, or at the first NACK.
+    """
+    def __init__(self, probes, handler, roles = None):
+        self.handler = handler
+        self.roles = roles or {} # Maps probe_id to the role it is prepared for: the ACK timeouts are estimated per role
+        self.lock = threading.Lock()
+        self.replies = {probe_id: None for probe_id in probes}
+        self.completed = threading.Event()
+
+    def set_reply(self, probe_id, reply : str) -> bool:
+        """
+        Records the reply of a probe. Returns False if the probe is not part of the round, or has already replied.
+        """
+        with self.lock:
+            if (probe_id not in self.replies) or (self.replies[probe_id] is not None):
+                return False
+            self.replies[probe_id] = reply
+            if (reply != "OK") or all((probe_reply is not None) for probe_reply in self.replies.values()):
+                self.completed.set()
+            return True
+
+    def timeout(self, default_timeout = DEFAULT_PREPARE_TIMEOUT) -> float:
+        """
+        Returns the seconds the round waits for the replies: the longest estimated ACK timeout of the probes.
+        A start_at sent in the prepare command must be at least this far, as a probe may ACK (armed) only at the end.
+        """
+        ack_timeouts = AckTimeouts.get_instance()
+        return max(ack_timeouts.timeout(probe_id, self.handler, PREPARE_COMMAND, default_timeout, self.roles.get(probe_id))
+                   for probe_id in self.replies)
+
+    def wait(self, default_timeout = DEFAULT_PREPARE_TIMEOUT):
+        """
+        Waits for the round completion, at most the longest estimated ACK timeout of the probes (see AckTimeouts).
+        The probes that don't reply in time are recorded as missed ACKs.
+        Returns:
+            tuple: (None, None) if every probe ACKed, otherwise (probe_id, reason) of a failed probe: the NACK reason,
+            or None if it didn't reply in time.
+        """
+        ack_timeouts = AckTimeouts.get_instance()
+        self.completed.wait(self.timeout(default_timeout))
+        with self.lock:
+            replies = dict(self.replies)
+        for probe_id, reply in replies.items():
+            if (reply is not None) and (reply != "OK"):
+                return probe_id, reply
+        silent_probes = [probe_id for probe_id, reply in replies.items() if reply is None]
+        for probe_id in silent_probes:
+            ack_timeouts.ack_missed(probe_id)
+        if silent_probes:
+            return silent_probes[0], None
+        return None, None
+
+    def probes_to_clean_up(self) -> list:
+        """
+        Returns the probes that ACKed or didn't reply: after a failed round, they may hold the measurement resources.
+        The probes that NACKed are left alone (e.g. they may be busy for another measurement).
+        """
+        with self.lock:
+            return [probe_id for probe_id, reply in self.replies.items() if (reply is None) or (reply == "OK")]
@@ -0,0 +1,193 @@
+"""
+mqtt_replay.py
+
+This module provides the MqttReplay class, which feeds a log recorded by MqttRecorder into an in-process coordinator,
+either by direct dispatch (Mqtt_Client.dispatch_message, no broker involved) or by publishing it on a (local) broker,
+at the recorded pace multiplied by a speed factor (1x, 10x, ...) or as fast as possible.
+At the end it reports throughput, per-handler latency and MongoDB write volume, read from the MetricsRegistry.
+"""
+
+import json
+import time
+import paho.mqtt.client as mqtt
+from modules.mqttModule.mqtt_recorder import read_mqtt_log
+from modules.metricsModule.metrics_registry import (MetricsRegistry, MQTT_MESSAGES_TOTAL, MQTT_DISPATCH_IN_FLIGHT,
+                                                    HANDLER_LATENCY_SECONDS, MONGO_OPERATION_LATENCY_SECONDS,
+                                                    MONGO_OPERATION_ERRORS_TOTAL)
+
+DIRECT_MODE = "direct"
+BROKER_MODE = "broker"
+MAX_SPEED = 0 # Speed factor that disables the pacing
+
+# Prefixes of the MongoDB methods (decorated with mongo_operation) that write on the database
+MONGO_WRITE_OPERATION_PREFIXES = ("insert_", "replace_", "update_", "set_", "delete_")
+# Result fields compared with time.time() by the coordinators, to discard the expired results
+RESULT_TIMESTAMP_FIELDS = ("timestamp", "start_timestamp")
+DRAIN_POLL_SECONDS = 0.1
+
+
+class MqttReplay:
+    """
+    Replays a recorded MQTT log. The messages are loaded in memory before the run, so that the log reading
+    doesn't weigh on the measured throughput.
+    """
+    def __init__(self, log_path, mqtt_client, mode = DIRECT_MODE, speed = 1.0, rebase_timestamps = True, drain_timeout = 60):
+        """
+        Args:
+            log_path (str): The log written by MqttRecorder.
+            mqtt_client (Mqtt_Client): The client of the in-process coordinator.
+            mode (str): DIRECT_MODE (dispatch_message) or BROKER_MODE (publish on the broker of mqtt_client).
+            speed (float): Multiplier of the recorded pace. MAX_SPEED replays without waits.
+            rebase_timestamps (bool): Shift the result timestamps as if the messages were recorded now, so that
+                the coordinators don't discard them as expired.
+            drain_timeout (float): In BROKER_MODE, max seconds to wait for the coordinator to dispatch all the messages.
+        """
+        self.log_path = log_path
+        self.mqtt_client = mqtt_client
+        self.mode = mode
+        self.speed = speed
+        self.rebase_timestamps = rebase_timestamps
+        self.drain_timeout = drain_timeout
+        self.metrics = MetricsRegistry.get_instance()
+        self.publisher = None
+        self.messages = self.load_messages()
+
+    def load_messages(self) -> list:
+        messages = list(read_mqtt_log(self.log_path))
+        if self.rebase_timestamps and messages:
+            shift = time.time() - messages[0][0]
+            messages = [(t, topic, self.rebase_payload(topic, payload, shift)) for t, topic, payload in messages]
+        print(f"MqttReplay: loaded {len(messages)} messages from |{self.log_path}|")
+        return messages
+
+    @staticmethod
+    def rebase_payload(topic, payload, shift) -> str:
+        if not topic.endswith("results"):
+            return payload
+        try:
+            json_payload = json.loads(payload)
+            result = json_payload.get("payload")
+            if not isinstance(result, dict):
+                return payload
+            for field in RESULT_TIMESTAMP_FIELDS:
+                if isinstance(result.get(field), (int, float)):
+                    result[field] += shift
+            return json.dumps(json_payload)
+        except (ValueError, AttributeError):
+            return payload
+
+    def connect_publisher(self):
+        """
+        Connects a second client, with the broker settings of the coordinator one, that publishes the recorded messages.
+        """
+        config = self.mqtt_client.config
+        self.publisher = mqtt.Client(client_id = f"{config['client_id']}-replay", clean_session = True)
+        if config['broker']['login']:
+            self.publisher.username_pw_set(config['credentials']['username'], config['credentials']['password'])
+        if self.mqtt_client.mosquitto_certificate_path is not None:
+            self.publisher.tls_set(ca_certs = self.mqtt_client.mosquitto_certificate_path, tls_version = mqtt.ssl.PROTOCOL_TLSv1_2)
+        self.publisher.connect(config['broker']['host'], config['broker']['port'], config['broker']['keep_alive'])
+        self.publisher.loop_start()
+        deadline = time.monotonic() + self.drain_timeout
+        while (not self.mqtt_client.connected_to_broker) and (time.monotonic() < deadline):
+            time.sleep(DRAIN_POLL_SECONDS)
+        if not self.mqtt_client.connected_to_broker:
+            raise ConnectionError("the coordinator client is not connected to the broker")
+        time.sleep(DRAIN_POLL_SECONDS) # Lets the coordinator client complete its subscriptions
+
+    def inbound_messages_count(self) -> int:
+        values = self.metrics.get_values(MQTT_MESSAGES_TOTAL)
+        return sum(value for labels, value in values.items() if ("direction", "in") in labels)
+
+    def wait_for_drain(self, expected_inbound) -> bool:
+        deadline = time.monotonic() + self.drain_timeout
+        while time.monotonic() < deadline:
+            in_flight = self.metrics.get_values(MQTT_DISPATCH_IN_FLIGHT).get((), 0)
+            if (self.inbound_messages_count() >= expected_inbound) and (in_flight == 0):
+                return True
+            time.sleep(DRAIN_POLL_SECONDS)
+        return False
+
+    def run(self) -> dict:
+        """
+        Replays all the loaded messages and returns the report.
+        """
+        if self.mode == BROKER_MODE:
+            self.connect_publisher()
+        mongo_operations_before = self.mongo_operations_count()
+        inbound_before = self.inbound_messages_count()
+        dispatch_errors = 0
+        payload_bytes = 0
+        schedule_lags = []
+
+        start = time.monotonic()
+        first_timestamp = self.messages[0][0] if self.messages else 0
+        for timestamp, topic, payload in self.messages:
+            if self.speed != MAX_SPEED:
+                due_time = start + (timestamp - first_timestamp) / self.speed
+                wait = due_time - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                schedule_lags.append(max(time.monotonic() - due_time, 0.0))
+            payload_bytes += len(payload.encode("utf-8"))
+            try:
+                if self.mode == BROKER_MODE:
+                    self.publisher.publish(topic = topic, payload = payload, qos = self.mqtt_client.config['publishing']['qos'])
+                else:
+                    self.mqtt_client.dispatch_message(topic, payload)
+            except Exception as e:
+                dispatch_errors += 1
+                print(f"MqttReplay: exception while dispatching a message on |{topic}| -> {e}")
+
+        drained = True
+        if self.mode == BROKER_MODE:
+            drained = self.wait_for_drain(inbound_before + len(self.messages))
+            self.publisher.loop_stop()
+            self.publisher.disconnect()
+        elapsed = time.monotonic() - start
+        return self.build_report(elapsed, payload_bytes, dispatch_errors, schedule_lags, drained,
+                                 mongo_operations_before, self.inbound_messages_count() - inbound_before)
+
+    def mongo_operations_count(self) -> dict:
+        latencies = self.metrics.get_values(MONGO_OPERATION_LATENCY_SECONDS)
+        errors = self.metrics.get_values(MONGO_OPERATION_ERRORS_TOTAL)
+        operations = {dict(labels)["operation"]: {"count": histogram.count, "errors": 0} for labels, histogram in latencies.items()}
+        for labels, value in errors.items():
+            operations.setdefault(dict(labels)["operation"], {"count": 0, "errors": 0})["errors"] = value
+        return operations
+
+    def build_report(self, elapsed, payload_bytes, dispatch_errors, schedule_lags, drained,
+                     mongo_operations_before, dispatched_messages) -> dict:
+        mongo_operations = {}
+        for operation, counts in self.mongo_operations_count().items():
+            before = mongo_operations_before.get(operation, {"count": 0, "errors": 0})
+            delta = {"count": counts["count"] - before["count"], "errors": counts["errors"] - before["errors"]}
+            if delta["count"] or delta["errors"]:
+                mongo_operations[operation] = delta
+
+        handler_latency = {}
+        for labels, histogram in self.metrics.get_values(HANDLER_LATENCY_SECONDS).items():
+            labels = dict(labels)
+            handler_latency[f"{labels.get('handler')}/{labels.get('topic_type')}"] = histogram.to_dict()
+
+        schedule_lags.sort()
+        return {
+            "mode": self.mode,
+            "speed": "max" if (self.speed == MAX_SPEED) else self.speed,
+            "messages": len(self.messages),
+            "dispatched_messages": dispatched_messages,
+            "dispatch_errors": dispatch_errors,
+            "drained": drained,
+            "payload_bytes": payload_bytes,
+            "elapsed_seconds": elapsed,
+            "throughput_messages_per_second": (len(self.messages) / elapsed) if elapsed > 0 else None,
+            "schedule_lag_seconds": {
+                "p50": schedule_lags[len(schedule_lags) // 2] if schedule_lags else None,
+                "p99": schedule_lags[int(len(schedule_lags) * 0.99)] if schedule_lags else None,
+                "max": schedule_lags[-1] if schedule_lags else None
+            },
+            "handler_latency_seconds": handler_latency,
+            "mongo_writes": sum(counts["count"] for operation, counts in mongo_operations.items()
+                                if operation.startswith(MONGO_WRITE_OPERATION_PREFIXES)),
+            "mongo_operations": mongo_operations
+        }
@@ -1,11 +1,17 @@
 import connexion
 import six
-from flask import current_app, Flask, jsonify
+from flask import current_app, Flask
 from modules.restAPIModule.swagger_server.rest_server import KEY_FOR_RETRIEVE_MONGO_INSTANCE
 from modules.restAPIModule.swagger_server.rest_server import KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER
+from modules.restAPIModule.swagger_server.rest_server import KEY_FOR_RETRIEVE_RESPONSE_CACHE
+from modules.restAPIModule.swagger_server.rest_server import KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER
+from modules.restAPIModule.swagger_server.rest_server import KEY_FOR_RETRIEVE_PIPELINE_RUNNER
+from modules.restAPIModule.swagger_server.response_cache import ResponseCache, CachedResponse
 from modules.mongoModule.mongoDB import MongoDB
 from modules.commandsMultiplexer.commands_multiplexer import CommandsMultiplexer
 
+from modules.metricsModule.metrics_registry import MetricsRegistry
+from modules.metricsModule.measurement_timings import aggregate_phase_percentiles
 from modules.mongoModule.models.error_model import ErrorModel  # noqa: E501
 from modules.mongoModule.models.measurement_model_mongo import MeasurementModelMongo  # noqa: E501
 
@@ -15,6 +21,8 @@ from swagger_server.models.inline_response2002 import InlineResponse2002  # noqa
 from swagger_server import util
 from bson import ObjectId
 import json
+import math
+import time
 
 # Funzione per serializzare ObjectId
 def json_serial(obj):
@@ -23,6 +31,31 @@ def json_serial(obj):
     raise TypeError("Type not serializable")
 
 
+def cached_response_to_return(cached_response : CachedResponse):
+    # Returns 304 without body if the client already has this version (If-None-Match), else the cached body with its ETag
+    if (cached_response.status == 200) and ResponseCache.etag_matches(connexion.request.headers.get("If-None-Match"), cached_response.etag):
+        return "", 304, {"ETag": cached_response.etag}
+    if cached_response.status != 200:
+        return cached_response.body, cached_response.status
+    return cached_response.body, cached_response.status, {"ETag": cached_response.etag}
+
+
+def admission_options_error(admission):
+    # Returns why the admission options of a measurement request are malformed, None if they are fine
+    if not isinstance(admission, dict):
+        return "admission must be an object"
+    priority = admission.get("priority", 0)
+    if isinstance(priority, bool) or (not isinstance(priority, int)):
+        return f"priority must be an integer -> |{priority}|"
+    deadline = admission.get("deadline")
+    if deadline is not None:
+        if isinstance(deadline, bool) or (not isinstance(deadline, (int, float))) or (not math.isfinite(deadline)):
+            return f"deadline must be a UNIX time -> |{deadline}|"
+        if deadline <= time.time():
+            return f"deadline is in the past -> |{deadline}|"
+    return None
+
+
 def create_measurement(body):  # noqa: E501
     """Create a new measurement.
 
@@ -42,9 +75,20 @@ def create_measurement(body):  # noqa: E501
                 error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="measurement", error_description=msg_to_return, error_cause="Missing field").to_dict()
                 return error_msg_to_return, 400
             commands_multiplexer : CommandsMultiplexer = current_app.config.get(KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER)
-            successs_message, info, error_cause = commands_multiplexer.prepare_probes_to_measure(measurement)
+            admission = connexion.request.get_json().get("admission") or {}
+            admission_error = admission_options_error(admission)
+            if admission_error is not None:
+                error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="measurement", error_description=admission_error, error_cause="Wrong admission options").to_dict()
+                return error_msg_to_return, 400
+            successs_message, info, error_cause = commands_multiplexer.admission_queue.submit(measurement,
+                                                                                             user = admission.get("user"),
+                                                                                             priority = admission.get("priority", 0),
+                                                                                             deadline = admission.get("deadline"),
+                                                                                             queue_if_busy = admission.get("queue", True))
             if successs_message == "OK":
                 return info, 200
+            elif successs_message == "QUEUED": # The probes are busy: the measurement starts when they are released
+                return info, 202
             else:
                 error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="measurement", error_description=info, error_cause=error_cause).to_dict()
                 return error_msg_to_return, 400
@@ -58,6 +102,56 @@ def create_measurement(body):  # noqa: E501
                 return error_msg_to_return, 400
 
 
+def get_admission_queues():  # noqa: E501
+    """Get the admission queues.
+
+    Returns the probes and interference groups held by the active measurements, for each of them the queued measurement requests in dispatch order, and the interference groups with their probes. # noqa: E501
+
+
+    :rtype: Object
+    """
+    commands_multiplexer : CommandsMultiplexer = current_app.config.get(KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER)
+    admission_queues = commands_multiplexer.admission_queue.get_queues()
+    admission_queues["interference_groups"] = commands_multiplexer.get_interference_groups()
+    return admission_queues, 200
+
+
+def get_admission_by_id(admission_id):  # noqa: E501
+    """Retrieve a queued measurement request.
+
+    Returns the state of the request (queued, dispatching, dispatched, failed, expired, cancelled) and, once dispatched, its measurement ID. # noqa: E501
+
+    :param admission_id: The ID returned by the creation of the queued measurement.
+    :type admission_id: str
+
+    :rtype: Object
+    """
+    commands_multiplexer : CommandsMultiplexer = current_app.config.get(KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER)
+    ticket = commands_multiplexer.admission_queue.get_ticket(admission_id)
+    if ticket is None:
+        error_msg_to_return = ErrorModel(object_ref_id=admission_id, object_ref_type="admission", error_description="Unknown admission", error_cause="Wrong id?").to_dict()
+        return error_msg_to_return, 404
+    return ticket, 200
+
+
+def cancel_admission_by_id(admission_id):  # noqa: E501
+    """Cancel a queued measurement request.
+
+    Removes the request from the admission queues. Returns an error if the request was already dispatched. # noqa: E501
+
+    :param admission_id: The ID returned by the creation of the queued measurement.
+    :type admission_id: str
+
+    :rtype: Object
+    """
+    commands_multiplexer : CommandsMultiplexer = current_app.config.get(KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER)
+    success_message, info, error_cause = commands_multiplexer.admission_queue.cancel(admission_id)
+    if success_message == "OK":
+        return info, 200
+    error_msg_to_return = ErrorModel(object_ref_id=admission_id, object_ref_type="admission", error_description=info, error_cause=error_cause).to_dict()
+    return error_msg_to_return, 400
+
+
 def get_measurement_by_id(measurement_id):  # noqa: E501
     """Retrieve a specific measurement by ID.
 
@@ -70,10 +164,16 @@ def get_measurement_by_id(measurement_id):  # noqa: E501
     """
 
     mongo_instance : MongoDB = current_app.config.get(KEY_FOR_RETRIEVE_MONGO_INSTANCE)
-    measurement_readed = mongo_instance.find_measurement_by_id(measurement_id=measurement_id)
-    if isinstance(measurement_readed, ErrorModel): #"error_cause" in measurement_readed:
-        return measurement_readed.to_dict(), 400
-    return measurement_readed.to_dict(), 200
+    response_cache : ResponseCache = current_app.config.get(KEY_FOR_RETRIEVE_RESPONSE_CACHE)
+
+    def load_measurement():
+        measurement_readed = mongo_instance.find_measurement_by_id(measurement_id=measurement_id)
+        if isinstance(measurement_readed, ErrorModel): #"error_cause" in measurement_readed:
+            return measurement_readed.to_dict(), 400, None
+        return json.loads(json.dumps(measurement_readed.to_dict(), default=json_serial)), 200, measurement_readed.state
+
+    cached_response = response_cache.get_or_load(ResponseCache.measurement_key(measurement_id), load_measurement)
+    return cached_response_to_return(cached_response)
 
 
 def get_measurement_results_by_measurement_id(measurement_id):  # noqa: E501
@@ -120,7 +220,47 @@ def get_measurex_general_info():  # noqa: E501
 
     :rtype: InlineResponse200
     """
-    return 'do some magic!'
+    general_info = {
+        "msg": "Measure X is a tool that helps you to perform 5G measurements, including latency, throughput, jitter, Age of Information, and Power Consumption analysis.",
+        "metrics": MetricsRegistry.get_instance().snapshot()
+    }
+    return general_info, 200
+
+
+def get_metrics():  # noqa: E501
+    """Get the coordinator runtime metrics.
+
+    Returns the coordinator runtime metrics in the Prometheus text exposition format. # noqa: E501
+
+
+    :rtype: str
+    """
+    return MetricsRegistry.get_instance().render_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def get_measurement_timings_percentiles(type=None, probe=None):  # noqa: E501
+    """Get the lifecycle phase percentiles.
+
+    Returns the p50/p90/p99 of each lifecycle phase of the most recent measurements, by measurement type and probe. # noqa: E501
+
+    :param type: The measurement type to aggregate.
+    :type type: str
+    :param probe: The probe to aggregate.
+    :type probe: str
+
+    :rtype: Object
+    """
+    mongo_instance : MongoDB = current_app.config.get(KEY_FOR_RETRIEVE_MONGO_INSTANCE)
+    try:
+        measurements = mongo_instance.find_measurements_timings(measurement_type = type, probe_id = probe)
+    except Exception as e:
+        error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="measurement", error_description="Error while reading the measurements timings", error_cause=str(e)).to_dict()
+        return error_msg_to_return, 500
+    percentiles = aggregate_phase_percentiles(measurements)
+    if probe is not None:
+        # A measurement involves two probes: keep only the samples attributed to the requested one
+        percentiles = {msm_type: {probe: probes[probe]} for msm_type, probes in percentiles.items() if probe in probes}
+    return percentiles, 200
 
 
 def get_result_by_measurement_id(measurement_id):  # noqa: E501
@@ -134,11 +274,21 @@ def get_result_by_measurement_id(measurement_id):  # noqa: E501
     :rtype: List[Object]
     """
     mongo_instance : MongoDB = current_app.config.get(KEY_FOR_RETRIEVE_MONGO_INSTANCE)
-    
-    result_list_as_dict = mongo_instance.find_all_results_by_measurement_id(msm_id = measurement_id)
-    if isinstance(result_list_as_dict, dict): #"error_cause" in measurement_readed:
-        return result_list_as_dict, 400
-    return jsonify(results=json.loads(json.dumps(result_list_as_dict, default=json_serial))), 200
+    response_cache : ResponseCache = current_app.config.get(KEY_FOR_RETRIEVE_RESPONSE_CACHE)
+
+    def load_results():
+        # The measurement state is read before the results, so a "started" measurement never yields a never-expiring entry
+        measurement_state = mongo_instance.get_measurement_state(measurement_id) if ObjectId.is_valid(measurement_id) else None
+        result_list_as_dict = mongo_instance.find_all_results_by_measurement_id(msm_id = measurement_id)
+        if isinstance(result_list_as_dict, dict): #"error_cause" in measurement_readed:
+            return result_list_as_dict, 400, None
+        # Results of unknown measurements are treated as running ones, so they are never cached forever
+        if measurement_state is None:
+            measurement_state = "started"
+        return {"results": json.loads(json.dumps(result_list_as_dict, default=json_serial))}, 200, measurement_state
+
+    cached_response = response_cache.get_or_load(ResponseCache.results_key(measurement_id), load_results)
+    return cached_response_to_return(cached_response)
 
 
 def stop_measurement_by_id(measurement_id):  # noqa: E501
@@ -158,3 +308,154 @@ def stop_measurement_by_id(measurement_id):  # noqa: E501
     
     error_msg_to_return = ErrorModel(object_ref_id = measurement_id, object_ref_type="measurement", error_description=info, error_cause=error_cause).to_dict()
     return error_msg_to_return, 400
+
+
+def get_all_campaigns():  # noqa: E501
+    """Get all the measurement campaigns.
+
+    Returns the recurring measurement campaigns, with their next run time and their run statistics. # noqa: E501
+
+
+    :rtype: List[CampaignModel]
+    """
+    campaign_scheduler = current_app.config.get(KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER)
+    return campaign_scheduler.get_campaigns(), 200
+
+
+def create_campaign(body):  # noqa: E501
+    """Create a recurring measurement campaign.
+
+    Stores the campaign and schedules its runs. Each run creates the measurements of the templates and submits them to the admission queues. Returns an error if the schedule or the templates are malformed. # noqa: E501
+
+    :param body: 
+    :type body: dict | bytes
+
+    :rtype: CampaignModel
+    """
+    if not connexion.request.is_json:
+        error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="campaign", error_description="JSON payload expected", error_cause="Wrong payload").to_dict()
+        return error_msg_to_return, 400
+    campaign_scheduler = current_app.config.get(KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER)
+    success_message, info, error_cause = campaign_scheduler.create_campaign(connexion.request.get_json())
+    if success_message == "OK":
+        return info, 200
+    error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="campaign", error_description=info, error_cause=error_cause).to_dict()
+    return error_msg_to_return, 400
+
+
+def get_campaign_by_id(campaign_id):  # noqa: E501
+    """Retrieve a measurement campaign.
+
+    :param campaign_id: The ID of the campaign.
+    :type campaign_id: str
+
+    :rtype: CampaignModel
+    """
+    campaign_scheduler = current_app.config.get(KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER)
+    campaign = campaign_scheduler.get_campaign(campaign_id)
+    if isinstance(campaign, ErrorModel):
+        return campaign.to_dict(), 404
+    return campaign, 200
+
+
+def delete_campaign_by_id(campaign_id):  # noqa: E501
+    """Delete a measurement campaign.
+
+    Cancels the next runs of the campaign. A run in progress completes, and the measurements already run are kept. # noqa: E501
+
+    :param campaign_id: The ID of the campaign.
+    :type campaign_id: str
+
+    :rtype: CampaignModel
+    """
+    campaign_scheduler = current_app.config.get(KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER)
+    success_message, info, error_cause = campaign_scheduler.delete_campaign(campaign_id)
+    if success_message == "OK":
+        return info, 200
+    error_msg_to_return = ErrorModel(object_ref_id=campaign_id, object_ref_type="campaign", error_description=info, error_cause=error_cause).to_dict()
+    return error_msg_to_return, 400
+
+
+def run_campaign_by_id(campaign_id):  # noqa: E501
+    """Run a measurement campaign now.
+
+    Starts a run of the campaign out of its schedule. Returns an error if a run of the campaign is in progress. # noqa: E501
+
+    :param campaign_id: The ID of the campaign.
+    :type campaign_id: str
+
+    :rtype: CampaignModel
+    """
+    campaign_scheduler = current_app.config.get(KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER)
+    success_message, info, error_cause = campaign_scheduler.run_now(campaign_id)
+    if success_message == "OK":
+        return info, 200
+    error_msg_to_return = ErrorModel(object_ref_id=campaign_id, object_ref_type="campaign", error_description=info, error_cause=error_cause).to_dict()
+    return error_msg_to_return, 400
+
+
+def get_all_pipelines():  # noqa: E501
+    """Get all the experiment pipelines.
+
+    Returns the running pipelines and the recently ended ones, with the state of each node. # noqa: E501
+
+
+    :rtype: List[PipelineModel]
+    """
+    pipeline_runner = current_app.config.get(KEY_FOR_RETRIEVE_PIPELINE_RUNNER)
+    return pipeline_runner.get_pipelines(), 200
+
+
+def create_pipeline(body):  # noqa: E501
+    """Submit an experiment pipeline.
+
+    Submits a DAG of measurements. Each node starts as soon as all the nodes it depends on are completed; independent branches run in parallel. Returns an error if a node is malformed or the dependencies have a cycle. # noqa: E501
+
+    :param body: 
+    :type body: dict | bytes
+
+    :rtype: PipelineModel
+    """
+    if not connexion.request.is_json:
+        error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="pipeline", error_description="JSON payload expected", error_cause="Wrong payload").to_dict()
+        return error_msg_to_return, 400
+    pipeline_runner = current_app.config.get(KEY_FOR_RETRIEVE_PIPELINE_RUNNER)
+    success_message, info, error_cause = pipeline_runner.create_pipeline(connexion.request.get_json())
+    if success_message == "OK":
+        return info, 200
+    error_msg_to_return = ErrorModel(object_ref_id='', object_ref_type="pipeline", error_description=info, error_cause=error_cause).to_dict()
+    return error_msg_to_return, 400
+
+
+def get_pipeline_by_id(pipeline_id):  # noqa: E501
+    """Retrieve an experiment pipeline.
+
+    :param pipeline_id: The ID of the pipeline.
+    :type pipeline_id: str
+
+    :rtype: PipelineModel
+    """
+    pipeline_runner = current_app.config.get(KEY_FOR_RETRIEVE_PIPELINE_RUNNER)
+    pipeline = pipeline_runner.get_pipeline(pipeline_id)
+    if pipeline is None:
+        error_msg_to_return = ErrorModel(object_ref_id=pipeline_id, object_ref_type="pipeline", error_description="Unknown pipeline", error_cause="Wrong id?").to_dict()
+        return error_msg_to_return, 404
+    return pipeline, 200
+
+
+def cancel_pipeline_by_id(pipeline_id):  # noqa: E501
+    """Cancel an experiment pipeline.
+
+    Withdraws the queued nodes, stops the running measurements and skips the nodes not yet started. # noqa: E501
+
+    :param pipeline_id: The ID of the pipeline.
+    :type pipeline_id: str
+
+    :rtype: PipelineModel
+    """
+    pipeline_runner = current_app.config.get(KEY_FOR_RETRIEVE_PIPELINE_RUNNER)
+    success_message, info, error_cause = pipeline_runner.cancel_pipeline(pipeline_id)
+    if success_message == "OK":
+        return info, 200
+    error_msg_to_return = ErrorModel(object_ref_id=pipeline_id, object_ref_type="pipeline", error_description=info, error_cause=error_cause).to_dict()
+    return error_msg_to_return, 400
@@ -0,0 +1,213 @@
+"""
+response_cache.py
+
+This module provides the ResponseCache class, a read-through cache for the hot REST reads
+(GET /measurements/{id} and GET /results/{id}). Entries are bounded by their serialized size
+in bytes and evicted in LRU order. Entries of measurements in a terminal state (completed/failed)
+never expire, while entries of "started" measurements live only for a short TTL and are
+invalidated as soon as the MongoDB module reports a state transition.
+Concurrent reads of the same key are coalesced, so only one of them hits MongoDB.
+"""
+
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_STARTED_TTL_SECONDS = 2.0
+STARTED_STATE = "started"
+
+MEASUREMENT_KEY_PREFIX = "measurement"
+RESULTS_KEY_PREFIX = "results"
+
+
+class CachedResponse:
+    """
+    A cached REST response: the JSON-ready body, its HTTP status, the ETag and the size in bytes.
+    """
+    def __init__(self, body, status, etag, size, expires_at = None):
+        self.body = body
+        self.status = status
+        self.etag = etag
+        self.size = size
+        self.expires_at = expires_at
+
+    def is_expired(self, now) -> bool:
+        return (self.expires_at is not None) and (now >= self.expires_at)
+
+
+class _InFlightLoad:
+    """
+    A load in progress for a key. Followers wait on the event and read the leader's outcome.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.exception = None
+
+
+class ResponseCache:
+    """
+    Byte-bounded LRU cache with single-flight loading, TTL for running measurements and ETag support.
+    """
+
+    def __init__(self, max_bytes = DEFAULT_MAX_BYTES, started_ttl_seconds = DEFAULT_STARTED_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.started_ttl_seconds = started_ttl_seconds
+        self.lock = threading.Lock()
+        self.entries : OrderedDict[str, CachedResponse] = OrderedDict()
+        self.current_bytes = 0
+        self.in_flight : dict[str, _InFlightLoad] = {}
+        self.generations : dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def measurement_key(measurement_id) -> str:
+        return f"{MEASUREMENT_KEY_PREFIX}:{measurement_id}"
+
+    @staticmethod
+    def results_key(measurement_id) -> str:
+        return f"{RESULTS_KEY_PREFIX}:{measurement_id}"
+
+    @staticmethod
+    def serialize(body) -> bytes:
+        """
+        Serializes a body in a stable way (sorted keys), so that equal bodies have equal ETags.
+        Non JSON-native values (ObjectId, datetime, ...) are serialized as strings.
+        """
+        return json.dumps(body, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+
+    @staticmethod
+    def etag_matches(if_none_match_header, etag) -> bool:
+        """
+        Checks an If-None-Match header value against an ETag (weak comparison, as per RFC 7232).
+        """
+        if (not if_none_match_header) or (etag is None):
+            return False
+        if if_none_match_header.strip() == "*":
+            return True
+        for candidate in if_none_match_header.split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == etag:
+                return True
+        return False
+
+    def get_or_load(self, key, loader) -> CachedResponse:
+        """
+        Returns the cached response for key, loading it with loader on a miss.
+        Args:
+            key (str): The cache key (see measurement_key / results_key).
+            loader (callable): Returns the triad (body, status, measurement_state).
+                Only responses with status 200 are stored. If measurement_state is "started",
+                the entry expires after started_ttl_seconds.
+        Returns:
+            CachedResponse: The response, either cached or freshly loaded.
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                if not cached.is_expired(time.monotonic()):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return cached
+                self._remove_entry(key)
+            flight = self.in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _InFlightLoad()
+                self.in_flight[key] = flight
+                generation = self.generations.get(key, 0)
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            flight.event.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.response
+
+        try:
+            body, status, measurement_state = loader()
+            serialized = self.serialize(body)
+            response = CachedResponse(body = body, status = status,
+                                      etag = '"' + hashlib.sha1(serialized).hexdigest() + '"',
+                                      size = len(serialized))
+            if measurement_state == STARTED_STATE:
+                response.expires_at = time.monotonic() + self.started_ttl_seconds
+            with self.lock:
+                # If an invalidation arrived while loading, the loaded body may be stale: serve it, but don't store it.
+                if (status == 200) and (self.generations.get(key, 0) == generation):
+                    self._store_entry(key, response)
+            flight.response = response
+            return response
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.event.set()
+
+    def invalidate_measurement(self, measurement_id):
+        """
+        Drops the cached measurement and results of measurement_id. Registered as MongoDB state change listener.
+        If measurement_id is None (bulk update), all the entries of running measurements are dropped.
+        """
+        with self.lock:
+            if measurement_id is None:
+                for key in [key for key, entry in self.entries.items() if entry.expires_at is not None]:
+                    self._invalidate_key(key)
+                return
+            self._invalidate_key(self.measurement_key(measurement_id))
+            self._invalidate_key(self.results_key(measurement_id))
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._invalidate_key(key)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions
+            }
+
+    # The following methods must be invoked holding self.lock
+
+    def _invalidate_key(self, key):
+        # The generation is only needed to tell an in-flight load that its body is stale
+        if key in self.in_flight:
+            self.generations[key] = self.generations.get(key, 0) + 1
+        else:
+            self.generations.pop(key, None)
+        self._remove_entry(key)
+
+    def _remove_entry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry.size
+
+    def _store_entry(self, key, response : CachedResponse):
+        if response.size > self.max_bytes:
+            return
+        self._remove_entry(key)
+        self.entries[key] = response
+        self.current_bytes += response.size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last = False)
+            self.current_bytes -= evicted.size
+            self.evictions += 1
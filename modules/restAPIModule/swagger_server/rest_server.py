@@ -6,20 +6,30 @@ import threading
 import connexion
 from modules.restAPIModule.swagger_server import encoder
 from modules.mongoModule.mongoDB import MongoDB
+from modules.restAPIModule.swagger_server.response_cache import ResponseCache
 
 current_directory = os.getcwd()
 sys.path.append(os.path.join(current_directory, 'modules', 'restAPIModule'))
 
 KEY_FOR_RETRIEVE_MONGO_INSTANCE = 'MONGO_INSTANCE'
 KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER = 'COMMAND_MULTIPLEXER_INSTANCE'
+KEY_FOR_RETRIEVE_RESPONSE_CACHE = 'RESPONSE_CACHE_INSTANCE'
+KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER = 'CAMPAIGN_SCHEDULER_INSTANCE'
+KEY_FOR_RETRIEVE_PIPELINE_RUNNER = 'PIPELINE_RUNNER_INSTANCE'
 
 class RestServer:
-    def __init__(self, mongo_instance : MongoDB, commands_multiplexer_instance = None):
+    def __init__(self, mongo_instance : MongoDB, commands_multiplexer_instance = None, response_cache : ResponseCache = None,
+                 campaign_scheduler_instance = None, pipeline_runner_instance = None):
         self.app = connexion.App(__name__, specification_dir='./swagger/')
         self.app.app.json_encoder = encoder.JSONEncoder
         self.app.add_api('swagger.yaml', arguments={'title': 'MeasureX RestAPI'}, pythonic_params=True)
         self.app.app.config[KEY_FOR_RETRIEVE_MONGO_INSTANCE] = mongo_instance
         self.app.app.config[KEY_FOR_RETIREVE_COMMANDS_MULTIPLEXER] = commands_multiplexer_instance
+        self.response_cache = ResponseCache() if response_cache is None else response_cache
+        mongo_instance.add_state_change_listener(self.response_cache.invalidate_measurement) # Every state transition on mongo drops the stale entries
+        self.app.app.config[KEY_FOR_RETRIEVE_RESPONSE_CACHE] = self.response_cache
+        self.app.app.config[KEY_FOR_RETRIEVE_CAMPAIGN_SCHEDULER] = campaign_scheduler_instance
+        self.app.app.config[KEY_FOR_RETRIEVE_PIPELINE_RUNNER] = pipeline_runner_instance
         self.server_thread = None
 
     def body_thread(self):
@@ -0,0 +1,49 @@
+"""
+scheduled_start.py
+
+This module provides the absolute start times ("start at T") of the start commands sent to the probes. Instead of
+starting when the command arrives (so, after the MQTT latency of each probe, and after the previous commands of the
+preparer), a probe arms the measurement, ACKs, and fires it at the start_at UNIX time of its synced clock. So the
+probes of a measurement, and its coex traffic, begin together. A measurement can ask for its own start_at in its
+parameters; otherwise the start is scheduled DEFAULT_START_LEAD_SECONDS after the start command. When start_at travels
+in a prepare command whose ACK comes after a clock sync (AoI, UDP-ping), the lead also covers the prepare round timeout.
+"""
+
+import time
+
+START_AT_KEY = "start_at"
+DEFAULT_START_LEAD_SECONDS = 2.0    # Must cover the delivery of the start command (and the coex conf, see Coex_Coordinator)
+MAX_START_DELAY_SECONDS = 24 * 3600 # A requested start_at further in the future is refused
+
+
+def check_requested_start_at(requested_start_at) -> str:
+    """
+    Checks the start_at of the measurement parameters, if any.
+    Args:
+        requested_start_at: The start_at of the parameters (None if not requested).
+    Returns:
+        str: 'OK' if valid (or not requested), otherwise an error message.
+    """
+    if requested_start_at is None:
+        return "OK"
+    if isinstance(requested_start_at, bool) or (not isinstance(requested_start_at, (int, float))):
+        return f"{START_AT_KEY} must be a UNIX time in seconds"
+    if requested_start_at > (time.time() + MAX_START_DELAY_SECONDS):
+        return f"{START_AT_KEY} is more than {MAX_START_DELAY_SECONDS}s in the future"
+    return "OK"
+
+
+def schedule_start_at(requested_start_at = None, lead = DEFAULT_START_LEAD_SECONDS) -> float:
+    """
+    Returns the start_at to put in a start command, to be sent right now.
+    Args:
+        requested_start_at (float): The start_at asked by the measurement, if any. If it is too close (or past),
+            the start is postponed of the lead, so that the probes receive the command in time.
+        lead (float): Seconds between the start command and the start.
+    Returns:
+        float: The UNIX time at which the probes must start.
+    """
+    earliest_start_at = time.time() + lead
+    if requested_start_at is None:
+        return earliest_start_at
+    return max(float(requested_start_at), earliest_start_at)
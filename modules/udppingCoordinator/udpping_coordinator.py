@@ -13,6 +13,13 @@ from modules.mqttModule.mqtt_client import Mqtt_Client
 from modules.configLoader.config_loader import ConfigLoader, UDPPING_KEY
 from modules.mongoModule.mongoDB import MongoDB, MeasurementModelMongo
 from modules.mongoModule.models.udpping_result_model_mongo import UDPPINGResultModelMongo
+from modules.metricsModule.measurement_timings import TimingsTracker, MEASUREMENT_PHASE
+from modules.metricsModule.ack_timeouts import AckTimeouts
+from modules.portsModule.port_allocator import PortAllocator
+from modules.scheduledStartModule.scheduled_start import START_AT_KEY, DEFAULT_START_LEAD_SECONDS, check_requested_start_at, schedule_start_at
+from modules.prepareModule.prepare_round import PrepareRound, PREPARE_COMMAND
+from modules.warmPoolModule.warm_servers import WarmServers, WARM_SERVER_KEY
+from modules.portsModule.port_allocator import AUTO_PORT
 
 class UDPPing_Coordinator:
     """
@@ -38,10 +45,14 @@ class UDPPing_Coordinator:
         """
         self.mqtt_client = mqtt_client
         self.ask_probe_ip_mac = ask_probe_ip_mac_callback
+        self.timings_tracker = TimingsTracker.get_instance()
+        self.ack_timeouts = AckTimeouts.get_instance()
         self.mongo_db = mongo_db
         self.queued_measurements = {}
         self.events_received_status_from_probe_sender = {}
         self.events_stop_server_ack = {}
+        self.prepare_rounds = {} # Maps msm_id to the PrepareRound waiting for the probes replies
+        self.warm_servers = WarmServers.get_instance()
 
         # Requests to commands_multiplexer: handler STATUS registration
         registration_response = registration_handler_status_callback( interested_status = "udpping",
@@ -78,21 +89,25 @@ class UDPPing_Coordinator:
             print(f"UDPPING_Coordinator: registration measurement stopper failed. Reason -> {registration_response}")
 
 
-    def send_probe_udpping_measure_start(self, probe_sender, msm_id):
+    def send_probe_udpping_prepare(self, probe_sender, msm_id, role, role_parameters : dict):
         """
-        Send a start command to the probe to begin a UDP-ping measurement.
+        Send the combined prepare command to a probe: the whole configuration of its role in one message.
         Args:
-            probe_sender (str): The probe to start the UDP-ping.
+            probe_sender (str): The probe to prepare.
             msm_id (str): The measurement ID.
+            role (str): The role of the probe (Client/Server).
+            role_parameters (dict): The configuration of the role (for the Client, start_at included).
         """
-        json_ping_start = {
+        json_udpping_prepare = {
             "handler": "udpping",
-            "command": "start",
+            "command": PREPARE_COMMAND,
             "payload": {
-                "msm_id":  msm_id
+                "msm_id": msm_id,
+                "role": role,
+                **role_parameters
             }
         }
-        self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_ping_start))
+        self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_udpping_prepare))
 
 
     def send_probe_udpping_measure_stop(self, probe_sender, msm_id):
@@ -112,35 +127,6 @@ class UDPPing_Coordinator:
         self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_ping_start))
 
     
-    def send_disable_ntp_service(self, probe_sender, msm_id, probe_ntp_server, probe_server_udpping, role, udpping_parameters):
-        """
-        Send a command to disable the NTP service on a probe before starting UDP-ping measurement.
-        Args:
-            probe_sender (str): The probe to disable NTP service on.
-            msm_id (str): The measurement ID.
-            probe_ntp_server (str): The NTP server IP.
-            probe_server_udpping (str): The UDP-ping server IP.
-            role (str): The role of the probe (Client/Server).
-            udpping_parameters (dict): UDP-ping measurement parameters.
-        """
-        json_disable_ntp_service = {
-            "handler": "udpping",
-            "command": "disable_ntp_service",
-            "payload": {
-                "msm_id": msm_id,
-                "probe_ntp_server": probe_ntp_server,
-                "probe_server_udpping": probe_server_udpping,
-                "listen_port": udpping_parameters['listen_port'],
-                "packets_size": udpping_parameters['packets_size'],
-                "packets_number": udpping_parameters['packets_number'],
-                "packets_interval": udpping_parameters['packets_interval'],
-                "live_mode": udpping_parameters['live_mode'],
-                "role": role
-                }
-            }
-        self.mqtt_client.publish_on_command_topic(probe_id = probe_sender, complete_command=json.dumps(json_disable_ntp_service))
-
-
     def send_enable_ntp_service(self, probe_sender, msm_id, role, listen_port = None):
         # This command, at the end of the measurement, must be sent to the client probe, to re-enable the ntp_sec service.
         # In this case, the last two paramers are not used, so they can be None (ONLY IN THIS SPECIFIC CASE).
@@ -208,6 +194,10 @@ class UDPPing_Coordinator:
                         if msm_id in self.events_received_status_from_probe_sender:
                             self.events_received_status_from_probe_sender[msm_id][1] = "OK"
                             self.events_received_status_from_probe_sender[msm_id][0].set()
+                    case "prepare":
+                        print(f"UDPPingController: ACK from probe |{probe_sender}| , command: |{command_executed_on_probe}| , msm_id: |{msm_id}|")
+                        if msm_id in self.prepare_rounds:
+                            self.prepare_rounds[msm_id].set_reply(probe_sender, "OK")
                     case _:
                         print(f"UDPPingController: ACK received for unkonwn UDPPING command -> {command_executed_on_probe}")
             case "NACK":
@@ -229,6 +219,10 @@ class UDPPing_Coordinator:
                         if msm_id in self.events_received_status_from_probe_sender:
                             self.events_received_status_from_probe_sender[msm_id][1] = reason
                             self.events_received_status_from_probe_sender[msm_id][0].set()
+                    case "prepare":
+                        print(f"UDPPingController: received NACK for {failed_command} from |{probe_sender}| -> reason: {reason}")
+                        if msm_id in self.prepare_rounds:
+                            self.prepare_rounds[msm_id].set_reply(probe_sender, reason)
                     case "run":
                         print(f"UDPPingController: received NACK for {failed_command} -> reason: {reason}")
                         if self.mongo_db.set_measurement_as_failed_by_id(measurement_id=msm_id):
@@ -252,66 +246,86 @@ class UDPPing_Coordinator:
         """
         new_measurement.assign_id()
         msm_id = str(new_measurement._id)
+        measurement_timings = self.timings_tracker.start(msm_id, "udpping")
 
         udpping_parameters = self.get_default_ping_parameters()
         udpping_parameters = self.override_default_parameters(udpping_parameters, new_measurement.parameters)
-
-        source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
+        start_at_check = check_requested_start_at(udpping_parameters.get(START_AT_KEY))
+        if start_at_check != "OK":
+            return "Error", start_at_check, "Wrong start_at"
+        # Only the server probe binds the listen port: with 0 (the default) a free warm udpServer of the probe is leased,
+        # else a port free on it is assigned
+        listen_port = None
+        if int(udpping_parameters.get('listen_port') or AUTO_PORT) == AUTO_PORT:
+            listen_port = self.warm_servers.lease(msm_id, new_measurement.dest_probe, "udpping", new_measurement.parameters)
+        udpping_parameters[WARM_SERVER_KEY] = (listen_port is not None)
+        if listen_port is None:
+            listen_port = PortAllocator.get_instance().assign(msm_id, (new_measurement.dest_probe,), udpping_parameters.get('listen_port'))
+        if listen_port is None:
+            return "Error", f"Listen port |{udpping_parameters.get('listen_port')}| not available on probe |{new_measurement.dest_probe}|", "Port already in use"
+        udpping_parameters['listen_port'] = listen_port
+
+        with measurement_timings.phase("ip_resolution"):
+            source_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.source_probe)
         if source_probe_ip is None:
             return "Error", f"No response from client probe: {new_measurement.source_probe}", "Reponse Timeout"
-        dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe)
+        with measurement_timings.phase("ip_resolution"):
+            dest_probe_ip, _ = self.ask_probe_ip_mac(new_measurement.dest_probe)
         if dest_probe_ip is None:
             return "Error", f"No response from client probe: {new_measurement.dest_probe}", "Reponse Timeout"
         new_measurement.source_probe_ip = source_probe_ip
         new_measurement.dest_probe_ip = dest_probe_ip
         new_measurement.parameters = udpping_parameters # This setting allow to store params in measurement object even if you don't have inserted them.
 
-        dest_probe_ip_for_clock_sync = self.ask_probe_ip_mac(new_measurement.dest_probe, sync_clock_ip = True)
+        with measurement_timings.phase("ip_resolution"):
+            dest_probe_ip_for_clock_sync = self.ask_probe_ip_mac(new_measurement.dest_probe, sync_clock_ip = True)
         
-        self.events_received_status_from_probe_sender[msm_id] = [threading.Event(), None]
-        self.send_enable_ntp_service(probe_sender=new_measurement.dest_probe, msm_id = msm_id,
-                                     listen_port = udpping_parameters['listen_port'], role="Server")
-        self.events_received_status_from_probe_sender[msm_id][0].wait(timeout = 5)        
-
-        event_enable_msg = self.events_received_status_from_probe_sender[msm_id][1]
-        if event_enable_msg == "OK":            
-            self.events_received_status_from_probe_sender[msm_id] = [threading.Event(), None]
-            self.send_disable_ntp_service(probe_sender = new_measurement.source_probe, probe_ntp_server = dest_probe_ip_for_clock_sync,
-                                          msm_id = msm_id,  probe_server_udpping = new_measurement.dest_probe_ip, role = "Client",
-                                          udpping_parameters = udpping_parameters)
-
-            self.events_received_status_from_probe_sender[msm_id][0].wait(5)
-
-            event_disable_msg = self.events_received_status_from_probe_sender[msm_id][1]
-            if event_disable_msg == "OK":
-                self.events_received_status_from_probe_sender[msm_id] = [threading.Event(), None]
-                self.send_probe_udpping_measure_start(probe_sender = new_measurement.source_probe, msm_id = msm_id)
-                self.events_received_status_from_probe_sender[msm_id][0].wait(timeout = 5)
-
-                event_start_msg = self.events_received_status_from_probe_sender[msm_id][1]
-                if event_start_msg == "OK":
-                    self.queued_measurements[msm_id] = new_measurement
-                    inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
-                    if inserted_measurement_id is None:
-                        print(f"UDPPingController: can't start udpping. Error while storing measurement on Mongo")
-                        return "Error", "Can't send start! Error while inserting measurement udpping in mongo", "MongoDB Down?"
-                    return "OK", new_measurement.to_dict(), None
-                
-                self.send_probe_udpping_measure_stop(probe_sender=new_measurement.dest_probe, msm_id=msm_id)
-                self.send_probe_udpping_measure_stop(probe_sender=new_measurement.source_probe, msm_id=msm_id)
-                if event_start_msg is not None:
-                    print(f"Preparer UDPPING: awaked from server conf NACK -> {event_start_msg}")
-                    return "Error", f"Probe |{new_measurement.source_probe}| says: {event_start_msg}", ""
-                else:
-                    print(f"Preparer UDPPING: No response from probe -> |{new_measurement.source_probe}")
-                    return "Error", f"No response from Probe: {new_measurement.source_probe}" , "Reponse Timeout"   
-        elif event_enable_msg is not None:
-            print(f"Preparer UDPPING: awaked from server conf NACK -> {event_enable_msg}")
-            self.send_probe_udpping_measure_stop(probe_sender=new_measurement.source_probe, msm_id=msm_id)
-            return "Error", f"Probe |{new_measurement.dest_probe}| says: {event_enable_msg}", ""            
-        else:
-            print(f"Preparer UDPPING: No response from probe -> |{new_measurement.dest_probe}")
-            return "Error", f"No response from Probe: {new_measurement.dest_probe}" , "Reponse Timeout"
+        # One parallel round trip: the server launches udpServer, the client stops ntpsec, syncs its clock with the
+        # server and arms udpClient for start_at. With a warm udpServer, only the client is prepared. The client may ACK
+        # only at the end of the round: start_at is postponed of the whole round timeout, so that it's still ahead once armed
+        warm_server = udpping_parameters[WARM_SERVER_KEY]
+        prepared_probes = (new_measurement.source_probe,) if warm_server else (new_measurement.dest_probe, new_measurement.source_probe)
+        prepare_round = PrepareRound(prepared_probes, handler = "udpping",
+                                     roles = {new_measurement.dest_probe: "Server", new_measurement.source_probe: "Client"})
+        udpping_parameters[START_AT_KEY] = schedule_start_at(udpping_parameters.get(START_AT_KEY), # Stored with the parameters
+                                                             lead = prepare_round.timeout() + DEFAULT_START_LEAD_SECONDS)
+        self.prepare_rounds[msm_id] = prepare_round
+        with measurement_timings.phase("prepare_ack_wait"):
+            if not warm_server:
+                self.send_probe_udpping_prepare(probe_sender = new_measurement.dest_probe, msm_id = msm_id, role = "Server",
+                                                role_parameters = {"listen_port": udpping_parameters['listen_port']})
+            self.send_probe_udpping_prepare(probe_sender = new_measurement.source_probe, msm_id = msm_id, role = "Client",
+                                            role_parameters = {"probe_ntp_server": dest_probe_ip_for_clock_sync,
+                                                               "probe_server_udpping": new_measurement.dest_probe_ip,
+                                                               "listen_port": udpping_parameters['listen_port'],
+                                                               "packets_size": udpping_parameters['packets_size'],
+                                                               "packets_number": udpping_parameters['packets_number'],
+                                                               "packets_interval": udpping_parameters['packets_interval'],
+                                                               "live_mode": udpping_parameters['live_mode'],
+                                                               START_AT_KEY: udpping_parameters[START_AT_KEY]})
+            failed_probe, failure_reason = prepare_round.wait()
+        self.prepare_rounds.pop(msm_id, None)
+
+        if failed_probe is None:
+            measurement_timings.start_phase(MEASUREMENT_PHASE)
+            self.queued_measurements[msm_id] = new_measurement
+            new_measurement.timings = measurement_timings.to_dict()
+            with measurement_timings.phase("db_insert"):
+                inserted_measurement_id = self.mongo_db.insert_measurement(measure = new_measurement)
+            if inserted_measurement_id is None:
+                print(f"UDPPingController: can't start udpping. Error while storing measurement on Mongo")
+                return "Error", "Can't send start! Error while inserting measurement udpping in mongo", "MongoDB Down?"
+            return "OK", new_measurement.to_dict(), None
+
+        for probe_to_clean_up in prepare_round.probes_to_clean_up():
+            self.send_probe_udpping_measure_stop(probe_sender = probe_to_clean_up, msm_id = msm_id)
+            if probe_to_clean_up == new_measurement.source_probe: # Re-enabling the ntpsec service of the client
+                self.send_enable_ntp_service(probe_sender = probe_to_clean_up, msm_id = msm_id, role = "Client")
+        if failure_reason is not None:
+            print(f"Preparer UDPPING: awaked from prepare NACK of |{failed_probe}| -> {failure_reason}")
+            return "Error", f"Probe |{failed_probe}| says: {failure_reason}", ""
+        print(f"Preparer UDPPING: No response from probe -> |{failed_probe}")
+        return "Error", f"No response from Probe: {failed_probe}" , "Reponse Timeout"
         
     
     def udpping_measurement_stopper(self, msm_id_to_stop : str):
@@ -326,20 +340,24 @@ class UDPPing_Coordinator:
         if msm_id_to_stop not in self.queued_measurements:
             return "Error", f"Unknown udpping measurement |{msm_id_to_stop}|", "May be failed"
         measurement_to_stop : MeasurementModelMongo = self.queued_measurements[msm_id_to_stop]
-        self.events_stop_server_ack[msm_id_to_stop] = [threading.Event(), None]
-        # Stop sending to the Server-udpping-Probe
-        self.send_probe_udpping_measure_stop(probe_sender = measurement_to_stop.dest_probe, msm_id = msm_id_to_stop)
-        self.events_stop_server_ack[msm_id_to_stop][0].wait(5)
-        # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK OF STOP COMMAND FROM DEST PROBE (UDPPING-SERVER)
-        stop_event_message = self.events_stop_server_ack[msm_id_to_stop][1]
-        stop_server_message_error = stop_event_message if (stop_event_message != "OK") else None
+        if self.uses_warm_server(msm_id_to_stop): # The warm udpServer is not stopped, but relaunched for the next measurement
+            self.send_warm_server_recycle(measurement_to_stop)
+            stop_server_message_error = None
+        else:
+            self.events_stop_server_ack[msm_id_to_stop] = [threading.Event(), None]
+            # Stop sending to the Server-udpping-Probe
+            self.send_probe_udpping_measure_stop(probe_sender = measurement_to_stop.dest_probe, msm_id = msm_id_to_stop)
+            self.ack_timeouts.wait_for_ack(self.events_stop_server_ack[msm_id_to_stop][0], measurement_to_stop.dest_probe, "udpping", "stop", default_timeout = 5)
+            # ------------------------------- YOU MUST WAIT (AT MOST 5s) FOR AN ACK/NACK OF STOP COMMAND FROM DEST PROBE (UDPPING-SERVER)
+            stop_event_message = self.events_stop_server_ack[msm_id_to_stop][1]
+            stop_server_message_error = stop_event_message if (stop_event_message != "OK") else None
 
         if (stop_server_message_error is not None) and ("MISMATCH" in stop_server_message_error):
             return "Error", f"Probe |{measurement_to_stop.dest_probe}| says: |{stop_server_message_error}|", "Probe already busy for different measurement"
 
         self.events_stop_server_ack[msm_id_to_stop] = [threading.Event(), None]
         self.send_probe_udpping_measure_stop(probe_sender = measurement_to_stop.source_probe, msm_id = msm_id_to_stop)
-        self.events_stop_server_ack[msm_id_to_stop][0].wait(5)
+        self.ack_timeouts.wait_for_ack(self.events_stop_server_ack[msm_id_to_stop][0], measurement_to_stop.source_probe, "udpping", "stop", default_timeout = 5)
         stop_event_message = self.events_stop_server_ack[msm_id_to_stop][1]
 
         # Renabling the ntp_sec service on client probe
@@ -377,7 +395,8 @@ class UDPPing_Coordinator:
 
         mongo_udpping_result = UDPPINGResultModelMongo(
             msm_id = ObjectId(msm_id),
-            udpping_result = udpping_result
+            udpping_result = udpping_result,
+            process_usage = result.get("process_usage")
         )
 
         result_id = str(self.mongo_db.insert_result(result = mongo_udpping_result))
@@ -386,14 +405,27 @@ class UDPPing_Coordinator:
         else:
             print(f"UDPPingController: error while storing result |{result_id}|")
 
+        if self.uses_warm_server(msm_id): # Recycled before the completion releases the lease of its port
+            self.send_warm_server_recycle(self.queued_measurements[msm_id])
         if self.mongo_db.update_results_array_in_measurement(msm_id=msm_id):
             print(f"UDPPingController: updated document linking in measure: |{msm_id}|")
         if self.mongo_db.set_measurement_as_completed(msm_id):
             print(f"UDPPingController: measurement |{msm_id}| completed ")
-        self.send_probe_udpping_measure_stop(self.queued_measurements[msm_id].dest_probe, msm_id=msm_id)
+        if not self.uses_warm_server(msm_id):
+            self.send_probe_udpping_measure_stop(self.queued_measurements[msm_id].dest_probe, msm_id=msm_id)
         self.send_enable_ntp_service(self.queued_measurements[msm_id].source_probe, msm_id=msm_id, role="Client")
 
     
+    def uses_warm_server(self, msm_id) -> bool:
+        """
+        Returns True if the measurement runs against a warm udpServer of its dest probe.
+        """
+        measurement = self.queued_measurements.get(msm_id)
+        return (measurement is not None) and isinstance(measurement.parameters, dict) and bool(measurement.parameters.get(WARM_SERVER_KEY))
+
+    def send_warm_server_recycle(self, measurement : MeasurementModelMongo):
+        self.warm_servers.send_recycle(self.mqtt_client, measurement.dest_probe, "udpping", measurement.parameters['listen_port'], str(measurement._id))
+
     def get_default_ping_parameters(self) -> json:
         """
         Load the default UDP-ping parameters from configuration files.
@@ -427,4 +459,6 @@ class UDPPing_Coordinator:
             if ('packets_interval' in measurement_parameters):
                 packets_interval = measurement_parameters['packets_interval']
                 json_overrided_config['packets_interval'] = packets_interval if (packets_interval != 0) else json_config['packets_interval']
+            if (START_AT_KEY in measurement_parameters):
+                json_overrided_config[START_AT_KEY] = measurement_parameters[START_AT_KEY]
         return json_overrided_config
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+warm_servers.py
+
+This module provides WarmServers, the registry of the warm servers announced by the probes: iperf3 and udpServer
+processes that a probe keeps running on a configured port range (see probesFirmware/warmPoolModule). A preparer leases
+a free warm port of the server probe and only prepares the client probe, skipping the server configuration round trip.
+The leases are PortAllocator reservations, so they are released when the measurement ends or its preparation fails.
+"""
+
+import json
+import threading
+from modules.mqttModule.mqtt_client import Mqtt_Client
+from modules.portsModule.port_allocator import PortAllocator
+
+WARM_SERVER_KEY = "warm_server"     # Measurement parameter: False opts out; stored as True when a warm port is leased
+WARM_PURPOSE = "warm_server"        # PortAllocator purpose of the leases
+RECYCLE_COMMAND = "recycle"
+
+
+class WarmServers:
+    """
+    Process-wide registry of the warm servers of the probes. Use WarmServers.get_instance() to obtain it.
+    It is fed by the CommandsMultiplexer with the ONLINE/UPDATE/OFFLINE states of the probes.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.warm_servers = {}  # Maps probe_id to {tool: [ports]} of its ready warm servers
+        self.port_allocator = PortAllocator.get_instance()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = WarmServers()
+            return cls._instance
+
+    def set_probe_warm_servers(self, probe_id, warm_servers):
+        """
+        Set the ready warm servers announced by a probe. Probes without a warm pool don't announce them.
+        Args:
+            probe_id (str): The probe identifier.
+            warm_servers (dict): {tool: [ports]} of the probe, or None.
+        """
+        with self.lock:
+            if isinstance(warm_servers, dict):
+                self.warm_servers[probe_id] = warm_servers
+            else:
+                self.warm_servers.pop(probe_id, None)
+
+    def get_probe_warm_ports(self, probe_id, tool) -> list:
+        with self.lock:
+            return list(self.warm_servers.get(probe_id, {}).get(tool, []))
+
+    def lease(self, msm_id, probe_id, tool, measurement_parameters = None) -> int:
+        """
+        Leases a free warm port of a probe for a measurement.
+        Args:
+            msm_id (str): The measurement that uses the server.
+            probe_id (str): The server probe.
+            tool (str): "iperf" or "udpping".
+            measurement_parameters (dict): The requested parameters: no lease if they set warm_server to False.
+        Returns:
+            int: The leased port, or None if the probe has no free warm server of the tool.
+        """
+        if isinstance(measurement_parameters, dict) and (measurement_parameters.get(WARM_SERVER_KEY) is False):
+            return None
+        warm_ports = self.get_probe_warm_ports(probe_id, tool)
+        if not warm_ports:
+            return None
+        port = self.port_allocator.reserve_any(msm_id, (probe_id,), warm_ports, purpose = WARM_PURPOSE)
+        if port is not None:
+            print(f"WarmServers: leased |{tool}/{port}| of probe |{probe_id}| to measurement |{msm_id}|")
+        return port
+
+    def send_recycle(self, mqtt : Mqtt_Client, probe_id, tool, port, msm_id):
+        """
+        Asks a probe to relaunch its warm server of the port, at the end of the measurement that used it.
+        """
+        json_command = {
+            "handler": "warm_pool",
+            "command": RECYCLE_COMMAND,
+            "payload": {
+                "tool": tool,
+                "port": port,
+                "msm_id": msm_id
+            }
+        }
+        mqtt.publish_on_command_topic(probe_id = probe_id, complete_command = json.dumps(json_command))
+
+    def handler_received_status(self, probe_sender, type, payload : json):
+        match type:
+            case "ACK":
+                print(f"WarmServers: probe |{probe_sender}|->|{payload.get('command')}|->|ACK|, measure -> {payload.get('msm_id')}")
+            case "NACK":
+                print(f"WarmServers: probe |{probe_sender}|->|{payload.get('command')}|->|NACK|, reason -> {payload.get('reason')}")
+            case _:
+                print(f"WarmServers: received unkown type message -> |{type}|")
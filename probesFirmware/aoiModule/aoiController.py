@@ -1,33 +1,50 @@
-import os, csv
-import time, datetime
+import os
+import time
 import json
 import subprocess, threading, signal
 import socket
 import base64, cbor2, pandas as pd
 from pathlib import Path
 from mqttModule.mqttClient import ProbeMqttClient
-from shared_resources import SharedState
+from shared_resources import SharedState, NIC_BANDWIDTH, NTPSEC_SERVICE, SHARED, EXCLUSIVE, udp_port, session_owner, START_AT_KEY, wait_until
+from process_supervisor import ProcessSupervisor
+from aoiModule.aoiPacer import AoIPacer
+from aoiModule.aoiReceiver import AoIReceiver
 
 DEFAULT_AoI_MEASUREMENT_FOLDER = "aoi_measurements"
+RESOURCE_OWNER = "aoi"
+NTPDATE_ATTEMPTS = 3        # With the prepare command, the server probe may still be starting its ntpsec
+NTPDATE_RETRY_SECONDS = 1
+
+class AoISession:
+    """
+    State of one AoI measurement of the probe. The controller runs several sessions at once (e.g. the server side of
+    two flows on different ports), as long as their resources don't conflict.
+    """
+    def __init__(self, msm_id, role, socket_port):
+        self.msm_id = msm_id
+        self.role = role
+        self.socket_port = socket_port
+        self.probe_ntp_server_ip = None
+        self.probe_server_aoi = None
+        self.payload_size = None
+        self.packets_rate = None
+        self.start_at = None # Absolute time at which the client begins to send (None: as soon as started)
+        self.arm_command = "start" # The command (start or prepare) that the client ACKs once armed
+        self.sender_stats = None # Pacing stats of the client run, sent with the stop ACK
+        self.stop_event = threading.Event()
+        self.measure_socket = None
+        self.thread = None
 
 class AgeOfInformationController:
     """ Class that implements the AGE OF INFORMATION measurement funcionality """
     def __init__(self, mqtt_client : ProbeMqttClient, registration_handler_request_function, wait_for_set_coordinator_ip):
         self.shared_state = SharedState.get_instance()
+        self.process_supervisor = ProcessSupervisor.get_instance()
 
         self.mqtt_client = mqtt_client
-        self.last_measurement_id = None
-        self.last_probe_ntp_server_ip = None
-        self.last_probe_server_aoi = None
-        self.last_payload_size = None
-        self.last_packets_rate = None
-
-        self.last_socket_port = None
-        self.last_role = None
-        self.stop_thread_event = threading.Event()
-        self.measure_socket = None
-
-        self.aoi_thread = None
+        self.sessions = {} # Maps msm_id to its AoISession, from the configuration to the stop
+        self.sessions_lock = threading.Lock()
         self.wait_for_set_coordinator_ip = wait_for_set_coordinator_ip
 
         # Requests to commands_demultiplexer
@@ -39,7 +56,7 @@ class AgeOfInformationController:
 
 
     # This function is called when an AoI command is received. It handles different commands such as 'start', 'stop',
-    # 'disable_ntp_service', and 'enable_ntp_service', performing the appropriate actions for each command.
+    # 'disable_ntp_service', 'enable_ntp_service' and 'prepare', performing the appropriate actions for each command.
     def aoi_command_handler(self, command : str, payload: json):
         msm_id = payload["msm_id"] if "msm_id" in payload else None
         if msm_id is None:
@@ -47,150 +64,199 @@ class AgeOfInformationController:
             return
         match command:
             case "start":
-                if (not self.shared_state.probe_is_ready()): # If the probe has an on-going measurement...
-                    if self.last_measurement_id != msm_id: # If this ongoing measurement is not the one mentioned in the command
-                        self.send_aoi_NACK(failed_command=command, 
-                                           error_info="PROBE BUSY", # This error info can be also a MISMATCH error, but in this case is the same
-                                           msm_id=msm_id)
-                        return
-                    if self.shared_state.get_coordinator_ip() is None:
-                        self.wait_for_set_coordinator_ip() # BLOCKING METHOD!
-                        if self.shared_state.get_coordinator_ip() is None: # Necessary check for confirm the coordinator response of coordinator_ip
-                            self.send_aoi_NACK(failed_command="start", error_info = "No response from coordinator. Missing coordinator ip for root service", msm_id=msm_id)
-                            return
-
-                    self.last_payload_size = payload['payload_size'] if ('payload_size' in payload) else None
-                    if self.last_payload_size is None:
-                        self.send_aoi_NACK(failed_command=command, error_info="No payload size provided. Force PROBE_READY", msm_id=msm_id)
-                        self.shared_state.set_probe_as_ready()
-                        return
-                    
-                    self.last_packets_rate = payload['packets_rate'] if ('packets_rate' in payload) else None
-                    if self.last_packets_rate is None:
-                        self.send_aoi_NACK(failed_command=command, error_info="No packets rate provided. Force PROBE_READY", msm_id=msm_id)
-                        self.shared_state.set_probe_as_ready()
-                        return
-                    
-                    returned_msg = self.submit_thread_to_aoi_measure(msm_id = msm_id)
-                    if returned_msg == "OK":
-                        self.aoi_thread.start()
-                    else:
-                        self.send_aoi_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
-                else:
+                session = self.get_session(msm_id)
+                if session is None:
                     self.send_aoi_NACK(failed_command = command, error_info = "No AoI measurement in progress", msm_id = msm_id)
+                    return
+                self.start_client_measurement(command, session, payload)
                     
             case "stop":
-                if self.shared_state.probe_is_ready():
+                session = self.get_session(msm_id)
+                if session is None:
                     self.send_aoi_NACK(failed_command = command, error_info = "No AoI measurement in progress", msm_id = msm_id)
                     return
-                if self.last_measurement_id != msm_id:
-                    self.send_aoi_NACK(failed_command=command, 
-                                           error_info = f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement |{self.last_measurement_id}|", 
-                                           msm_id=msm_id)
-                    return
-                
-                termination_message = self.stop_aoi_thread()
+                termination_message = self.stop_aoi_session(session)
                 if termination_message == "OK":
-                    self.send_aoi_ACK(successed_command=command, msm_id=msm_id)
+                    self.send_aoi_ACK(successed_command=command, msm_id=msm_id, sender_stats=session.sender_stats)
                 else:
-                    self.send_aoi_NACK(failed_command=command, error_info=termination_message)
+                    self.send_aoi_NACK(failed_command=command, error_info=termination_message, msm_id=msm_id)
                 
             case "disable_ntp_service":
-                if not self.shared_state.set_probe_as_busy():
-                    self.send_aoi_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
-                    return
-                probe_ntp_server_ip = payload["probe_ntp_server"] if ("probe_ntp_server" in payload) else None
-                if probe_ntp_server_ip is None:
-                    self.send_aoi_NACK(failed_command=command, error_info="No probe-ntp-server provided", msm_id=msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-                socket_port = payload["socket_port"] if ("socket_port" in payload) else None
-                if socket_port is None:
-                    self.send_aoi_NACK(failed_command=command, error_info="No socket port provided", msm_id=msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-                role = payload["role"] if ("role" in payload) else None
-                if role is None:
-                    self.send_aoi_NACK(failed_command=command, error_info="No role provided", msm_id=msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-                last_probe_server_aoi = payload["probe_server_aoi"] if ("probe_server_aoi" in payload) else None
-                if last_probe_server_aoi is None:
-                    self.send_aoi_NACK(failed_command=command, error_info="No server aoi provided", msm_id=msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-                disable_msg = self.stop_ntpsec_service()
-                if disable_msg == "OK":
-                    self.last_measurement_id = msm_id
-                    self.last_probe_ntp_server_ip = probe_ntp_server_ip
-                    self.last_probe_server_aoi = last_probe_server_aoi
-                    self.last_socket_port = socket_port
-                    self.last_role = role
-                    socket_creation_msg = self.create_socket()
-                    if socket_creation_msg == "OK":
-                        self.send_aoi_ACK(successed_command = command, msm_id = msm_id)
-                    else:
-                        self.send_aoi_NACK(failed_command = command, error_info = socket_creation_msg, msm_id = msm_id)
-                else:
-                    self.send_aoi_NACK(failed_command = command, error_info = disable_msg, msm_id = msm_id)
-                    self.shared_state.set_probe_as_ready()
+                if self.configure_client_measurement(command, msm_id, payload) is not None:
+                    self.send_aoi_ACK(successed_command = command, msm_id = msm_id)
             case "enable_ntp_service":
                 role = payload["role"] if ("role" in payload) else None
                 if role is None:
                     self.send_aoi_NACK(failed_command=command, error_info="No role provided", msm_id=msm_id)
                     return
-                payload_size = payload['payload_size'] if ('payload_size' in payload) else None
                 if role == "Server":
-                    if not self.shared_state.set_probe_as_busy():
-                        self.send_aoi_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
-                        return
-                    socket_port = payload["socket_port"] if ("socket_port" in payload) else None
-                    if socket_port is None:
-                        self.send_aoi_NACK(failed_command=command, error_info="No socket_port provided", msm_id=msm_id)
-                        self.shared_state.set_probe_as_ready()
-                        return
-                    if payload_size is None:
-                        self.send_aoi_NACK(failed_command=command, error_info="No payload_size provided", msm_id=msm_id)
-                        self.shared_state.set_probe_as_ready()
-                        return
-                    
-                    enable_msg = self.start_ntpsec_service()
-                    if enable_msg == "OK":
-                        self.last_socket_port = socket_port
-                        self.last_role = role
-                        self.last_payload_size = payload_size
-                        self.last_measurement_id = msm_id
-                        socket_creation_msg = self.create_socket()
-                        if socket_creation_msg == "OK":
-                            returned_msg = self.submit_thread_to_aoi_measure(msm_id = msm_id)
-                            if returned_msg == "OK":
-                                self.aoi_thread.start()
-                                self.send_aoi_ACK(successed_command = command, msm_id = msm_id)
-                            else:
-                                self.send_aoi_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
-                        else:
-                            self.send_aoi_NACK(failed_command=command, error_info=socket_creation_msg, msm_id=msm_id)
-                    else:
-                        self.send_aoi_NACK(failed_command = command, error_info = enable_msg, msm_id = msm_id)
-                        self.shared_state.set_probe_as_ready()
+                    self.start_server_measurement(command, msm_id, payload)
                 elif role == "Client":
                     enable_msg = self.start_ntpsec_service()
                     if enable_msg == "OK":
                         self.send_aoi_ACK(successed_command = command, msm_id = msm_id)
-                        #self.shared_state.set_probe_as_ready()
                     else:
                         self.send_aoi_NACK(failed_command = command, error_info = enable_msg, msm_id = msm_id)
                 else:
                     self.send_aoi_NACK(failed_command = command, error_info = (f"Wrong role -> {role}"), msm_id = msm_id)
+            case "prepare":
+                # Combined command: the whole configuration of the role in one round trip. The server ACKs when listening,
+                # the client when armed (ntpsec stopped, clock synced): then it sends from start_at.
+                role = payload["role"] if ("role" in payload) else None
+                if role == "Server":
+                    self.start_server_measurement(command, msm_id, payload)
+                elif role == "Client":
+                    if (payload.get('payload_size') is None) or (payload.get('packets_rate') is None):
+                        self.send_aoi_NACK(failed_command = command, error_info = "No payload size or packets rate provided", msm_id = msm_id)
+                        return
+                    session = self.configure_client_measurement(command, msm_id, payload)
+                    if session is not None:
+                        self.start_client_measurement(command, session, payload)
+                else:
+                    self.send_aoi_NACK(failed_command = command, error_info = (f"Wrong role -> {role}"), msm_id = msm_id)
+            case _:
+                self.send_aoi_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+
+    def get_session(self, msm_id) -> AoISession:
+        with self.sessions_lock:
+            return self.sessions.get(msm_id)
+
+    # Locks the resources of a new session, and registers it. Returns None (NACK sent) if they are held by another measurement.
+    def open_session(self, command, msm_id, role, socket_port) -> AoISession:
+        if not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, msm_id), self.aoi_resources(role, socket_port)):
+            self.send_aoi_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
+            return None
+        session = AoISession(msm_id, role, socket_port)
+        with self.sessions_lock:
+            self.sessions[msm_id] = session
+        return session
+
+    # Unregisters the session, closes its socket and releases its resources. Invoked once per session, by the stop or by
+    # the measurement thread that ends it.
+    def close_session(self, session : AoISession):
+        with self.sessions_lock:
+            if self.sessions.get(session.msm_id) is session:
+                self.sessions.pop(session.msm_id)
+        if session.measure_socket is not None:
+            session.measure_socket.close()
+        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, session.msm_id))
+
+
+    # Client side of disable_ntp_service (and prepare): locks the resources, stops ntpsec and opens the socket.
+    # Returns the session if the client is configured, otherwise None: it has already sent the NACK.
+    def configure_client_measurement(self, command, msm_id, payload) -> AoISession:
+        probe_ntp_server_ip = payload["probe_ntp_server"] if ("probe_ntp_server" in payload) else None
+        if probe_ntp_server_ip is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No probe-ntp-server provided", msm_id=msm_id)
+            return None
+        socket_port = payload["socket_port"] if ("socket_port" in payload) else None
+        if socket_port is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No socket port provided", msm_id=msm_id)
+            return None
+        role = payload["role"] if ("role" in payload) else None
+        if role is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No role provided", msm_id=msm_id)
+            return None
+        probe_server_aoi = payload["probe_server_aoi"] if ("probe_server_aoi" in payload) else None
+        if probe_server_aoi is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No server aoi provided", msm_id=msm_id)
+            return None
+        session = self.open_session(command, msm_id, role, socket_port)
+        if session is None:
+            return None
+        disable_msg = self.stop_ntpsec_service()
+        if disable_msg == "OK":
+            session.probe_ntp_server_ip = probe_ntp_server_ip
+            session.probe_server_aoi = probe_server_aoi
+            socket_creation_msg = self.create_socket(session)
+            if socket_creation_msg == "OK":
+                return session
+            self.send_aoi_NACK(failed_command = command, error_info = socket_creation_msg, msm_id = msm_id)
+        else:
+            self.send_aoi_NACK(failed_command = command, error_info = disable_msg, msm_id = msm_id)
+        self.close_session(session)
+        return None
+
+
+    # Client side of start (and prepare): submits the sending thread, which ACKs the command once the clock is synced.
+    def start_client_measurement(self, command, session : AoISession, payload):
+        msm_id = session.msm_id
+        if self.shared_state.get_coordinator_ip() is None:
+            self.wait_for_set_coordinator_ip() # BLOCKING METHOD!
+            if self.shared_state.get_coordinator_ip() is None: # Necessary check for confirm the coordinator response of coordinator_ip
+                self.send_aoi_NACK(failed_command=command, error_info = "No response from coordinator. Missing coordinator ip for root service", msm_id=msm_id)
+                return
+
+        session.payload_size = payload['payload_size'] if ('payload_size' in payload) else None
+        if session.payload_size is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No payload size provided. Force PROBE_READY", msm_id=msm_id)
+            self.close_session(session)
+            return
+        
+        session.packets_rate = payload['packets_rate'] if ('packets_rate' in payload) else None
+        if session.packets_rate is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No packets rate provided. Force PROBE_READY", msm_id=msm_id)
+            self.close_session(session)
+            return
+        
+        session.start_at = payload.get(START_AT_KEY)
+        session.arm_command = command
+        session.sender_stats = None
+        returned_msg = self.submit_thread_to_aoi_measure(session)
+        if returned_msg == "OK":
+            session.thread.start()
+        else:
+            self.send_aoi_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
+
+
+    # Server side of enable_ntp_service (and prepare): locks the resources, keeps ntpsec running for the client clock sync,
+    # opens the socket and starts listening.
+    def start_server_measurement(self, command, msm_id, payload):
+        payload_size = payload['payload_size'] if ('payload_size' in payload) else None
+        socket_port = payload["socket_port"] if ("socket_port" in payload) else None
+        if socket_port is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No socket_port provided", msm_id=msm_id)
+            return
+        if payload_size is None:
+            self.send_aoi_NACK(failed_command=command, error_info="No payload_size provided", msm_id=msm_id)
+            return
+        session = self.open_session(command, msm_id, "Server", socket_port)
+        if session is None:
+            return
+        
+        enable_msg = self.start_ntpsec_service()
+        if enable_msg == "OK":
+            session.payload_size = payload_size
+            socket_creation_msg = self.create_socket(session)
+            if socket_creation_msg == "OK":
+                returned_msg = self.submit_thread_to_aoi_measure(session)
+                if returned_msg == "OK":
+                    session.thread.start()
+                    self.send_aoi_ACK(successed_command = command, msm_id = msm_id)
+                    return
+                self.send_aoi_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
+            else:
+                self.send_aoi_NACK(failed_command=command, error_info=socket_creation_msg, msm_id=msm_id)
+        else:
+            self.send_aoi_NACK(failed_command = command, error_info = enable_msg, msm_id = msm_id)
+        self.close_session(session)
                 
                 
-    # Creates and binds a UDP socket for AoI measurement communication.
-    def create_socket(self):
+
+    # Returns the probe resources locked by an AoI measurement: the UDP port of its socket, and the ntpsec service,
+    # which the client stops (so exclusively), while the server keeps it running as NTP server (so shared).
+    def aoi_resources(self, role, socket_port) -> dict:
+        ntpsec_mode = SHARED if (role == "Server") else EXCLUSIVE
+        return {NTPSEC_SERVICE: ntpsec_mode, udp_port(socket_port): EXCLUSIVE, NIC_BANDWIDTH: SHARED}
+
+    # Creates and binds the UDP socket of the session.
+    def create_socket(self, session : AoISession):
         try:
-            self.measure_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.measure_socket.bind((self.shared_state.get_probe_ip(), self.last_socket_port))
-            if self.last_role == "Server":
-                print(f"AoIController: I'm Server. Opened socket on IP: |{self.shared_state.get_probe_ip()}| , port: |{self.last_socket_port}|")
+            session.measure_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            session.measure_socket.bind((self.shared_state.get_probe_ip(), session.socket_port))
+            if session.role == "Server":
+                print(f"AoIController: I'm Server. Opened socket on IP: |{self.shared_state.get_probe_ip()}| , port: |{session.socket_port}|")
             #self.measure_socket.settimeout(10)
             return "OK"
         except socket.error as e:
@@ -198,14 +264,14 @@ class AgeOfInformationController:
             return f"Socket error: {str(e)}"
         except Exception as e:
             print(f"AoIController: Exception while creating socket -> {str(e)}")
-            self.measure_socket.close()
+            session.measure_socket.close()
             return str(e)
                 
 
-    # Prepares and starts the thread that will run the AoI measurement (client or server role).
-    def submit_thread_to_aoi_measure(self, msm_id):
+    # Prepares the thread that will run the AoI measurement of the session (client or server role).
+    def submit_thread_to_aoi_measure(self, session : AoISession):
         try:
-            self.aoi_thread = threading.Thread(target=self.run_aoi_measurement, args=(msm_id,))
+            session.thread = threading.Thread(target=self.run_aoi_measurement, args=(session,))
             return "OK"
         except Exception as e:
             returned_msg = (f"Exception while starting measure thread -> {str(e)}")
@@ -213,66 +279,51 @@ class AgeOfInformationController:
             return returned_msg
 
 
-    # Main logic for running the AoI measurement, either as a client (sending timestamps) or server (receiving and logging AoI).
-    def run_aoi_measurement(self, msm_id):
-        if self.last_role == "Client":
+    # Main logic for running the AoI measurement, either as a client (sending timestamps, paced by AoIPacer) or server (receiving and logging AoI).
+    def run_aoi_measurement(self, session : AoISession):
+        msm_id = session.msm_id
+        if session.role == "Client":
             stderr_command = None
+            armed = False
             try:
-                if self.last_packets_rate is None:
-                    raise Exception(f"AoIController: wrong packets_rate -> |{self.last_packets_rate}|")
-                print(f"Role client thread -> last_probe_ntp_server_ip: |{self.last_probe_ntp_server_ip}|")
-                result = subprocess.run( ['sudo', 'ntpdate', self.last_probe_ntp_server_ip], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if session.packets_rate is None:
+                    raise Exception(f"AoIController: wrong packets_rate -> |{session.packets_rate}|")
+                print(f"Role client thread -> probe_ntp_server_ip: |{session.probe_ntp_server_ip}|")
+                result = self.sync_clock(session)
                 if result.returncode == 0:
-                    print(f"AoIController: clock synced with {self.last_probe_ntp_server_ip}")
-                    self.send_aoi_ACK(successed_command = "start", msm_id = msm_id)
-                    while(not self.stop_thread_event.is_set()):
-                        time.sleep(1 / self.last_packets_rate) # packets_rate can't be 0. The coordinator must check it.
-                        timestamp_value = datetime.datetime.now().timestamp()
-                        
-                        timestamp_message = {
-                            "timestamp" : timestamp_value,
-                            "dummy_payload" : str("F" * self.last_payload_size) # Create a dummy payload of 'payload_size' bytes
-                        }
-                        print(f"AoI client: sending... -> {timestamp_value}" )
-                        json_timestamp = json.dumps(timestamp_message)
-                        self.measure_socket.sendto(json_timestamp.encode(), (self.last_probe_server_aoi, self.last_socket_port))
+                    print(f"AoIController: clock synced with {session.probe_ntp_server_ip}")
+                    self.send_aoi_ACK(successed_command = session.arm_command, msm_id = msm_id) # Armed: the sending begins at start_at
+                    armed = True
+                    pacer = AoIPacer(measure_socket = session.measure_socket,
+                                     server_address = (session.probe_server_aoi, session.socket_port),
+                                     packets_rate = session.packets_rate, # packets_rate can't be 0. The coordinator must check it.
+                                     payload_size = session.payload_size,
+                                     stop_event = session.stop_event)
+                    wait_until(session.start_at, session.stop_event)
+                    print(f"AoIController: sending at |{session.packets_rate}| packets/s to |{session.probe_server_aoi}:{session.socket_port}|")
+                    pacer.run()
+                    session.sender_stats = pacer.stats()
+                    print(f"AoIController: sending stopped -> {session.sender_stats}")
                 else:
                     raise Exception(result.stderr.decode('utf-8'))
-                    #print(f"AoIController: returncode -> {result.returncode}. STDOUT: {result.stdout.decode('utf-8')} , STDERR: {result.stderr.decode('utf-8')}")
-                    #self.send_aoi_NACK(failed_command="start", error_info=)
             except Exception as e:
                 stderr_command = str(e)
             finally:
                 if stderr_command is not None:
-                    self.send_aoi_NACK(failed_command="start", error_info=stderr_command, msm_id=msm_id)
+                    self.send_aoi_NACK(failed_command = "start" if armed else session.arm_command, error_info=stderr_command, msm_id=msm_id)
 
-        elif self.last_role == "Server":
+        elif session.role == "Server":
             receive_error = None
             base_path = Path(__file__).parent
             aoi_measurement_folder_path = os.path.join(base_path, DEFAULT_AoI_MEASUREMENT_FOLDER)
             Path(aoi_measurement_folder_path).mkdir(parents=True, exist_ok=True)
             complete_file_path = os.path.join(aoi_measurement_folder_path, msm_id + ".csv")
             with open(complete_file_path, mode="w", newline="") as csv_file:
+                receiver = AoIReceiver(measure_socket = session.measure_socket, csv_file = csv_file, stop_event = session.stop_event)
                 try:
-                    fieldnames = ["Timestamp", "AoI"]
-                    writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                    writer.writeheader()
                     print(f"AoIController: Role server thread. Listening...")
-                    #self.send_aoi_ACK(successed_command="start", msm_id=msm_id)
-                    while(not self.stop_thread_event.is_set()):
-                        data, addr = self.measure_socket.recvfrom(self.last_payload_size)
-                        #BLOCKING RECV
-                        if self.stop_thread_event.is_set():
-                            break
-                        reception_timestamp = datetime.datetime.now().timestamp()
-
-                        json_message = json.loads(data.decode())
-                        client_timestamp = json_message["timestamp"]
-                        dummy_payload = json_message["dummy_payload"]
-                        
-                        aoi = reception_timestamp - client_timestamp
-                        writer.writerow({"Timestamp": reception_timestamp, "AoI": aoi})
-                        print(f"Timestamp reception: |{reception_timestamp}| , AoI: |{aoi:.6f}| , DUMMY SIZE: |{len(dummy_payload)}| bytes")
+                    receiver.run() #BLOCKING RECV, until the stop
+                    print(f"AoIController: reception stopped -> {receiver.stats()}")
                 except socket.timeout:
                     receive_error = "SOCKET TIMEOUT. The client-probe is down?"
                     print(f"AoIController: {receive_error}")
@@ -284,24 +335,28 @@ class AgeOfInformationController:
                         print(f"Exception in socket reception: {receive_error}")
                     csv_file.close()
             if receive_error is None:
-                self.compress_and_publish_aoi_result(msm_id = msm_id)
-            self.shared_state.set_probe_as_ready()
+                self.compress_and_publish_aoi_result(msm_id = msm_id, receiver_stats = receiver.stats())
+            if not session.stop_event.is_set(): # Otherwise the stop closes the session, once this thread has ended
+                self.close_session(session)
         else:
-            print(f"THREAD START WITH STRANGE ROLE -> {self.last_role}")
-
-    # Stops the AoI measurement thread and cleans up resources. Returns a status string.
-    def stop_aoi_thread(self) -> str:
-        if self.aoi_thread is None:
-            return "No AoI measure in progress"
-        self.stop_thread_event.set()
-        if self.last_role == "Server":
-            self.measure_socket.sendto( str("F" * self.last_payload_size).encode() , (self.shared_state.get_probe_ip(), self.last_socket_port))
-        self.aoi_thread.join()
-        self.stop_thread_event.clear()
-        self.measure_socket.close()
-        if (self.last_role is not None):
-            self.shared_state.set_probe_as_ready()
-            self.reset_vars()
+            print(f"THREAD START WITH STRANGE ROLE -> {session.role}")
+
+    # Syncs the client clock with the server probe (ntpdate), retrying a few times. Returns the last ntpdate process.
+    def sync_clock(self, session : AoISession):
+        for attempt in range(NTPDATE_ATTEMPTS):
+            result = self.process_supervisor.run(RESOURCE_OWNER, session.msm_id, ['sudo', 'ntpdate', session.probe_ntp_server_ip], text=False)
+            if (result.returncode == 0) or (attempt == NTPDATE_ATTEMPTS - 1) or session.stop_event.wait(NTPDATE_RETRY_SECONDS):
+                return result
+
+    # Stops the measurement thread of the session and closes it. Returns a status string.
+    def stop_aoi_session(self, session : AoISession) -> str:
+        session.stop_event.set()
+        if session.thread is not None:
+            self.process_supervisor.stop(RESOURCE_OWNER, session.msm_id) # A client still syncing its clock (ntpdate)
+            if session.role == "Server": # Wakes up the receive
+                session.measure_socket.sendto(str("F" * session.payload_size).encode(), (self.shared_state.get_probe_ip(), session.socket_port))
+            session.thread.join()
+        self.close_session(session)
         return "OK"
     
 
@@ -331,11 +386,13 @@ class AgeOfInformationController:
     
 
     # Publishes an ACK message for a successful AoI command via MQTT.
-    def send_aoi_ACK(self, successed_command, msm_id = None):
+    def send_aoi_ACK(self, successed_command, msm_id = None, sender_stats = None):
         json_ack = { 
             "command" : successed_command,
             "msm_id" : msm_id
             }
+        if sender_stats is not None:
+            json_ack["sender_stats"] = sender_stats
         print(f"AoIController: ACK sending -> {json_ack}")
         self.mqtt_client.publish_command_ACK(handler='aoi', payload=json_ack) 
 
@@ -350,18 +407,8 @@ class AgeOfInformationController:
         print(f"AoIController: NACK sending -> {json_nack}")
         self.mqtt_client.publish_command_NACK(handler='aoi', payload = json_nack) 
 
-    # Resets internal state variables after a measurement is finished or aborted.
-    def reset_vars(self):
-        print("reset_vars()")
-        self.last_measurement_id = None
-        self.last_probe_ntp_server_ip = None
-        self.last_socket_port = None
-        self.last_role = None
-        self.aoi_thread = None
-        self.last_probe_server_aoi = None
-
     # Compresses the AoI measurement results, encodes them, and publishes them via MQTT.
-    def compress_and_publish_aoi_result(self, msm_id):
+    def compress_and_publish_aoi_result(self, msm_id, receiver_stats = None):
         base_path = Path(__file__).parent
         aoi_measurement_file_path = os.path.join(base_path, DEFAULT_AoI_MEASUREMENT_FOLDER, msm_id + ".csv")
         df = pd.read_csv(aoi_measurement_file_path)
@@ -386,9 +433,10 @@ class AgeOfInformationController:
                 "msm_id": msm_id,           # Measurement ID
                 "c_aois_b64": c_aois_b64,   # Compressed AoI timeseries (base64 CBOR)
                 "aoi_min" : aoi_min,         # Minimum AoI (ms)
-                "aoi_max" : aoi_max          # Maximum AoI (ms)
+                "aoi_max" : aoi_max,         # Maximum AoI (ms)
+                "receiver_stats": receiver_stats # Lost/reordered/duplicated packets, kernel timestamps
              }
         }
         # Publish the result on the MQTT result topic
-        self.mqtt_client.publish_on_result_topic(result=json.dumps(json_aoi_result))
+        self.mqtt_client.publish_on_result_topic(result=json_aoi_result)
         print(f"AoIController: compressed and published result of msm -> {msm_id}")
\ No newline at end of file
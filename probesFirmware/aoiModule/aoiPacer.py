@@ -0,0 +1,119 @@
+"""
+Pacing engine of the AoI client: the packets are sent on absolute deadlines (start + seq / packets_rate) of the
+monotonic clock, so the sleep overshoots don't accumulate and the achieved rate doesn't drift below the requested one.
+Each packet is a preallocated binary buffer, AOI_HEADER (sequence number, send timestamp) followed by payload_size
+padding bytes, rewritten in place before each send. When the sender is behind schedule the due packets are sent back to
+back, at most max_batch per wake-up; a backlog older than MAX_BACKLOG_SECONDS is skipped instead of being sent as a
+burst. The achieved rate and the send jitter (lateness of each packet on its deadline) are reported at the end.
+"""
+
+import math
+import time
+import socket
+import struct
+import threading
+
+AOI_HEADER = struct.Struct("!Qd") # sequence number, send timestamp (epoch seconds, clock synced with the server probe)
+DEFAULT_MAX_BATCH = 64
+MAX_BACKLOG_SECONDS = 1.0
+MAX_SLEEP_SECONDS = 0.2     # The loop checks the stop event at least this often
+
+
+def aoi_packet_size(payload_size) -> int:
+    return AOI_HEADER.size + int(payload_size)
+
+
+class RunningStats:
+    """
+    Mean, standard deviation (Welford's algorithm) and maximum of a series, without storing it.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.max = value if ((self.max is None) or (value > self.max)) else self.max
+
+    def stdev(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if (self.count > 1) else None
+
+
+class AoIPacer:
+    """
+    Sends the AoI packets at packets_rate until stop_event is set. run() blocks, stats() reports the sending.
+    """
+    def __init__(self, measure_socket : socket.socket, server_address : tuple, packets_rate, payload_size,
+                 stop_event : threading.Event, max_batch = DEFAULT_MAX_BATCH):
+        self.measure_socket = measure_socket
+        self.server_address = server_address
+        self.packets_rate = float(packets_rate)
+        if self.packets_rate <= 0:
+            raise ValueError(f"Wrong packets_rate -> |{packets_rate}|")
+        self.period = 1 / self.packets_rate
+        self.packet = bytearray(aoi_packet_size(payload_size)) # Zero padding, the header is packed in place
+        self.stop_event = stop_event
+        self.max_batch = max(1, int(max_batch))
+        self.max_backlog = max(1, int(self.packets_rate * MAX_BACKLOG_SECONDS))
+        self.packets_sent = 0
+        self.packets_skipped = 0
+        self.batches = 0 # Wake-ups that sent more than one packet
+        self.lateness = RunningStats()  # Seconds between the deadline and the send of each packet
+        self.intervals = RunningStats() # Seconds between two consecutive sends
+        self.started_at = None
+        self.elapsed_seconds = 0.0
+
+    def run(self):
+        pack_into, packet, sendto, address = AOI_HEADER.pack_into, self.packet, self.measure_socket.sendto, self.server_address
+        monotonic, wall_clock = time.monotonic, time.time
+        self.started_at = wall_clock()
+        start = monotonic()
+        slot = 0 # Index of the next deadline: start + slot * period
+        last_send = None
+        while not self.stop_event.is_set():
+            now = monotonic()
+            due = int((now - start) * self.packets_rate) + 1 - slot # Deadlines passed, not served yet
+            if due <= 0:
+                time.sleep(min(start + slot * self.period - now, MAX_SLEEP_SECONDS))
+                continue
+            if due > self.max_backlog: # Too far behind (e.g. the process was preempted): skip the backlog
+                self.packets_skipped += due - 1
+                slot += due - 1
+                due = 1
+            batch = min(due, self.max_batch)
+            if batch > 1:
+                self.batches += 1
+            for _ in range(batch):
+                pack_into(packet, 0, self.packets_sent, wall_clock())
+                sendto(packet, address)
+                sent_at = monotonic()
+                self.lateness.add(sent_at - (start + slot * self.period))
+                if last_send is not None:
+                    self.intervals.add(sent_at - last_send)
+                last_send = sent_at
+                self.packets_sent += 1
+                slot += 1
+        self.elapsed_seconds = monotonic() - start
+
+    def stats(self) -> dict:
+        """
+        Returns the requested and achieved rates, the packets sent/skipped and the send jitter (microseconds).
+        """
+        to_us = lambda seconds: round(seconds * 10**6, 1) if (seconds is not None) else None
+        return {
+            "requested_rate": self.packets_rate,
+            "achieved_rate": round(self.packets_sent / self.elapsed_seconds, 3) if (self.elapsed_seconds > 0) else None,
+            "packets_sent": self.packets_sent,
+            "packets_skipped": self.packets_skipped,
+            "batches": self.batches,
+            "packet_bytes": len(self.packet),
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "lateness_mean_us": to_us(self.lateness.mean) if self.lateness.count else None,
+            "lateness_max_us": to_us(self.lateness.max),
+            "send_jitter_us": to_us(self.intervals.stdev()) # Standard deviation of the inter-send times
+        }
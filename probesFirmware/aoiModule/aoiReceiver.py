@@ -0,0 +1,161 @@
+"""
+Receiver of the AoI server: each packet is timestamped by the kernel on arrival (SO_TIMESTAMPNS), so the AoI doesn't
+include the latency of the interpreter, and its AOI_HEADER (sequence number, send timestamp) is decoded with struct.
+The (reception timestamp, AoI) rows are appended to preallocated arrays and written to the CSV file in blocks, with no
+per-packet print. The sequence numbers track the lost, reordered and duplicated packets, in a fixed-size window of bits
+behind the highest sequence number: a sequence number leaving the window without being received is lost.
+"""
+
+import csv
+import json
+import time
+import socket
+import struct
+import threading
+from array import array
+from aoiModule.aoiPacer import AOI_HEADER
+
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35) # Not exported by the socket module on every Python version
+TIMESPEC = struct.Struct("@ll")
+CMSG_SPACE = socket.CMSG_SPACE(TIMESPEC.size)
+RECEIVE_BUFFER_BYTES = 65535            # Whole datagram, whatever the payload size of the client
+SOCKET_BUFFER_BYTES = 4 * 1024 * 1024   # Kernel receive buffer: absorbs the bursts of a client behind schedule
+FLUSH_BLOCK_ROWS = 4096
+SEQUENCE_WINDOW = 1 << 16              # Sequence numbers tracked behind the highest one (a ring of 8 KiB of bits): a later packet is untracked
+SEQUENCE_WINDOW_MASK = SEQUENCE_WINDOW - 1
+MAX_SEQUENCE_JUMP = 1 << 20             # A sequence number further than this above the highest one is not trusted (it would count as lost all the ones in between)
+
+
+class AoIReceiver:
+    """
+    Receives the AoI packets on measure_socket until stop_event is set (the socket must then get a packet, or be
+    closed, to wake up the receive), writing the "Timestamp","AoI" rows (epoch seconds, seconds) to csv_file.
+    """
+    def __init__(self, measure_socket : socket.socket, csv_file, stop_event : threading.Event, block_rows = FLUSH_BLOCK_ROWS):
+        self.measure_socket = measure_socket
+        self.writer = csv.writer(csv_file)
+        self.stop_event = stop_event
+        self.block_rows = int(block_rows)
+        self.timestamps = array("d", bytes(8 * self.block_rows)) # Preallocated blocks, filled up to self.rows
+        self.aois = array("d", bytes(8 * self.block_rows))
+        self.rows = 0
+        self.received = 0
+        self.kernel_timestamps = 0
+        self.received_sequences = bytearray(SEQUENCE_WINDOW >> 3) # Ring of bits, indexed by sequence % SEQUENCE_WINDOW
+        self.window_received = 0 # Bits set in the ring
+        self.highest_sequence = -1
+        self.lost = 0            # Sequence numbers left the window without being received
+        self.reordered = 0
+        self.duplicates = 0
+        self.sequence_gaps = 0 # Jumps forward of the sequence number (a gap may be filled later by a reordered packet)
+        self.untracked = 0     # Packets without a usable sequence number (JSON packets of an older client, too far ahead, or behind the window)
+        try:
+            self.measure_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError as e:
+            print(f"AoIReceiver: no kernel timestamps, reception timestamped in user space -> {e}")
+        try:
+            self.measure_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+        except OSError:
+            pass
+
+    def track_sequence(self, sequence) -> bool:
+        """
+        Records a sequence number. Returns False, without recording it, if it's more than MAX_SEQUENCE_JUMP above the
+        highest one (a corrupted or forged packet), or behind the window (already counted as lost, and a duplicate
+        can't be told from a late packet anymore).
+        """
+        if (sequence > self.highest_sequence + MAX_SEQUENCE_JUMP) or (sequence <= self.highest_sequence - SEQUENCE_WINDOW):
+            return False
+        if sequence > self.highest_sequence:
+            self.slide_window(sequence)
+            if sequence > self.highest_sequence + 1:
+                self.sequence_gaps += 1
+            self.highest_sequence = sequence
+        byte_index, bit = (sequence & SEQUENCE_WINDOW_MASK) >> 3, 1 << (sequence & 7)
+        if self.received_sequences[byte_index] & bit:
+            self.duplicates += 1
+            return True
+        self.received_sequences[byte_index] |= bit
+        self.window_received += 1
+        if sequence < self.highest_sequence:
+            self.reordered += 1
+        return True
+
+    def slide_window(self, sequence):
+        # Moves the window up to sequence: the sequence numbers up to sequence - SEQUENCE_WINDOW leave it, lost if not
+        # received, and their bits are cleared for the new ones
+        first_leaving = max(self.highest_sequence - SEQUENCE_WINDOW + 1, 0)
+        last_leaving = sequence - SEQUENCE_WINDOW
+        received_sequences = self.received_sequences
+        for leaving in range(first_leaving, min(last_leaving, self.highest_sequence) + 1):
+            byte_index, bit = (leaving & SEQUENCE_WINDOW_MASK) >> 3, 1 << (leaving & 7)
+            if received_sequences[byte_index] & bit:
+                received_sequences[byte_index] &= ~bit
+                self.window_received -= 1
+            else:
+                self.lost += 1
+        skipped = last_leaving - max(self.highest_sequence, first_leaving - 1)
+        if skipped > 0: # Jumped over by more than the window: never in it
+            self.lost += skipped
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        self.writer.writerows(zip(self.timestamps[:self.rows], self.aois[:self.rows]))
+        self.rows = 0
+
+    def run(self):
+        """
+        Receives until stop_event is set, then flushes the rows. Socket errors are raised to the caller.
+        """
+        self.writer.writerow(["Timestamp", "AoI"])
+        recvmsg, unpack_from, timespec_unpack = self.measure_socket.recvmsg, AOI_HEADER.unpack_from, TIMESPEC.unpack_from
+        header_size = AOI_HEADER.size
+        try:
+            while not self.stop_event.is_set():
+                data, ancillary_data, _, _ = recvmsg(RECEIVE_BUFFER_BYTES, CMSG_SPACE)
+                if self.stop_event.is_set(): # The wake-up packet of the stop
+                    break
+                reception_timestamp = None
+                for level, cmsg_type, cmsg_data in ancillary_data:
+                    if (level == socket.SOL_SOCKET) and (cmsg_type == SO_TIMESTAMPNS):
+                        seconds, nanoseconds = timespec_unpack(cmsg_data)
+                        reception_timestamp = seconds + nanoseconds / 10**9
+                        self.kernel_timestamps += 1
+                if reception_timestamp is None:
+                    reception_timestamp = time.time()
+                if data[:1] == b"{": # JSON packet of a client with an older firmware
+                    client_timestamp = json.loads(data.decode())["timestamp"]
+                    self.untracked += 1
+                elif len(data) >= header_size:
+                    sequence, client_timestamp = unpack_from(data)
+                    if not self.track_sequence(sequence):
+                        self.untracked += 1
+                        continue
+                else:
+                    continue
+                self.received += 1
+                self.timestamps[self.rows] = reception_timestamp
+                self.aois[self.rows] = reception_timestamp - client_timestamp
+                self.rows += 1
+                if self.rows == self.block_rows:
+                    self.flush()
+        finally:
+            self.flush()
+
+    def stats(self) -> dict:
+        """
+        Returns the reception stats: packets received, lost (missing sequence numbers up to the highest one), reordered
+        and duplicated, and whether the timestamps came from the kernel.
+        """
+        tracked = self.highest_sequence >= 0
+        missing_in_window = min(self.highest_sequence + 1, SEQUENCE_WINDOW) - self.window_received
+        return {
+            "packets_received": self.received,
+            "packets_lost": (self.lost + missing_in_window) if tracked else None,
+            "sequence_gaps": self.sequence_gaps if tracked else None,
+            "packets_reordered": self.reordered if tracked else None,
+            "packets_duplicated": self.duplicates if tracked else None,
+            "packets_untracked": self.untracked,
+            "kernel_timestamps": (self.kernel_timestamps > 0) and (self.kernel_timestamps >= self.received)
+        }
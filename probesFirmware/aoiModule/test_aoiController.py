@@ -0,0 +1,106 @@
+"""
+Unit tests of the AoI controller sessions: two server flows of the same probe, on different ports, at once.
+Run from probesFirmware: python -m unittest aoiModule.test_aoiController
+"""
+
+import time
+import socket
+import tempfile
+import unittest
+from unittest import mock
+from shared_resources import SharedState
+from aoiModule import aoiController
+from aoiModule.aoiController import AgeOfInformationController, RESOURCE_OWNER
+from aoiModule.aoiPacer import AOI_HEADER
+
+WAIT_SECONDS = 5
+
+
+class RecordingMqttClient:
+    def __init__(self):
+        self.acks = []
+        self.nacks = []
+
+    def publish_command_ACK(self, handler, payload):
+        self.acks.append(payload)
+
+    def publish_command_NACK(self, handler, payload):
+        self.nacks.append(payload)
+
+
+def free_udp_ports(count) -> list:
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(count)]
+    for free_socket in sockets:
+        free_socket.bind(("127.0.0.1", 0))
+    ports = [free_socket.getsockname()[1] for free_socket in sockets]
+    for free_socket in sockets:
+        free_socket.close()
+    return ports
+
+
+class TestAoIServerSessions(unittest.TestCase):
+
+    def setUp(self):
+        SharedState._instance = None
+        self.addCleanup(setattr, SharedState, "_instance", None)
+        measurement_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(measurement_folder.cleanup)
+        for patcher in (mock.patch.object(aoiController, "DEFAULT_AoI_MEASUREMENT_FOLDER", measurement_folder.name),
+                        mock.patch.object(SharedState, "get_probe_ip", return_value = "127.0.0.1"),
+                        mock.patch.object(AgeOfInformationController, "start_ntpsec_service", return_value = "OK"),
+                        mock.patch.object(AgeOfInformationController, "compress_and_publish_aoi_result")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mqtt_client = RecordingMqttClient()
+        self.controller = AgeOfInformationController(self.mqtt_client, lambda interested_command, handler: "OK",
+                                                     wait_for_set_coordinator_ip = lambda: None)
+
+    def prepare_server(self, msm_id, port):
+        self.controller.aoi_command_handler("prepare", {"msm_id": msm_id, "role": "Server", "socket_port": port, "payload_size": 16})
+
+    def wait_received(self, msm_id, port):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+            client_socket.sendto(AOI_HEADER.pack(0, time.time()) + bytes(16), ("127.0.0.1", port))
+        deadline = time.monotonic() + WAIT_SECONDS
+        while time.monotonic() < deadline:
+            if self.controller.get_session(msm_id).thread.is_alive():
+                return
+            time.sleep(0.01)
+        self.fail(f"No receiver thread for {msm_id}")
+
+    def test_two_flows_on_different_ports(self):
+        first_port, second_port = free_udp_ports(2)
+        self.prepare_server("m1", first_port)
+        self.prepare_server("m2", second_port)
+        self.assertEqual([ack["msm_id"] for ack in self.mqtt_client.acks], ["m1", "m2"])
+        self.assertEqual(self.mqtt_client.nacks, [])
+        self.assertCountEqual(self.controller.shared_state.sessions_of(RESOURCE_OWNER), ["m1", "m2"])
+        self.wait_received("m1", first_port)
+        self.wait_received("m2", second_port)
+
+        self.controller.aoi_command_handler("stop", {"msm_id": "m1"})
+        self.assertEqual(self.mqtt_client.acks[-1]["command"], "stop")
+        self.assertEqual(self.controller.shared_state.sessions_of(RESOURCE_OWNER), ["m2"])
+        self.assertTrue(self.controller.get_session("m2").thread.is_alive()) # The other flow goes on
+
+        self.controller.aoi_command_handler("stop", {"msm_id": "m2"})
+        self.assertEqual(self.controller.shared_state.sessions_of(RESOURCE_OWNER), [])
+        published = [call.kwargs["msm_id"] for call in self.controller.compress_and_publish_aoi_result.call_args_list]
+        self.assertEqual(published, ["m1", "m2"])
+
+    def test_same_port_refused(self):
+        port, = free_udp_ports(1)
+        self.prepare_server("m1", port)
+        self.prepare_server("m2", port)
+        self.assertEqual(self.mqtt_client.nacks[-1]["msm_id"], "m2")
+        self.assertEqual(self.mqtt_client.nacks[-1]["reason"], "PROBE BUSY")
+        self.assertIsNone(self.controller.get_session("m2"))
+        self.controller.aoi_command_handler("stop", {"msm_id": "m1"})
+
+    def test_stop_of_an_unknown_measurement(self):
+        self.controller.aoi_command_handler("stop", {"msm_id": "m1"})
+        self.assertEqual(self.mqtt_client.nacks[-1]["reason"], "No AoI measurement in progress")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Unit tests of the AoI pacing engine, sending to a loopback UDP socket.
+Run from probesFirmware: python -m unittest aoiModule.test_aoiPacer
+"""
+
+import socket
+import unittest
+import threading
+import statistics
+from aoiModule.aoiPacer import AoIPacer, RunningStats, AOI_HEADER, aoi_packet_size
+
+RUN_SECONDS = 0.5
+
+
+class TestRunningStats(unittest.TestCase):
+
+    def test_same_as_the_statistics_module(self):
+        values = [0.3, 1.2, 0.7, 2.5, 0.1]
+        running_stats = RunningStats()
+        for value in values:
+            running_stats.add(value)
+        self.assertEqual(running_stats.count, 5)
+        self.assertAlmostEqual(running_stats.mean, statistics.mean(values))
+        self.assertAlmostEqual(running_stats.stdev(), statistics.stdev(values))
+        self.assertEqual(running_stats.max, 2.5)
+
+    def test_no_stdev_of_one_value(self):
+        running_stats = RunningStats()
+        self.assertIsNone(running_stats.stdev())
+        running_stats.add(1.0)
+        self.assertIsNone(running_stats.stdev())
+
+
+class TestAoIPacer(unittest.TestCase):
+
+    def setUp(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.setblocking(False)
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.server_socket.close)
+        self.addCleanup(self.client_socket.close)
+        self.stop_event = threading.Event()
+
+    def run_pacer(self, pacer):
+        timer = threading.Timer(RUN_SECONDS, self.stop_event.set)
+        timer.start()
+        pacer.run()
+        timer.join()
+
+    def received_packets(self) -> list:
+        packets = []
+        while True:
+            try:
+                packets.append(self.server_socket.recv(65535))
+            except BlockingIOError:
+                return packets
+
+    def test_rate_and_sequence_numbers(self):
+        pacer = AoIPacer(self.client_socket, self.server_socket.getsockname(), packets_rate = 200, payload_size = 32,
+                         stop_event = self.stop_event)
+        self.run_pacer(pacer)
+        packets = self.received_packets()
+        stats = pacer.stats()
+
+        self.assertEqual(len(packets), stats["packets_sent"])
+        self.assertTrue(all(len(packet) == aoi_packet_size(32) for packet in packets))
+        sequences = [AOI_HEADER.unpack_from(packet)[0] for packet in packets]
+        self.assertEqual(sequences, list(range(len(packets))))
+        send_timestamps = [AOI_HEADER.unpack_from(packet)[1] for packet in packets]
+        self.assertEqual(send_timestamps, sorted(send_timestamps))
+        self.assertGreaterEqual(send_timestamps[0], pacer.started_at)
+
+        self.assertEqual(stats["requested_rate"], 200)
+        self.assertAlmostEqual(stats["achieved_rate"], 200, delta = 20)
+        self.assertEqual(stats["packets_skipped"], 0)
+        self.assertEqual(stats["packet_bytes"], AOI_HEADER.size + 32)
+        self.assertGreaterEqual(stats["lateness_mean_us"], 0)
+        self.assertIsNotNone(stats["send_jitter_us"])
+
+    def test_no_packet_once_stopped(self):
+        self.stop_event.set()
+        pacer = AoIPacer(self.client_socket, self.server_socket.getsockname(), 100, 0, self.stop_event)
+        pacer.run()
+        self.assertEqual(pacer.stats()["packets_sent"], 0)
+        self.assertIsNone(pacer.stats()["lateness_mean_us"])
+        self.assertEqual(self.received_packets(), [])
+
+    def test_wrong_rate(self):
+        for packets_rate in (0, -5):
+            with self.assertRaises(ValueError):
+                AoIPacer(self.client_socket, self.server_socket.getsockname(), packets_rate, 32, self.stop_event)
+
+
+if __name__ == "__main__":
+    unittest.main()
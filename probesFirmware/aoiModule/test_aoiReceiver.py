@@ -0,0 +1,149 @@
+"""
+Unit tests of the AoI receiver: sequence tracking, and a run on a loopback UDP socket.
+Run from probesFirmware: python -m unittest aoiModule.test_aoiReceiver
+"""
+
+import io
+import csv
+import json
+import time
+import socket
+import unittest
+import threading
+from aoiModule.aoiPacer import AOI_HEADER
+from aoiModule.aoiReceiver import AoIReceiver, MAX_SEQUENCE_JUMP, SEQUENCE_WINDOW
+
+WAIT_SECONDS = 5
+
+
+class TestTrackSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = AoIReceiver(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), io.StringIO(), threading.Event())
+        self.addCleanup(self.receiver.measure_socket.close)
+
+    def track(self, sequences):
+        return [self.receiver.track_sequence(sequence) for sequence in sequences]
+
+    def test_in_order(self):
+        self.assertTrue(all(self.track(range(10))))
+        stats = self.receiver.stats()
+        self.assertEqual(stats["packets_lost"], 0)
+        self.assertEqual(stats["sequence_gaps"], 0)
+        self.assertEqual(stats["packets_reordered"], 0)
+        self.assertEqual(stats["packets_duplicated"], 0)
+
+    def test_lost_reordered_duplicated(self):
+        self.track([0, 1, 3, 2, 2, 6, 7])
+        stats = self.receiver.stats()
+        self.assertEqual(stats["packets_lost"], 2) # 4 and 5
+        self.assertEqual(stats["sequence_gaps"], 2)
+        self.assertEqual(stats["packets_reordered"], 1)
+        self.assertEqual(stats["packets_duplicated"], 1)
+
+    def test_window_slides(self):
+        self.track([sequence for sequence in range(10) if sequence != 5])
+        self.assertTrue(self.receiver.track_sequence(9 + SEQUENCE_WINDOW)) # 5 and 10..8 + SEQUENCE_WINDOW are lost
+        self.assertEqual(len(self.receiver.received_sequences), SEQUENCE_WINDOW >> 3)
+        self.assertEqual(self.receiver.lost, 1) # 5 left the window
+        self.assertEqual(self.receiver.stats()["packets_lost"], 1 + SEQUENCE_WINDOW - 1)
+        self.assertTrue(self.receiver.track_sequence(10)) # Still in the window: late, not lost
+        self.assertEqual(self.receiver.stats()["packets_lost"], SEQUENCE_WINDOW - 1)
+        self.assertEqual(self.receiver.reordered, 1)
+
+    def test_behind_the_window_not_tracked(self):
+        self.track([0, 1])
+        self.assertTrue(self.receiver.track_sequence(1 + 3 * SEQUENCE_WINDOW)) # Jumps over the window
+        self.assertEqual(len(self.receiver.received_sequences), SEQUENCE_WINDOW >> 3)
+        self.assertEqual(self.receiver.stats()["packets_lost"], 3 * SEQUENCE_WINDOW - 1)
+        self.assertFalse(self.receiver.track_sequence(1 + 2 * SEQUENCE_WINDOW)) # Already counted as lost
+        self.assertFalse(self.receiver.track_sequence(1)) # Duplicate or late: can't tell anymore
+        self.assertEqual(self.receiver.duplicates, 0)
+        self.assertTrue(self.receiver.track_sequence(2 + 2 * SEQUENCE_WINDOW))
+        self.assertEqual(self.receiver.stats()["packets_lost"], 3 * SEQUENCE_WINDOW - 2)
+
+    def test_long_run(self):
+        lost = set(range(3, 4 * SEQUENCE_WINDOW, 1000))
+        self.track([sequence for sequence in range(4 * SEQUENCE_WINDOW) if sequence not in lost])
+        stats = self.receiver.stats()
+        self.assertEqual(stats["packets_lost"], len(lost))
+        self.assertEqual(stats["sequence_gaps"], len(lost))
+        self.assertEqual(stats["packets_reordered"], 0)
+
+    def test_jump_beyond_the_window_not_tracked(self):
+        self.track([0, 1])
+        self.assertFalse(self.receiver.track_sequence(1 + MAX_SEQUENCE_JUMP + 1))
+        self.assertEqual(self.receiver.highest_sequence, 1)
+        self.assertTrue(self.receiver.track_sequence(1 + MAX_SEQUENCE_JUMP))
+
+    def test_not_tracked_yet(self):
+        stats = self.receiver.stats()
+        self.assertIsNone(stats["packets_lost"])
+        self.assertIsNone(stats["packets_reordered"])
+
+
+class TestAoIReceiverRun(unittest.TestCase):
+
+    def setUp(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.server_socket.close)
+        self.addCleanup(self.client_socket.close)
+        self.stop_event = threading.Event()
+        self.csv_file = io.StringIO()
+        self.receiver = AoIReceiver(self.server_socket, self.csv_file, self.stop_event, block_rows = 4)
+        self.thread = threading.Thread(target = self.receiver.run, daemon = True)
+        self.thread.start()
+
+    def send(self, packet : bytes):
+        self.client_socket.sendto(packet, self.server_socket.getsockname())
+
+    def stop(self):
+        deadline = time.monotonic() + WAIT_SECONDS
+        while (self.receiver.received + self.receiver.untracked < self.sent) and (time.monotonic() < deadline):
+            time.sleep(0.01)
+        self.stop_event.set()
+        self.send(b"") # Wakes up the receive
+        self.thread.join(timeout = WAIT_SECONDS)
+        self.assertFalse(self.thread.is_alive())
+
+    def rows(self) -> list:
+        return list(csv.reader(io.StringIO(self.csv_file.getvalue())))
+
+    def test_rows_and_stats(self):
+        sequences = [0, 1, 2, 4, 3, 3, 6, 7, 8, 9]
+        for sequence in sequences:
+            self.send(AOI_HEADER.pack(sequence, time.time() - 0.1) + bytes(16))
+        self.sent = len(sequences)
+        self.stop()
+
+        rows = self.rows()
+        self.assertEqual(rows[0], ["Timestamp", "AoI"])
+        self.assertEqual(len(rows) - 1, len(sequences)) # Flushed in blocks of 4, and at the end
+        self.assertTrue(all(0.1 <= float(aoi) < 0.1 + WAIT_SECONDS for _, aoi in rows[1:]))
+
+        stats = self.receiver.stats()
+        self.assertEqual(stats["packets_received"], 10)
+        self.assertEqual(stats["packets_lost"], 1)
+        self.assertEqual(stats["packets_reordered"], 1)
+        self.assertEqual(stats["packets_duplicated"], 1)
+        self.assertEqual(stats["packets_untracked"], 0)
+
+    def test_untracked_packets(self):
+        self.send(json.dumps({"timestamp": time.time()}).encode()) # Client with an older firmware
+        self.send(AOI_HEADER.pack(0, time.time()))
+        self.send(AOI_HEADER.pack(MAX_SEQUENCE_JUMP + 10, time.time())) # Out of the window: no row
+        self.send(b"short")
+        self.sent = 3
+        self.stop()
+
+        self.assertEqual(len(self.rows()) - 1, 2)
+        stats = self.receiver.stats()
+        self.assertEqual(stats["packets_received"], 2)
+        self.assertEqual(stats["packets_untracked"], 2)
+        self.assertEqual(stats["packets_lost"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Capabilities of the probe, announced to the coordinator in the ONLINE/UPDATE state messages.
+The coordinator caches them and rejects the measurements that can't run on the probe (missing handler, sensor, tool
+or interface) at submission time, without sending any command.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import psutil
+from pathlib import Path
+from shared_resources import INA219_SENSOR
+from pingModule.pingEngine import icmp_socket_kind
+
+CAPABILITIES_VERSION = 1
+TOOL_VERSION_TIMEOUT_SECONDS = 2
+
+# Tools run through the PATH: name -> command printing the version
+PATH_TOOLS = {
+    "iperf3": ["iperf3", "--version"],
+    "tcpreplay": ["tcpreplay", "--version"],
+    "tcprewrite": ["tcprewrite", "--version"],
+    "ntpdate": ["ntpdate", "-v"],
+}
+# Executables shipped with the firmware: name -> path
+BUNDLED_TOOLS = {
+    "udpClient": os.path.join(Path(__file__).parent, "udppingModule", "udpClient"),
+    "udpServer": os.path.join(Path(__file__).parent, "udppingModule", "udpServer"),
+}
+# Sensors made available by a registered handler
+HANDLER_SENSORS = {
+    "energy": [INA219_SENSOR],
+}
+
+
+def tool_version(version_command) -> dict:
+    """
+    Returns {"available", "version"} of a tool in the PATH. The version is the first non empty line it prints.
+    """
+    if shutil.which(version_command[0]) is None:
+        return {"available": False, "version": None}
+    try:
+        result = subprocess.run(version_command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True,
+                                timeout = TOOL_VERSION_TIMEOUT_SECONDS)
+        lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+        return {"available": True, "version": lines[0] if lines else None}
+    except Exception as e:
+        print(f"Capabilities: can't get the version of |{version_command[0]}| -> {e}")
+        return {"available": True, "version": None}
+
+
+def collect_tools() -> dict:
+    tools = {name: tool_version(version_command) for name, version_command in PATH_TOOLS.items()}
+    for name, path in BUNDLED_TOOLS.items():
+        tools[name] = {"available": os.access(path, os.X_OK), "version": None}
+    kind = icmp_socket_kind() # The echo engine of the ping handler: "dgram" or "raw"
+    tools["icmp_socket"] = {"available": kind is not None, "version": kind}
+    return tools
+
+
+def collect_interfaces() -> dict:
+    """
+    Returns {nic: {"up", "ipv4"}} of the network interfaces of the probe, loopback excluded.
+    """
+    interfaces = {}
+    nic_stats = psutil.net_if_stats()
+    for nic, addresses in psutil.net_if_addrs().items():
+        if nic == "lo":
+            continue
+        interfaces[nic] = {
+            "up": nic_stats[nic].isup if (nic in nic_stats) else False,
+            "ipv4": [address.address for address in addresses if address.family == socket.AF_INET]
+        }
+    return interfaces
+
+
+def build_capabilities(handlers, tools : dict, interfaces : dict) -> dict:
+    handlers = sorted(handler for handler in handlers if handler != "root_service")
+    sensors = sorted({sensor for handler in handlers for sensor in HANDLER_SENSORS.get(handler, [])})
+    return {
+        "version": CAPABILITIES_VERSION,
+        "handlers": handlers,
+        "sensors": sensors,
+        "tools": tools,
+        "interfaces": interfaces
+    }
+
+
+def collect_capabilities(handlers) -> dict:
+    """
+    Probes the tools and the interfaces of this host. Called once, after the registration of the controllers.
+    Args:
+        handlers: The handlers registered in the CommandsDemultiplexer.
+    """
+    return build_capabilities(handlers, collect_tools(), collect_interfaces())
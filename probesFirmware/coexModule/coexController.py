@@ -2,15 +2,17 @@
 # Controller for Coexisting Applications (COEX) functionality in Measure-X
 # Handles configuration, traffic generation, and result/error reporting for COEX experiments
 
-import os, signal
+import os
 import json
 from pathlib import Path
 from mqttModule.mqttClient import ProbeMqttClient
-from shared_resources import SharedState
+from shared_resources import SharedState, EXCLUSIVE, udp_port, session_owner, START_AT_KEY, wait_until
+from process_supervisor import ProcessSupervisor
 from scapy.all import *
 
 DEFAULT_THREAD_NAME = "coex_traffic_worker"
 DEFAULT_PCAP_FOLDER = "pcap"
+RESOURCE_OWNER = "coex"
 
 class CoexParamaters:
     """
@@ -50,6 +52,7 @@ class CoexController:
     def __init__(self, mqtt_client : ProbeMqttClient, registration_handler_request_function):
         # Initialize shared state and MQTT client
         self.shared_state = SharedState.get_instance()
+        self.process_supervisor = ProcessSupervisor.get_instance()
         self.mqtt_client = mqtt_client
         self.last_msm_id = None
         self.last_coex_parameters = CoexParamaters()
@@ -62,6 +65,8 @@ class CoexController:
         self.closed_by_manual_stop = threading.Event()
         self.closed_by_scheduled_stop = threading.Event()
         self.last_complete_trace_rewrited = None
+        self.last_start_at = None # Absolute time at which the client begins the traffic (None: as soon as started)
+        self.last_arm_command = None # The command (conf, start or prepare) that the traffic thread ACKs once armed
 
         # Register handler for COEX commands
         registration_response = registration_handler_request_function(
@@ -80,21 +85,9 @@ class CoexController:
             return
         match command:
             case 'conf':
-                if not self.shared_state.set_probe_as_busy():
-                    self.send_coex_NACK(failed_command = command, error_info = "PROBE BUSY", measurement_related_conf = msm_id)
+                if not self.configure_coex_traffic(command, msm_id, payload):
                     return
-                check_parameters_msg = self.check_all_parameters(payload=payload)
-                if check_parameters_msg != "OK":
-                    self.send_coex_NACK(failed_command = command, error_info = check_parameters_msg, measurement_related_conf = msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-                                
-                thread_creation_msg = self.submit_thread_for_coex_traffic()
-                if thread_creation_msg != "OK":
-                    self.send_coex_NACK(failed_command = command, error_info = "PROBE BUSY", measurement_related_conf = msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-                
+                self.last_arm_command = command
                 if self.last_coex_parameters.role == "Client": # THE SERVER WILL SEND conf ACK in body_worker_for_coex_traffic
                     self.send_coex_ACK(successed_command = "conf", measurement_related_conf = self.last_msm_id)
                 self.print_coex_conf_info_message()       
@@ -103,7 +96,7 @@ class CoexController:
                 
 
             case 'start':
-                if self.shared_state.probe_is_ready():
+                if not self.shared_state.sessions_of(RESOURCE_OWNER):
                     self.send_coex_NACK(failed_command = command, error_info = "No coex measure in progress", measurement_related_conf = msm_id)
                     return
                 if msm_id != self.last_msm_id:
@@ -113,10 +106,22 @@ class CoexController:
                     return
                 
                 if self.last_coex_parameters.role == "Client":
+                    self.last_start_at = payload.get(START_AT_KEY)
+                    self.last_arm_command = command
                     self.thread_worker_on_socket.start()
 
+            case 'prepare':
+                # Combined command: conf (and, for the client, start) in one round trip. Both the roles ACK from the traffic
+                # thread: the server when listening, the client when armed, then it begins the traffic at start_at.
+                if not self.configure_coex_traffic(command, msm_id, payload):
+                    return
+                self.last_arm_command = command
+                self.last_start_at = payload.get(START_AT_KEY)
+                self.print_coex_conf_info_message()
+                self.thread_worker_on_socket.start()
+
             case 'stop':
-                if self.shared_state.probe_is_ready():
+                if not self.shared_state.sessions_of(RESOURCE_OWNER):
                     silent_mode = payload["silent"]
                     if not silent_mode:
                         self.send_coex_NACK(failed_command = command, error_info = "No coex measure in progress", measurement_related_conf = msm_id)
@@ -137,6 +142,29 @@ class CoexController:
                 self.send_coex_NACK(failed_command = command, error_info = "Command not handled", measurement_related_conf = msm_id)
 
 
+    def configure_coex_traffic(self, command, msm_id, payload : dict) -> bool:
+        """
+        Checks the parameters, locks the coex port, and creates the traffic thread (conf and prepare commands).
+        Returns True if configured, otherwise the NACK has already been sent.
+        """
+        check_parameters_msg = self.check_all_parameters(payload=payload)
+        if check_parameters_msg != "OK":
+            self.send_coex_NACK(failed_command = command, error_info = check_parameters_msg, measurement_related_conf = msm_id)
+            return False
+        # The coex traffic is meant to coexist with the other measurements: it only locks its own port, not the NIC
+        coex_resources = {udp_port(payload.get("socket_port")): EXCLUSIVE}
+        if self.shared_state.sessions_of(RESOURCE_OWNER) or (not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, msm_id), coex_resources)):
+            self.send_coex_NACK(failed_command = command, error_info = "PROBE BUSY", measurement_related_conf = msm_id)
+            return False
+        self.set_parameters(payload = payload) # Only once the port is locked: a busy probe keeps the parameters of its measurement
+
+        thread_creation_msg = self.submit_thread_for_coex_traffic()
+        if thread_creation_msg != "OK":
+            self.send_coex_NACK(failed_command = command, error_info = "PROBE BUSY", measurement_related_conf = msm_id)
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
+            return False
+        return True
+
     def send_coex_ACK(self, successed_command, measurement_related_conf):
         """
         Publishes an ACK message for a successful COEX command via MQTT.
@@ -169,7 +197,7 @@ class CoexController:
             "type": "result",
             "payload": json_coex_result
         }
-        self.mqtt_client.publish_on_result_topic(result=json.dumps(json_command_result))
+        self.mqtt_client.publish_on_result_topic(result=json_command_result)
         print(f"CoexController: sent coex result -> {json_coex_result}")
 
     def send_coex_error(self, command_error, msm_id, reason):
@@ -213,7 +241,7 @@ class CoexController:
                 if self.last_coex_parameters.trace_name is None: # This means that there will be a Custom Traffic (UDP)
                     self.measure_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                     self.measure_socket.bind((self.shared_state.get_probe_ip(), self.last_coex_parameters.socker_port))
-                    self.send_coex_ACK(successed_command="conf", measurement_related_conf=self.last_msm_id)
+                    self.send_coex_ACK(successed_command=self.last_arm_command, measurement_related_conf=self.last_msm_id)
                     print(f"Thread_Coex: Opened socket on IP: |{self.shared_state.get_probe_ip()}| , port: |{self.last_coex_parameters.socker_port}|")
                     print(f"Thread_Coex: Listening for {self.last_coex_parameters.packets_size} byte ...")
                     while(not self.stop_thread_event.is_set()):
@@ -230,11 +258,11 @@ class CoexController:
                         result = subprocess.run(cmd_to_add_rule_for_RST_packets_suppression, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check = True)
                         if result.returncode == 0:
                             print(f"Thread_Coex: added rule for RST packets suppression for [{self.last_coex_parameters.counterpart_probe_ip}:{self.last_coex_parameters.socker_port}]")
-                            self.send_coex_ACK(successed_command = "conf", measurement_related_conf = self.last_msm_id)
+                            self.send_coex_ACK(successed_command = self.last_arm_command, measurement_related_conf = self.last_msm_id)
                         else:
                             print(f"Thread_Coex: error while adding suppression rule. Error -> : {result.stderr.decode()}")
-                            self.send_coex_NACK(failed_command = "conf", error_info= f"Error while adding suppression rule. Error --> {result.stderr.decode()}", measurement_related_conf = self.last_msm_id)
-                            self.shared_state.set_probe_as_ready()
+                            self.send_coex_NACK(failed_command = self.last_arm_command, error_info= f"Error while adding suppression rule. Error --> {result.stderr.decode()}", measurement_related_conf = self.last_msm_id)
+                            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                             self.reset_vars()
                             return
                         print(f"Thread_Coex: Waiting for coex traffic stop...")
@@ -251,8 +279,8 @@ class CoexController:
                             print(f"Thread_Coex: error while deleting suppression rule. Exception -> {e}")
                     except subprocess.CalledProcessError as e:
                         print(f"Thread_Coex: error while adding suppression rule. Exception -> {e}")
-                        self.send_coex_NACK(failed_command = "conf", error_info= f"Error while adding suppression rule. Exception --> {e}", measurement_related_conf = self.last_msm_id)
-                        self.shared_state.set_probe_as_ready()
+                        self.send_coex_NACK(failed_command = self.last_arm_command, error_info= f"Error while adding suppression rule. Exception --> {e}", measurement_related_conf = self.last_msm_id)
+                        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                         self.reset_vars()
                     
             elif self.last_coex_parameters.role == "Client": # If i'm Coex Client
@@ -270,7 +298,9 @@ class CoexController:
                     n_pkts = self.last_coex_parameters.packets_number
                     size = self.last_coex_parameters.packets_size
                     pkt = Ether(src=src_mac, dst=dst_mac) / IP(src=src_ip, dst=dst_ip) / UDP(sport=30000, dport=dport) / Raw(RandString(size=size))
-                    self.send_coex_ACK(successed_command="start", measurement_related_conf=self.last_msm_id)
+                    self.send_coex_ACK(successed_command=self.last_arm_command, measurement_related_conf=self.last_msm_id) # Armed: the traffic begins at last_start_at
+                    if not self.wait_scheduled_start():
+                        return
                     if n_pkts == 0: # Then, the traffic will continue unitl "duration" seconds
                         if self.last_coex_parameters.duration != 0:
                             print(f"Thread_Coex: starting sendpfast. Future-kill scheduled to terminate after {self.last_coex_parameters.duration} seconds.")
@@ -289,7 +319,7 @@ class CoexController:
                                 self.future_stopper.cancel()
                                 print("Thread_Coex: sendpfast has sent all packets. Deleted future-kill")
                                 self.send_coex_ACK(successed_command="stop", measurement_related_conf=self.last_msm_id)
-                                self.shared_state.set_probe_as_ready()
+                                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                                 self.reset_vars()
                         else:
                             d = sendpfast(pkt, pps = rate, loop = 1, parse_results = True) # Send the packet forever (duration: 0)
@@ -302,29 +332,33 @@ class CoexController:
                                         "--enet-smac=" + src_mac , "--enet-dmac=" + dst_mac ,
                                         "--portmap=" + str(dport) + ":" + str(dport)]
                     try:
-                        result = subprocess.run(tcprewrite_cmd, check=True)
+                        result = self.process_supervisor.run(RESOURCE_OWNER, self.last_msm_id, tcprewrite_cmd, text=False)
                         if result.returncode == 0: # If the tcprewrite is succesful...
                             print(f"Thread_Coex: tcprewrite OK")
+                            self.send_coex_ACK(successed_command = self.last_arm_command, measurement_related_conf = self.last_msm_id) # Armed: the replay begins at last_start_at
+                            if not self.wait_scheduled_start():
+                                return
                             if self.last_coex_parameters.duration != 0: # If the duration is 0, this means that the traffic generation will go forever (until you stop the primary measure)
                                 print(f"Thread_Coex: tcpreplay future-kill scheduled to terminate after {self.last_coex_parameters.duration} seconds.")
                                 self.future_stopper = threading.Timer(self.last_coex_parameters.duration, self.stop_worker_socket_thread, args=(True, self.last_msm_id,))
                                 self.future_stopper.start()
 
                             print(f"Thread_Coex: tcpreplay started")
-                            self.send_coex_ACK(successed_command = "start", measurement_related_conf = self.last_msm_id)
                             tcpreplay_cmd = ["sudo", "tcpreplay", "-i", self.shared_state.default_nic_name , self.last_complete_trace_rewrited]
-                            result = subprocess.run(tcpreplay_cmd, check=True)
+                            result = self.process_supervisor.run(RESOURCE_OWNER, self.last_msm_id, tcpreplay_cmd, stdout=None, stderr=None)
+                            if result.stop_requested: # Killed by a manual or scheduled stop, as a failed tcpreplay before
+                                raise subprocess.CalledProcessError(result.returncode, tcpreplay_cmd)
                             if result.returncode == 0:
                                 deleted_future_stopper_msg = "."
                                 if self.future_stopper:
                                     self.future_stopper.cancel()
                                     deleted_future_stopper_msg = ". Deleted scheduled-kill."
-                                print(f"Thread_Coex: tcpreplay ended. All packets have been sent{deleted_future_stopper_msg}")
+                                print(f"Thread_Coex: tcpreplay ended. All packets have been sent{deleted_future_stopper_msg} Usage: {result.usage()}")
                                 self.send_coex_ACK(successed_command="stop", measurement_related_conf=self.last_msm_id)
-                                self.shared_state.set_probe_as_ready()
+                                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                                 self.reset_vars()
                             else:
-                                print(f"TCPREPLAY TERMINATO CON {str(result.returncode)}")
+                                raise subprocess.CalledProcessError(result.returncode, tcpreplay_cmd)
                         else:
                             raise Exception(f"Thread_Coex: tcprewrite error -> {result.stderr.decode('utf-8')}")
                             #self.send_coex_NACK(successed_command="start", measurement_related_conf=self.last_msm_id, error_info=result.stderr.decode('utf-8'))    
@@ -343,8 +377,8 @@ class CoexController:
                             #self.send_coex_ACK(successed_command="stop", measurement_related_conf=self.last_msm_id)
                         else:
                             print(f"Thread_Coex: tcpreplay exception with error -> {e}")
-                            self.send_coex_NACK(failed_command="start", measurement_related_conf=self.last_msm_id, error_info=str(e))
-                            self.shared_state.set_probe_as_ready()
+                            self.send_coex_NACK(failed_command=self.last_arm_command, measurement_related_conf=self.last_msm_id, error_info=str(e))
+                            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                             self.reset_vars()
                     """
                     packets = rdpcap(self.last_complete_trace_path)
@@ -381,7 +415,7 @@ class CoexController:
                         self.future_stopper.cancel()
                     print("Thread_Coex: sendpfast ended")
                     self.send_coex_ACK(successed_command="stop", measurement_related_conf=self.last_msm_id)
-                    self.shared_state.set_probe_as_ready()
+                    self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                     self.reset_vars()
                     """
                     # BLOCKING
@@ -391,11 +425,22 @@ class CoexController:
         except Exception as e:
             print(f"CoexController: Role: {self.last_coex_parameters.role} , Exception -> |{str(e)}| , msm_id: |{self.last_msm_id}|")
             if (self.last_coex_parameters.role == "Server") and (not self.stop_thread_event.is_set()):
-                self.send_coex_NACK(failed_command="conf", measurement_related_conf= self.last_msm_id, error_info = str(e))
-                self.shared_state.set_probe_as_ready()
+                self.send_coex_NACK(failed_command=self.last_arm_command, measurement_related_conf= self.last_msm_id, error_info = str(e))
+                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                 self.reset_vars()
             
 
+    def wait_scheduled_start(self) -> bool:
+        """
+        Blocks the client thread until the scheduled start of the traffic, if any.
+        Returns False if the measurement has been stopped in the meanwhile (the stop has already released everything).
+        """
+        armed_msm_id = self.last_msm_id
+        if not wait_until(self.last_start_at, self.stop_thread_event) or (self.last_msm_id != armed_msm_id):
+            print(f"Thread_Coex: coex traffic of |{armed_msm_id}| stopped before its scheduled start")
+            return False
+        return True
+
     def stop_worker_socket_thread(self, invoked_by_timer = False, measurement_coex_to_stop = ""):
         """
         Stops the COEX worker thread and cleans up resources. Handles both server and client roles.
@@ -412,34 +457,29 @@ class CoexController:
                     self.measure_socket.close()
                 else:
                     self.thread_worker_on_socket.join()
-                self.shared_state.set_probe_as_ready()
+                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                 self.reset_vars()
             elif self.last_coex_parameters.role == "Client":
                 if (invoked_by_timer): # If this is an automatic invocation, then we must be sure to stop the coex traffic.
                     if (measurement_coex_to_stop == self.last_msm_id): # May be this automatic invocation is delayed too much that fall in another measurement, so it's mandatory check the msm_id
                         self.closed_by_scheduled_stop.set()
 
-                        proc = subprocess.run(["sudo", "pgrep", "tcpreplay"], capture_output=True, text=True)
-                        if proc.stdout:
-                            pid = int(proc.stdout.strip())
-                            os.kill(pid, signal.SIGKILL)
+                        if self.process_supervisor.stop(RESOURCE_OWNER, measurement_coex_to_stop): # Only the tcpreplay of this measurement
                             print("CoexController: Scheduled-kill of tcpreplay.")
                         #self.send_coex_ACK(successed_command="stop", measurement_related_conf=measurement_coex_to_stop)
                         #self.reset_vars()
-                        #self.shared_state.set_probe_as_ready()
+                        #self.shared_state.release_resources(RESOURCE_OWNER)
                 else:
+                    self.stop_thread_event.set() # Wakes up the client thread, if it is still waiting for the scheduled start
                     deleted_future_stopper_msg = "."
                     if self.future_stopper:
                         self.future_stopper.cancel()
                         deleted_future_stopper_msg = ". Deleted scheduled-kill."
                     self.closed_by_manual_stop.set()
-                    proc = subprocess.run(["sudo", "pgrep", "tcpreplay"], capture_output=True, text=True)
-                    if proc.stdout:
-                        pid = int(proc.stdout.strip())
-                        os.kill(pid, signal.SIGKILL)
+                    if self.process_supervisor.stop(RESOURCE_OWNER, self.last_msm_id):
                         print(f"CoexController: Manual-kill of tcpreplay{deleted_future_stopper_msg}")
                 self.send_coex_ACK(successed_command="stop", measurement_related_conf=self.last_msm_id)
-                self.shared_state.set_probe_as_ready()
+                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_msm_id))
                 self.reset_vars()
             return "OK"
         except Exception as e:
@@ -474,42 +514,46 @@ class CoexController:
             self.future_stopper.cancel()
         self.future_stopper = None
         self.last_complete_trace_rewrited = None
+        self.last_start_at = None
+        self.last_arm_command = None
 
 
+    def find_trace(self, trace_name) -> tuple:
+        """
+        Looks for the pcap file of the trace in the coex module folder, then in the home dir of the probe.
+        Returns (trace_path, rewrited_trace_path), or None if the file is not found.
+        """
+        trace_name_rewrited = trace_name.replace(".pcap", "_r.pcap") if (trace_name.endswith(".pcap")) else (trace_name + "_r.pcap")
+        trace_name += ".pcap" if (not trace_name.endswith(".pcap")) else ""
+        trace_directory = os.path.join(Path(__file__).parent, DEFAULT_PCAP_FOLDER)
+        trace_path = os.path.join(trace_directory , trace_name)
+        if not Path(trace_path).exists(): # If the pcap file is not present in the coex module path, the probe will check in its home dir
+            trace_directory = os.path.join("/", "home", os.getlogin(), DEFAULT_PCAP_FOLDER) # This change the "base path" of the rewrited trace path
+            trace_path = os.path.join("/", "home", os.getlogin(), DEFAULT_PCAP_FOLDER, trace_name)
+            if not Path(trace_path).exists():
+                return None
+        return trace_path, os.path.join(trace_directory , trace_name_rewrited)
+
     def check_all_parameters(self, payload : dict) -> str:
         """
-        Checks all required parameters for a COEX measurement and sets them if valid.
+        Checks all required parameters for a COEX measurement, without setting them (see set_parameters).
         Returns 'OK' if all parameters are valid, otherwise returns an error message.
         """
         role = payload.get("role")
         counterpart_probe_ip = payload.get("counterpart_probe_ip")
         trace_name = payload.get("trace_name")
-        packets_size = payload.get("packets_size")
         packets_rate = payload.get("packets_rate")
         packets_number = payload.get("packets_number")
         socket_port = payload.get("socket_port")
         counterpart_probe_mac = payload.get("counterpart_probe_mac")
         msm_id = payload.get("msm_id")
-        duration = payload.get("duration")
 
         if role is None:
             return "No role provided"
         elif role == "Client":            
             if trace_name is not None: # Checking if pcap file exists
-                trace_name_rewrited = trace_name.replace(".pcap", "_r.pcap") if (trace_name.endswith(".pcap")) else (trace_name + "_r.pcap")
-                trace_name += ".pcap" if (not trace_name.endswith(".pcap")) else ""
-                trace_directory = os.path.join(Path(__file__).parent, DEFAULT_PCAP_FOLDER)
-                trace_path = os.path.join(trace_directory , trace_name)
-                if not Path(trace_path).exists(): # If the pcap file is not present in the coex module path, the probe will check in its home dir
-                    trace_directory = os.path.join("/", "home", os.getlogin(), DEFAULT_PCAP_FOLDER) # This change the "base path" of the rewrited trace path
-                    trace_path = os.path.join("/", "home", os.getlogin(), DEFAULT_PCAP_FOLDER, trace_name)
-                    if not Path(trace_path).exists():
-                        return f"Trace file |{trace_name}| not found!"
-                    print(f"CoexController: file {trace_name} found in alternative folder")
-                else:
-                    print(f"CoexController: file {trace_name} found in Coex Module folder")
-                self.last_complete_trace_path = trace_path
-                self.last_complete_trace_rewrited = os.path.join(trace_directory , trace_name_rewrited)
+                if self.find_trace(trace_name) is None:
+                    return f"Trace file |{trace_name}| not found!"
             else:          
                 if packets_rate is None:
                     return "No packets rate provided"
@@ -528,9 +572,19 @@ class CoexController:
             
         if msm_id is None:
             return "No measurement ID provided"
-        
-        self.last_msm_id = msm_id
-        self.last_coex_parameters = CoexParamaters(role = role, packets_size = packets_size, packets_number = packets_number,
-                                                   packets_rate = packets_rate, socker_port = socket_port, counterpart_probe_ip = counterpart_probe_ip,
-                                                   counterpart_probe_mac = counterpart_probe_mac, trace_name = trace_name, duration=duration)
-        return "OK"
\ No newline at end of file
+        return "OK"
+
+    def set_parameters(self, payload : dict):
+        """
+        Sets the parameters of the measurement, already checked by check_all_parameters.
+        """
+        trace_name = payload.get("trace_name")
+        if (payload.get("role") == "Client") and (trace_name is not None):
+            self.last_complete_trace_path, self.last_complete_trace_rewrited = self.find_trace(trace_name)
+            print(f"CoexController: trace file {trace_name} found -> {self.last_complete_trace_path}")
+        self.last_msm_id = payload.get("msm_id")
+        self.last_coex_parameters = CoexParamaters(role = payload.get("role"), packets_size = payload.get("packets_size"),
+                                                   packets_number = payload.get("packets_number"), packets_rate = payload.get("packets_rate"),
+                                                   socker_port = payload.get("socket_port"), counterpart_probe_ip = payload.get("counterpart_probe_ip"),
+                                                   counterpart_probe_mac = payload.get("counterpart_probe_mac"), trace_name = trace_name,
+                                                   duration = payload.get("duration"))
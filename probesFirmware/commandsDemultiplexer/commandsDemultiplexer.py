@@ -1,10 +1,29 @@
+"""
+Demultiplexer of the commands received by the probe.
+The MQTT network thread only parses a command: the handler runs on the serial executor of its controller, so that a
+slow command (systemctl, ntpdate, tcprewrite, ...) doesn't block the reception of the other commands (e.g. a stop for
+another controller) nor the MQTT keepalives, while the commands for the same controller stay ordered.
+"""
+
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from mqttModule.mqttClient import ProbeMqttClient
 from shared_resources import SharedState
+from capabilities import collect_capabilities
 
 class CommandsDemultiplexer():
-    def __init__(self):
+    def __init__(self, serial_executors = True):
+        """
+        Args:
+            serial_executors (bool): If False, the handlers run on the MQTT network thread, as the fake controllers of
+                the virtual probes do (they never block, and one thread per handler of thousands of probes is too many).
+        """
         self.commands_handler_list = {}
+        self.serial_executors = serial_executors
+        self.handler_executors = {} # Maps handler to its single-thread executor: the commands of a controller run in order
+        self.handler_executors_lock = threading.Lock()
         # The CommandsDemultiplexer set as a handler for "root_service" commands, an its internal method
         self.registration_handler_request(interested_command="root_service", handler=self.root_service_command_handler)
 
@@ -32,7 +51,19 @@ class CommandsDemultiplexer():
         else:
             return "There is already a registered handler for |" + interested_command + "|"
 
+    def announce_capabilities(self, capabilities = None):
+        """
+        Publishes an UPDATE state with the capabilities of the probe: to be called once all the controllers are registered
+        (the ONLINE state is published on connection, before the registrations).
+        Without capabilities, they are collected from the registered handlers and the host.
+        """
+        if capabilities is None:
+            capabilities = collect_capabilities(self.commands_handler_list.keys())
+        self.mqtt_client.capabilities = capabilities
+        self.mqtt_client.publish_probe_state("UPDATE")
+
     def decode_command(self, complete_command):
+        received_at, received_monotonic = time.time(), time.monotonic()
         try:
             nested_command = json.loads(complete_command)
         except Exception as e:
@@ -43,8 +74,13 @@ class CommandsDemultiplexer():
         handler = nested_command["handler"]
         command = nested_command["command"]
         payload = nested_command["payload"]
+        if isinstance(payload, dict) and ("msm_id" in payload) and (self.mqtt_client is not None):
+            self.mqtt_client.mark_command_received(handler, command, payload["msm_id"], received_at, received_monotonic, payload.get("role"))
         if handler in self.commands_handler_list:
-            self.commands_handler_list[handler](command, payload)
+            if self.serial_executors:
+                self.executor_of(handler).submit(self.run_command, handler, command, payload)
+            else:
+                self.run_command(handler, command, payload)
         else:
             msm_id = payload["msm_id"] if ("msm_id" in payload) else None
             nack_no_handler = {
@@ -55,6 +91,35 @@ class CommandsDemultiplexer():
             self.mqtt_client.publish_command_NACK(handler=handler, payload=nack_no_handler)
             print(f"CommandsDemultiplexer: no registered handler for |{handler}|")
 
+    def executor_of(self, handler) -> ThreadPoolExecutor:
+        with self.handler_executors_lock:
+            if handler not in self.handler_executors:
+                self.handler_executors[handler] = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f"handler_{handler}")
+            return self.handler_executors[handler]
+
+    def run_command(self, handler, command, payload):
+        try:
+            self.commands_handler_list[handler](command, payload)
+        except Exception as e:
+            # Out of the MQTT thread nobody else logs it: the coordinator gets a NACK instead of an ACK timeout
+            print(f"CommandsDemultiplexer: exception in the |{handler}| handler, command |{command}| -> {e}")
+            nack_exception = {
+                "command" : command,
+                "reason" : f"Exception in the {handler} handler: {e}",
+                "msm_id" : payload.get("msm_id") if isinstance(payload, dict) else None
+            }
+            self.mqtt_client.publish_command_NACK(handler=handler, payload=nack_exception)
+
+    def shutdown(self):
+        """
+        Stops the handler executors, once the running commands are completed. The queued ones are dropped.
+        """
+        with self.handler_executors_lock:
+            executors = list(self.handler_executors.values())
+            self.handler_executors.clear()
+        for executor in executors:
+            executor.shutdown(wait = True, cancel_futures = True)
+
     def root_service_command_handler(self, command, payload):
         shared_state = SharedState.get_instance()
         match command:
@@ -5,9 +5,12 @@ import psutil, time
 from pathlib import Path
 from energyModule.ina219Driver import Ina219Driver, SYNC_OTII_PIN
 from mqttModule.mqttClient import ProbeMqttClient
-from shared_resources import SharedState
+from shared_resources import SharedState, INA219_SENSOR, EXCLUSIVE, session_owner
 
 DEFAULT_ENERGY_MEASUREMENT_FOLDER = "energy_measurements"
+RESOURCE_OWNER = "energy"
+# The energy measurement runs alongside the other measurements: it only locks the sensor
+ENERGY_RESOURCES = {INA219_SENSOR: EXCLUSIVE}
 
 """ Class that implements the POWER CONSUMPTION measurement funcionality """
 class EnergyController:
@@ -52,16 +55,23 @@ class EnergyController:
                     if self.INA_sensor_test() != "PASSED":
                         self.send_energy_NACK(failed_command="start", error_info="INA219 NOT FOUND", measurement_id=msm_id)
                         return
-                    base_path = Path(__file__).parent
-                    energy_measurement_folder_path = os.path.join(base_path, DEFAULT_ENERGY_MEASUREMENT_FOLDER)
-                    Path(energy_measurement_folder_path).mkdir(parents=True, exist_ok=True)
-                    complete_file_path = os.path.join(energy_measurement_folder_path, msm_id + ".csv")
-                    start_msg = self.driverINA.start_current_measurement(filename = complete_file_path)
+                    if not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, msm_id), ENERGY_RESOURCES):
+                        self.send_energy_NACK(failed_command="start", error_info="PROBE BUSY", measurement_id=msm_id)
+                        return
+                    try:
+                        base_path = Path(__file__).parent
+                        energy_measurement_folder_path = os.path.join(base_path, DEFAULT_ENERGY_MEASUREMENT_FOLDER)
+                        Path(energy_measurement_folder_path).mkdir(parents=True, exist_ok=True)
+                        complete_file_path = os.path.join(energy_measurement_folder_path, msm_id + ".csv")
+                        netstat = psutil.net_io_counters(pernic=True)
+                        default_nic_netstat = netstat[self.shared_state.default_nic_name]
+                        start_msg = self.driverINA.start_current_measurement(filename = complete_file_path)
+                    except (OSError, KeyError) as e:
+                        start_msg = f"Can't start the energy measurement -> {e}"
                     if start_msg != "OK":
                         self.send_energy_NACK(failed_command="start", error_info=start_msg, measurement_id=msm_id)
+                        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
                     else:
-                        netstat = psutil.net_io_counters(pernic=True)
-                        default_nic_netstat = netstat[self.shared_state.default_nic_name]
                         self.bytes_received_at_measure_start =  default_nic_netstat.bytes_recv
                         self.byte_trasmitted_at_measure_start = default_nic_netstat.bytes_sent
                         self.send_energy_ACK(successed_command="start", measurement_id=msm_id)
@@ -70,12 +80,20 @@ class EnergyController:
                     if msm_id is None:
                         self.send_energy_NACK(failed_command="stop", error_info="No measurement provided")
                         return
-                    stop_msg = self.driverINA.stop_current_measurement()
-                    if stop_msg != "OK":
-                        self.send_energy_NACK(failed_command="stop", error_info=stop_msg, measurement_id=msm_id)
-                    else:
-                        self.send_energy_ACK(successed_command="stop", measurement_id=msm_id)
-                        self.compress_and_publish_energy_result(msm_id = msm_id)
+                    if not self.shared_state.owns_resources(session_owner(RESOURCE_OWNER, msm_id)):
+                        self.send_energy_NACK(failed_command="stop", error_info="No energy measurement in progress", measurement_id=msm_id)
+                        return
+                    try: # The sensor is released whatever the outcome: a failed stop or result must not lock it forever
+                        stop_msg = self.driverINA.stop_current_measurement()
+                        if stop_msg != "OK":
+                            self.send_energy_NACK(failed_command="stop", error_info=stop_msg, measurement_id=msm_id)
+                        else:
+                            self.send_energy_ACK(successed_command="stop", measurement_id=msm_id)
+                            self.compress_and_publish_energy_result(msm_id = msm_id)
+                    except Exception as e:
+                        print(f"EnergyController: stop or result of msm -> {msm_id} failed -> {e}")
+                    finally:
+                        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
             case _:
                 print(f"EnergyController: unkown command -> {command}")
                 self.send_energy_NACK(failed_command=command, error_info="Unknown command")
@@ -123,7 +141,7 @@ class EnergyController:
                 "duration": measure_duration
              }
         }
-        self.mqtt_client.publish_on_result_topic(result=json.dumps(json_energy_result))
+        self.mqtt_client.publish_on_result_topic(result=json_energy_result)
         print(f"EnergyController: compressed and published result of msm -> {msm_id}")
     
 
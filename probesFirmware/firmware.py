@@ -18,6 +18,7 @@ from aoiModule.aoiController import AgeOfInformationController
 from shared_resources import SharedState, HAT_IFACE
 from udppingModule.udppingController import UDPPingController
 from coexModule.coexController import CoexController
+from warmPoolModule.warmPoolController import WarmPoolController
 
 class Probe:
     """
@@ -73,6 +74,13 @@ class Probe:
         self.coex_controller = CoexController(self.mqtt_client,
                                               self.commands_demultiplexer.registration_handler_request)   # ENABLE COEXISTING APPLICATION FUNCTIONALITY
 
+        self.warm_pool_controller = WarmPoolController(self.mqtt_client,
+                                                       self.commands_demultiplexer.registration_handler_request,
+                                                       get_warm_pool_config_from_yaml()) # ENABLE WARM IPERF/UDP-PING SERVERS (if configured)
+
+        self.commands_demultiplexer.announce_capabilities() # Handlers, sensors, tools and interfaces, for the coordinator checks
+        self.warm_pool_controller.start()
+
         
     def waiting_for_5G_connection(self):
         """
@@ -117,7 +125,9 @@ class Probe:
         """
         Disconnect the MQTT client and clean up resources.
         """
+        self.warm_pool_controller.shutdown()
         self.mqtt_client.disconnect()
+        self.commands_demultiplexer.shutdown()
 
 def get_probe_id_from_yaml(yaml_path="probe_config.yaml"):
     """
@@ -131,6 +141,22 @@ def get_probe_id_from_yaml(yaml_path="probe_config.yaml"):
         print(f"Error reading probe id from yaml: {e}")
         return None
 
+def get_warm_pool_config_from_yaml(yaml_path="probe_config.yaml"):
+    """
+    Reads the optional warm pool section from the yaml configuration file, e.g.
+        warm_pool:
+          iperf: {first_port: 5210, size: 2}
+          udpping: {first_port: 5310, size: 2}
+    Returns None (no warm server) if it is missing.
+    """
+    try:
+        with open(os.path.join(os.path.dirname(__file__), yaml_path), "r") as f:
+            config = yaml.safe_load(f)
+            return config.get("warm_pool", None)
+    except Exception as e:
+        print(f"Error reading warm pool from yaml: {e}")
+        return None
+
 def main():
     """
     Main entry point for the probe firmware. Handles argument parsing and probe lifecycle.
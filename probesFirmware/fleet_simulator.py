@@ -0,0 +1,107 @@
+"""
+Virtual probe fleet simulator for load-testing the coordinator.
+Runs N virtual probes in one process against an MQTT broker (typically a local one). Each virtual probe uses the
+firmware ProbeMqttClient and CommandsDemultiplexer, with fake controllers that ACK, NACK and publish results of
+realistic size and timing. The coordinator throughput and tail latencies can be read on its /metrics endpoint.
+
+Example: python3 fleet_simulator.py -n 1000 --host localhost --port 1883 --nack-rate 0.01 --time-scale 0.1
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import yaml
+from simulatorModule.fleetResources import FleetProfile
+from simulatorModule.virtualProbe import VirtualProbeFleet, DEFAULT_ID_PREFIX, DEFAULT_BASE_IP
+
+# One paho network thread runs for each virtual probe: a smaller stack keeps 1000+ probes in memory
+VIRTUAL_PROBE_THREAD_STACK_SIZE = 512 * 1024
+
+
+def build_mqtt_config(args) -> dict:
+    """
+    Returns the "mqtt_client" section for the virtual probes: the one of --config, if provided, else a plain
+    (no TLS, no login) configuration with the same topics of the real probes. The command line options override it.
+    """
+    if args.config is not None:
+        with open(args.config) as file:
+            mqtt_config = yaml.safe_load(file)['mqtt_client']
+    else:
+        mqtt_config = {
+            "clean_session": True,
+            "broker": {"host": "localhost", "port": 1883, "keep_alive": 60, "login": False},
+            "subscription_topics": ["probes/PROBE_ID/commands"],
+            "publishing": {
+                "status_topic": "probes/PROBE_ID/status",
+                "results_topic": "probes/PROBE_ID/results",
+                "error_topic": "probes/PROBE_ID/errors",
+                "qos": 1,
+                "retain": False
+            }
+        }
+    if args.host is not None:
+        mqtt_config["broker"]["host"] = args.host
+    if args.port is not None:
+        mqtt_config["broker"]["port"] = args.port
+    if args.username is not None:
+        mqtt_config["broker"]["login"] = True
+        mqtt_config["credentials"] = {"username": args.username, "password": args.password}
+    if args.tls_cert is not None:
+        mqtt_config["mosquitto_certificate_path"] = os.path.abspath(args.tls_cert)
+    elif args.no_tls:
+        mqtt_config.pop("mosquitto_certificate_path", None)
+    return mqtt_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a fleet of virtual probes against the coordinator.")
+    parser.add_argument('-n', '--probes', type=int, default=10, help="Number of virtual probes.")
+    parser.add_argument('--config', default=None, help="Probe MQTT yaml configuration (as probe_mqtt_client_config.yaml).")
+    parser.add_argument('--host', default=None, help="Broker host.")
+    parser.add_argument('--port', type=int, default=None, help="Broker port.")
+    parser.add_argument('--username', default=None, help="Broker username.")
+    parser.add_argument('--password', default=None, help="Broker password.")
+    parser.add_argument('--tls-cert', default=None, help="CA certificate of the broker, to connect with TLS.")
+    parser.add_argument('--no-tls', action='store_true', help="Ignore the certificate of --config.")
+    parser.add_argument('--id-prefix', default=DEFAULT_ID_PREFIX, help="Prefix of the virtual probe ids.")
+    parser.add_argument('--base-ip', default=DEFAULT_BASE_IP, help="IP announced by the first virtual probe.")
+    parser.add_argument('--ramp-rate', type=float, default=100, help="Virtual probes started per second.")
+    parser.add_argument('--ack-delay', type=float, default=0.05, help="Mean processing time (s) before an ACK/NACK.")
+    parser.add_argument('--ack-jitter', type=float, default=0.02, help="Standard deviation (s) of the processing time.")
+    parser.add_argument('--nack-rate', type=float, default=0.0, help="Probability of an injected NACK.")
+    parser.add_argument('--silent-rate', type=float, default=0.0, help="Probability that a command is never answered.")
+    parser.add_argument('--result-loss-rate', type=float, default=0.0, help="Probability that a result is never published.")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Multiplier of the measurement durations.")
+    parser.add_argument('--rtt-ms', type=float, default=25.0, help="Mean RTT (ms) of the simulated network.")
+    parser.add_argument('--rtt-jitter-ms', type=float, default=5.0, help="RTT standard deviation (ms).")
+    parser.add_argument('--packet-loss-rate', type=float, default=0.0, help="Per-packet loss of the simulated network.")
+    parser.add_argument('--throughput-mbps', type=float, default=100.0, help="Mean throughput (Mbit/s) of the simulated network.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the random generator, for reproducible runs.")
+    parser.add_argument('--stats-interval', type=float, default=10.0, help="Seconds between two statistics prints (0 to disable).")
+    args = parser.parse_args()
+
+    profile = FleetProfile(ack_delay = args.ack_delay, ack_jitter = args.ack_jitter, nack_rate = args.nack_rate,
+                           silent_rate = args.silent_rate, result_loss_rate = args.result_loss_rate, time_scale = args.time_scale,
+                           rtt_ms = args.rtt_ms, rtt_jitter_ms = args.rtt_jitter_ms, packet_loss_rate = args.packet_loss_rate,
+                           throughput_mbps = args.throughput_mbps, seed = args.seed)
+
+    threading.stack_size(VIRTUAL_PROBE_THREAD_STACK_SIZE)
+    fleet = VirtualProbeFleet(probe_count = args.probes, mqtt_config = build_mqtt_config(args), profile = profile,
+                              id_prefix = args.id_prefix, base_ip = args.base_ip, ramp_rate = args.ramp_rate)
+    fleet.start()
+    try:
+        while True:
+            time.sleep(args.stats_interval if args.stats_interval > 0 else 3600)
+            if args.stats_interval > 0:
+                print(f"FleetSimulator: connected {fleet.connected_count()}/{args.probes} -> {json.dumps(fleet.stats.snapshot())}")
+    except KeyboardInterrupt:
+        print("FleetSimulator: stopping...")
+    finally:
+        fleet.stop()
+        print(f"FleetSimulator: final stats -> {json.dumps(fleet.stats.snapshot())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Adaptive duration of the throughput tests: the interval samples of the running iperf3 (--json-stream) feed an estimate
+of the mean throughput, and the test is ended as soon as the confidence interval of that mean is within the requested
+tolerance (relative half width), after min_seconds. The test still lasts at most max_seconds (iperf3 -t).
+The samples of the first warmup_seconds (e.g. TCP slow start) are not part of the estimate.
+Consecutive interval throughputs are autocorrelated (congestion window, queues), so their sample variance understates
+the variance of the mean: the confidence interval is computed by non-overlapping batch means, with batches of about
+sqrt(n) intervals, whose means are close to independent.
+"""
+
+import math
+from statistics import NormalDist
+
+# Configuration keys (client configuration and measurement parameters) -> ThroughputEstimator arguments
+ADAPTIVE_DURATION_KEYS = {
+    "adaptive_tolerance_percent": "tolerance_percent",
+    "adaptive_min_seconds": "min_seconds",
+    "adaptive_confidence": "confidence",
+    "adaptive_warmup_seconds": "warmup_seconds",
+}
+DEFAULT_ADAPTIVE_MAX_SECONDS = 10
+MIN_BATCHES = 3 # Fewer batch means give no usable estimate of the variance
+
+
+def t_quantile(confidence : float, degrees_of_freedom : int) -> float:
+    """
+    Two-sided Student t quantile, by the Cornish-Fisher expansion of the normal one (within ~3% from 2 degrees of
+    freedom, enough for a stopping rule).
+    """
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    df = max(1, degrees_of_freedom)
+    return (z + (z**3 + z) / (4 * df) + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * df**2)
+            + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * df**3))
+
+
+class ThroughputEstimator:
+    """
+    Mean and batch means confidence interval of the interval throughputs.
+    """
+    def __init__(self, tolerance_percent = 5, min_seconds = 3, confidence = 0.95, warmup_seconds = 1):
+        self.tolerance = float(tolerance_percent) / 100
+        self.min_seconds = float(min_seconds)
+        self.confidence = float(confidence)
+        self.warmup_seconds = float(warmup_seconds)
+        self.samples = [] # The throughputs after the warmup: one per interval, at most max_seconds of them
+        self.mean = 0.0
+        self.elapsed_seconds = 0.0
+        self.converged = False
+
+    def add(self, sample : dict) -> bool:
+        """
+        Adds an interval sample (see iperfStream.compact_interval). Returns True once the estimate has converged.
+        """
+        self.elapsed_seconds = sample.get("end", self.elapsed_seconds)
+        throughput = sample.get("bits_per_second")
+        if (throughput is None) or (sample.get("start", 0.0) < self.warmup_seconds):
+            return self.converged
+        self.samples.append(throughput)
+        self.mean += (throughput - self.mean) / self.count
+        if (not self.converged) and (self.elapsed_seconds >= self.min_seconds):
+            relative_half_width = self.relative_half_width()
+            self.converged = (relative_half_width is not None) and (relative_half_width <= self.tolerance)
+        return self.converged
+
+    @property
+    def count(self) -> int:
+        return len(self.samples)
+
+    def batch_means(self) -> list:
+        """
+        Returns the means of the non-overlapping batches of ceil(sqrt(n)) samples, the oldest samples left over.
+        """
+        batch_size = math.ceil(math.sqrt(self.count)) if self.samples else 1
+        batches = self.count // batch_size
+        batched_samples = self.samples[self.count - batches * batch_size:]
+        return [sum(batched_samples[index : index + batch_size]) / batch_size for index in range(0, len(batched_samples), batch_size)]
+
+    def half_width(self) -> float:
+        batch_means = self.batch_means()
+        batches = len(batch_means)
+        if batches < MIN_BATCHES:
+            return None
+        batches_mean = sum(batch_means) / batches
+        variance = sum((batch_mean - batches_mean) ** 2 for batch_mean in batch_means) / (batches - 1)
+        return t_quantile(self.confidence, batches - 1) * math.sqrt(variance / batches)
+
+    def relative_half_width(self) -> float:
+        half_width = self.half_width()
+        if (half_width is None) or (self.mean <= 0):
+            return None
+        return half_width / self.mean
+
+    def precision(self) -> dict:
+        """
+        The achieved precision, recorded with the result.
+        """
+        half_width = self.half_width()
+        relative_half_width = self.relative_half_width()
+        return {
+            "converged": self.converged,
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "samples": self.count,
+            "batches": len(self.batch_means()),
+            "mean_bps": self.mean,
+            "ci_half_width_bps": half_width,
+            "ci_relative_percent": round(relative_half_width * 100, 3) if (relative_half_width is not None) else None,
+            "confidence": self.confidence,
+            "tolerance_percent": self.tolerance * 100
+        }
@@ -0,0 +1,130 @@
+"""
+UDP capacity search: instead of one test at a fixed offered load (-b 1000M, which floods a 5G link and reports the loss
+of the flood), short iperf3 probes are run at increasing offered loads (doubling from start_mbps) until one is not
+sustainable, then the rate is bisected between the last sustainable and the first unsustainable load, until they are
+within tolerance_percent. A load is sustainable if its loss (and, when set, its jitter) is within the thresholds.
+The result is the maximum sustainable offered load, with the samples of all the probes.
+"""
+
+import threading
+
+CAPACITY_PROBE_PAUSE_SECONDS = 0.5 # Between two probes: the server gets ready for the next test
+
+# Configuration keys (client configuration and measurement parameters) -> CapacitySearch arguments
+CAPACITY_SEARCH_KEYS = {
+    "capacity_min_mbps": "min_mbps",
+    "capacity_start_mbps": "start_mbps",
+    "capacity_max_mbps": "max_mbps",
+    "capacity_probe_seconds": "probe_seconds",
+    "capacity_loss_percent": "loss_percent",
+    "capacity_jitter_ms": "jitter_ms",
+    "capacity_tolerance_percent": "tolerance_percent",
+    "capacity_max_probes": "max_probes",
+}
+
+
+def udp_sample(json_result : dict, offered_bps : float) -> dict:
+    """
+    Reduces the --json result of a UDP probe to its sample: offered and received rate, loss, jitter and bytes.
+    """
+    end = json_result.get("end", {})
+    udp_sum = end.get("sum", {})
+    lost_percent = udp_sum.get("lost_percent", 0.0)
+    received = end.get("sum_received", {}) # iperf3 >= 3.13, else derived from the sender rate and the loss
+    received_bps = received.get("bits_per_second", udp_sum.get("bits_per_second", 0.0) * (1 - lost_percent / 100))
+    return {
+        "offered_bps": offered_bps,
+        "received_bps": received_bps,
+        "lost_percent": lost_percent,
+        "jitter_ms": udp_sum.get("jitter_ms"),
+        "bytes": udp_sum.get("bytes", 0),
+        "seconds": udp_sum.get("seconds", 0.0)
+    }
+
+
+class CapacitySearch:
+    """
+    Search of the maximum sustainable UDP offered load. run_probe(rate_bps, seconds) runs one iperf3 probe and returns
+    its --json result, or None if the probe failed or was stopped (the search is aborted). Setting stop_event aborts
+    the search at the next pause between two probes.
+    """
+    def __init__(self, run_probe, stop_event : threading.Event, min_mbps = 1, start_mbps = 10, max_mbps = 1000,
+                 probe_seconds = 2, loss_percent = 1.0, jitter_ms = 0, tolerance_percent = 5, max_probes = 12):
+        self.run_probe = run_probe
+        self.stop_event = stop_event
+        self.min_bps = float(min_mbps) * 10**6
+        self.start_bps = min(max(float(start_mbps) * 10**6, self.min_bps), float(max_mbps) * 10**6)
+        self.max_bps = float(max_mbps) * 10**6
+        self.probe_seconds = max(1, int(probe_seconds))
+        self.loss_percent = float(loss_percent)
+        self.jitter_ms = float(jitter_ms) # 0: no jitter threshold
+        self.tolerance = float(tolerance_percent) / 100
+        self.max_probes = int(max_probes)
+        self.samples = []
+        self.best_result = None     # --json result of the highest sustainable probe
+        self.last_result = None
+        self.sustainable_bps = 0.0  # Highest sustainable offered load found
+        self.unsustainable_bps = None # Lowest unsustainable offered load found
+        self.converged = False
+
+    def is_sustainable(self, sample : dict) -> bool:
+        if sample["lost_percent"] > self.loss_percent:
+            return False
+        return (self.jitter_ms <= 0) or (sample["jitter_ms"] is None) or (sample["jitter_ms"] <= self.jitter_ms)
+
+    def probe(self, rate_bps) -> bool:
+        """
+        Runs a probe at rate_bps. Returns whether the load is sustainable, None if the probe failed.
+        """
+        if self.samples and self.stop_event.wait(CAPACITY_PROBE_PAUSE_SECONDS):
+            return None
+        json_result = self.run_probe(rate_bps, self.probe_seconds)
+        if json_result is None:
+            return None
+        sample = udp_sample(json_result, rate_bps)
+        sample["sustainable"] = self.is_sustainable(sample)
+        self.samples.append(sample)
+        self.last_result = json_result
+        if sample["sustainable"] and (rate_bps >= self.sustainable_bps):
+            self.sustainable_bps = rate_bps
+            self.best_result = json_result
+        elif (not sample["sustainable"]) and ((self.unsustainable_bps is None) or (rate_bps < self.unsustainable_bps)):
+            self.unsustainable_bps = rate_bps
+        return sample["sustainable"]
+
+    def run(self) -> bool:
+        """
+        Runs the search. Returns False if a probe failed (or was stopped) before the end.
+        """
+        rate_bps = self.start_bps
+        while self.unsustainable_bps is None: # Ramp: doubling the load up to the first unsustainable one
+            sustainable = self.probe(rate_bps)
+            if sustainable is None:
+                return False
+            if sustainable and (rate_bps >= self.max_bps): # The whole range is sustainable
+                self.converged = True
+                return True
+            if len(self.samples) >= self.max_probes:
+                return True
+            rate_bps = min(rate_bps * 2, self.max_bps)
+        while len(self.samples) < self.max_probes: # Bisection between the sustainable and the unsustainable loads
+            gap_bps = self.unsustainable_bps - self.sustainable_bps
+            if (gap_bps <= self.tolerance * self.unsustainable_bps) or (self.unsustainable_bps <= self.min_bps):
+                self.converged = True
+                return True
+            if self.probe((self.sustainable_bps + self.unsustainable_bps) / 2) is None:
+                return False
+        return True
+
+    def summary(self) -> dict:
+        best_sample = max((sample for sample in self.samples if sample["sustainable"]), key = lambda sample: sample["offered_bps"], default = None)
+        return {
+            "max_sustainable_bps": self.sustainable_bps,
+            "max_sustainable_received_bps": best_sample["received_bps"] if best_sample else 0.0,
+            "converged": self.converged,
+            "loss_threshold_percent": self.loss_percent,
+            "jitter_threshold_ms": self.jitter_ms if (self.jitter_ms > 0) else None,
+            "total_bytes": sum(sample["bytes"] for sample in self.samples),
+            "total_seconds": round(sum(sample["seconds"] for sample in self.samples), 3),
+            "probes": self.samples
+        }
@@ -1,14 +1,22 @@
 import time
 import os
 import json
-import subprocess
 import base64, cbor2
 from pathlib import Path
 import threading
 import signal
-import psutil
-from shared_resources import SharedState
+from shared_resources import SharedState, NIC_BANDWIDTH, EXCLUSIVE, tcp_port, session_owner, START_AT_KEY, wait_until, wait_port_bound
 from mqttModule.mqttClient import ProbeMqttClient
+from process_supervisor import ProcessSupervisor, merge_usages
+from iperfModule.iperfStream import IntervalBatcher, read_json_stream, lean_summary, summary_from_intervals, DEFAULT_INTERVAL_BATCH_SIZE
+from iperfModule.iperfAdaptive import ThroughputEstimator, ADAPTIVE_DURATION_KEYS, DEFAULT_ADAPTIVE_MAX_SECONDS
+from iperfModule.iperfCapacitySearch import CapacitySearch, CAPACITY_SEARCH_KEYS
+
+RESOURCE_OWNER = "iperf"
+REPETITION_PAUSE_SECONDS = 0.5 # Between two repetitions, for the server to accept the next test
+SERVER_LISTEN_TIMEOUT_SECONDS = 3 # The server ACKs its conf/prepare once iperf3 -s listens: NACK if it doesn't in this time
+# iperf3 saturates the link: any other traffic would bias the throughput, and would be biased in turn
+IPERF_CLIENT_RESOURCES = {NIC_BANDWIDTH: EXCLUSIVE}
 
 class IperfController:
     """
@@ -22,6 +30,7 @@ class IperfController:
         """
 
         self.shared_state = SharedState.get_instance()
+        self.process_supervisor = ProcessSupervisor.get_instance()
 
         self.mqtt_client = mqtt_client
         self.last_role = None
@@ -41,6 +50,22 @@ class IperfController:
         self.repetitions = 1
         self.save_result_on_flash = None
         self.last_json_result = None
+        self.last_process_usage = None # Resource usage of the last iperf3 run, published with its result
+        self.stream_intervals = False # --json-stream: interval samples published during the test, lean summary at the end
+        self.interval_batch_size = DEFAULT_INTERVAL_BATCH_SIZE
+        self.current_repetition = 0
+        self.current_repetition_started_at = None
+        self.capacity_search = False # UDP only: search of the maximum sustainable rate instead of a test at -b 1000M
+        self.capacity_settings = {}
+        self.capacity_probe_usages = []
+        self.capacity_probe_returncode = None
+        self.last_capacity_summary = None
+        self.adaptive_duration = False # Ends each test once the throughput estimate converges (needs --json-stream)
+        self.adaptive_max_seconds = DEFAULT_ADAPTIVE_MAX_SECONDS
+        self.adaptive_settings = {}
+        self.last_precision = None
+        self.last_start_at = None # Absolute time of the first repetition (None: as soon as started)
+        self.armed_stop_event = threading.Event() # Wakes up a client stopped while waiting for last_start_at
 
         # Iperf Server - Parameters
         self.listening_port = None
@@ -62,14 +87,19 @@ class IperfController:
             return "Missing Role!"
         
         my_role = payload['role']
-        if my_role == "Client": # If the role is client, then i ONLY check if the probe state is READY. This is beacuse, for the client, the Conf and Start are separated.
-            if not self.shared_state.probe_is_ready():
+        if my_role == "Client": # If the role is client, then i ONLY check if the iperf controller is idle. This is beacuse, for the client, the Conf and Start are separated.
+            if self.shared_state.sessions_of(RESOURCE_OWNER):
                 return "PROBE BUSY"
             return self.read_client_configuration(payload)
-        elif my_role == "Server": # If the role is client, the i check if is possible to set its state ad BUSY. This is beacuse, for the server, the Conf and Start collide.
-            if not self.shared_state.set_probe_as_busy():
+        elif my_role == "Server": # If the role is server, then i acquire its resources now. This is beacuse, for the server, the Conf and Start collide.
+            server_resources = {NIC_BANDWIDTH: EXCLUSIVE, tcp_port(payload.get('listen_port')): EXCLUSIVE}
+            owner = session_owner(RESOURCE_OWNER, payload.get('msm_id'))
+            if self.shared_state.sessions_of(RESOURCE_OWNER) or (not self.shared_state.acquire_resources(owner, server_resources)):
                 return "PROBE BUSY"
-            return self.read_server_configuration(payload)
+            configuration_message = self.read_server_configuration(payload)
+            if configuration_message != "OK":
+                self.shared_state.release_resources(owner)
+            return configuration_message
         else:
             return "Wrong Role!"
 
@@ -106,6 +136,18 @@ class IperfController:
             self.verbose_function = payload_conf['verbose']
             self.repetitions = int(payload_conf['repetitions'])
             self.save_result_on_flash = payload_conf["save_result_on_flash"]
+            self.stream_intervals = bool(payload_conf.get('stream_intervals', False))
+            self.interval_batch_size = int(payload_conf.get('interval_batch_size', DEFAULT_INTERVAL_BATCH_SIZE))
+            self.capacity_search = bool(payload_conf.get('capacity_search', False))
+            if self.capacity_search and (self.transport_protocol == "TCP"):
+                return "The capacity search needs the UDP transport"
+            self.capacity_settings = {argument: payload_conf[key] for key, argument in CAPACITY_SEARCH_KEYS.items() if key in payload_conf}
+            self.adaptive_duration = bool(payload_conf.get('adaptive_duration', False))
+            if self.adaptive_duration and (self.transport_protocol != "TCP") and (not self.reverse_function):
+                # The client intervals of a forward UDP test are sender side: they measure the offered rate, not the throughput
+                return "The adaptive duration of a UDP test needs the reverse mode"
+            self.adaptive_max_seconds = int(payload_conf.get('adaptive_max_seconds', DEFAULT_ADAPTIVE_MAX_SECONDS))
+            self.adaptive_settings = {argument: payload_conf[key] for key, argument in ADAPTIVE_DURATION_KEYS.items() if key in payload_conf}
             self.last_measurement_id = payload_conf['msm_id']
             self.last_role = "Client"
             self.last_error = None
@@ -124,31 +166,57 @@ class IperfController:
             case 'conf':
                 measurement_related_conf = payload['msm_id']
                 role_related_conf = payload['role']
-                if not self.shared_state.probe_is_ready():
+                if self.shared_state.sessions_of(RESOURCE_OWNER): # One iperf3 at a time: it saturates the link
                     self.send_iperf_NACK(failed_command=command, error_info="PROBE BUSY", role = role_related_conf, msm_id = measurement_related_conf)
                     return
                 
                 configuration_message = self.read_configuration(payload)
                 if configuration_message == "OK": # if the configuration goes good, then ACK, else NACK
-                    self.send_iperf_ACK(successed_command = command, msm_id = measurement_related_conf)
                     if self.last_role == "Server":
-                        self.start_iperf()
+                        self.start_iperf_server(command, measurement_related_conf)
+                    else:
+                        self.send_iperf_ACK(successed_command = command, msm_id = measurement_related_conf)
                 else:
                     self.send_iperf_NACK(failed_command=command, error_info = configuration_message, role = role_related_conf, msm_id = measurement_related_conf)
             case 'start':
                 if self.last_role == None:
                     self.send_iperf_NACK(failed_command=command, error_info="No configuration")
                     return
-                if not self.shared_state.probe_is_ready():
+                if self.shared_state.sessions_of(RESOURCE_OWNER):
                     self.send_iperf_NACK(failed_command = command, error_info = "PROBE BUSY", role = self.last_role)
                     return
-                self.shared_state.set_probe_as_busy()
                 if self.last_role == "Client":
                     if self.last_measurement_id is None:
                         self.send_iperf_NACK(failed_command="start", error_info="measure_id is None")
                         return
+                    if not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, self.last_measurement_id), IPERF_CLIENT_RESOURCES):
+                        self.send_iperf_NACK(failed_command = command, error_info = "PROBE BUSY", role = self.last_role)
+                        return
+                    self.last_start_at = payload.get(START_AT_KEY)
                     self.start_iperf()
                     self.last_execution_code = None
+            case 'prepare':
+                # Combined command: conf (and, for the client, start) in one round trip. The server ACKs when iperf3 -s is
+                # listening, the client when armed: it runs the first repetition at start_at.
+                measurement_related_conf = payload.get('msm_id')
+                role_related_conf = payload.get('role')
+                if self.shared_state.sessions_of(RESOURCE_OWNER):
+                    self.send_iperf_NACK(failed_command=command, error_info="PROBE BUSY", role = role_related_conf, msm_id = measurement_related_conf)
+                    return
+                configuration_message = self.read_configuration(payload)
+                if configuration_message != "OK":
+                    self.send_iperf_NACK(failed_command=command, error_info = configuration_message, role = role_related_conf, msm_id = measurement_related_conf)
+                    return
+                if (self.last_role == "Client") and (not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, measurement_related_conf), IPERF_CLIENT_RESOURCES)):
+                    self.send_iperf_NACK(failed_command = command, error_info = "PROBE BUSY", role = self.last_role, msm_id = measurement_related_conf)
+                    self.reset_conf()
+                    return
+                if self.last_role == "Server":
+                    self.start_iperf_server(command, measurement_related_conf)
+                    return
+                self.last_start_at = payload.get(START_AT_KEY)
+                self.send_iperf_ACK(successed_command = command, msm_id = measurement_related_conf)
+                self.start_iperf()
             case 'stop':
                 msm_id = payload["msm_id"] if ("msm_id" in payload) else None
                 if msm_id is None:
@@ -157,7 +225,7 @@ class IperfController:
                 termination_message = self.stop_iperf_thread(msm_id)
                 if termination_message == "OK":
                     self.send_iperf_ACK(successed_command=command, msm_id=self.last_measurement_id)
-                    self.shared_state.set_probe_as_ready()
+                    self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
                     self.reset_conf()
                 else:
                     self.send_iperf_NACK(failed_command=command, error_info=termination_message, msm_id = msm_id)
@@ -171,7 +239,7 @@ class IperfController:
         Starts the iperf measurement in a new thread, depending on the current role (client or server).
         """
         if self.last_role is None:
-            self.shared_state.set_probe_as_ready()
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_measurement_id))
             self.send_iperf_NACK(failed_command="start", error_info="No configuration")
             return
         
@@ -184,26 +252,51 @@ class IperfController:
             #self.iperf_thread.join()
 
 
+    def start_iperf_server(self, command, msm_id):
+        """
+        Launches iperf3 -s, and ACKs the command only once it listens: the client may connect right after the ACK.
+        The wait runs in its own thread, not to block the MQTT callbacks.
+        """
+        self.start_iperf()
+        server_thread = self.iperf_thread
+        def ack_when_listening():
+            if wait_port_bound("tcp", self.listening_port, SERVER_LISTEN_TIMEOUT_SECONDS, server_thread.is_alive):
+                self.send_iperf_ACK(successed_command = command, msm_id = msm_id)
+                return
+            print(f"IperfController: iperf3 server not listening on port |{self.listening_port}| after {SERVER_LISTEN_TIMEOUT_SECONDS}s")
+            self.process_supervisor.stop(RESOURCE_OWNER, msm_id) # The server thread releases the resources
+            server_thread.join()
+            self.send_iperf_NACK(failed_command = command, error_info = "iperf3 server not listening", role = "Server", msm_id = msm_id)
+            self.reset_conf()
+        threading.Thread(target = ack_when_listening, daemon = True).start()
+
+
     def iperf_client_body(self): # BODY CLIENT THREAD 
         """
         Main loop for the iperf client thread. Handles repetitions, result publishing, and error handling.
         """
+        msm_id = self.last_measurement_id # reset_conf clears it before the release
         repetition_count = 0
         execution_return_code = -2
         while (repetition_count < self.repetitions):
-            time.sleep(0.5)
+            if (repetition_count == 0) and (self.last_start_at is not None):
+                if not wait_until(self.last_start_at, self.armed_stop_event):
+                    print(f"IperfController: measurement |{self.last_measurement_id}| stopped before its scheduled start")
+                    return # The stop command releases the resources
+            elif repetition_count > 0:
+                time.sleep(REPETITION_PAUSE_SECONDS)
             print(f"\n*************** Repetition: {repetition_count + 1} ***************")
+            self.current_repetition = repetition_count
             execution_return_code = self.run_iperf_execution()
             if execution_return_code != 0: # 0 is the correct execution code
                 break
             self.publish_last_output_iperf(repetition = repetition_count, last_result=((repetition_count + 1) == self.repetitions))
             repetition_count += 1
-            time.sleep(0.5)
 
         if (execution_return_code != 0) and (execution_return_code != signal.SIGTERM):
             self.send_iperf_NACK(failed_command="start", error_info=self.last_error, msm_id=self.last_measurement_id)
         self.reset_conf()
-        self.shared_state.set_probe_as_ready()
+        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
         
 
     
@@ -219,20 +312,30 @@ class IperfController:
             command += ["-p", str(self.destination_server_port)]
             command += ["-P", str(self.parallel_connections)]
 
+            if self.reverse_function:
+                command.append("-R")
+            if self.verbose_function:
+                command.append("-V")
             if self.transport_protocol != "TCP":
                 command.append("-u")
+                if self.capacity_search:
+                    return self.run_capacity_search(command)
                 command.append("-b")
                 command.append("1000M")
             else:
                 command.append("--bandwidth")
                 command.append("1000M")
-            if self.reverse_function:
-                command.append("-R")
-            if self.verbose_function:
-                command.append("-V")
 
+            if self.adaptive_duration: # The upper bound of the test: it ends before, once the estimate converges
+                command += ["-t", str(self.adaptive_max_seconds)]
+            if self.stream_intervals or self.adaptive_duration:
+                command.append("--json-stream")
+                return self.run_streaming_client(command)
             command.append("--json")
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)        
+            result = self.process_supervisor.run(RESOURCE_OWNER, self.last_measurement_id, command)
+            self.last_process_usage = result.usage()
+            if result.stop_requested: # Stopped by the coordinator: reported as SIGTERM, as the callers expect
+                return signal.SIGTERM
             if result.returncode != 0:
                 if result.returncode != signal.SIGTERM:
                     self.last_error = result.stderr
@@ -246,11 +349,7 @@ class IperfController:
                         raise Exception("Connection refused from server")
                         
                     if self.save_result_on_flash: # if the save_on_flash mode in enabled...
-                        base_path = Path(__file__).parent
-                        complete_output_json_dir = os.path.join(base_path, self.output_iperf_dir , self.output_json_filename + self.last_measurement_id + ".json")
-                        with open(complete_output_json_dir, "w") as output_file:
-                            json.dump(self.last_json_result, output_file, indent=4)
-                        print(f"IperfController: results saved in: {complete_output_json_dir}")
+                        self.save_last_result_on_flash()
                 except json.JSONDecodeError as e:
                     self.last_error = "Decode result json failed"
                     return -1
@@ -263,27 +362,151 @@ class IperfController:
             command += ["-s", "-p", str(self.listening_port), "-i", "0"]
             if self.verbose_function:
                 command.append("-V")
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if (result.returncode != 0) and (result.returncode != 1) and (result.returncode != signal.SIGTERM) :
+            result = self.process_supervisor.run(RESOURCE_OWNER, self.last_measurement_id, command)
+            if (not result.stop_requested) and (result.returncode != 0) and (result.returncode != 1) and (result.returncode != signal.SIGTERM) :
                 print(f"Iperf execution error. stderr: {result.stderr}  | return_code: {result.returncode }")
                 self.send_iperf_NACK(failed_command="conf", error_info = result.stderr, role="Server", msm_id=self.last_measurement_id)
-            self.shared_state.set_probe_as_ready()
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, self.last_measurement_id))
         return result.returncode
     
 
+    def run_streaming_client(self, command) -> int:
+        """
+        Runs the iperf3 client with --json-stream, reading its events while the test runs: the interval samples are
+        published in batches (stream_intervals), and last_json_result becomes the lean summary of the test.
+        With adaptive_duration, the test is ended as soon as the throughput estimate converges: its summary is then
+        estimated from the interval samples, and last_precision records the achieved precision.
+        Returns the return code, as run_iperf_execution.
+        """
+        self.current_repetition_started_at = time.time()
+        process = self.process_supervisor.launch(RESOURCE_OWNER, self.last_measurement_id, command)
+        batcher = IntervalBatcher(self.publish_interval_batch, self.interval_batch_size)
+        estimator = ThroughputEstimator(**self.adaptive_settings) if self.adaptive_duration else None
+        samples = []
+
+        def on_interval(sample):
+            samples.append(sample)
+            if self.stream_intervals:
+                batcher.add(sample)
+            if (estimator is not None) and (not estimator.converged) and estimator.add(sample):
+                print(f"IperfController: throughput estimate converged after {estimator.elapsed_seconds}s, ending the test")
+                self.process_supervisor.signal_process(process, signal.SIGTERM) # Not a stop: the result is published
+
+        start_data, end_data, stream_error = read_json_stream(process.popen.stdout, on_interval)
+        batcher.flush()
+        stderr_output = process.popen.stderr.read()
+        process.wait()
+        self.process_supervisor.forget(process)
+        self.last_process_usage = process.usage()
+        self.last_precision = estimator.precision() if (estimator is not None) else None
+        if process.stop_requested: # Stopped by the coordinator: reported as SIGTERM, as the callers expect
+            return signal.SIGTERM
+        if (estimator is not None) and estimator.converged and samples:
+            # Ended by the estimate: iperf3 reports the interruption as an error, and may not emit the end event
+            has_end_sums = isinstance(end_data, dict) and ("sum_received" in end_data)
+            self.last_json_result = lean_summary(start_data, end_data) if has_end_sums else summary_from_intervals(start_data, samples)
+            if self.save_result_on_flash:
+                self.save_last_result_on_flash()
+            return 0
+        if (process.returncode != 0) or (stream_error is not None) or (end_data is None):
+            self.last_error = stream_error or stderr_output or f"iperf3 exited with {process.returncode} without the end event"
+            print(f"IperfController: Iperf execution error: {self.last_error} | return_code: {process.returncode}")
+            return process.returncode if (process.returncode != 0) else -1
+        self.last_json_result = lean_summary(start_data, end_data)
+        if self.save_result_on_flash:
+            self.save_last_result_on_flash()
+        return 0
+
+    def run_capacity_search(self, command) -> int:
+        """
+        Runs the UDP capacity search: short iperf3 probes at different offered loads (see iperfCapacitySearch).
+        last_json_result becomes the result of the highest sustainable probe (the last probe if none is), and
+        last_capacity_summary the search outcome. Returns the return code, as run_iperf_execution.
+        """
+        self.capacity_probe_usages = []
+        self.capacity_probe_returncode = None
+        search = CapacitySearch(lambda rate_bps, seconds: self.run_capacity_probe(command, rate_bps, seconds),
+                                self.armed_stop_event, **self.capacity_settings)
+        completed = search.run()
+        self.last_process_usage = merge_usages(self.capacity_probe_usages)
+        if (self.capacity_probe_returncode == signal.SIGTERM) or self.armed_stop_event.is_set(): # Stopped by the coordinator
+            return signal.SIGTERM
+        if (not completed) or (search.last_result is None):
+            print(f"IperfController: capacity search failed after {len(search.samples)} probes: {self.last_error}")
+            return self.capacity_probe_returncode if self.capacity_probe_returncode else -1
+        self.last_capacity_summary = search.summary()
+        self.last_json_result = search.best_result if (search.best_result is not None) else search.last_result
+        print(f"IperfController: max sustainable rate {search.sustainable_bps / 10**6:.2f} Mbps after {len(search.samples)} probes")
+        if self.save_result_on_flash:
+            self.save_last_result_on_flash()
+        return 0
+
+    def run_capacity_probe(self, command, rate_bps, seconds):
+        """
+        Runs one probe of the capacity search at the offered load rate_bps (split among the parallel streams).
+        Returns its --json result, or None if it failed or was stopped.
+        """
+        stream_rate_bps = max(1, int(rate_bps / max(1, self.parallel_connections)))
+        probe_command = command + ["-b", str(stream_rate_bps), "-t", str(seconds), "--json"]
+        result = self.process_supervisor.run(RESOURCE_OWNER, self.last_measurement_id, probe_command)
+        self.capacity_probe_usages.append(result.usage())
+        if result.stop_requested:
+            self.capacity_probe_returncode = signal.SIGTERM
+            return None
+        try:
+            json_result = json.loads(result.stdout)
+        except json.JSONDecodeError:
+            json_result = None
+        if (result.returncode != 0) or (json_result is None) or ("error" in json_result):
+            self.capacity_probe_returncode = result.returncode if (result.returncode != 0) else -1
+            self.last_error = json_result.get("error") if isinstance(json_result, dict) and ("error" in json_result) else (result.stderr or "Decode result json failed")
+            return None
+        return json_result
+
+    def publish_interval_batch(self, samples : list):
+        """
+        Publishes a batch of interval samples of the running repetition via MQTT.
+        """
+        json_intervals = {
+            "handler": "iperf",
+            "type": "result",
+            "payload":
+            {
+                "msm_id": self.last_measurement_id,
+                "repetition_number": self.current_repetition,
+                "transport_protocol": self.transport_protocol,
+                "start_timestamp": self.current_repetition_started_at,
+                "intervals": samples
+            }
+        }
+        self.mqtt_client.publish_on_result_topic(result=json_intervals)
+
+    def save_last_result_on_flash(self):
+        base_path = Path(__file__).parent
+        complete_output_json_dir = os.path.join(base_path, self.output_iperf_dir , self.output_json_filename + self.last_measurement_id + ".json")
+        with open(complete_output_json_dir, "w") as output_file:
+            json.dump(self.last_json_result, output_file, indent=4)
+        print(f"IperfController: results saved in: {complete_output_json_dir}")
+
     def stop_iperf_thread(self, msm_id):
         """
         Stops the iperf thread and kills the iperf3 process if running.
         Checks the measurement ID for safety. Returns 'OK' or an error message.
         """
-        iperf_process_pid = None
         process_name = "iperf3"
+        if (self.iperf_thread is not None) and (self.last_role == "Client") and (self.last_start_at is not None) and (time.time() < self.last_start_at):
+            if msm_id != self.last_measurement_id: # The client is armed, waiting for its scheduled start
+                return f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement {self.last_measurement_id}"
+            self.armed_stop_event.set()
+            self.iperf_thread.join()
+            return "OK"
+        if (self.iperf_thread is not None) and (self.last_role == "Client") and self.capacity_search and (msm_id == self.last_measurement_id):
+            self.armed_stop_event.set() # Between two probes of the capacity search no iperf3 is running
+            self.process_supervisor.stop(RESOURCE_OWNER, msm_id)
+            self.iperf_thread.join()
+            return "OK"
         if (self.iperf_thread is not None) and (self.last_role is not None):
-            for process in psutil.process_iter(['pid', 'name']):
-                if process_name in process.info['name']:  # Finding the iperf3 process
-                    iperf_process_pid = process.info['pid']
-                    break
-            if iperf_process_pid == None:
+            if not self.process_supervisor.processes_of(RESOURCE_OWNER, self.last_measurement_id):
                 return "Process " + process_name + "-" + self.last_role + " not in Execution"
             if msm_id != self.last_measurement_id:
                     return f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement {self.last_measurement_id}"
@@ -294,7 +517,7 @@ class IperfController:
                     return
                     """
             try:
-                os.kill(iperf_process_pid, signal.SIGTERM)
+                self.process_supervisor.stop(RESOURCE_OWNER, msm_id) # Only the iperf3 of this measurement, reaped
                 self.iperf_thread.join()
                 return "OK"
             except OSError as e:
@@ -311,7 +534,7 @@ class IperfController:
             "command" : successed_command,
             "msm_id" : self.last_measurement_id if (msm_id is None) else msm_id
             }
-        if (successed_command == "conf") and (self.last_role == "Server"):
+        if (successed_command in ("conf", "prepare")) and (self.last_role == "Server"):
             json_ack['port'] = self.listening_port
         print(f"IperfController: ACK sending -> {json_ack}")
         self.mqtt_client.publish_command_ACK(handler='iperf', payload=json_ack) 
@@ -374,14 +597,19 @@ class IperfController:
                     "duration": duration,
                     "avg_speed": avg_speed,
                     "last_result": last_result,
+                    "process_usage": self.last_process_usage,
+                    "capacity_search": self.last_capacity_summary,
+                    "precision": self.last_precision,
                     "full_result_c_b64": compressed_full_result_b64
                 }
             }
 
             # json_byte_result = json.dumps(json_copmpressed_data).encode('utf-8') Valutare se conviene binarizzarla
 
-            self.mqtt_client.publish_on_result_topic(result=json.dumps(json_summary_data))
+            self.mqtt_client.publish_on_result_topic(result=json_summary_data)
             self.last_json_result = None # reset the result about last iperf measurement
+            self.last_capacity_summary = None
+            self.last_precision = None
             print(f"IperfController: measurement [{self.last_measurement_id}] result published")
         except Exception as e:
             #print(f"Exception in publish_last_output_iperf -> {e} ")
@@ -421,6 +649,17 @@ class IperfController:
         self.repetitions = 1
         self.save_result_on_flash = None
         self.last_json_result = None
+        self.stream_intervals = False
+        self.interval_batch_size = DEFAULT_INTERVAL_BATCH_SIZE
+        self.capacity_search = False
+        self.capacity_settings = {}
+        self.last_capacity_summary = None
+        self.adaptive_duration = False
+        self.adaptive_max_seconds = DEFAULT_ADAPTIVE_MAX_SECONDS
+        self.adaptive_settings = {}
+        self.last_precision = None
+        self.last_start_at = None
+        self.armed_stop_event.clear()
 
         # Iperf Server - Parameters
         self.listening_port = None
\ No newline at end of file
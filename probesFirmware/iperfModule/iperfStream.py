@@ -0,0 +1,128 @@
+"""
+Incremental reader of the iperf3 --json-stream output (iperf3 >= 3.17): one JSON event per line,
+{"event": "start" | "interval" | "end" | "error", "data": ...}.
+Each interval is reduced to a compact sample (throughput, retransmits, RTT, cwnd, UDP loss/jitter) and the samples are
+published in batches while the test runs; the end event becomes a lean summary, shaped as the --json document
+({"start", "end"}) but without the per-interval and per-stream arrays.
+"""
+
+import json
+import time
+
+DEFAULT_INTERVAL_BATCH_SIZE = 5         # Intervals (seconds, with the default -i 1) per published batch
+MAX_INTERVAL_BATCH_SECONDS = 10         # A batch is published at least this often, whatever its size
+
+
+def compact_interval(interval_data : dict) -> dict:
+    """
+    Reduces an interval event to its sample: the stream sums, plus the mean RTT/RTTVAR and the total cwnd of the
+    TCP sender streams. The fields iperf3 doesn't report for the test (e.g. retransmits of a receiver) are omitted.
+    """
+    interval_sum = interval_data.get("sum", {})
+    sample = {
+        "start": round(interval_sum.get("start", 0.0), 3),
+        "end": round(interval_sum.get("end", 0.0), 3),
+        "bytes": interval_sum.get("bytes"),
+        "bits_per_second": interval_sum.get("bits_per_second"),
+        "retransmits": interval_sum.get("retransmits"),
+        "lost_percent": interval_sum.get("lost_percent"),
+        "jitter_ms": interval_sum.get("jitter_ms")
+    }
+    streams = interval_data.get("streams", [])
+    rtts = [stream["rtt"] for stream in streams if stream.get("rtt") is not None]
+    if rtts: # Microseconds, sender side only
+        sample["rtt_us"] = sum(rtts) / len(rtts)
+        sample["rttvar_us"] = sum(stream.get("rttvar", 0) for stream in streams) / len(rtts)
+        sample["snd_cwnd"] = sum(stream.get("snd_cwnd", 0) for stream in streams)
+    return {key: value for key, value in sample.items() if value is not None}
+
+
+def lean_summary(start_data : dict, end_data : dict) -> dict:
+    """
+    Returns the {"start", "end"} document of the test, without the per-stream details of the end event.
+    """
+    start_data = start_data or {}
+    return {
+        "start": {
+            "timestamp": start_data.get("timestamp"),
+            "connected": start_data.get("connected", []),
+            "test_start": start_data.get("test_start")
+        },
+        "end": {key: value for key, value in (end_data or {}).items() if key != "streams"}
+    }
+
+
+def summary_from_intervals(start_data : dict, samples : list) -> dict:
+    """
+    Returns the {"start", "end"} document of a test ended before its end event (adaptive duration), with the end sums
+    estimated from the interval samples seen by the client (sender side in a forward TCP test, receiver side with -R:
+    a forward UDP test, whose client intervals are the offered rate, can't have an adaptive duration).
+    """
+    seconds = samples[-1]["end"] if samples else 0.0
+    total_bytes = sum(sample.get("bytes", 0) for sample in samples)
+    interval_sum = {
+        "start": 0.0,
+        "end": seconds,
+        "seconds": seconds,
+        "bytes": total_bytes,
+        "bits_per_second": (total_bytes * 8 / seconds) if (seconds > 0) else 0.0
+    }
+    summary = lean_summary(start_data, None)
+    summary["end"] = {"sum_sent": dict(interval_sum), "sum_received": dict(interval_sum), "estimated_from_intervals": True}
+    return summary
+
+
+class IntervalBatcher:
+    """
+    Collects the interval samples of a repetition, and hands them to publish_batch(samples) every batch_size samples
+    (or every MAX_INTERVAL_BATCH_SECONDS).
+    """
+    def __init__(self, publish_batch, batch_size = DEFAULT_INTERVAL_BATCH_SIZE):
+        self.publish_batch = publish_batch
+        self.batch_size = max(1, int(batch_size))
+        self.samples = []
+        self.last_publish = time.monotonic()
+        self.published_count = 0
+
+    def add(self, sample : dict):
+        self.samples.append(sample)
+        if (len(self.samples) >= self.batch_size) or ((time.monotonic() - self.last_publish) >= MAX_INTERVAL_BATCH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        if not self.samples:
+            return
+        samples, self.samples = self.samples, []
+        self.publish_batch(samples)
+        self.published_count += len(samples)
+        self.last_publish = time.monotonic()
+
+
+def read_json_stream(stdout, on_interval):
+    """
+    Consumes the iperf3 --json-stream output line by line, until EOF.
+    Args:
+        stdout: The text stream of the iperf3 stdout.
+        on_interval (callable): Invoked with the compact sample of each interval event.
+    Returns:
+        tuple: (start_data, end_data, error) of the test. error is the message of the error event, or None.
+    """
+    start_data = end_data = error = None
+    for line in stdout:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            continue # e.g. a warning printed out of the JSON events
+        match event.get("event"):
+            case "start":
+                start_data = event.get("data")
+            case "interval":
+                on_interval(compact_interval(event.get("data", {})))
+            case "end":
+                end_data = event.get("data")
+            case "error":
+                error = event.get("data")
+    return start_data, end_data, error
@@ -0,0 +1,92 @@
+"""
+Unit tests of the adaptive duration estimator of the throughput tests.
+Run from probesFirmware: python -m unittest iperfModule.test_iperfAdaptive
+"""
+
+import math
+import unittest
+from iperfModule.iperfAdaptive import ThroughputEstimator, t_quantile, MIN_BATCHES
+
+
+def interval_samples(throughputs, start = 0.0):
+    """
+    One second interval samples with the given throughputs.
+    """
+    return [{"start": start + index, "end": start + index + 1, "bits_per_second": throughput}
+            for index, throughput in enumerate(throughputs)]
+
+
+class TestTQuantile(unittest.TestCase):
+
+    def test_close_to_the_tabulated_values(self):
+        # Two-sided 95% quantiles of the Student t distribution: ~3% low at 2 degrees of freedom, within 1% above
+        self.assertAlmostEqual(t_quantile(0.95, 2), 4.303, delta = 0.035 * 4.303)
+        for degrees_of_freedom, expected in [(3, 3.182), (5, 2.571), (10, 2.228), (30, 2.042)]:
+            self.assertAlmostEqual(t_quantile(0.95, degrees_of_freedom), expected, delta = 0.01 * expected)
+
+    def test_tends_to_the_normal_quantile(self):
+        self.assertAlmostEqual(t_quantile(0.95, 10**6), 1.95996, places = 4)
+
+
+class TestThroughputEstimator(unittest.TestCase):
+
+    def test_warmup_samples_excluded(self):
+        estimator = ThroughputEstimator(warmup_seconds = 2)
+        for sample in interval_samples([1e6, 2e6, 100e6, 100e6]):
+            estimator.add(sample)
+        self.assertEqual(estimator.count, 2)
+        self.assertEqual(estimator.mean, 100e6)
+        self.assertEqual(estimator.elapsed_seconds, 4)
+
+    def test_samples_without_throughput_ignored(self):
+        estimator = ThroughputEstimator(warmup_seconds = 0)
+        estimator.add({"start": 0.0, "end": 1.0})
+        self.assertEqual(estimator.count, 0)
+        self.assertEqual(estimator.elapsed_seconds, 1.0)
+
+    def test_batch_means(self):
+        estimator = ThroughputEstimator(warmup_seconds = 0)
+        for sample in interval_samples(range(1, 11)):
+            estimator.add(sample)
+        # 10 samples: batches of ceil(sqrt(10)) = 4, the 2 oldest samples left over
+        self.assertEqual(estimator.batch_means(), [4.5, 8.5])
+        self.assertIsNone(estimator.half_width()) # Fewer than MIN_BATCHES batches
+
+    def test_not_converged_before_min_seconds(self):
+        estimator = ThroughputEstimator(min_seconds = 20, warmup_seconds = 0)
+        converged = [estimator.add(sample) for sample in interval_samples([100e6] * 19)]
+        self.assertFalse(any(converged))
+        self.assertTrue(estimator.add(interval_samples([100e6], start = 19)[0]))
+
+    def test_not_converged_with_too_few_batches(self):
+        estimator = ThroughputEstimator(min_seconds = 0, warmup_seconds = 0)
+        for sample in interval_samples([100e6] * 20):
+            if estimator.add(sample):
+                break
+        # Converged on the first sample giving MIN_BATCHES batch means, not before
+        self.assertEqual(len(estimator.batch_means()), MIN_BATCHES)
+        self.assertIsNotNone(estimator.half_width())
+
+    def test_converges_on_a_steady_throughput(self):
+        estimator = ThroughputEstimator(tolerance_percent = 5, min_seconds = 3, warmup_seconds = 1)
+        throughputs = [10e6] + [100e6 * (1 + 0.02 * math.sin(index)) for index in range(60)] # Slow start, then steady
+        for sample in interval_samples(throughputs):
+            if estimator.add(sample):
+                break
+        self.assertTrue(estimator.converged)
+        self.assertLess(estimator.elapsed_seconds, 60)
+        precision = estimator.precision()
+        self.assertLessEqual(precision["ci_relative_percent"], 5)
+        self.assertAlmostEqual(precision["mean_bps"], 100e6, delta = 2e6)
+        self.assertGreaterEqual(precision["batches"], MIN_BATCHES)
+
+    def test_does_not_converge_on_a_noisy_throughput(self):
+        estimator = ThroughputEstimator(tolerance_percent = 1, min_seconds = 3, warmup_seconds = 0)
+        for sample in interval_samples([50e6, 150e6, 20e6, 180e6, 90e6, 10e6, 200e6, 70e6, 130e6, 40e6]):
+            estimator.add(sample)
+        self.assertFalse(estimator.converged)
+        self.assertFalse(estimator.precision()["converged"])
+
+
+if __name__ == "__main__":
+    unittest.main()
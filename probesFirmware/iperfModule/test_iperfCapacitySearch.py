@@ -0,0 +1,103 @@
+"""
+Unit tests of the UDP capacity search, against a simulated link.
+Run from probesFirmware: python -m unittest iperfModule.test_iperfCapacitySearch
+"""
+
+import unittest
+import threading
+from unittest import mock
+from iperfModule import iperfCapacitySearch
+from iperfModule.iperfCapacitySearch import CapacitySearch, udp_sample
+
+
+class SimulatedLink:
+    """
+    run_probe of a link of capacity_mbps: the load above the capacity is lost.
+    """
+    def __init__(self, capacity_mbps, jitter_ms = 0.1):
+        self.capacity_bps = capacity_mbps * 10**6
+        self.jitter_ms = jitter_ms
+        self.offered = []
+
+    def __call__(self, rate_bps, seconds):
+        self.offered.append(rate_bps)
+        lost_percent = max(0.0, (rate_bps - self.capacity_bps) / rate_bps * 100)
+        return {"end": {"sum": {"lost_percent": lost_percent, "jitter_ms": self.jitter_ms, "bytes": int(rate_bps * seconds / 8),
+                                "seconds": float(seconds), "bits_per_second": rate_bps}}}
+
+
+class TestCapacitySearch(unittest.TestCase):
+
+    def setUp(self):
+        pause_patch = mock.patch.object(iperfCapacitySearch, "CAPACITY_PROBE_PAUSE_SECONDS", 0)
+        pause_patch.start()
+        self.addCleanup(pause_patch.stop)
+        self.stop_event = threading.Event()
+
+    def test_converges_near_the_capacity(self):
+        link = SimulatedLink(capacity_mbps = 73)
+        search = CapacitySearch(link, self.stop_event, start_mbps = 10, max_mbps = 1000, tolerance_percent = 5)
+        self.assertTrue(search.run())
+        self.assertTrue(search.converged)
+        self.assertEqual(link.offered[:4], [10e6, 20e6, 40e6, 80e6]) # Ramp up to the first unsustainable load
+        self.assertLessEqual(search.sustainable_bps, link.capacity_bps)
+        self.assertGreater(search.unsustainable_bps, link.capacity_bps)
+        self.assertLessEqual(search.unsustainable_bps - search.sustainable_bps, 0.05 * search.unsustainable_bps)
+
+        summary = search.summary()
+        self.assertEqual(summary["max_sustainable_bps"], search.sustainable_bps)
+        self.assertEqual(len(summary["probes"]), len(link.offered))
+        self.assertEqual(summary["total_bytes"], sum(int(rate * 2 / 8) for rate in link.offered))
+
+    def test_whole_range_sustainable(self):
+        link = SimulatedLink(capacity_mbps = 500)
+        search = CapacitySearch(link, self.stop_event, start_mbps = 10, max_mbps = 100)
+        self.assertTrue(search.run())
+        self.assertTrue(search.converged)
+        self.assertEqual(link.offered[-1], 100e6)
+        self.assertEqual(search.sustainable_bps, 100e6)
+        self.assertIsNone(search.unsustainable_bps)
+
+    def test_jitter_threshold(self):
+        search = CapacitySearch(SimulatedLink(capacity_mbps = 500, jitter_ms = 5), self.stop_event, max_mbps = 100, jitter_ms = 2)
+        self.assertTrue(search.run())
+        self.assertEqual(search.sustainable_bps, 0.0)
+        self.assertTrue(all(not sample["sustainable"] for sample in search.samples))
+
+    def test_max_probes_bounds_the_search(self):
+        link = SimulatedLink(capacity_mbps = 73)
+        search = CapacitySearch(link, self.stop_event, tolerance_percent = 0.001, max_probes = 6)
+        self.assertTrue(search.run())
+        self.assertFalse(search.converged)
+        self.assertEqual(len(link.offered), 6)
+
+    def test_probe_failure_aborts(self):
+        search = CapacitySearch(lambda rate_bps, seconds: None, self.stop_event)
+        self.assertFalse(search.run())
+        self.assertEqual(search.samples, [])
+
+    def test_stop_event_aborts(self):
+        link = SimulatedLink(capacity_mbps = 73)
+
+        def run_probe(rate_bps, seconds):
+            self.stop_event.set() # Stopped while the first probe runs
+            return link(rate_bps, seconds)
+
+        search = CapacitySearch(run_probe, self.stop_event)
+        self.assertFalse(search.run())
+        self.assertEqual(len(link.offered), 1)
+
+
+class TestUdpSample(unittest.TestCase):
+
+    def test_received_rate_derived_from_the_loss(self):
+        sample = udp_sample({"end": {"sum": {"lost_percent": 10.0, "bits_per_second": 100e6}}}, 100e6)
+        self.assertAlmostEqual(sample["received_bps"], 90e6)
+
+    def test_received_rate_of_the_receiver_sum(self):
+        json_result = {"end": {"sum": {"lost_percent": 10.0, "bits_per_second": 100e6}, "sum_received": {"bits_per_second": 85e6}}}
+        self.assertEqual(udp_sample(json_result, 100e6)["received_bps"], 85e6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 import yaml
 import json
+import time
+import threading
 from pathlib import Path
 import os
 import psutil
@@ -12,14 +14,17 @@ Handles MQTT connection, publishing, and subscription logic for probe devices in
 """
 
 VERBOSE = False
+MAX_TRACKED_COMMANDS = 256 # Reception times of commands never acknowledged are dropped beyond this size
 
 class ProbeMqttClient(mqtt.Client):
     """
     MQTT client for probe devices. Manages connection, topics, publishing, and message handling.
     """
-    def __init__(self, probe_id, msg_received_handler_callback):
+    def __init__(self, probe_id, msg_received_handler_callback, config = None):
         """
         Initialize the MQTT client, load configuration, set up topics, and connect to the broker.
+        If config (the content of the "mqtt_client" section) is provided, the yaml file is not read.
+        Without a mosquitto_certificate_path, the connection is not encrypted (e.g. local test broker).
         """
         self.config = None
         self.probe_id = None
@@ -28,18 +33,23 @@ class ProbeMqttClient(mqtt.Client):
         self.results_topic = None
         self.connected_to_broker = False
         self.external_mqtt_msg_handler = msg_received_handler_callback
+        self.commands_received_at = {} # Maps (handler, command, msm_id) to the reception (time, monotonic time) and role, echoed in the ACK/NACK
+        self.commands_received_at_lock = threading.Lock()
+        self.capabilities = None # Announced in the ONLINE/UPDATE states, once the controllers are registered
+        self.warm_servers = None # {tool: [ports]} of the ready warm servers, announced in the ONLINE/UPDATE states
 
         base_path = Path(__file__).parent
-        # VECCHIO
-        #yaml_path = os.path.join(base_path, probe_id + ".yaml")
-        yaml_path = os.path.join(base_path, "probe_mqtt_client_config.yaml")
-        with open(yaml_path) as file:
-            self.config = yaml.safe_load(file)
+        if config is None:
+            # VECCHIO
+            #yaml_path = os.path.join(base_path, probe_id + ".yaml")
+            yaml_path = os.path.join(base_path, "probe_mqtt_client_config.yaml")
+            with open(yaml_path) as file:
+                config = yaml.safe_load(file)['mqtt_client']
 
-        self.config = self.config['mqtt_client']
+        self.config = config
         self.probe_id = probe_id
-        cert_path = self.config['mosquitto_certificate_path']
-        self.mosquitto_certificate_path = os.path.join(base_path, cert_path)
+        cert_path = self.config.get('mosquitto_certificate_path')
+        self.mosquitto_certificate_path = os.path.join(base_path, cert_path) if cert_path else None
         clean_session = self.config['clean_session']
         broker_ip = self.config['broker']['host']
         broker_port = self.config['broker']['port']
@@ -60,8 +70,9 @@ class ProbeMqttClient(mqtt.Client):
                 self.config['credentials']['username'],
                 self.config['credentials']['password'])
         
-        self.tls_set( ca_certs = self.mosquitto_certificate_path,
-                       tls_version=mqtt.ssl.PROTOCOL_TLSv1_2)
+        if self.mosquitto_certificate_path is not None:
+            self.tls_set( ca_certs = self.mosquitto_certificate_path,
+                           tls_version=mqtt.ssl.PROTOCOL_TLSv1_2)
         
         self.connect(broker_ip, broker_port, keep_alive)
         self.loop_start()
@@ -110,8 +121,13 @@ class ProbeMqttClient(mqtt.Client):
     def publish_on_result_topic(self, result):
         """
         Publish a result message to the results topic.
+        If the result is a dict, the publish timestamp is added to its payload before the serialization.
         """
         # Invoked when you want to publish a result
+        if isinstance(result, dict):
+            if isinstance(result.get("payload"), dict):
+                result["payload"]["timestamps"] = {"published": time.time()}
+            result = json.dumps(result)
         self.publish(
             topic = self.results_topic,
             payload = result,
@@ -132,10 +148,39 @@ class ProbeMqttClient(mqtt.Client):
         if VERBOSE:
             print(f"MqttClient: sent on topic |{self.error_topic}| -> {error_msg}")
         
+    def mark_command_received(self, handler, command, msm_id, received_at, received_monotonic = None, role = None):
+        """
+        Store the reception time of a command, so that its ACK/NACK can report the probe processing time (and the role
+        of the command, whose processing time may differ per role).
+        The processing time is measured on the monotonic clock: the wall clock may be stepped meanwhile (e.g. ntpdate).
+        """
+        received_monotonic = time.monotonic() if (received_monotonic is None) else received_monotonic
+        with self.commands_received_at_lock:
+            if len(self.commands_received_at) >= MAX_TRACKED_COMMANDS:
+                self.commands_received_at.pop(next(iter(self.commands_received_at)))
+            self.commands_received_at[(handler, command, msm_id)] = (received_at, received_monotonic, role)
+
+    def add_command_timestamps(self, handler, payload):
+        """
+        Add the {"received", "ack"} timestamps (wall clock) and the "processing" seconds (monotonic clock) to an
+        ACK/NACK payload, if the command reception has been marked, and the role of the command if it had one.
+        """
+        if not isinstance(payload, dict):
+            return payload
+        with self.commands_received_at_lock:
+            received = self.commands_received_at.pop((handler, payload.get("command"), payload.get("msm_id")), None)
+        if received is not None:
+            received_at, received_monotonic, role = received
+            payload["timestamps"] = {"received": received_at, "ack": time.time(), "processing": time.monotonic() - received_monotonic}
+            if role is not None:
+                payload.setdefault("role", role)
+        return payload
+
     def publish_command_ACK(self, handler, payload):
         """
         Publish an ACK message for a command to the status topic.
         """
+        payload = self.add_command_timestamps(handler, payload)
         json_ACK = {
             "handler": handler,
             "type" : "ACK",
@@ -147,6 +192,7 @@ class ProbeMqttClient(mqtt.Client):
         """
         Publish a NACK message for a command to the status topic.
         """
+        payload = self.add_command_timestamps(handler, payload)
         json_NACK = {
             "handler": handler,
             "type" : "NACK",
@@ -180,8 +226,8 @@ class ProbeMqttClient(mqtt.Client):
     def publish_probe_state(self, state):
         """
         Publish the probe's state (ONLINE, UPDATE, OFFLINE) to the status topic, including IP and MAC if relevant.
+        ONLINE and UPDATE carry the capabilities of the probe and its ready warm servers too, when they are known.
         """
-        shared_state = SharedState.get_instance()   
         json_status = {
             "handler": "root_service",
             "type": "state",
@@ -190,11 +236,32 @@ class ProbeMqttClient(mqtt.Client):
             }
         }
         if (state == "ONLINE") or (state == "UPDATE"):
-            json_status["payload"]["ip"] = shared_state.get_probe_ip()
-            json_status["payload"]["clock_sync_ip"] = shared_state.get_probe_ip_for_clock_sync()
-            json_status["payload"]["mac"] = shared_state.get_probe_mac()
+            probe_ip, probe_ip_for_clock_sync, probe_mac = self.get_probe_addresses()
+            json_status["payload"]["ip"] = probe_ip
+            json_status["payload"]["clock_sync_ip"] = probe_ip_for_clock_sync
+            json_status["payload"]["mac"] = probe_mac
+            json_status["payload"]["gateway"] = self.get_probe_gateway()
+            if self.capabilities is not None:
+                json_status["payload"]["capabilities"] = self.capabilities
+            if self.warm_servers is not None:
+                json_status["payload"]["warm_servers"] = self.warm_servers
         self.publish_on_status_topic(json.dumps(json_status))
 
+    def get_probe_addresses(self):
+        """
+        Return the (ip, clock_sync_ip, mac) announced in the ONLINE/UPDATE state messages.
+        """
+        shared_state = SharedState.get_instance()
+        return shared_state.get_probe_ip(), shared_state.get_probe_ip_for_clock_sync(), shared_state.get_probe_mac()
+
+    def get_probe_gateway(self):
+        """
+        Return the default gateway identity {"ip", "mac", "nic", "point_to_point"}, used by the coordinator to build the
+        interference groups. It doesn't block (this runs in the MQTT callbacks): if the gateway MAC is still being
+        resolved, an UPDATE state announces it once known.
+        """
+        return SharedState.get_instance().get_gateway_identity(on_resolved = lambda: self.publish_probe_state("UPDATE"))
+
     def publish_error(self, handler, payload):
         """
         Publish a generic error message to the error topic.
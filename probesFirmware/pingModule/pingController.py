@@ -1,19 +1,18 @@
 """
-PingController: Implements the LATENCY measurement functionality using the system ping command.
+PingController: Implements the LATENCY measurement functionality with the in-process echo engine (pingEngine).
 Handles configuration, command dispatch, execution, and result reporting for ping measurements.
 """
 
 import json
 import threading
-import os
-import subprocess
-import platform
-import signal
-import psutil
 import time
-from pingparsing import PingParsing
 from mqttModule.mqttClient import ProbeMqttClient
-from shared_resources import SharedState
+from shared_resources import SharedState, NIC_BANDWIDTH, SHARED, session_owner
+from pingModule.pingEngine import EchoEngine, DEFAULT_PACKETS_INTERVAL_SECONDS
+
+RESOURCE_OWNER = "ping"
+# The ICMP traffic is light: the ping shares the NIC with the other measurements
+PING_RESOURCES = {NIC_BANDWIDTH: SHARED}
 
 """ Class that implements the LATENCY measurement funcionality """
 class PingController:
@@ -28,6 +27,7 @@ class PingController:
         self.shared_state = SharedState.get_instance()
         self.mqtt_client = mqtt_client        
         self.ping_thread = None
+        self.stop_ping_event = threading.Event()
         self.ping_result = None
         self.last_msm_id = None
 
@@ -50,10 +50,12 @@ class PingController:
             return
         match command:
             case 'start':
-                if not self.shared_state.set_probe_as_busy():
+                # One ping at a time: the engine pings many targets at once
+                if self.shared_state.sessions_of(RESOURCE_OWNER) or (not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, msm_id), PING_RESOURCES)):
                     self.send_ping_NACK(failed_command = command, error_info = "PROBE BUSY", measurement_related_conf = msm_id)
                     return
                 self.send_ping_ACK(successed_command = "start", measurement_related_conf = msm_id)
+                self.stop_ping_event.clear()
                 self.ping_thread = threading.Thread(target=self.start_ping, args=(payload,))
                 self.ping_thread.start()
             case 'stop':
@@ -62,7 +64,7 @@ class PingController:
                                         error_info="Measure_ID Mismatch: The provided measure_id does not correspond to the ongoing measurement",
                                         measurement_related_conf = msm_id)
                     return
-                termination_message = self.stop_ping_thread()
+                termination_message = self.stop_ping_thread(msm_id)
                 if termination_message != "OK":
                     self.send_ping_NACK(failed_command=command, error_info=termination_message, measurement_related_conf = msm_id)
                 else:
@@ -75,66 +77,54 @@ class PingController:
 
     def start_ping(self, payload : json):
         """
-        Executes the ping command in a separate thread, parses the result, and publishes it.
+        Runs the echo engine in a separate thread, and publishes its result.
+        With a list of "destinations" the targets are pinged concurrently, and their results are published together.
         Handles both normal and error termination.
         """
-        destination_ip = payload['destination_ip']
-        packets_number = payload['packets_number']
-        packets_size = payload['packets_size']
         msm_id = payload['msm_id']
-        # Command construction
-        if platform.system() == "Windows": # It's necessary for the output parsing to execute the ping-command-linux-based
-            command = ["wsl", "ping"]
-        else:
-            command = ["ping"]
-        command += [destination_ip, "-c", str(packets_number), "-s", str(packets_size)]
         timestamp = time.time() # start_timestamp
         try:
             self.last_msm_id = msm_id
-            ping_result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            if ping_result.returncode == 0:
-                parser = PingParsing()
-                dict_result = parser.parse(ping_result.stdout)
-                self.send_ping_result( json_ping_result=dict_result.as_dict(), 
-                                    icmp_replies = dict_result.icmp_replies,
-                                    timestamp = timestamp,
-                                    msm_id=msm_id)
-        except subprocess.CalledProcessError as e: 
-            if e.returncode == -signal.SIGTERM: # if the returncode of the ping process is SIG_TERM, then the process has been stopped from the coordinator. So, it's better to "ACK it"
-                self.send_ping_ACK(successed_command="stop", measurement_related_conf = msm_id)
-            else: # if the return code is different from (SIG.TERM and CorrectTermination), then something strange happened, so the probe sends NACK to the coordinator
-                self.send_ping_NACK(failed_command="start", error_info=str(e), measurement_related_conf = msm_id)
-        except Exception as e: #In case of abnormal exception, send the nack to the coordinator
+            multi_target = ('destinations' in payload)
+            engine = EchoEngine(destinations = payload['destinations'] if multi_target else payload['destination_ip'],
+                                packets_number = payload['packets_number'],
+                                packets_size = payload['packets_size'],
+                                stop_event = self.stop_ping_event,
+                                packets_interval = payload.get('packets_interval', DEFAULT_PACKETS_INTERVAL_SECONDS),
+                                protocol = payload.get('protocol', "icmp"),
+                                udp_port = payload.get('udp_port'))
+            engine.run()
+            if engine.stopped: # Stopped from the coordinator: the stop command ACKs it
+                return
+            if multi_target:
+                self.send_multi_target_ping_result(results = engine.results(), timestamp = timestamp, msm_id = msm_id,
+                                                   process_usage = engine.usage())
+                return
+            dict_result = engine.result()
+            self.send_ping_result(json_ping_result = dict_result,
+                                  icmp_replies = dict_result.pop("icmp_replies"),
+                                  timestamp = timestamp,
+                                  msm_id = msm_id,
+                                  process_usage = engine.usage())
+        except Exception as e: #In case of abnormal exception (e.g. ICMP socket not allowed), send the nack to the coordinator
             self.send_ping_NACK(failed_command="start", error_info=str(e), measurement_related_conf=msm_id)
         finally:
-            self.shared_state.set_probe_as_ready()
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
     
         
-    def stop_ping_thread(self):
+    def stop_ping_thread(self, msm_id):
         """
-        Stops the ping thread and kills the ping process if running.
+        Stops the echo engine of the running measurement, and waits for its thread.
         Returns 'OK' or an error message.
         """
-        ping_process = None
-        process_name = "ping"
-        if self.ping_thread != None:
-            for process in psutil.process_iter(['pid', 'name']):  # Finding the ping process
-                if process_name in process.info['name']: 
-                    ping_process = process.info['pid']
-                    break
-        if ping_process == None:
-            return "Process " + process_name + " not in Execution"
-    
-        try:
-            os.kill(ping_process, signal.SIGTERM)
-            self.ping_thread.join()
-            self.ping_thread = None
-            print(f"PingController: ping command stopped.")
-            self.shared_state.set_probe_as_ready()
-            return "OK"
-        except OSError as e:
-            self.shared_state.set_probe_as_ready()
-            return str(e)
+        if (self.ping_thread is None) or (not self.ping_thread.is_alive()):
+            return "Process ping not in Execution"
+        self.stop_ping_event.set()
+        self.ping_thread.join()
+        self.ping_thread = None
+        print(f"PingController: ping stopped.")
+        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
+        return "OK"
         
 
     def send_ping_ACK(self, successed_command, measurement_related_conf):
@@ -160,14 +150,15 @@ class PingController:
         self.mqtt_client.publish_command_NACK(handler='ping', payload = json_nack)
         print(f"PingController: sent NACK, reason-> {error_info} for measure -> |{measurement_related_conf}|")
 
-    def send_ping_result(self, json_ping_result : json, icmp_replies, timestamp, msm_id):
+    def send_ping_result(self, json_ping_result : json, icmp_replies, timestamp, msm_id, process_usage = None):
         """
-        Publishes the result of a ping measurement, including ICMP replies, via MQTT.
+        Publishes the result of a ping measurement, including ICMP replies, the RTT vector and the resource usage of the echo engine, via MQTT.
         """
         my_ip = self.shared_state.get_probe_ip()
         json_ping_result["source"] = my_ip
         json_ping_result["timestamp"] = timestamp
         json_ping_result["msm_id"] = msm_id
+        json_ping_result["process_usage"] = process_usage
 
         essential_icmp_replies = []
         for icmp_reply in icmp_replies:
@@ -185,5 +176,24 @@ class PingController:
             "type": "result",
             "payload": json_ping_result
         }
-        self.mqtt_client.publish_on_result_topic(result=json.dumps(json_command_result))
-        print(f"PingController: sent ping result -> {json_ping_result}")
\ No newline at end of file
+        self.mqtt_client.publish_on_result_topic(result=json_command_result)
+        print(f"PingController: sent ping result -> {json_ping_result}")
+
+    def send_multi_target_ping_result(self, results : list, timestamp, msm_id, process_usage = None):
+        """
+        Publishes the results of a multi-target ping measurement, one per destination, in a single result message.
+        """
+        json_ping_result = {
+            "source": self.shared_state.get_probe_ip(),
+            "timestamp": timestamp,
+            "msm_id": msm_id,
+            "process_usage": process_usage,
+            "results": results
+        }
+        json_command_result = {
+            "handler": "ping",
+            "type": "result",
+            "payload": json_ping_result
+        }
+        self.mqtt_client.publish_on_result_topic(result=json_command_result)
+        print(f"PingController: sent ping results of |{len(results)}| destinations for measure -> |{msm_id}|")
\ No newline at end of file
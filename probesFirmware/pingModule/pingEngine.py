@@ -0,0 +1,409 @@
+"""
+In-process echo engine of the LATENCY measurements, in place of the system ping: one socket and a selector loop send
+the echo requests on a fixed schedule and match the replies by source address and sequence number.
+Several destinations are pinged concurrently, fping-style: the requests of the targets are interleaved, evenly spaced
+within each packets_interval, which is the minimum time between two requests to the same target.
+The RTTs are measured on the monotonic clock, so a step of the wall clock (e.g. ntpdate) doesn't corrupt them. The replies
+are timestamped by the kernel (SO_TIMESTAMPNS), so the RTTs don't include the wake-up of the loop: these timestamps are on
+the realtime clock, and they are brought to the monotonic one with the realtime - monotonic offset. If the offset has
+moved since the request, the clock was stepped meanwhile: the kernel timestamp is dropped for the user space one.
+The per-sequence state lives in arrays, and each target has a result with the summary fields of pingparsing plus the
+RTT vector.
+
+Protocols:
+- "icmp": ICMP echo, on an unprivileged ICMP datagram socket (net.ipv4.ping_group_range), or on a raw socket (root).
+- "udp": UDP echo towards udp_port of the destination (e.g. an RFC 862 echo service), sequence number in the payload.
+"""
+
+import math
+import time
+import socket
+import struct
+import random
+import resource
+import selectors
+import threading
+from array import array
+
+DEFAULT_PACKETS_INTERVAL_SECONDS = 1.0  # As ping
+DEFAULT_REPLY_TIMEOUT_SECONDS = 2.0     # Wait for the late replies after the last request
+MIN_PACKETS_INTERVAL_SECONDS = 0.01
+MAX_PACKETS_NUMBER = 0xFFFF             # The ICMP sequence number is 16 bits
+MAX_DESTINATIONS = 256
+MIN_SEND_GAP_SECONDS = 0.001            # Between two requests of the engine, whatever the target
+STOP_POLL_SECONDS = 0.2                 # The loop checks the stop event at least this often
+RECEIVE_BUFFER_BYTES = 65535
+CLOCK_STEP_TOLERANCE_NS = 10**6         # Realtime - monotonic offset change beyond NTP slewing, during a reply timeout
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+# Not exported by the socket module on every Python version (Linux values)
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+IP_RECVTTL = getattr(socket, "IP_RECVTTL", 12)
+UDP_ECHO_HEADER = struct.Struct("!IIq") # token, sequence number, send time (monotonic ns)
+TIMESPEC = struct.Struct("@ll")
+CMSG_SPACE = socket.CMSG_SPACE(TIMESPEC.size) + socket.CMSG_SPACE(struct.calcsize("@i"))
+
+
+def icmp_checksum(data : bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return (~total) & 0xFFFF
+
+
+def open_icmp_socket():
+    """
+    Returns (socket, kind) with kind "dgram" (unprivileged ping socket) or "raw". Raises OSError if neither is allowed.
+    """
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), "dgram"
+    except OSError:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), "raw"
+
+
+def icmp_socket_kind() -> str:
+    """
+    Returns the kind of ICMP socket this host allows ("dgram" or "raw"), None if none. Announced in the capabilities.
+    """
+    try:
+        icmp_socket, kind = open_icmp_socket()
+        icmp_socket.close()
+        return kind
+    except OSError:
+        return None
+
+
+def thread_cpu_times() -> tuple:
+    """
+    Returns (user, system) CPU seconds of the calling thread, or of the process where RUSAGE_THREAD is not available.
+    """
+    usage = resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF))
+    return usage.ru_utime, usage.ru_stime
+
+
+class EchoTarget:
+    """
+    A destination of the engine, with its per-sequence state (indexed by seq - 1).
+    """
+    def __init__(self, destination, ip, packets_number, error = None):
+        self.destination = destination
+        self.ip = ip
+        self.error = error # Why the destination is not pinged (e.g. its name can't be resolved), None if it is
+        self.sent_ns = array("q", [0]) * packets_number # Monotonic
+        self.clock_offset_ns = array("q", [0]) * packets_number # Realtime - monotonic at each request
+        self.rtt_ms = array("d", [-1.0]) * packets_number
+        self.replies = array("H", [0]) * packets_number
+        self.ttl = array("h", [-1]) * packets_number
+        self.reply_bytes = array("l", [0]) * packets_number
+        self.packets_sent = 0
+        self.pending = 0 # Requests sent and not replied yet
+
+    def record_reply(self, seq, received_ns, ttl, reply_bytes):
+        index = seq - 1
+        if not (0 <= index < self.packets_sent):
+            return
+        self.replies[index] += 1
+        if self.replies[index] > 1: # Duplicate: the first reply gives the RTT
+            return
+        self.pending -= 1
+        self.rtt_ms[index] = max(received_ns - self.sent_ns[index], 0) / 10**6
+        self.ttl[index] = ttl if (ttl is not None) else -1
+        self.reply_bytes[index] = reply_bytes
+
+    def clock_stepped(self, seq, clock_offset_ns) -> bool:
+        """
+        Returns True if the realtime - monotonic offset has moved since the request seq was sent.
+        """
+        index = seq - 1
+        return (0 <= index < self.packets_sent) and (abs(clock_offset_ns - self.clock_offset_ns[index]) > CLOCK_STEP_TOLERANCE_NS)
+
+    def result(self) -> dict:
+        """
+        Returns the summary (pingparsing fields: rtt in ms, loss rate in %), the replies and the RTT vector.
+        """
+        rtts = [rtt for rtt in self.rtt_ms if rtt >= 0]
+        received = len(rtts)
+        duplicates = sum(max(replies - 1, 0) for replies in self.replies)
+        rtt_avg = (sum(rtts) / received) if rtts else None
+        # Same definition of the ping mdev: sqrt(E[rtt^2] - E[rtt]^2)
+        rtt_mdev = math.sqrt(max((sum(rtt * rtt for rtt in rtts) / received) - (rtt_avg * rtt_avg), 0.0)) if rtts else None
+        icmp_replies = [{
+                "bytes": self.reply_bytes[index],
+                "icmp_seq": index + 1,
+                "ttl": self.ttl[index] if (self.ttl[index] >= 0) else None,
+                "time": round(self.rtt_ms[index], 3)
+            } for index in range(self.packets_sent) if self.rtt_ms[index] >= 0]
+        target_result = {
+            "destination": self.destination,
+            "packet_transmit": self.packets_sent,
+            "packet_receive": received,
+            "packet_loss_count": self.packets_sent - received,
+            "packet_loss_rate": ((self.packets_sent - received) / self.packets_sent * 100) if self.packets_sent > 0 else None,
+            "packet_duplicate_count": duplicates,
+            "packet_duplicate_rate": (duplicates / received * 100) if received > 0 else None,
+            "rtt_min": round(min(rtts), 3) if rtts else None,
+            "rtt_avg": round(rtt_avg, 3) if rtts else None,
+            "rtt_max": round(max(rtts), 3) if rtts else None,
+            "rtt_mdev": round(rtt_mdev, 3) if rtts else None,
+            "icmp_replies": icmp_replies,
+            "rtt_vector": [round(rtt, 3) if (rtt >= 0) else None for rtt in self.rtt_ms[:self.packets_sent]]
+        }
+        if self.error is not None:
+            target_result["error"] = self.error
+        return target_result
+
+
+class EchoEngine:
+    """
+    One echo measurement towards one or more destinations: run() blocks until all the replies are in, the reply
+    timeout expires or stop_event is set.
+    """
+    def __init__(self, destinations, packets_number, packets_size, stop_event : threading.Event,
+                 packets_interval = DEFAULT_PACKETS_INTERVAL_SECONDS, protocol = "icmp", udp_port = None,
+                 reply_timeout = DEFAULT_REPLY_TIMEOUT_SECONDS):
+        """
+        Args:
+            destinations: The destination (IP or host name), or the list of the destinations.
+            packets_interval (float): Seconds between two requests to the same destination.
+        """
+        self.destinations = [destinations] if isinstance(destinations, str) else list(destinations)
+        if not (0 < len(self.destinations) <= MAX_DESTINATIONS):
+            raise ValueError(f"The destinations must be 1..{MAX_DESTINATIONS}")
+        self.packets_number = int(packets_number)
+        if not (0 < self.packets_number <= MAX_PACKETS_NUMBER):
+            raise ValueError(f"packets_number must be in 1..{MAX_PACKETS_NUMBER}")
+        self.packets_size = int(packets_size)
+        # The requests are evenly spaced: the interval of each target is stretched if the engine can't keep up
+        self.requested_interval = max(float(packets_interval), MIN_PACKETS_INTERVAL_SECONDS)
+        self.set_schedule(len(self.destinations))
+        self.protocol = protocol
+        if protocol not in ("icmp", "udp"):
+            raise ValueError(f"Unknown protocol |{protocol}|")
+        if (protocol == "udp") and (udp_port is None):
+            raise ValueError("The udp protocol needs the udp_port of the echo service")
+        if (protocol == "udp") and (self.packets_size < UDP_ECHO_HEADER.size):
+            raise ValueError(f"The udp protocol needs packets_size >= {UDP_ECHO_HEADER.size}")
+        self.udp_port = int(udp_port) if (udp_port is not None) else None
+        self.reply_timeout = float(reply_timeout)
+        self.stop_event = stop_event
+        self.stopped = False
+        self.token = random.getrandbits(32)   # Identifies the replies of this run (UDP payload)
+        self.identifier = self.token & 0xFFFF # ICMP identifier (overwritten by the kernel on a datagram socket)
+        self.socket = None
+        self.socket_kind = None
+        self.kernel_timestamps = 0 # Replies timestamped by the kernel
+        self.clock_steps = 0 # Kernel timestamps dropped, because the wall clock was stepped since their request
+        self.targets = []           # All the destinations, in order (the unresolved ones with their error)
+        self.active_targets = []    # The resolved ones, that are pinged
+        self.target_by_ip = {}
+        self.requests_sent = 0
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = (None, None)
+
+    def set_schedule(self, targets_number):
+        self.send_gap = max(self.requested_interval / targets_number, MIN_SEND_GAP_SECONDS)
+        self.packets_interval = self.send_gap * targets_number
+
+    def resolve_targets(self):
+        """
+        Resolves the destinations. A destination that can't be resolved gets an error result, the others are pinged
+        anyway. Raises ValueError if two of them are the same host (the replies can't be told apart), or if the only
+        destination can't be resolved.
+        """
+        for destination in self.destinations:
+            try:
+                ip = socket.gethostbyname(destination)
+            except (OSError, UnicodeError) as e: # socket.gaierror, or a name with an empty label
+                print(f"EchoEngine: destination |{destination}| not resolved -> {e}")
+                self.targets.append(EchoTarget(destination, None, self.packets_number, error = f"Name resolution failed: {e}"))
+                continue
+            if ip in self.target_by_ip:
+                raise ValueError(f"Duplicate destination |{destination}| -> {ip}")
+            target = EchoTarget(destination, ip, self.packets_number)
+            self.targets.append(target)
+            self.active_targets.append(target)
+            self.target_by_ip[ip] = target
+        if (len(self.targets) == 1) and (not self.active_targets):
+            raise ValueError(self.targets[0].error)
+        if self.active_targets and (len(self.active_targets) < len(self.targets)):
+            self.set_schedule(len(self.active_targets)) # The requested interval of each target, over the pinged ones
+
+    def open_socket(self):
+        if self.protocol == "icmp":
+            self.socket, self.socket_kind = open_icmp_socket()
+        else:
+            self.socket, self.socket_kind = socket.socket(socket.AF_INET, socket.SOCK_DGRAM), "udp"
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError:
+            pass # User space timestamps
+        if self.socket_kind != "raw": # The raw socket gets the TTL from the IP header
+            try:
+                self.socket.setsockopt(socket.IPPROTO_IP, IP_RECVTTL, 1)
+            except OSError:
+                pass
+        self.socket.setblocking(False)
+
+    def request(self, seq) -> bytes:
+        if self.protocol == "udp":
+            header = UDP_ECHO_HEADER.pack(self.token, seq, time.monotonic_ns())
+            return header + bytes(self.packets_size - len(header))
+        payload = struct.pack("!I", self.token) + bytes(max(self.packets_size - 4, 0))
+        payload = payload[:self.packets_size]
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self.identifier, seq)
+        checksum = icmp_checksum(header + payload)
+        return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, self.identifier, seq) + payload
+
+    def send_next(self):
+        """
+        Sends the next request of the interleaved schedule: target requests_sent % targets, seq requests_sent // targets + 1.
+        """
+        target = self.active_targets[self.requests_sent % len(self.active_targets)]
+        index = target.packets_sent
+        target.sent_ns[index] = time.monotonic_ns()
+        target.clock_offset_ns[index] = time.time_ns() - target.sent_ns[index]
+        try:
+            self.socket.sendto(self.request(index + 1), (target.ip, self.udp_port if (self.protocol == "udp") else 0))
+        except OSError as e:
+            print(f"EchoEngine: request |{index + 1}| to |{target.destination}| not sent -> {e}")
+        target.packets_sent += 1
+        target.pending += 1
+        self.requests_sent += 1
+
+    def parse_reply(self, data : bytes, ttl) -> tuple:
+        """
+        Returns (seq, ttl, bytes) of an echo reply of this run, None for any other packet.
+        """
+        if self.protocol == "udp":
+            if len(data) < UDP_ECHO_HEADER.size:
+                return None
+            token, seq, _ = UDP_ECHO_HEADER.unpack_from(data)
+            return (seq, ttl, len(data)) if (token == self.token) else None
+        if self.socket_kind == "raw":
+            header_length = (data[0] & 0x0F) * 4
+            ttl = data[8]
+            data = data[header_length:]
+        if len(data) < 8:
+            return None
+        icmp_type, _, _, identifier, seq = struct.unpack_from("!BBHHH", data)
+        if icmp_type != ICMP_ECHO_REPLY:
+            return None
+        if (self.socket_kind == "raw") and (identifier != self.identifier):
+            return None # Reply to another process
+        return seq, ttl, len(data)
+
+    def receive(self):
+        """
+        Drains the socket, recording the replies with their kernel receive timestamp (on the monotonic clock).
+        """
+        while True:
+            try:
+                data, ancillary_data, _, address = self.socket.recvmsg(RECEIVE_BUFFER_BYTES, CMSG_SPACE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError: # ICMP port unreachable of a UDP request: the request is lost
+                continue
+            target = self.target_by_ip.get(address[0]) if address else None
+            if target is None:
+                continue
+            received_ns = time.monotonic_ns()
+            clock_offset_ns = time.time_ns() - received_ns
+            kernel_received_ns, ttl = None, None
+            for level, cmsg_type, cmsg_data in ancillary_data:
+                if (level == socket.SOL_SOCKET) and (cmsg_type == SO_TIMESTAMPNS) and (len(cmsg_data) >= TIMESPEC.size):
+                    seconds, nanoseconds = TIMESPEC.unpack_from(cmsg_data)
+                    kernel_received_ns = seconds * 10**9 + nanoseconds
+                elif (level == socket.IPPROTO_IP) and (cmsg_type == socket.IP_TTL) and (len(cmsg_data) >= 4):
+                    ttl = struct.unpack("@i", cmsg_data[:4])[0]
+            reply = self.parse_reply(data, ttl)
+            if reply is None:
+                continue
+            seq, ttl, reply_bytes = reply
+            if kernel_received_ns is not None:
+                if target.clock_stepped(seq, clock_offset_ns):
+                    self.clock_steps += 1
+                else:
+                    received_ns = kernel_received_ns - clock_offset_ns
+                    self.kernel_timestamps += 1
+            target.record_reply(seq, received_ns, ttl, reply_bytes)
+
+    def all_replied(self) -> bool:
+        return (self.requests_sent == self.packets_number * len(self.active_targets)) and all(target.pending == 0 for target in self.active_targets)
+
+    def run(self):
+        """
+        Sends the requests on schedule and collects the replies. Raises OSError if the socket can't be opened.
+        """
+        cpu_at_start = thread_cpu_times()
+        self.resolve_targets()
+        self.open_socket()
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        self.started_at = time.time()
+        start = time.monotonic()
+        total_requests = self.packets_number * len(self.active_targets)
+        deadline = None
+        try:
+            while True:
+                if self.stop_event.is_set():
+                    self.stopped = True
+                    break
+                now = time.monotonic()
+                while (self.requests_sent < total_requests) and (now >= start + self.requests_sent * self.send_gap):
+                    self.send_next()
+                    now = time.monotonic()
+                if self.requests_sent == total_requests:
+                    if deadline is None:
+                        deadline = now + self.reply_timeout
+                    if self.all_replied() or (now >= deadline):
+                        break
+                    wake_at = deadline
+                else:
+                    wake_at = start + self.requests_sent * self.send_gap
+                if selector.select(min(max(wake_at - now, 0), STOP_POLL_SECONDS)):
+                    self.receive()
+        finally:
+            selector.close()
+            self.socket.close()
+            self.wall_seconds = time.monotonic() - start
+            if self.clock_steps > 0:
+                print(f"EchoEngine: wall clock stepped during the run, |{self.clock_steps}| replies timestamped in user space")
+            cpu_at_end = thread_cpu_times()
+            self.cpu_seconds = (cpu_at_end[0] - cpu_at_start[0], cpu_at_end[1] - cpu_at_start[1])
+
+    def results(self) -> list:
+        """
+        Returns the result of each destination, in the order of the destinations.
+        """
+        common = {
+            "protocol": self.protocol,
+            "packets_interval": self.packets_interval,
+            "timestamping": "kernel" if (self.kernel_timestamps > 0) else "user"
+        }
+        return [dict(target.result(), **common) for target in self.targets]
+
+    def result(self) -> dict:
+        """
+        Returns the result of the (first) destination.
+        """
+        return self.results()[0]
+
+    def usage(self) -> dict:
+        """
+        Returns the resource usage of the run, with the fields of SupervisedProcess.usage().
+        """
+        return {
+            "process": f"echo engine ({self.socket_kind})",
+            "returncode": 0,
+            "stopped": self.stopped,
+            "wall_seconds": round(self.wall_seconds, 3) if (self.wall_seconds is not None) else None,
+            "user_cpu_seconds": round(self.cpu_seconds[0], 3) if (self.cpu_seconds[0] is not None) else None,
+            "system_cpu_seconds": round(self.cpu_seconds[1], 3) if (self.cpu_seconds[1] is not None) else None,
+            "max_rss_kb": None,
+            "voluntary_context_switches": None,
+            "involuntary_context_switches": None
+        }
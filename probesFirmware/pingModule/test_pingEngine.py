@@ -0,0 +1,188 @@
+"""
+Unit tests of the echo engine, on the loopback interface (UDP echo server thread, ICMP if the host allows it).
+Run from probesFirmware: python -m unittest pingModule.test_pingEngine
+"""
+
+import time
+import socket
+import unittest
+import threading
+from unittest import mock
+from pingModule import pingEngine
+from pingModule.pingEngine import EchoEngine, EchoTarget, icmp_socket_kind, UDP_ECHO_HEADER, CLOCK_STEP_TOLERANCE_NS
+
+PACKETS_INTERVAL_SECONDS = 0.01
+REPLY_TIMEOUT_SECONDS = 0.5
+
+
+class UdpEchoServer:
+    """
+    RFC 862 echo service on 127.0.0.1, in a thread. drop(seq) tells the requests not to reply to, duplicate(seq) the
+    ones to reply twice to, on_request(seq) is called before replying.
+    """
+    def __init__(self, drop = None, duplicate = None, on_request = None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.drop = drop or (lambda seq: False)
+        self.duplicate = duplicate or (lambda seq: False)
+        self.on_request = on_request or (lambda seq: None)
+        self.closing = False
+        self.thread = threading.Thread(target = self.serve, daemon = True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            data, address = self.socket.recvfrom(65535)
+            if self.closing:
+                return
+            seq = UDP_ECHO_HEADER.unpack_from(data)[1] if (len(data) >= UDP_ECHO_HEADER.size) else 0
+            self.on_request(seq)
+            if self.drop(seq):
+                continue
+            for _ in range(2 if self.duplicate(seq) else 1):
+                self.socket.sendto(data, address)
+
+    def close(self):
+        self.closing = True
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as wake_up_socket: # Wakes up the blocked recvfrom
+            wake_up_socket.sendto(b"", ("127.0.0.1", self.port))
+        self.thread.join(timeout = 2)
+        self.socket.close()
+
+
+class TestEchoEngineUdp(unittest.TestCase):
+
+    def start_server(self, **kwargs):
+        server = UdpEchoServer(**kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def new_engine(self, destinations, server, packets_number = 5, packets_size = 32, stop_event = None):
+        return EchoEngine(destinations, packets_number, packets_size, stop_event or threading.Event(),
+                          packets_interval = PACKETS_INTERVAL_SECONDS, protocol = "udp", udp_port = server.port,
+                          reply_timeout = REPLY_TIMEOUT_SECONDS)
+
+    def test_all_replied(self):
+        engine = self.new_engine("127.0.0.1", self.start_server())
+        engine.run()
+        result = engine.result()
+        self.assertEqual(result["destination"], "127.0.0.1")
+        self.assertEqual(result["protocol"], "udp")
+        self.assertEqual(result["packet_transmit"], 5)
+        self.assertEqual(result["packet_receive"], 5)
+        self.assertEqual(result["packet_loss_count"], 0)
+        self.assertEqual(result["packet_loss_rate"], 0)
+        self.assertEqual([reply["icmp_seq"] for reply in result["icmp_replies"]], [1, 2, 3, 4, 5])
+        self.assertTrue(all(reply["bytes"] == 32 for reply in result["icmp_replies"]))
+        self.assertEqual(len(result["rtt_vector"]), 5)
+        self.assertTrue(0 <= result["rtt_min"] <= result["rtt_avg"] <= result["rtt_max"] < REPLY_TIMEOUT_SECONDS * 1000)
+        self.assertNotIn("error", result)
+        self.assertFalse(engine.stopped)
+
+    def test_lost_and_duplicated_replies(self):
+        server = self.start_server(drop = lambda seq: seq in (2, 4), duplicate = lambda seq: seq == 1)
+        engine = self.new_engine("127.0.0.1", server)
+        engine.run()
+        result = engine.result()
+        self.assertEqual(result["packet_receive"], 3)
+        self.assertEqual(result["packet_loss_count"], 2)
+        self.assertEqual(result["packet_loss_rate"], 40)
+        self.assertEqual(result["packet_duplicate_count"], 1)
+        self.assertIsNone(result["rtt_vector"][1])
+        self.assertIsNone(result["rtt_vector"][3])
+
+    def test_wall_clock_step(self):
+        # ntpdate steps the wall clock by an hour while the request 3 is in flight. The kernel timestamps can't be
+        # stepped by the test: the replies are timestamped in user space (see TestClockStepped for the kernel ones)
+        real_time_ns = time.time_ns
+        step_ns = []
+        server = self.start_server(on_request = lambda seq: step_ns.append(3600 * 10**9) if (seq == 3) else None)
+        engine = self.new_engine("127.0.0.1", server)
+        with mock.patch.object(pingEngine, "SO_TIMESTAMPNS", -1), \
+             mock.patch("time.time_ns", side_effect = lambda: real_time_ns() + sum(step_ns)):
+            engine.run()
+        result = engine.result()
+        self.assertEqual(result["timestamping"], "user")
+        self.assertEqual(result["packet_receive"], 5)
+        self.assertTrue(0 <= result["rtt_min"] <= result["rtt_max"] < REPLY_TIMEOUT_SECONDS * 1000)
+
+    def test_unresolved_destination_among_others(self):
+        engine = self.new_engine(["127.0.0.1", "a..b"], self.start_server(), packets_number = 3)
+        engine.run()
+        resolved, unresolved = engine.results()
+        self.assertEqual(resolved["packet_receive"], 3)
+        self.assertNotIn("error", resolved)
+        self.assertEqual(unresolved["destination"], "a..b")
+        self.assertEqual(unresolved["packet_transmit"], 0)
+        self.assertIn("Name resolution failed", unresolved["error"])
+
+    def test_only_destination_unresolved(self):
+        engine = self.new_engine("a..b", self.start_server())
+        with self.assertRaises(ValueError):
+            engine.run()
+
+    def test_duplicate_destinations(self):
+        engine = self.new_engine(["127.0.0.1", "127.0.0.1"], self.start_server())
+        with self.assertRaises(ValueError):
+            engine.run()
+
+    def test_stop_event(self):
+        stop_event = threading.Event()
+        stop_event.set()
+        engine = self.new_engine("127.0.0.1", self.start_server(), stop_event = stop_event)
+        engine.run()
+        self.assertTrue(engine.stopped)
+        self.assertEqual(engine.result()["packet_transmit"], 0)
+
+    def test_invalid_arguments(self):
+        stop_event = threading.Event()
+        with self.assertRaises(ValueError):
+            EchoEngine("127.0.0.1", 5, 32, stop_event, protocol = "udp") # No udp_port
+        with self.assertRaises(ValueError):
+            EchoEngine("127.0.0.1", 5, UDP_ECHO_HEADER.size - 1, stop_event, protocol = "udp", udp_port = 7)
+        with self.assertRaises(ValueError):
+            EchoEngine("127.0.0.1", 0, 32, stop_event)
+        with self.assertRaises(ValueError):
+            EchoEngine("127.0.0.1", 5, 32, stop_event, protocol = "tcp")
+        with self.assertRaises(ValueError):
+            EchoEngine([], 5, 32, stop_event)
+
+
+class TestClockStepped(unittest.TestCase):
+
+    def test_offset_moved_since_the_request(self):
+        target = EchoTarget("127.0.0.1", "127.0.0.1", 3)
+        target.packets_sent = 2
+        target.clock_offset_ns[0] = 10**18
+        target.clock_offset_ns[1] = 10**18
+        self.assertFalse(target.clock_stepped(1, 10**18 + CLOCK_STEP_TOLERANCE_NS // 2)) # NTP slewing
+        self.assertTrue(target.clock_stepped(2, 10**18 + 3600 * 10**9))
+        self.assertTrue(target.clock_stepped(2, 10**18 - 3600 * 10**9))
+        self.assertFalse(target.clock_stepped(3, 0)) # Never sent
+
+    def test_rtt_not_negative(self):
+        target = EchoTarget("127.0.0.1", "127.0.0.1", 1)
+        target.packets_sent, target.pending = 1, 1
+        target.sent_ns[0] = 2000
+        target.record_reply(1, 1000, None, 32)
+        self.assertEqual(target.result()["rtt_vector"], [0.0])
+
+
+@unittest.skipIf(icmp_socket_kind() is None, "No ICMP socket: neither net.ipv4.ping_group_range nor root")
+class TestEchoEngineIcmp(unittest.TestCase):
+
+    def test_loopback(self):
+        engine = EchoEngine("127.0.0.1", 3, 56, threading.Event(), packets_interval = PACKETS_INTERVAL_SECONDS,
+                            reply_timeout = REPLY_TIMEOUT_SECONDS)
+        engine.run()
+        result = engine.result()
+        self.assertEqual(result["protocol"], "icmp")
+        self.assertEqual(result["packet_transmit"], 3)
+        self.assertEqual(result["packet_receive"], 3)
+        self.assertEqual(result["packet_duplicate_count"], 0)
+        self.assertTrue(all(reply["ttl"] is not None for reply in result["icmp_replies"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,312 @@
+"""
+Supervisor of the measurement subprocesses of the probe (iperf3, ping, udpClient/udpServer, tcprewrite/tcpreplay, ntpdate).
+Each process is launched in its own process group and tracked by (owner, msm_id), the owner being the controller handler:
+a stop signals exactly the processes of that measurement (never another ping or iperf3 running on the host), escalates
+from SIGTERM to SIGKILL, and reaps them. The resource usage of each reaped process (wait4 rusage) is kept, to be
+reported with the result.
+"""
+
+import os
+import time
+import signal
+import threading
+import subprocess
+
+STOP_GRACE_SECONDS = 2.0    # Time given to a process to exit on SIGTERM, before the SIGKILL
+KILL_WAIT_SECONDS = 2.0     # Time given to the kernel to deliver the SIGKILL, before giving up the reap
+REAP_POLL_SECONDS = 0.05    # Poll period of a wait with timeout (wait4 has no timeout)
+REAPED_WAIT_SECONDS = 1.0   # Time given to the thread that reaped a process to set its returncode
+LOST_RETURNCODE = 255       # Returncode of a process reaped outside the supervisor, whose exit status is lost
+POSIX = (os.name == "posix")
+
+
+class SupervisedProcess:
+    """
+    A process launched by the ProcessSupervisor. stdout and stderr hold the output collected by ProcessSupervisor.run.
+    On POSIX the process is reaped here with wait4, never by Popen, so that the resource usage of the process (and of
+    the descendants it reaped, e.g. the command run by sudo) is available once it has exited.
+    """
+    def __init__(self, owner, msm_id, command, popen : subprocess.Popen):
+        self.owner = owner
+        self.msm_id = msm_id
+        self.name = os.path.basename(command[1] if (command[0] == "sudo") and (len(command) > 1) else command[0])
+        self.popen = popen
+        self.started_at = time.monotonic()
+        self.ended_at = None
+        self.stop_requested = False # Set by ProcessSupervisor.stop: the exit is not a failure
+        self.stdout = None
+        self.stderr = None
+        self.rusage = None
+        self.reaped = threading.Event()
+
+    @property
+    def pid(self):
+        return self.popen.pid
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+    def reap(self, options) -> bool:
+        """
+        Reaps the process with wait4 (os.WNOHANG in options: without blocking). Returns True once it's reaped, by this
+        call or by another thread.
+        """
+        if self.popen.returncode is not None:
+            return True
+        try:
+            reaped_pid, status, rusage = os.wait4(self.pid, options)
+        except ChildProcessError: # Reaped by another thread, which is setting the returncode
+            if self.reaped.wait(timeout = REAPED_WAIT_SECONDS):
+                return True
+            # Nobody is setting it: reaped outside the supervisor (e.g. a waitpid(-1), or SIGCHLD ignored)
+            if self.popen.poll() is None:
+                self.popen.returncode = LOST_RETURNCODE
+            print(f"SupervisedProcess: |{self.name}| ({self.pid}) reaped outside the supervisor, returncode -> {self.returncode}")
+            if self.ended_at is None:
+                self.ended_at = time.monotonic()
+            self.reaped.set()
+            return True
+        if reaped_pid != self.pid:
+            return False
+        self.rusage = rusage
+        self.popen.returncode = os.waitstatus_to_exitcode(status) # Popen doesn't wait a process with a returncode
+        if self.ended_at is None:
+            self.ended_at = time.monotonic()
+        self.reaped.set()
+        return True
+
+    def is_running(self) -> bool:
+        if not POSIX:
+            return self.popen.poll() is None
+        return not self.reap(os.WNOHANG)
+
+    def wait(self, timeout = None) -> int:
+        if not POSIX:
+            returncode = self.popen.wait(timeout = timeout)
+        elif timeout is None:
+            self.reap(0)
+            returncode = self.returncode
+        else:
+            deadline = time.monotonic() + timeout
+            while not self.reap(os.WNOHANG):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.popen.args, timeout)
+                time.sleep(min(remaining, REAP_POLL_SECONDS))
+            returncode = self.returncode
+        if self.ended_at is None:
+            self.ended_at = time.monotonic()
+        return returncode
+
+    def communicate(self, timeout = None):
+        """
+        As Popen.communicate, but the process is reaped by wait: the pipes are drained by reader threads meanwhile.
+        """
+        if not POSIX:
+            self.stdout, self.stderr = self.popen.communicate(timeout = timeout)
+            if self.ended_at is None:
+                self.ended_at = time.monotonic()
+            return self.stdout, self.stderr
+        output = {}
+        readers = []
+        for name in ("stdout", "stderr"):
+            stream = getattr(self.popen, name)
+            if stream is not None:
+                reader = threading.Thread(target = lambda name = name, stream = stream: output.update({name: stream.read()}), daemon = True)
+                reader.start()
+                readers.append(reader)
+        self.wait(timeout = timeout) # On timeout the readers end when the caller stops the process
+        for reader in readers:
+            reader.join()
+        for name in ("stdout", "stderr"):
+            stream = getattr(self.popen, name)
+            if stream is not None:
+                stream.close()
+        self.stdout, self.stderr = output.get("stdout"), output.get("stderr")
+        return self.stdout, self.stderr
+
+    def usage(self) -> dict:
+        """
+        Returns the resource usage of the process, to be published with the result. The rusage fields are None until
+        the process is reaped (or on the platforms without wait4).
+        """
+        rusage = self.rusage
+        wall_seconds = ((self.ended_at if (self.ended_at is not None) else time.monotonic()) - self.started_at)
+        return {
+            "process": self.name,
+            "returncode": self.returncode,
+            "stopped": self.stop_requested,
+            "wall_seconds": round(wall_seconds, 3),
+            "user_cpu_seconds": round(rusage.ru_utime, 3) if rusage else None,
+            "system_cpu_seconds": round(rusage.ru_stime, 3) if rusage else None,
+            "max_rss_kb": rusage.ru_maxrss if rusage else None,
+            "voluntary_context_switches": rusage.ru_nvcsw if rusage else None,
+            "involuntary_context_switches": rusage.ru_nivcsw if rusage else None
+        }
+
+
+def process_group_members(pgid) -> list:
+    """
+    Returns the pids of the processes of the group pgid, the leader first. Read from /proc: empty where it's not available.
+    """
+    members = []
+    try:
+        pids = [int(entry) for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        return members
+    for pid in pids:
+        try:
+            if os.getpgid(pid) == pgid:
+                members.append(pid)
+        except OSError: # Exited meanwhile
+            continue
+    return sorted(members, key = lambda pid: pid != pgid)
+
+
+def merge_usages(usages : list) -> dict:
+    """
+    Returns the usage of a series of runs of the same tool (e.g. the probes of a capacity search): the times and the
+    context switches are summed, max_rss_kb is the peak, returncode and stopped are the ones of the last run.
+    """
+    if not usages:
+        return None
+    merged = dict(usages[-1])
+    for field in ("wall_seconds", "user_cpu_seconds", "system_cpu_seconds", "voluntary_context_switches", "involuntary_context_switches"):
+        values = [usage[field] for usage in usages if usage.get(field) is not None]
+        merged[field] = round(sum(values), 3) if values else None
+    rss_values = [usage["max_rss_kb"] for usage in usages if usage.get("max_rss_kb") is not None]
+    merged["max_rss_kb"] = max(rss_values) if rss_values else None
+    merged["runs"] = len(usages)
+    return merged
+
+
+class ProcessSupervisor:
+    """
+    Process-wide registry of the measurement subprocesses. Use ProcessSupervisor.get_instance() to obtain it.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {} # Maps (owner, msm_id) to the list of its SupervisedProcess, until they are reaped
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = ProcessSupervisor()
+            return cls._instance
+
+    def launch(self, owner, msm_id, command, stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True) -> SupervisedProcess:
+        """
+        Launches command in a new process group, tracked under (owner, msm_id).
+        Args:
+            owner (str): The controller handler launching the process (e.g. "iperf").
+            msm_id (str): The measurement the process belongs to (None for the commands outside a measurement).
+            command (list): The command line.
+        Returns:
+            SupervisedProcess: The launched process. The caller waits for it (wait/communicate), which reaps it.
+        """
+        popen = subprocess.Popen(command, stdout = stdout, stderr = stderr, text = text, start_new_session = POSIX)
+        process = SupervisedProcess(owner, msm_id, command, popen)
+        with self.lock:
+            self.processes.setdefault((owner, msm_id), []).append(process)
+        return process
+
+    def run(self, owner, msm_id, command, timeout = None, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+            text = True) -> SupervisedProcess:
+        """
+        Launches command and waits for its exit, collecting its output (as subprocess.run does).
+        On timeout the process is stopped, and subprocess.TimeoutExpired is raised.
+        """
+        process = self.launch(owner, msm_id, command, stdout = stdout, stderr = stderr, text = text)
+        try:
+            process.communicate(timeout = timeout)
+        except subprocess.TimeoutExpired:
+            self.stop_process(process)
+            raise
+        finally:
+            self.forget(process)
+        return process
+
+    def forget(self, process : SupervisedProcess):
+        with self.lock:
+            processes = self.processes.get((process.owner, process.msm_id), [])
+            if process in processes:
+                processes.remove(process)
+            if not processes:
+                self.processes.pop((process.owner, process.msm_id), None)
+
+    def processes_of(self, owner, msm_id = None) -> list:
+        """
+        Returns the running processes of owner, only the ones of msm_id if provided.
+        """
+        with self.lock:
+            tracked = [process for (process_owner, process_msm_id), processes in self.processes.items()
+                       for process in processes
+                       if (process_owner == owner) and ((msm_id is None) or (process_msm_id == msm_id))]
+        running = []
+        for process in tracked:
+            if process.is_running():
+                running.append(process)
+            else:
+                self.forget(process)
+        return running
+
+    def signal_process(self, process : SupervisedProcess, signal_number):
+        try:
+            if POSIX:
+                os.killpg(process.pid, signal_number) # The process group id is the pid of its leader
+            elif signal_number == signal.SIGTERM:
+                process.popen.terminate()
+            else:
+                process.popen.kill()
+        except ProcessLookupError:
+            pass # Already exited
+        except PermissionError: # e.g. a group with root-only members: each member is signalled on its own
+            members = process_group_members(process.pid) or [process.pid]
+            refused = []
+            for pid in members:
+                try:
+                    os.kill(pid, signal_number)
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    refused.append(pid)
+            print(f"ProcessSupervisor: |{process.name}| ({process.pid}) group can't be signalled, "
+                  f"{signal.Signals(signal_number).name} sent to its processes one by one. Refused by -> {refused}")
+
+    def stop_process(self, process : SupervisedProcess, grace_seconds = STOP_GRACE_SECONDS) -> bool:
+        """
+        Signals the process group with SIGTERM, then SIGKILL after grace_seconds, and reaps the process.
+        Returns False if it is still alive after the SIGKILL.
+        """
+        process.stop_requested = True
+        self.signal_process(process, signal.SIGTERM)
+        try:
+            process.wait(timeout = grace_seconds)
+            return True
+        except subprocess.TimeoutExpired:
+            print(f"ProcessSupervisor: |{process.name}| ({process.pid}) ignored SIGTERM, sending SIGKILL")
+        self.signal_process(process, signal.SIGKILL)
+        try:
+            process.wait(timeout = KILL_WAIT_SECONDS)
+            return True
+        except subprocess.TimeoutExpired:
+            print(f"ProcessSupervisor: |{process.name}| ({process.pid}) still alive after SIGKILL")
+            return False
+
+    def stop(self, owner, msm_id = None, grace_seconds = STOP_GRACE_SECONDS) -> list:
+        """
+        Stops the running processes of owner (only the ones of msm_id if provided).
+        Returns:
+            list: The stopped SupervisedProcess, with their usage. Empty if none was running.
+        """
+        stopped = []
+        for process in self.processes_of(owner, msm_id):
+            self.stop_process(process, grace_seconds)
+            self.forget(process)
+            stopped.append(process)
+        return stopped
@@ -1,14 +1,93 @@
 import threading
 import socket
+import time
+import psutil
 import netifaces
 import scapy.all as scapy
 
 BUSY = "BUSY"
 READY = "READY"
 
+# Resources that the controllers lock while a measurement runs. A resource can be held by many owners in SHARED mode,
+# or by one owner in EXCLUSIVE mode. WHOLE_PROBE conflicts with every other resource (legacy BUSY flag).
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+NIC_BANDWIDTH = "nic_bandwidth"
+INA219_SENSOR = "ina219_sensor"
+NTPSEC_SERVICE = "ntpsec_service"
+WHOLE_PROBE = "whole_probe"
+LEGACY_OWNER = "probe"
+
+def udp_port(port) -> str:
+    return f"udp_port/{port}"
+
+def tcp_port(port) -> str:
+    return f"tcp_port/{port}"
+
+def session_owner(controller, msm_id) -> tuple:
+    # The owner of the resources of one measurement: a controller can run several sessions at once, if their resources don't conflict
+    return (controller, msm_id)
+
+# Scheduled start: the coordinator can put in a start command the absolute UNIX time (of the synced clock) at which
+# the measurement must begin. The probe arms the measurement at once (ACK), then fires it at that time.
+START_AT_KEY = "start_at"
+SPIN_WAIT_SECONDS = 0.002 # The last part of the wait is a busy loop: a sleep can overshoot by some milliseconds
+
+def wait_until(start_at, stop_event : threading.Event = None) -> bool:
+    """
+    Blocks until the UNIX time start_at, or returns at once if start_at is None or already past.
+    Returns False if stop_event has been set while waiting (the armed measurement has been stopped), True otherwise.
+    """
+    if start_at is None:
+        return True
+    late = time.time() - start_at
+    if late > 0:
+        print(f"wait_until: scheduled start missed by {late:.3f}s, starting now")
+        return (stop_event is None) or (not stop_event.is_set())
+    while True: # The remaining time is computed again at each step: the clock may be stepped (e.g. by ntpdate)
+        remaining = start_at - time.time()
+        if remaining <= SPIN_WAIT_SECONDS:
+            break
+        if stop_event is None:
+            time.sleep(remaining - SPIN_WAIT_SECONDS)
+        elif stop_event.wait(remaining - SPIN_WAIT_SECONDS):
+            return False
+    while time.time() < start_at:
+        pass
+    return (stop_event is None) or (not stop_event.is_set())
+
+PORT_BIND_POLL_SECONDS = 0.05
+
+def is_port_bound(protocol, port) -> bool:
+    """
+    Returns True if a socket of this host listens on the TCP port (protocol "tcp"), or is bound to the UDP port ("udp").
+    """
+    port = int(port)
+    connections = psutil.net_connections(kind = protocol)
+    if protocol == "tcp":
+        return any(connection.laddr and (connection.laddr.port == port) and (connection.status == psutil.CONN_LISTEN)
+                   for connection in connections)
+    return any(connection.laddr and (connection.laddr.port == port) for connection in connections)
+
+def wait_port_bound(protocol, port, timeout, still_starting = None) -> bool:
+    """
+    Waits at most timeout seconds for a server to bind the port (see is_port_bound). Returns False at the timeout, or
+    as soon as still_starting (e.g. the is_alive of the server thread) returns False.
+    """
+    deadline = time.monotonic() + timeout
+    while not is_port_bound(protocol, port):
+        if (time.monotonic() > deadline) or ((still_starting is not None) and (not still_starting())):
+            return False
+        time.sleep(PORT_BIND_POLL_SECONDS)
+    return True
+
 # MY_PC_IFACE = "Wi-Fi" # This is for test on my PC
 # WLAN_IFACE = 'wlan0'
 ETHERNET_IFACE = 'eth0'
+GATEWAY_ARP_TIMEOUT_SECONDS = 2
+GATEWAY_RETRY_SECONDS = 60  # A failed ARP resolution of the gateway is retried after this time
+IFF_POINTOPOINT = 0x10      # Interface flags of /sys/class/net/<iface>/flags
+IFF_NOARP = 0x80
 HAT_IFACE = 'rmnet_mhi0.1'
 
 class SharedState:
@@ -24,6 +103,11 @@ class SharedState:
             cls._instance.probe_ip = None
             cls._instance.probe_mac = None
             cls._instance.probe_ip_for_clock_sync = None
+            cls._instance.gateway_identity = None
+            cls._instance.gateway_resolving = False
+            cls._instance.gateway_failed_at = None
+            cls._instance.resource_holders = {}  # Maps resource to {owner: mode}
+            cls._instance.owned_resources = {}   # Maps owner (a session_owner, or a probe service key) to {resource: mode}
         return cls._instance
     
     def __init__(self):
@@ -51,23 +135,6 @@ class SharedState:
         with self.lock:
             if self.probe_mac is None:
                 try:
-                    """
-                    gateways = netifaces.gateways()
-                    gateway_ip = gateways['default'][netifaces.AF_INET][0]
-                    print(f"GATEWAY IP -> {gateway_ip}") # DBG FOR FINDING GATWAY MAC
-
-                    default_iface = gateways['default'][netifaces.AF_INET][1]
-                    self.default_nic_name = default_iface
-                    my_mac = netifaces.ifaddresses(default_iface)[netifaces.AF_LINK][0]['addr']
-
-                    arp_res = scapy.arping(gateway_ip, verbose=False)[0]
-                    gateway_mac = arp_res[0][1].hwsrc if arp_res else None # Per adesso lascio stare. Comunque le probe devono informare il coordinator del MAC del loro gateway. Leggi tesi se ti dimentichi perchè!
-
-                    print(f"GATEWAY MAC -> {gateway_mac}")
-
-                    print(f"SharedState: default nic -> |{default_iface}| , my_mac -> |{my_mac}| ")
-                    self.probe_mac = my_mac
-                    """
                     gateways = netifaces.gateways()
                     default_iface = gateways['default'][netifaces.AF_INET][1]
                     self.default_nic_name = default_iface
@@ -79,6 +146,63 @@ class SharedState:
                     self.probe_mac = "ff:ff:ff:ff:ff:ff"
             return self.probe_mac
 
+    @staticmethod
+    def is_point_to_point(iface) -> bool:
+        # Point-to-point or ARP-less interfaces (e.g. the cellular HAT) have no gateway MAC to resolve
+        try:
+            with open(f"/sys/class/net/{iface}/flags") as flags_file:
+                return bool(int(flags_file.read().strip(), 16) & (IFF_POINTOPOINT | IFF_NOARP))
+        except (OSError, ValueError):
+            return False
+
+    def get_gateway_identity(self, on_resolved = None) -> dict:
+        """
+        Returns {"ip", "mac", "nic", "point_to_point"} of the default gateway, announced to the coordinator to group the
+        probes that share their first hop (and so interfere when measured concurrently). It never blocks: the MAC is
+        resolved via ARP in a background thread, and is None until then (and on the point-to-point interfaces, where
+        the coordinator groups by the gateway IP). A failed resolution is not kept: it is retried after
+        GATEWAY_RETRY_SECONDS. on_resolved is invoked, from the background thread, once the MAC is resolved.
+        """
+        gateway_ip, default_iface = None, None
+        try:
+            gateways = netifaces.gateways()
+            gateway_ip, default_iface = gateways['default'][netifaces.AF_INET][0], gateways['default'][netifaces.AF_INET][1]
+        except Exception as e:
+            print(f"SharedState: exception in retrieve the gateway -> {e}")
+        point_to_point = (default_iface is not None) and self.is_point_to_point(default_iface)
+        with self.lock:
+            cached = self.gateway_identity
+            if (cached is not None) and (cached["ip"] == gateway_ip) and (cached["nic"] == default_iface):
+                return dict(cached)
+            identity = {"ip": gateway_ip, "mac": None, "nic": default_iface, "point_to_point": point_to_point}
+            if (gateway_ip is None) or point_to_point:
+                self.gateway_identity = identity if (gateway_ip is not None) else None
+                return identity
+            retry_due = (self.gateway_failed_at is None) or ((time.monotonic() - self.gateway_failed_at) > GATEWAY_RETRY_SECONDS)
+            if self.gateway_resolving or (not retry_due):
+                return identity
+            self.gateway_resolving = True
+        threading.Thread(target = self.resolve_gateway_mac, args = (identity, on_resolved), daemon = True).start()
+        return identity
+
+    def resolve_gateway_mac(self, identity : dict, on_resolved = None):
+        gateway_mac = None
+        try:
+            arp_res = scapy.arping(identity["ip"], iface = identity["nic"], timeout = GATEWAY_ARP_TIMEOUT_SECONDS, verbose = False)[0]
+            gateway_mac = arp_res[0][1].hwsrc if arp_res else None
+        except Exception as e:
+            print(f"SharedState: exception in resolve the gateway mac -> {e}")
+        print(f"SharedState: gateway ip -> |{identity['ip']}| , gateway mac -> |{gateway_mac}|")
+        with self.lock:
+            self.gateway_resolving = False
+            if gateway_mac is None:
+                self.gateway_failed_at = time.monotonic()
+                return
+            self.gateway_failed_at = None
+            self.gateway_identity = dict(identity, mac = gateway_mac)
+        if on_resolved is not None:
+            on_resolved()
+
     def get_probe_ip_for_clock_sync(self):
         with self.lock:
             if (self.probe_ip_for_clock_sync is None) or (self.probe_ip_for_clock_sync == "0.0.0.0"):
@@ -107,24 +231,82 @@ class SharedState:
             raise Exception(f"No network interfaces found! List -> {available_interfaces}")
         """
 
-    def set_probe_as_ready(self) -> bool:
-        with self.lock:
-            self.probe_state = READY
-            print(f"SharedState: state setted to |{READY}|")
-            return True
+    def find_resource_conflicts(self, resources : dict) -> list:
+        # Must be invoked holding the lock
+        conflicts = []
+        whole_probe_holders = self.resource_holders.get(WHOLE_PROBE)
+        if whole_probe_holders:
+            return [WHOLE_PROBE]
+        if (WHOLE_PROBE in resources) and any(self.resource_holders.values()):
+            return [resource for resource, holders in self.resource_holders.items() if holders]
+        for resource, mode in resources.items():
+            holders = self.resource_holders.get(resource)
+            if holders and ((mode == EXCLUSIVE) or (EXCLUSIVE in holders.values())):
+                conflicts.append(resource)
+        return conflicts
 
-    def set_probe_as_busy(self) -> bool:
+    def acquire_resources(self, owner, resources : dict) -> bool:
+        """
+        Locks all the resources ({resource: SHARED or EXCLUSIVE}) for owner, or none of them.
+        Returns False if owner already holds resources (the same session twice), or if any resource conflicts, also
+        with the other sessions of the same controller.
+        """
         with self.lock:
-            if self.probe_state == BUSY:
-                print(f"SharedState: the probe is already busy")
+            if self.owned_resources.get(owner):
+                print(f"SharedState: |{owner}| already holds {list(self.owned_resources[owner])}")
                 return False
+            conflicts = self.find_resource_conflicts(resources)
+            if conflicts:
+                print(f"SharedState: |{owner}| can't acquire {conflicts}, held by {[list(self.resource_holders[c]) for c in conflicts]}")
+                return False
+            for resource, mode in resources.items():
+                self.resource_holders.setdefault(resource, {})[owner] = mode
+            self.owned_resources[owner] = dict(resources)
             self.probe_state = BUSY
-            print(f"SharedState: state setted to |{BUSY}|")
+            print(f"SharedState: |{owner}| acquired {list(resources)}")
+            return True
+
+    def release_resources(self, owner) -> bool:
+        """
+        Releases all the resources held by owner. Releasing an owner without resources is a no-op.
+        """
+        with self.lock:
+            for resource in self.owned_resources.pop(owner, {}):
+                holders = self.resource_holders.get(resource, {})
+                holders.pop(owner, None)
+                if not holders:
+                    self.resource_holders.pop(resource, None)
+            if not self.owned_resources:
+                self.probe_state = READY
+            print(f"SharedState: |{owner}| released its resources")
             return True
+
+    def owns_resources(self, owner) -> bool:
+        with self.lock:
+            return bool(self.owned_resources.get(owner))
+
+    def sessions_of(self, controller) -> list:
+        """
+        Returns the msm_id of the sessions of controller that hold resources.
+        """
+        with self.lock:
+            return [owner[1] for owner, resources in self.owned_resources.items()
+                    if isinstance(owner, tuple) and (owner[0] == controller) and resources]
+
+    def get_held_resources(self) -> dict:
+        with self.lock:
+            return {owner: dict(resources) for owner, resources in self.owned_resources.items()}
+
+    def set_probe_as_ready(self) -> bool:
+        # Legacy whole-probe flag: the controllers lock their own resources with acquire_resources
+        return self.release_resources(LEGACY_OWNER)
+
+    def set_probe_as_busy(self) -> bool:
+        return self.acquire_resources(LEGACY_OWNER, {WHOLE_PROBE: EXCLUSIVE})
         
     def probe_is_ready(self) -> bool:
         with self.lock:
-            return (self.probe_state == READY)
+            return not self.owned_resources
         
     
     def set_coordinator_ip(self, coordinator_ip):
@@ -0,0 +1,764 @@
+"""
+Fake measurement controllers of the virtual probes.
+Each fake speaks the same MQTT protocol of the real controller it replaces (same commands, same ACK/NACK payloads,
+same result fields), but instead of running ping, iperf3, udpping or the INA219 sampling, it schedules its replies
+and builds results of realistic size and timing from the FleetProfile of the fleet.
+"""
+
+import math
+import time
+import base64
+import threading
+import cbor2
+from simulatorModule.fleetResources import REPLY_NACK, REPLY_SILENT
+
+PING_INTERVAL_SECONDS = 1.0         # Default interval of the ping command
+IPERF_DEFAULT_DURATION = 10         # Default duration (s) of an iperf3 client run
+IPERF_REPETITION_PAUSE = 1.0        # The real client sleeps 0.5s before and after each repetition
+NTP_TOGGLE_SECONDS = 1.0            # Time to stop/start the ntpsec service
+NTPDATE_SECONDS = 0.3               # Time of the ntpdate clock sync before an AoI/UDP-PING start
+ENERGY_SAMPLE_RATE_HZ = 29          # INA219 sampling rate at 12 bit
+ENERGY_BUS_VOLTAGE = 5.1
+COEX_DEFAULT_TRACE_DURATION = 10    # Duration (s) of a coex trace replay, when it can't be derived from the parameters
+
+
+class FakeController:
+    """
+    Base class of the fake controllers: fault injection, delayed ACK/NACK and result publishing.
+    """
+    handler = None
+
+    def __init__(self, virtual_probe, registration_handler_request_function):
+        self.virtual_probe = virtual_probe
+        self.mqtt_client = virtual_probe.mqtt_client
+        self.state = virtual_probe.state
+        self.profile = virtual_probe.profile
+        self.scheduler = virtual_probe.scheduler
+        self.stats = virtual_probe.stats
+        self.lock = threading.Lock()
+        self.last_msm_id = None
+        self.pending_action = None
+
+        registration_response = registration_handler_request_function(
+            interested_command = self.handler,
+            handler = self.command_handler)
+        if registration_response != "OK":
+            print(f"{type(self).__name__}: registration handler failed. Reason -> {registration_response}")
+
+    def command_handler(self, command : str, payload : dict):
+        self.stats.inc(self.handler, "command")
+        msm_id = payload.get("msm_id") if isinstance(payload, dict) else None
+        reply = self.profile.draw_reply()
+        if reply == REPLY_SILENT: # The command is lost: the coordinator will hit its ACK timeout
+            self.stats.inc(self.handler, "silent")
+            return
+        if reply == REPLY_NACK:
+            self.send_NACK(failed_command = command, error_info = "Injected failure", msm_id = msm_id)
+            return
+        self.handle_command(command, payload, msm_id)
+
+    def handle_command(self, command : str, payload : dict, msm_id):
+        """
+        Replies to a command that passed the fault injection. Overridden by each fake: the base one NACKs, as the real
+        controllers do for an unknown command.
+        """
+        self.send_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+    def send_ACK(self, successed_command, msm_id, extra_fields = None, extra_delay = 0.0) -> float:
+        """
+        Schedules an ACK after the simulated processing time. Returns the delay, so that a following result can be
+        scheduled after the ACK.
+        """
+        json_ack = {
+            "command": successed_command,
+            "msm_id": msm_id
+        }
+        json_ack.update(extra_fields or {})
+        delay = self.profile.draw_ack_delay() + extra_delay
+        self.scheduler.schedule(delay, self.publish_reply, True, json_ack)
+        return delay
+
+    def send_NACK(self, failed_command, error_info, msm_id = None, extra_fields = None):
+        json_nack = {
+            "command": failed_command,
+            "reason": error_info,
+            "msm_id": msm_id
+        }
+        json_nack.update(extra_fields or {})
+        self.scheduler.schedule(self.profile.draw_ack_delay(), self.publish_reply, False, json_nack)
+
+    def publish_reply(self, is_ack, payload):
+        if is_ack:
+            self.mqtt_client.publish_command_ACK(handler = self.handler, payload = payload)
+            self.stats.inc(self.handler, "ack")
+        else:
+            self.mqtt_client.publish_command_NACK(handler = self.handler, payload = payload)
+            self.stats.inc(self.handler, "nack")
+
+    def publish_result(self, result_payload : dict):
+        if self.profile.draw_result_lost():
+            self.stats.inc(self.handler, "result_lost")
+            return
+        json_result = {
+            "handler": self.handler,
+            "type": "result",
+            "payload": result_payload
+        }
+        self.mqtt_client.publish_on_result_topic(result = json_result)
+        self.stats.inc(self.handler, "result")
+
+    @staticmethod
+    def start_delay(payload : dict) -> float:
+        """
+        Seconds until the start_at of a start command: as the real controllers, the fakes fire at that time.
+        """
+        start_at = payload.get("start_at") if isinstance(payload, dict) else None
+        return max(0.0, start_at - time.time()) if (start_at is not None) else 0.0
+
+    def schedule_pending(self, delay, action, *args):
+        with self.lock:
+            self.pending_action = self.scheduler.schedule(delay, action, *args)
+
+    def take_pending(self):
+        """
+        Detaches the pending action. Returns it, or None if it has already run or has been cancelled.
+        """
+        with self.lock:
+            pending_action = self.pending_action
+            self.pending_action = None
+        return pending_action
+
+    def cancel_pending(self) -> bool:
+        pending_action = self.take_pending()
+        if pending_action is None:
+            return False
+        pending_action.cancel()
+        return True
+
+    @staticmethod
+    def compress(data) -> str:
+        return base64.b64encode(cbor2.dumps(data)).decode("utf-8")
+
+
+class FakePingController(FakeController):
+    handler = "ping"
+
+    def handle_command(self, command, payload, msm_id):
+        if msm_id is None:
+            self.send_NACK(failed_command = command, error_info = "No measurement_id provided")
+            return
+        match command:
+            case "start":
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                self.last_msm_id = msm_id
+                self.send_ACK(successed_command = "start", msm_id = msm_id)
+                packets_number = int(payload.get("packets_number", 4))
+                self.schedule_pending(self.profile.scaled(packets_number * PING_INTERVAL_SECONDS), self.complete_ping, payload, time.time())
+            case "stop":
+                if (self.last_msm_id is not None) and (msm_id != self.last_msm_id):
+                    self.send_NACK(failed_command = command,
+                                   error_info = "Measure_ID Mismatch: The provided measure_id does not correspond to the ongoing measurement",
+                                   msm_id = msm_id)
+                    return
+                if not self.cancel_pending():
+                    self.send_NACK(failed_command = command, error_info = "Process ping not in Execution", msm_id = msm_id)
+                    return
+                self.state.set_probe_as_ready()
+                self.send_ACK(successed_command = "stop", msm_id = msm_id)
+                self.last_msm_id = None
+            case _:
+                self.send_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+    def complete_ping(self, payload, timestamp):
+        if self.take_pending() is None:
+            return
+        self.last_msm_id = None
+        self.state.set_probe_as_ready()
+        if "destinations" in payload: # Multi-target: one result per destination, in one message
+            results = [self.build_ping_result(dict(payload, destination_ip = destination), timestamp) for destination in payload["destinations"]]
+            for result in results:
+                for key in ("source", "timestamp", "msm_id"):
+                    result.pop(key)
+            self.publish_result({"source": self.virtual_probe.probe_ip, "timestamp": timestamp, "msm_id": payload["msm_id"],
+                                 "results": results})
+            return
+        self.publish_result(self.build_ping_result(payload, timestamp))
+
+    def build_ping_result(self, payload, timestamp) -> dict:
+        packets_number = int(payload.get("packets_number", 4))
+        packets_size = int(payload.get("packets_size", 32))
+        icmp_replies = []
+        rtt_vector = [] # As the echo engine: one RTT per request, None for the lost ones
+        for icmp_seq in range(1, packets_number + 1):
+            if self.profile.draw_packet_lost():
+                rtt_vector.append(None)
+                continue
+            icmp_replies.append({
+                "bytes": packets_size + 8,
+                "icmp_seq": icmp_seq,
+                "ttl": 64,
+                "time": round(self.profile.draw_rtt_ms(), 3)
+            })
+            rtt_vector.append(icmp_replies[-1]["time"])
+        rtts = [icmp_reply["time"] for icmp_reply in icmp_replies]
+        packets_received = len(rtts)
+        rtt_avg = (sum(rtts) / packets_received) if rtts else None
+        # Same definition of the ping mdev: sqrt(E[rtt^2] - E[rtt]^2)
+        rtt_mdev = math.sqrt(max((sum(rtt * rtt for rtt in rtts) / packets_received) - (rtt_avg * rtt_avg), 0.0)) if rtts else None
+        return {
+            "destination": payload.get("destination_ip"),
+            "packet_transmit": packets_number,
+            "packet_receive": packets_received,
+            "packet_loss_count": packets_number - packets_received,
+            "packet_loss_rate": ((packets_number - packets_received) / packets_number * 100) if packets_number > 0 else None,
+            "packet_duplicate_count": 0,
+            "packet_duplicate_rate": 0.0,
+            "rtt_min": min(rtts) if rtts else None,
+            "rtt_avg": rtt_avg,
+            "rtt_max": max(rtts) if rtts else None,
+            "rtt_mdev": rtt_mdev,
+            "source": self.virtual_probe.probe_ip,
+            "timestamp": timestamp,
+            "msm_id": payload["msm_id"],
+            "icmp_replies": icmp_replies,
+            "rtt_vector": rtt_vector
+        }
+
+
+class FakeIperfController(FakeController):
+    handler = "iperf"
+
+    def __init__(self, virtual_probe, registration_handler_request_function):
+        super().__init__(virtual_probe, registration_handler_request_function)
+        self.last_role = None
+        self.last_conf = None
+
+    def handle_command(self, command, payload, msm_id):
+        match command:
+            case "conf":
+                role = payload.get("role")
+                if not self.state.probe_is_ready():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id, extra_fields = {"role": role})
+                    return
+                if role == "Server":
+                    if not self.state.set_probe_as_busy():
+                        self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id, extra_fields = {"role": role})
+                        return
+                    self.last_role, self.last_conf, self.last_msm_id = role, payload, msm_id
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_fields = {"port": payload.get("listen_port")})
+                elif role == "Client":
+                    self.last_role, self.last_conf, self.last_msm_id = role, payload, msm_id
+                    self.send_ACK(successed_command = command, msm_id = msm_id)
+                else:
+                    self.send_NACK(failed_command = command, error_info = "Wrong Role!", msm_id = msm_id, extra_fields = {"role": role})
+            case "start":
+                if self.last_role is None:
+                    self.send_NACK(failed_command = command, error_info = "No configuration", extra_fields = {"role": None})
+                    return
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", extra_fields = {"role": self.last_role})
+                    return
+                if self.last_role == "Client":
+                    self.schedule_pending(self.start_delay(payload) + self.profile.scaled(IPERF_DEFAULT_DURATION + IPERF_REPETITION_PAUSE),
+                                          self.complete_repetition, 0)
+            case "prepare": # Combined command: conf, and start for the client, with a single ACK
+                role = payload.get("role")
+                if role not in ("Server", "Client"):
+                    self.send_NACK(failed_command = command, error_info = "Wrong Role!", msm_id = msm_id, extra_fields = {"role": role})
+                    return
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id, extra_fields = {"role": role})
+                    return
+                self.last_role, self.last_conf, self.last_msm_id = role, payload, msm_id
+                if role == "Server":
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_fields = {"port": payload.get("listen_port")})
+                else:
+                    ack_delay = max(self.send_ACK(successed_command = command, msm_id = msm_id), self.start_delay(payload))
+                    self.schedule_pending(ack_delay + self.profile.scaled(IPERF_DEFAULT_DURATION + IPERF_REPETITION_PAUSE), self.complete_repetition, 0)
+            case "stop":
+                if msm_id is None:
+                    self.send_NACK(failed_command = "stop", error_info = "No measure_id provided", extra_fields = {"role": "Server"})
+                    return
+                if self.last_role is None:
+                    self.send_NACK(failed_command = command, error_info = "Process iperf3 not in execution", msm_id = msm_id, extra_fields = {"role": None})
+                    return
+                if msm_id != self.last_msm_id:
+                    self.send_NACK(failed_command = command,
+                                   error_info = f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement {self.last_msm_id}",
+                                   msm_id = msm_id, extra_fields = {"role": self.last_role})
+                    return
+                self.cancel_pending()
+                self.send_ACK(successed_command = command, msm_id = msm_id)
+                self.reset_conf()
+            case _:
+                self.send_NACK(failed_command = command, error_info = "Command not handled", extra_fields = {"role": self.last_role})
+
+    def complete_repetition(self, repetition):
+        if self.take_pending() is None:
+            return
+        repetitions = int(self.last_conf.get("repetitions", 1))
+        last_result = ((repetition + 1) >= repetitions)
+        self.publish_result(self.build_iperf_result(self.last_conf, repetition, last_result))
+        if last_result:
+            self.reset_conf()
+        else:
+            self.schedule_pending(self.profile.scaled(IPERF_DEFAULT_DURATION + IPERF_REPETITION_PAUSE), self.complete_repetition, repetition + 1)
+
+    def reset_conf(self):
+        self.last_role = None
+        self.last_conf = None
+        self.last_msm_id = None
+        self.state.set_probe_as_ready()
+
+    def build_iperf_result(self, conf, repetition, last_result) -> dict:
+        parallel_connections = max(int(conf.get("parallel_connections", 1)), 1)
+        transport_protocol = conf.get("transport_protocol", "TCP")
+        source_port = int(self.profile.draw_uniform(32768, 60999))
+        destination_ip = conf.get("destination_server_ip")
+        destination_port = int(conf.get("destination_server_port", 5201))
+        start_timestamp = time.time() - self.profile.scaled(IPERF_DEFAULT_DURATION)
+
+        # Same structure of the iperf3 --json output, with one interval per second
+        intervals = []
+        total_bytes = 0
+        for second in range(IPERF_DEFAULT_DURATION):
+            bits_per_second = self.profile.draw_throughput_bps()
+            interval_bytes = int(bits_per_second / 8)
+            total_bytes += interval_bytes
+            streams = [{
+                "socket": 5 + stream,
+                "start": float(second),
+                "end": float(second + 1),
+                "seconds": 1.0,
+                "bytes": interval_bytes // parallel_connections,
+                "bits_per_second": bits_per_second / parallel_connections,
+                "omitted": False,
+                "sender": True
+            } for stream in range(parallel_connections)]
+            intervals.append({
+                "streams": streams,
+                "sum": {"start": float(second), "end": float(second + 1), "seconds": 1.0, "bytes": interval_bytes,
+                        "bits_per_second": bits_per_second, "omitted": False, "sender": True}
+            })
+        avg_speed = total_bytes * 8 / IPERF_DEFAULT_DURATION
+        sum_total = {"start": 0, "end": float(IPERF_DEFAULT_DURATION), "seconds": float(IPERF_DEFAULT_DURATION),
+                     "bytes": total_bytes, "bits_per_second": avg_speed, "sender": True}
+        full_result = {
+            "start": {
+                "connected": [{"socket": 5, "local_host": self.virtual_probe.probe_ip, "local_port": source_port,
+                               "remote_host": destination_ip, "remote_port": destination_port}],
+                "version": "iperf 3.12",
+                "timestamp": {"time": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(start_timestamp)),
+                              "timesecs": int(start_timestamp)},
+                "test_start": {"protocol": transport_protocol, "num_streams": parallel_connections,
+                               "duration": IPERF_DEFAULT_DURATION, "reverse": int(bool(conf.get("reverse")))}
+            },
+            "intervals": intervals,
+            "end": {
+                "sum_sent": sum_total,
+                "sum_received": dict(sum_total, sender = False)
+            }
+        }
+        return {
+            "msm_id": conf["msm_id"],
+            "repetition_number": repetition,
+            "transport_protocol": transport_protocol,
+            "start_timestamp": int(start_timestamp),
+            "source_ip": self.virtual_probe.probe_ip,
+            "source_port": source_port,
+            "destination_ip": destination_ip,
+            "destination_port": destination_port,
+            "bytes_received": total_bytes,
+            "duration": float(IPERF_DEFAULT_DURATION),
+            "avg_speed": avg_speed,
+            "last_result": last_result,
+            "full_result_c_b64": self.compress(full_result)
+        }
+
+
+class FakeAgeOfInformationController(FakeController):
+    handler = "aoi"
+
+    def __init__(self, virtual_probe, registration_handler_request_function):
+        super().__init__(virtual_probe, registration_handler_request_function)
+        self.last_role = None
+        self.started_at = None
+
+    def handle_command(self, command, payload, msm_id):
+        if msm_id is None:
+            self.send_NACK(failed_command = command, error_info = "No measurement_id provided")
+            return
+        match command:
+            case "enable_ntp_service":
+                role = payload.get("role")
+                if role == "Server":
+                    if not self.state.set_probe_as_busy():
+                        self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                        return
+                    if (payload.get("socket_port") is None) or (payload.get("payload_size") is None):
+                        self.send_NACK(failed_command = command, error_info = "No socket_port or payload_size provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                    self.last_role, self.last_msm_id, self.started_at = role, msm_id, time.time()
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+                elif role == "Client":
+                    self.last_role, self.last_msm_id = None, None
+                    self.state.set_probe_as_ready()
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+                else:
+                    self.send_NACK(failed_command = command, error_info = f"Wrong role -> {role}", msm_id = msm_id)
+            case "disable_ntp_service":
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                for required_field in ("probe_ntp_server", "socket_port", "role", "probe_server_aoi"):
+                    if payload.get(required_field) is None:
+                        self.send_NACK(failed_command = command, error_info = f"No {required_field} provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                self.last_role, self.last_msm_id = payload["role"], msm_id
+                self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+            case "start":
+                if self.state.probe_is_ready():
+                    self.send_NACK(failed_command = command, error_info = "No AoI measurement in progress", msm_id = msm_id)
+                    return
+                if self.last_msm_id != msm_id:
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                packets_rate = payload.get("packets_rate")
+                if (payload.get("payload_size") is None) or (not packets_rate):
+                    self.send_NACK(failed_command = command, error_info = "No payload size or packets rate provided. Force PROBE_READY", msm_id = msm_id)
+                    self.state.set_probe_as_ready()
+                    return
+                # The server probe is in the same process: it reads the sending rate from here when it builds the result
+                self.virtual_probe.sessions[msm_id] = {"packets_rate": packets_rate}
+                self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTPDATE_SECONDS)
+            case "prepare": # Combined command: enable_ntp_service for the server, disable_ntp_service and start for the client
+                role = payload.get("role")
+                if role == "Server":
+                    required_fields = ("socket_port", "payload_size")
+                elif role == "Client":
+                    required_fields = ("probe_ntp_server", "socket_port", "probe_server_aoi", "payload_size", "packets_rate")
+                else:
+                    self.send_NACK(failed_command = command, error_info = f"Wrong role -> {role}", msm_id = msm_id)
+                    return
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                for required_field in required_fields:
+                    if payload.get(required_field) is None:
+                        self.send_NACK(failed_command = command, error_info = f"No {required_field} provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                self.last_role, self.last_msm_id = role, msm_id
+                if role == "Server":
+                    self.started_at = time.time()
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+                else:
+                    self.virtual_probe.sessions[msm_id] = {"packets_rate": payload["packets_rate"]}
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS + NTPDATE_SECONDS)
+            case "stop":
+                if self.state.probe_is_ready():
+                    self.send_NACK(failed_command = command, error_info = "No AoI measurement in progress", msm_id = msm_id)
+                    return
+                if self.last_msm_id != msm_id:
+                    self.send_NACK(failed_command = command,
+                                   error_info = f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement |{self.last_msm_id}|",
+                                   msm_id = msm_id)
+                    return
+                ack_delay = self.send_ACK(successed_command = command, msm_id = msm_id)
+                if self.last_role == "Server":
+                    self.scheduler.schedule(ack_delay, self.publish_result, self.build_aoi_result(msm_id, time.time() - self.started_at))
+                    self.last_role, self.last_msm_id = None, None
+                    self.state.set_probe_as_ready()
+            case _:
+                self.send_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+    def build_aoi_result(self, msm_id, elapsed) -> dict:
+        session = self.virtual_probe.sessions.pop(msm_id, None) or {"packets_rate": 1}
+        packets_rate = session["packets_rate"]
+        # With a time_scale < 1 the measurement is compressed: the result covers the unscaled duration
+        packets_number = int((elapsed / self.profile.time_scale) * packets_rate) if self.profile.time_scale > 0 else 0
+        first_timestamp = time.time() - (packets_number / packets_rate)
+        aois = []
+        for packet in range(packets_number):
+            if self.profile.draw_packet_lost():
+                continue
+            aois.append({"Timestamp": first_timestamp + packet / packets_rate, "AoI": self.profile.draw_rtt_ms() / 2})
+        return {
+            "msm_id": msm_id,
+            "c_aois_b64": self.compress(aois),
+            "aoi_min": min(aoi["AoI"] for aoi in aois) if aois else None,
+            "aoi_max": max(aoi["AoI"] for aoi in aois) if aois else None
+        }
+
+
+class FakeUDPPingController(FakeController):
+    handler = "udpping"
+    required_fields = ("probe_ntp_server", "probe_server_udpping", "listen_port", "packets_size",
+                       "packets_number", "packets_interval", "live_mode", "role")
+
+    def __init__(self, virtual_probe, registration_handler_request_function):
+        super().__init__(virtual_probe, registration_handler_request_function)
+        self.last_role = None
+        self.last_parameters = None
+        self.started_at = None
+
+    def handle_command(self, command, payload, msm_id):
+        if msm_id is None:
+            self.send_NACK(failed_command = command, error_info = "No measurement_id provided")
+            return
+        match command:
+            case "disable_ntp_service":
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                for required_field in self.required_fields:
+                    if payload.get(required_field) is None:
+                        self.send_NACK(failed_command = command, error_info = f"No {required_field} provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                self.last_role, self.last_parameters, self.last_msm_id = payload["role"], payload, msm_id
+                self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+            case "start":
+                if self.state.probe_is_ready():
+                    self.send_NACK(failed_command = command, error_info = "No UDP-PING measurement in progress", msm_id = msm_id)
+                    return
+                if self.last_msm_id != msm_id:
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                ack_delay = self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTPDATE_SECONDS)
+                ack_delay = max(ack_delay, self.start_delay(payload)) # The ACK arms the client, the traffic begins at start_at
+                self.started_at = time.time() + ack_delay
+                duration = int(self.last_parameters["packets_number"]) * float(self.last_parameters["packets_interval"]) / 1000
+                self.schedule_pending(ack_delay + self.profile.scaled(duration), self.complete_udpping, msm_id)
+            case "prepare": # Combined command: enable_ntp_service for the server, disable_ntp_service and start for the client
+                role = payload.get("role")
+                required_fields = ("listen_port",) if (role == "Server") else self.required_fields
+                if role not in ("Server", "Client"):
+                    self.send_NACK(failed_command = command, error_info = f"Wrong role -> {role}", msm_id = msm_id)
+                    return
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                for required_field in required_fields:
+                    if payload.get(required_field) is None:
+                        self.send_NACK(failed_command = command, error_info = f"No {required_field} provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                self.last_role, self.last_parameters, self.last_msm_id = role, payload, msm_id
+                if role == "Server":
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+                else:
+                    ack_delay = self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS + NTPDATE_SECONDS)
+                    ack_delay = max(ack_delay, self.start_delay(payload))
+                    self.started_at = time.time() + ack_delay
+                    duration = int(payload["packets_number"]) * float(payload["packets_interval"]) / 1000
+                    self.schedule_pending(ack_delay + self.profile.scaled(duration), self.complete_udpping, msm_id)
+            case "stop":
+                if self.state.probe_is_ready():
+                    self.send_NACK(failed_command = command, error_info = "No UDP-PING measurement in progress", msm_id = msm_id)
+                    return
+                if self.last_msm_id != msm_id:
+                    self.send_NACK(failed_command = command,
+                                   error_info = f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement |{self.last_msm_id}|",
+                                   msm_id = msm_id)
+                    return
+                ack_delay = self.send_ACK(successed_command = command, msm_id = msm_id)
+                if self.last_role == "Client":
+                    if self.cancel_pending(): # Stopped before the end: the real udpClient publishes what it has sent so far
+                        self.scheduler.schedule(ack_delay, self.publish_result, self.build_udpping_result(msm_id, time.time() - self.started_at))
+                else:
+                    self.last_role, self.last_parameters, self.last_msm_id = None, None, None
+                self.state.set_probe_as_ready()
+            case "enable_ntp_service":
+                role = payload.get("role")
+                if role == "Server":
+                    if not self.state.set_probe_as_busy():
+                        self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                        return
+                    if payload.get("listen_port") is None:
+                        self.send_NACK(failed_command = command, error_info = "No listen port provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                    self.last_role, self.last_parameters, self.last_msm_id = role, payload, msm_id
+                    self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+                elif role == "Client":
+                    if self.last_msm_id == msm_id:
+                        self.last_role, self.last_parameters, self.last_msm_id = None, None, None
+                        self.send_ACK(successed_command = command, msm_id = msm_id, extra_delay = NTP_TOGGLE_SECONDS)
+                    elif self.last_msm_id is None:
+                        self.send_NACK(failed_command = command, error_info = "No UDP-PING measurement in progress", msm_id = None)
+                    else:
+                        self.send_NACK(failed_command = command,
+                                       error_info = f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement |{self.last_msm_id}|",
+                                       msm_id = msm_id)
+                else:
+                    self.send_NACK(failed_command = command, error_info = f"Wrong role -> {role}", msm_id = msm_id)
+
+    def complete_udpping(self, msm_id):
+        if self.take_pending() is None:
+            return
+        self.publish_result(self.build_udpping_result(msm_id, time.time() - self.started_at))
+        self.state.set_probe_as_ready()
+
+    def build_udpping_result(self, msm_id, elapsed) -> dict:
+        packets_interval_ns = int(float(self.last_parameters["packets_interval"]) * 1e6)
+        packets_number = int(self.last_parameters["packets_number"])
+        if self.profile.time_scale > 0:
+            packets_number = min(packets_number, int((elapsed / self.profile.time_scale) * 1e9 / packets_interval_ns))
+        start_ns = time.time_ns() - packets_number * packets_interval_ns
+        # Same columns of the udpping client output, all times in ns
+        lines = ["SeqNr,SendTime,ServerTime,ReceiveTime,Client->Server,Server->Client,RTT (all times in ns)"]
+        for sequence_number in range(packets_number):
+            if self.profile.draw_packet_lost():
+                continue
+            client_to_server = int(self.profile.draw_rtt_ms() * 1e6 / 2)
+            server_to_client = int(self.profile.draw_rtt_ms() * 1e6 / 2)
+            send_time = start_ns + sequence_number * packets_interval_ns
+            lines.append(f"{sequence_number},{send_time},{send_time + client_to_server},{send_time + client_to_server + server_to_client},"
+                         f"{client_to_server},{server_to_client},{client_to_server + server_to_client}")
+        return {
+            "msm_id": msm_id,
+            "c_udpping_b64": self.compress("\n".join(lines) + "\n")
+        }
+
+
+class FakeEnergyController(FakeController):
+    handler = "energy"
+
+    def __init__(self, virtual_probe, registration_handler_request_function):
+        super().__init__(virtual_probe, registration_handler_request_function)
+        self.started_at = {}
+
+    def handle_command(self, command, payload, msm_id):
+        match command:
+            case "check":
+                self.send_ACK(successed_command = "check", msm_id = msm_id)
+            case "start":
+                if msm_id is None:
+                    self.send_NACK(failed_command = "start", error_info = "No measurement provided")
+                    return
+                self.started_at[msm_id] = time.time()
+                self.send_ACK(successed_command = "start", msm_id = msm_id)
+            case "stop":
+                if msm_id is None:
+                    self.send_NACK(failed_command = "stop", error_info = "No measurement provided")
+                    return
+                started_at = self.started_at.pop(msm_id, None)
+                if started_at is None:
+                    self.send_NACK(failed_command = "stop", error_info = "No current measurement in progress", msm_id = msm_id)
+                    return
+                ack_delay = self.send_ACK(successed_command = "stop", msm_id = msm_id)
+                self.scheduler.schedule(ack_delay, self.publish_result, self.build_energy_result(msm_id, time.time() - started_at))
+            case _:
+                self.send_NACK(failed_command = command, error_info = "Unknown command", msm_id = msm_id)
+
+    def build_energy_result(self, msm_id, elapsed) -> dict:
+        duration = (elapsed / self.profile.time_scale) if self.profile.time_scale > 0 else 0.0
+        samples_number = int(duration * ENERGY_SAMPLE_RATE_HZ)
+        first_timestamp = time.time() - duration
+        data = [{"Timestamp": first_timestamp + sample / ENERGY_SAMPLE_RATE_HZ,
+                 "Current": self.profile.draw_uniform(0.85, 1.15)} for sample in range(samples_number)]
+        current_mean = (sum(sample["Current"] for sample in data) / samples_number) if samples_number > 0 else 0.0
+        bytes_per_second = self.profile.throughput_mbps * 1e6 / 8 * 0.01 # Background traffic of an idle probe
+        return {
+            "msm_id": msm_id,
+            "energy": current_mean * ENERGY_BUS_VOLTAGE * duration,
+            "c_data_b64": self.compress(data),
+            "byte_tx": int(bytes_per_second * duration),
+            "byte_rx": int(bytes_per_second * duration),
+            "duration": duration
+        }
+
+
+class FakeCoexController(FakeController):
+    handler = "coex"
+    required_fields = ("role", "counterpart_probe_ip", "socket_port", "counterpart_probe_mac")
+
+    def __init__(self, virtual_probe, registration_handler_request_function):
+        super().__init__(virtual_probe, registration_handler_request_function)
+        self.last_parameters = None
+
+    def handle_command(self, command, payload, msm_id):
+        if msm_id is None:
+            self.send_NACK(failed_command = command, error_info = "No measurement_id provided")
+            return
+        match command:
+            case "conf":
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                for required_field in self.required_fields:
+                    if payload.get(required_field) is None:
+                        self.send_NACK(failed_command = command, error_info = f"No {required_field} provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                self.last_parameters, self.last_msm_id = payload, msm_id
+                self.send_ACK(successed_command = "conf", msm_id = msm_id)
+            case "start":
+                if self.state.probe_is_ready():
+                    self.send_NACK(failed_command = command, error_info = "No coex measure in progress", msm_id = msm_id)
+                    return
+                if msm_id != self.last_msm_id:
+                    self.send_NACK(failed_command = command,
+                                   error_info = f"Measure_id mismatch: The provided measure_id does not correspond to the ongoing measurement |{self.last_msm_id}|",
+                                   msm_id = msm_id)
+                    return
+                if self.last_parameters["role"] == "Client":
+                    ack_delay = max(self.send_ACK(successed_command = "start", msm_id = msm_id), self.start_delay(payload))
+                    # As the real client, the traffic stops by itself at the end of the duration (or of the packets)
+                    self.schedule_pending(ack_delay + self.profile.scaled(self.traffic_duration(self.last_parameters)), self.complete_traffic, msm_id)
+            case "prepare": # Combined command: conf, and start for the client, with a single ACK
+                if not self.state.set_probe_as_busy():
+                    self.send_NACK(failed_command = command, error_info = "PROBE BUSY", msm_id = msm_id)
+                    return
+                for required_field in self.required_fields:
+                    if payload.get(required_field) is None:
+                        self.send_NACK(failed_command = command, error_info = f"No {required_field} provided", msm_id = msm_id)
+                        self.state.set_probe_as_ready()
+                        return
+                self.last_parameters, self.last_msm_id = payload, msm_id
+                ack_delay = max(self.send_ACK(successed_command = command, msm_id = msm_id), self.start_delay(payload))
+                if payload["role"] == "Client":
+                    self.schedule_pending(ack_delay + self.profile.scaled(self.traffic_duration(payload)), self.complete_traffic, msm_id)
+            case "stop":
+                if self.state.probe_is_ready():
+                    if not payload.get("silent"):
+                        self.send_NACK(failed_command = command, error_info = "No coex measure in progress", msm_id = msm_id)
+                    return
+                if (self.last_msm_id is not None) and (msm_id != self.last_msm_id):
+                    self.send_NACK(failed_command = command,
+                                   error_info = f"Measure_ID Mismatch: The provided measure_id does not correspond to the ongoing measurement. Busy for |{self.last_msm_id}|",
+                                   msm_id = msm_id)
+                    return
+                self.cancel_pending()
+                self.send_ACK(successed_command = "stop", msm_id = msm_id)
+                self.reset_vars()
+            case _:
+                self.send_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+    @staticmethod
+    def traffic_duration(parameters) -> float:
+        if parameters.get("duration"):
+            return float(parameters["duration"])
+        if parameters.get("packets_number") and parameters.get("packets_rate"):
+            return float(parameters["packets_number"]) / float(parameters["packets_rate"])
+        return COEX_DEFAULT_TRACE_DURATION
+
+    def complete_traffic(self, msm_id):
+        if self.take_pending() is None:
+            return
+        self.send_ACK(successed_command = "stop", msm_id = msm_id)
+        self.reset_vars()
+
+    def reset_vars(self):
+        self.last_parameters = None
+        self.last_msm_id = None
+        self.state.set_probe_as_ready()
+
+
+FAKE_CONTROLLERS = (FakeIperfController, FakePingController, FakeEnergyController,
+                    FakeAgeOfInformationController, FakeUDPPingController, FakeCoexController)
@@ -0,0 +1,175 @@
+"""
+Shared resources of the virtual probe fleet: the FleetProfile (latency and failure knobs), the ActionScheduler
+that runs all the delayed replies of the fleet on one thread, the FleetStats counters and the per-probe
+VirtualProbeState that replaces the process-wide SharedState of a real probe.
+"""
+
+import time
+import heapq
+import random
+import threading
+import itertools
+
+BUSY = "BUSY"
+READY = "READY"
+
+REPLY_NORMAL = "normal"
+REPLY_NACK = "nack"
+REPLY_SILENT = "silent"
+
+
+class FleetProfile:
+    """
+    Knobs of the simulated fleet. Delays are in seconds, rates are probabilities in [0, 1].
+    """
+    def __init__(self, ack_delay = 0.05, ack_jitter = 0.02, nack_rate = 0.0, silent_rate = 0.0, result_loss_rate = 0.0,
+                 time_scale = 1.0, rtt_ms = 25.0, rtt_jitter_ms = 5.0, packet_loss_rate = 0.0, throughput_mbps = 100.0,
+                 seed = None):
+        self.ack_delay = ack_delay                  # Mean processing time of a command before its ACK/NACK
+        self.ack_jitter = ack_jitter                # Standard deviation of the processing time
+        self.nack_rate = nack_rate                  # Probability that a command is refused with an injected NACK
+        self.silent_rate = silent_rate              # Probability that a command is never answered (ACK timeout)
+        self.result_loss_rate = result_loss_rate    # Probability that a result is never published
+        self.time_scale = time_scale                # Multiplies the duration of the measurements (e.g. 0.01 to run them 100x faster)
+        self.rtt_ms = rtt_ms                        # Mean RTT of the simulated network
+        self.rtt_jitter_ms = rtt_jitter_ms
+        self.packet_loss_rate = packet_loss_rate    # Per-packet loss of the simulated network
+        self.throughput_mbps = throughput_mbps      # Mean throughput of the simulated network
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def draw_reply(self) -> str:
+        with self.random_lock:
+            draw = self.random.random()
+        if draw < self.silent_rate:
+            return REPLY_SILENT
+        if draw < (self.silent_rate + self.nack_rate):
+            return REPLY_NACK
+        return REPLY_NORMAL
+
+    def draw_ack_delay(self) -> float:
+        with self.random_lock:
+            return max(self.random.gauss(self.ack_delay, self.ack_jitter), 0.0)
+
+    def draw_result_lost(self) -> bool:
+        with self.random_lock:
+            return self.random.random() < self.result_loss_rate
+
+    def draw_rtt_ms(self) -> float:
+        with self.random_lock:
+            return max(self.random.gauss(self.rtt_ms, self.rtt_jitter_ms), 0.1)
+
+    def draw_packet_lost(self) -> bool:
+        with self.random_lock:
+            return self.random.random() < self.packet_loss_rate
+
+    def draw_throughput_bps(self) -> float:
+        with self.random_lock:
+            return max(self.random.gauss(self.throughput_mbps, self.throughput_mbps * 0.1), 0.1) * 1e6
+
+    def draw_uniform(self, low, high) -> float:
+        with self.random_lock:
+            return self.random.uniform(low, high)
+
+    def scaled(self, duration) -> float:
+        return duration * self.time_scale
+
+
+class ScheduledAction:
+    def __init__(self, due_time, action, args):
+        self.due_time = due_time
+        self.action = action
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ActionScheduler:
+    """
+    Runs delayed actions (ACK replies, result publishing) of all the virtual probes on a single thread,
+    so that thousands of probes don't need thousands of timer threads.
+    """
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count() # Tie-breaker for actions with the same due time
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = "fleet-scheduler", daemon = True)
+        self.thread.start()
+
+    def schedule(self, delay, action, *args) -> ScheduledAction:
+        scheduled_action = ScheduledAction(time.monotonic() + max(delay, 0.0), action, args)
+        with self.condition:
+            heapq.heappush(self.heap, (scheduled_action.due_time, next(self.sequence), scheduled_action))
+            self.condition.notify()
+        return scheduled_action
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and ((not self.heap) or (self.heap[0][0] > time.monotonic())):
+                    timeout = (self.heap[0][0] - time.monotonic()) if self.heap else None
+                    self.condition.wait(timeout = timeout)
+                if not self.running:
+                    return
+                _, _, scheduled_action = heapq.heappop(self.heap)
+            if scheduled_action.cancelled:
+                continue
+            try:
+                scheduled_action.action(*scheduled_action.args)
+            except Exception as e:
+                print(f"ActionScheduler: exception in scheduled action -> {e}")
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+
+class FleetStats:
+    """
+    Thread-safe counters of the fleet activity, by handler and event (command, ack, nack, silent, result, result_lost).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def inc(self, handler, event, amount = 1):
+        with self.lock:
+            key = (handler, event)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snapshot = {}
+            for (handler, event), value in self.counters.items():
+                snapshot.setdefault(handler, {})[event] = value
+            return snapshot
+
+
+class VirtualProbeState:
+    """
+    READY/BUSY state of a single virtual probe (the real firmware uses the process-wide SharedState).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.probe_state = READY
+
+    def set_probe_as_ready(self) -> bool:
+        with self.lock:
+            self.probe_state = READY
+            return True
+
+    def set_probe_as_busy(self) -> bool:
+        with self.lock:
+            if self.probe_state == BUSY:
+                return False
+            self.probe_state = BUSY
+            return True
+
+    def probe_is_ready(self) -> bool:
+        with self.lock:
+            return (self.probe_state == READY)
@@ -0,0 +1,112 @@
+"""
+Virtual probes for load-testing the coordinator.
+A VirtualProbe is made of the real ProbeMqttClient and CommandsDemultiplexer of the firmware, plus the fake
+controllers of fakeControllers.py. A VirtualProbeFleet runs many of them in the same process, sharing one
+ActionScheduler and one FleetProfile.
+"""
+
+import time
+import ipaddress
+from mqttModule.mqttClient import ProbeMqttClient
+from commandsDemultiplexer.commandsDemultiplexer import CommandsDemultiplexer
+from simulatorModule.fleetResources import FleetProfile, ActionScheduler, FleetStats, VirtualProbeState
+from simulatorModule.fakeControllers import FAKE_CONTROLLERS
+from capabilities import build_capabilities, PATH_TOOLS, BUNDLED_TOOLS
+
+DEFAULT_ID_PREFIX = "vprobe"
+DEFAULT_BASE_IP = "10.200.0.1"
+
+
+class VirtualProbeMqttClient(ProbeMqttClient):
+    """
+    ProbeMqttClient that announces the virtual addresses of its probe, instead of the ones of the host.
+    """
+    def __init__(self, probe_id, msg_received_handler_callback, config, probe_ip, probe_mac):
+        self.virtual_probe_ip = probe_ip
+        self.virtual_probe_mac = probe_mac
+        super().__init__(probe_id, msg_received_handler_callback, config = config)
+
+    def get_probe_addresses(self):
+        return self.virtual_probe_ip, self.virtual_probe_ip, self.virtual_probe_mac
+
+    def get_probe_gateway(self):
+        # The virtual probes of the same /24 share a virtual gateway (so they form one interference group)
+        gateway_ip = str(ipaddress.ip_network(f"{self.virtual_probe_ip}/24", strict = False).network_address + 254)
+        gateway_mac = "02:00:" + ":".join(f"{int(octet):02x}" for octet in gateway_ip.split("."))
+        return {"ip": gateway_ip, "mac": gateway_mac, "nic": "virtual"}
+
+    def virtual_capabilities(self, handlers) -> dict:
+        # The fake controllers don't run any tool: all of them are announced as available, without probing the host
+        tools = {name: {"available": True, "version": "simulated"} for name in list(PATH_TOOLS) + list(BUNDLED_TOOLS) + ["icmp_socket"]}
+        return build_capabilities(handlers, tools, {"virtual": {"up": True, "ipv4": [self.virtual_probe_ip]}})
+
+
+class VirtualProbe:
+    def __init__(self, probe_id, probe_ip, probe_mac, mqtt_config, fleet):
+        self.id = probe_id
+        self.probe_ip = probe_ip
+        self.probe_mac = probe_mac
+        self.profile = fleet.profile
+        self.scheduler = fleet.scheduler
+        self.stats = fleet.stats
+        self.sessions = fleet.sessions
+        self.state = VirtualProbeState()
+
+        self.commands_demultiplexer = CommandsDemultiplexer(serial_executors = False) # The fake controllers never block
+        self.mqtt_client = VirtualProbeMqttClient(probe_id, self.commands_demultiplexer.decode_command,
+                                                  mqtt_config, probe_ip, probe_mac)
+        self.commands_demultiplexer.set_mqtt_client(self.mqtt_client)
+        self.controllers = [controller_class(self, self.commands_demultiplexer.registration_handler_request)
+                            for controller_class in FAKE_CONTROLLERS]
+        self.commands_demultiplexer.announce_capabilities(
+            self.mqtt_client.virtual_capabilities(self.commands_demultiplexer.commands_handler_list.keys()))
+
+    def disconnect(self):
+        self.mqtt_client.disconnect()
+
+
+class VirtualProbeFleet:
+    """
+    Starts probe_count virtual probes, at most ramp_rate per second, with ids id_prefix1, id_prefix2, ...
+    and consecutive IPs from base_ip.
+    """
+    def __init__(self, probe_count, mqtt_config, profile : FleetProfile = None,
+                 id_prefix = DEFAULT_ID_PREFIX, base_ip = DEFAULT_BASE_IP, ramp_rate = 100):
+        self.probe_count = probe_count
+        self.mqtt_config = mqtt_config
+        self.profile = profile if (profile is not None) else FleetProfile()
+        self.id_prefix = id_prefix
+        self.base_ip = ipaddress.ip_address(base_ip)
+        self.ramp_rate = ramp_rate
+        self.scheduler = ActionScheduler()
+        self.stats = FleetStats()
+        self.sessions = {} # Measurement data shared between the two virtual probes of the same measurement
+        self.probes = []
+
+    @staticmethod
+    def virtual_mac(index) -> str:
+        # Locally administered unicast MAC (02:...), unique for each index
+        return "02:" + ":".join(f"{byte:02x}" for byte in index.to_bytes(5, "big"))
+
+    def start(self):
+        for index in range(1, self.probe_count + 1):
+            probe_id = f"{self.id_prefix}{index}"
+            try:
+                self.probes.append(VirtualProbe(probe_id = probe_id, probe_ip = str(self.base_ip + index - 1),
+                                                probe_mac = self.virtual_mac(index), mqtt_config = self.mqtt_config, fleet = self))
+            except Exception as e:
+                print(f"VirtualProbeFleet: can't start |{probe_id}| -> {e}")
+            if self.ramp_rate:
+                time.sleep(1 / self.ramp_rate)
+        print(f"VirtualProbeFleet: started {len(self.probes)} of {self.probe_count} virtual probes")
+
+    def connected_count(self) -> int:
+        return sum(1 for probe in self.probes if probe.mqtt_client.connected_to_broker)
+
+    def stop(self):
+        for probe in self.probes:
+            try:
+                probe.disconnect()
+            except Exception as e:
+                print(f"VirtualProbeFleet: exception while disconnecting |{probe.id}| -> {e}")
+        self.scheduler.stop()
@@ -0,0 +1,55 @@
+"""
+Unit tests of the process supervisor: reap of a process waited outside the supervisor, group stop without killpg.
+Run from probesFirmware: python -m unittest test_process_supervisor
+"""
+
+import os
+import time
+import signal
+import unittest
+from unittest import mock
+import process_supervisor
+from process_supervisor import ProcessSupervisor, process_group_members, LOST_RETURNCODE
+
+WAIT_SECONDS = 5
+
+
+@unittest.skipUnless(process_supervisor.POSIX, "wait4 and process groups are POSIX")
+class TestProcessSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor()
+
+    def test_reaped_outside_the_supervisor(self):
+        process = self.supervisor.launch("test", "m1", ["sh", "-c", "exit 3"], stdout = None, stderr = None)
+        os.waitpid(process.pid, 0) # The exit status is taken by someone else
+        with mock.patch.object(process_supervisor, "REAPED_WAIT_SECONDS", 0.1):
+            started = time.monotonic()
+            returncode = process.wait(timeout = WAIT_SECONDS)
+        self.assertLess(time.monotonic() - started, WAIT_SECONDS)
+        self.assertIn(returncode, (0, LOST_RETURNCODE)) # Popen.poll gives 0 when it can't wait the process either
+        self.assertTrue(process.reaped.is_set())
+        self.assertFalse(process.is_running())
+
+    def test_group_signalled_one_by_one(self):
+        process = self.supervisor.launch("test", "m1", ["sh", "-c", "sleep 30 & sleep 30; wait"], stdout = None, stderr = None)
+        deadline = time.monotonic() + WAIT_SECONDS
+        while (len(process_group_members(process.pid)) < 3) and (time.monotonic() < deadline): # sh and its two sleeps
+            time.sleep(0.01)
+        members = process_group_members(process.pid)
+        if not members:
+            self.skipTest("No /proc to list the process group")
+        self.assertEqual(members[0], process.pid)
+        self.assertEqual(len(members), 3)
+
+        with mock.patch.object(process_supervisor.os, "killpg", side_effect = PermissionError):
+            self.assertEqual(self.supervisor.stop("test", "m1"), [process])
+        self.assertEqual(process.returncode, -signal.SIGTERM)
+        deadline = time.monotonic() + WAIT_SECONDS
+        while process_group_members(process.pid) and (time.monotonic() < deadline): # The sleeps are reaped by init
+            time.sleep(0.01)
+        self.assertEqual(process_group_members(process.pid), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
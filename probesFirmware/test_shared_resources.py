@@ -0,0 +1,68 @@
+"""
+Unit tests of the probe resource locks of the SharedState: sessions of one controller, per measurement.
+Run from probesFirmware: python -m unittest test_shared_resources
+"""
+
+import unittest
+from shared_resources import (SharedState, session_owner, NIC_BANDWIDTH, NTPSEC_SERVICE, INA219_SENSOR, WHOLE_PROBE,
+                              SHARED, EXCLUSIVE, udp_port)
+
+
+def aoi_server_resources(port) -> dict:
+    return {NTPSEC_SERVICE: SHARED, udp_port(port): EXCLUSIVE, NIC_BANDWIDTH: SHARED}
+
+
+class TestSessionResources(unittest.TestCase):
+
+    def setUp(self):
+        SharedState._instance = None # A fresh singleton for each test
+        self.addCleanup(setattr, SharedState, "_instance", None)
+        self.shared_state = SharedState.get_instance()
+
+    def test_two_concurrent_sessions_of_one_controller(self):
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("aoi", "m1"), aoi_server_resources(40000)))
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("aoi", "m2"), aoi_server_resources(40001)))
+        self.assertCountEqual(self.shared_state.sessions_of("aoi"), ["m1", "m2"])
+        self.assertFalse(self.shared_state.probe_is_ready())
+
+    def test_overlapping_sessions_refused(self):
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("aoi", "m1"), aoi_server_resources(40000)))
+        self.assertFalse(self.shared_state.acquire_resources(session_owner("aoi", "m2"), aoi_server_resources(40000)))
+        # The client stops ntpsec: it can't run beside a server, even on another port
+        client_resources = {NTPSEC_SERVICE: EXCLUSIVE, udp_port(40001): EXCLUSIVE, NIC_BANDWIDTH: SHARED}
+        self.assertFalse(self.shared_state.acquire_resources(session_owner("aoi", "m3"), client_resources))
+        self.assertEqual(self.shared_state.sessions_of("aoi"), ["m1"])
+
+    def test_same_session_twice_refused(self):
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("aoi", "m1"), aoi_server_resources(40000)))
+        self.assertFalse(self.shared_state.acquire_resources(session_owner("aoi", "m1"), aoi_server_resources(40001)))
+
+    def test_release_per_measurement(self):
+        self.shared_state.acquire_resources(session_owner("aoi", "m1"), aoi_server_resources(40000))
+        self.shared_state.acquire_resources(session_owner("aoi", "m2"), aoi_server_resources(40001))
+        self.shared_state.release_resources(session_owner("aoi", "m1"))
+        self.assertEqual(self.shared_state.sessions_of("aoi"), ["m2"])
+        self.assertFalse(self.shared_state.owns_resources(session_owner("aoi", "m1")))
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("aoi", "m3"), aoi_server_resources(40000)))
+        self.shared_state.release_resources(session_owner("aoi", "m2"))
+        self.shared_state.release_resources(session_owner("aoi", "m3"))
+        self.assertTrue(self.shared_state.probe_is_ready())
+
+    def test_sessions_of_other_controllers(self):
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("ping", "m1"), {NIC_BANDWIDTH: SHARED}))
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("energy", "m2"), {INA219_SENSOR: EXCLUSIVE}))
+        self.assertTrue(self.shared_state.acquire_resources("iperf/5201", {udp_port(5201): EXCLUSIVE})) # A warm server
+        self.assertEqual(self.shared_state.sessions_of("ping"), ["m1"])
+        self.assertEqual(self.shared_state.sessions_of("aoi"), [])
+        self.assertFalse(self.shared_state.acquire_resources(session_owner("iperf", "m3"), {NIC_BANDWIDTH: EXCLUSIVE}))
+
+    def test_whole_probe(self):
+        self.assertTrue(self.shared_state.set_probe_as_busy())
+        self.assertFalse(self.shared_state.acquire_resources(session_owner("ping", "m1"), {NIC_BANDWIDTH: SHARED}))
+        self.shared_state.set_probe_as_ready()
+        self.assertTrue(self.shared_state.acquire_resources(session_owner("ping", "m1"), {NIC_BANDWIDTH: SHARED}))
+        self.assertFalse(self.shared_state.acquire_resources("probe", {WHOLE_PROBE: EXCLUSIVE}))
+
+
+if __name__ == "__main__":
+    unittest.main()
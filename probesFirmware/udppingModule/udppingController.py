@@ -5,9 +5,15 @@ import subprocess, threading, signal
 import base64, cbor2, pandas as pd
 from pathlib import Path
 from mqttModule.mqttClient import ProbeMqttClient
-from shared_resources import SharedState
+from shared_resources import SharedState, NIC_BANDWIDTH, NTPSEC_SERVICE, SHARED, EXCLUSIVE, udp_port, session_owner, START_AT_KEY, wait_until
+from process_supervisor import ProcessSupervisor
 
 DEFAULT_UDPPing_MEASUREMENT_FOLDER = "udpping_measurements"
+RESOURCE_OWNER = "udpping"
+NTPDATE_ATTEMPTS = 3        # With the prepare command, the server probe may still be starting its ntpsec
+NTPDATE_RETRY_SECONDS = 1
+# The client stops ntpsec to sync its clock with the server probe, and sends from an ephemeral port
+UDPPING_CLIENT_RESOURCES = {NTPSEC_SERVICE: EXCLUSIVE, NIC_BANDWIDTH: SHARED}
 
 class UDPPingParameters:
     def __init__(self, role = None, probe_server_udpping = None, listen_port = None, packets_interval = None, live_mode = None, packets_number = None, packets_size = None):
@@ -38,6 +44,7 @@ class UDPPingController:
     """ Class that implements the UDP-PING measurement funcionality """
     def __init__(self, mqtt_client : ProbeMqttClient, registration_handler_request_function, wait_for_set_coordinator_ip):
         self.shared_state = SharedState.get_instance()
+        self.process_supervisor = ProcessSupervisor.get_instance()
 
         self.mqtt_client = mqtt_client
         self.last_measurement_id = None
@@ -47,7 +54,9 @@ class UDPPingController:
         self.stop_thread_event = threading.Event()
 
         self.last_udpping_params = UDPPingParameters()
-        self.udpping_process = None
+        self.udpping_process = None # SupervisedProcess of udpClient/udpServer
+        self.last_start_at = None # Absolute time at which the client launches udpClient (None: as soon as started)
+        self.last_arm_command = None # The command (start, enable_ntp_service or prepare) ACKed once the probe is armed
 
         self.wait_for_set_coordinator_ip = wait_for_set_coordinator_ip
 
@@ -66,41 +75,22 @@ class UDPPingController:
             return
         match command:
             case "disable_ntp_service":
-                if not self.shared_state.set_probe_as_busy():
-                    self.send_udpping_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
-                    return
-                
-                check_params_msg = self.check_all_parameters(payload)
-                if check_params_msg != "OK":
-                    self.send_udpping_NACK(failed_command=command, error_info = check_params_msg, msm_id=msm_id)
-                    self.shared_state.set_probe_as_ready()
-                    return
-
-                disable_msg = self.stop_ntpsec_service()
-                if disable_msg == "OK":
-                    self.last_measurement_id = msm_id
+                if self.configure_client_measurement(command, msm_id, payload):
                     self.send_udpping_ACK(successed_command = command, msm_id = msm_id)
-                else:
-                    self.send_udpping_NACK(failed_command = command, error_info = disable_msg, msm_id = msm_id)
-                    self.shared_state.set_probe_as_ready()
 
             case "start":
-                if (not self.shared_state.probe_is_ready()): # If the probe has an on-going measurement...
+                if self.shared_state.sessions_of(RESOURCE_OWNER): # If the probe has an on-going UDP-PING measurement...
                     if self.last_measurement_id != msm_id: # If this ongoing measurement is not the one mentioned in the command
                         self.send_udpping_NACK(failed_command=command, 
                                             error_info="PROBE BUSY", # This error info can be also a MISMATCH error, but in this case is the same
                                             msm_id=msm_id)
                         return
                     
-                    returned_msg = self.submit_thread_to_udpping_measure(msm_id = msm_id)
-                    if returned_msg == "OK": # Thread submit and start are separated
-                        self.udpping_thread.start()
-                    else:
-                        self.send_udpping_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
+                    self.start_measurement_thread(command, msm_id, payload)
                 else:
                     self.send_udpping_NACK(failed_command = command, error_info = "No UDP-PING measurement in progress", msm_id = msm_id)
             case "stop":
-                if self.shared_state.probe_is_ready():
+                if not self.shared_state.sessions_of(RESOURCE_OWNER):
                     self.send_udpping_NACK(failed_command = command, error_info = "No UDP-PING measurement in progress", msm_id = msm_id)
                     return
                 if self.last_measurement_id != msm_id:
@@ -116,7 +106,7 @@ class UDPPingController:
                         self.reset_vars()
                 else:
                     self.send_udpping_NACK(failed_command=command, error_info=termination_message)
-                self.shared_state.set_probe_as_ready()
+                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
                 
             
             case "enable_ntp_service":
@@ -125,36 +115,14 @@ class UDPPingController:
                     self.send_udpping_NACK(failed_command=command, error_info="No role provided", msm_id=msm_id)
                     return
                 if role == "Server":
-                    if not self.shared_state.set_probe_as_busy():
-                        self.send_udpping_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
-                        return
-                    listen_port = payload["listen_port"] if ("listen_port" in payload) else None
-                    if listen_port is None:
-                        self.send_udpping_NACK(failed_command=command, error_info="No listen port provided", msm_id=msm_id)
-                        self.shared_state.set_probe_as_ready()
-                        return
-                    
-                    enable_msg = self.start_ntpsec_service()
-                    if enable_msg == "OK":
-                        self.last_udpping_params = UDPPingParameters(role=role, listen_port=listen_port)
-                        self.last_measurement_id = msm_id
-                        
-                        returned_msg = self.submit_thread_to_udpping_measure(msm_id = msm_id)
-                        if returned_msg == "OK":
-                            self.udpping_thread.start()
-                            #self.send_udpping_ACK(successed_command = command, msm_id = msm_id)
-                        else:
-                            self.send_udpping_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
-                    else:
-                        self.send_udpping_NACK(failed_command = command, error_info = enable_msg, msm_id = msm_id)
-                        self.shared_state.set_probe_as_ready()
+                    self.start_server_measurement(command, msm_id, payload)
                 elif role == "Client":
                     if self.last_measurement_id == msm_id:
                         enable_msg = self.start_ntpsec_service()
                         self.reset_vars()
                         if enable_msg == "OK":
                             self.send_udpping_ACK(successed_command = command, msm_id = msm_id)
-                            #self.shared_state.set_probe_as_ready()
+                            #self.shared_state.release_resources(RESOURCE_OWNER)
                         else:
                             self.send_udpping_NACK(failed_command = command, error_info = enable_msg, msm_id = msm_id)
                     elif self.last_measurement_id is None:
@@ -165,7 +133,79 @@ class UDPPingController:
                                             msm_id=msm_id) 
                 else:
                     self.send_udpping_NACK(failed_command = command, error_info = (f"Wrong role -> {role}"), msm_id = msm_id)
-            
+            case "prepare":
+                # Combined command: the whole configuration of the role in one round trip. The server ACKs when udpServer
+                # is running, the client when armed (ntpsec stopped, clock synced): then it launches udpClient at start_at.
+                role = payload["role"] if ("role" in payload) else None
+                if role == "Server":
+                    self.start_server_measurement(command, msm_id, payload)
+                elif role == "Client":
+                    if self.configure_client_measurement(command, msm_id, payload):
+                        self.start_measurement_thread(command, msm_id, payload)
+                else:
+                    self.send_udpping_NACK(failed_command = command, error_info = (f"Wrong role -> {role}"), msm_id = msm_id)
+            case _:
+                self.send_udpping_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+
+    def configure_client_measurement(self, command, msm_id, payload) -> bool:
+        """
+        Client side of disable_ntp_service (and prepare): locks the resources, checks the parameters and stops ntpsec.
+        Returns True if the client is configured, otherwise the NACK has already been sent.
+        """
+        if self.shared_state.sessions_of(RESOURCE_OWNER) or (not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, msm_id), UDPPING_CLIENT_RESOURCES)):
+            self.send_udpping_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
+            return False
+        
+        check_params_msg = self.check_all_parameters(payload)
+        if check_params_msg != "OK":
+            self.send_udpping_NACK(failed_command=command, error_info = check_params_msg, msm_id=msm_id)
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
+            return False
+
+        disable_msg = self.stop_ntpsec_service()
+        if disable_msg == "OK":
+            self.last_measurement_id = msm_id
+            return True
+        self.send_udpping_NACK(failed_command = command, error_info = disable_msg, msm_id = msm_id)
+        self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
+        return False
+
+
+    def start_server_measurement(self, command, msm_id, payload):
+        """
+        Server side of enable_ntp_service (and prepare): locks the resources, keeps ntpsec running for the client clock
+        sync, and starts udpServer. The measurement thread ACKs the command once udpServer is running.
+        """
+        listen_port = payload["listen_port"] if ("listen_port" in payload) else None
+        if listen_port is None:
+            self.send_udpping_NACK(failed_command=command, error_info="No listen port provided", msm_id=msm_id)
+            return
+        # The server keeps ntpsec running as NTP server of the client probe
+        server_resources = {NTPSEC_SERVICE: SHARED, udp_port(listen_port): EXCLUSIVE, NIC_BANDWIDTH: SHARED}
+        if self.shared_state.sessions_of(RESOURCE_OWNER) or (not self.shared_state.acquire_resources(session_owner(RESOURCE_OWNER, msm_id), server_resources)):
+            self.send_udpping_NACK(failed_command=command, error_info="PROBE BUSY", msm_id=msm_id)
+            return
+        
+        enable_msg = self.start_ntpsec_service()
+        if enable_msg == "OK":
+            self.last_udpping_params = UDPPingParameters(role="Server", listen_port=listen_port)
+            self.last_measurement_id = msm_id
+            self.start_measurement_thread(command, msm_id, payload)
+        else:
+            self.send_udpping_NACK(failed_command = command, error_info = enable_msg, msm_id = msm_id)
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
+
+
+    def start_measurement_thread(self, command, msm_id, payload):
+        self.last_start_at = payload.get(START_AT_KEY)
+        self.last_arm_command = command
+        returned_msg = self.submit_thread_to_udpping_measure(msm_id = msm_id)
+        if returned_msg == "OK": # Thread submit and start are separated
+            self.udpping_thread.start()
+        else:
+            self.send_udpping_NACK(failed_command = command, error_info = returned_msg, msm_id = msm_id)
+
 
     def submit_thread_to_udpping_measure(self, msm_id):
         try:
@@ -182,22 +222,25 @@ class UDPPingController:
             stderr_command = None
             try:
                 print(f"Role client thread -> last_probe_ntp_server_ip: |{self.last_probe_ntp_server_ip}|")
-                result = subprocess.run( ['sudo', 'ntpdate', self.last_probe_ntp_server_ip], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                result = self.sync_clock(msm_id)
                 if result.returncode == 0:
                     print(f"UDPPingController: clock synced with {self.last_probe_ntp_server_ip}")
-                    self.send_udpping_ACK(successed_command = "start", msm_id = msm_id)
+                    self.send_udpping_ACK(successed_command = self.last_arm_command, msm_id = msm_id) # Armed: udpClient is launched at last_start_at
+                    if not wait_until(self.last_start_at, self.stop_thread_event):
+                        print(f"UDPPingController: measurement |{msm_id}| stopped before its scheduled start")
+                        return # The stop command releases the resources
                     base_path = Path(__file__).parent
                     udpping_measurement_folder_path = os.path.join(base_path, DEFAULT_UDPPing_MEASUREMENT_FOLDER)
                     Path(udpping_measurement_folder_path).mkdir(parents=True, exist_ok=True)
                     complete_file_path = os.path.join(udpping_measurement_folder_path, msm_id + ".csv")
                     with open(complete_file_path, "w") as output:
                         command = self.last_udpping_params.get_udpping_command_with_parameters()
-                        self.udpping_process = subprocess.Popen(command, stdout=output, stderr=subprocess.PIPE, text=True)
+                        self.udpping_process = self.process_supervisor.launch(RESOURCE_OWNER, msm_id, command, stdout=output)
                         print(f"UDPPingController: udpping tool started as Client")
                         self.udpping_process.wait()
                     
-                    if (self.udpping_process is not None) and (self.udpping_process.returncode != 0) and (self.udpping_process.returncode != -15): # -15 is the SIGTERM signal
-                        stderr_output = self.udpping_process.stderr.read()
+                    if (self.udpping_process is not None) and (self.udpping_process.returncode != 0) and (not self.udpping_process.stop_requested):
+                        stderr_output = self.udpping_process.popen.stderr.read()
                         errore_msg = f"UDPPingController: Process finished with error. STDERR: {stderr_output}"
                         print(errore_msg)
                         self.send_udpping_NACK(failed_command="enable_ntp_service", error_info=errore_msg, msm_id=msm_id)
@@ -205,19 +248,19 @@ class UDPPingController:
                     print(f"UDPPingController: udpping tool stopped")
                     output.close()
                     time.sleep(1) # Waiting for closing file
-                    self.compress_and_publish_udpping_result(msm_id=msm_id)
+                    self.compress_and_publish_udpping_result(msm_id=msm_id, process_usage=self.udpping_process.usage())
                 else:
                     raise Exception(result.stderr.decode('utf-8'))                    
             except Exception as e:
                 stderr_command = str(e)
-                self.send_udpping_NACK(failed_command="start", error_info=stderr_command, msm_id=msm_id)
-            self.shared_state.set_probe_as_ready()
+                self.send_udpping_NACK(failed_command=self.last_arm_command, error_info=stderr_command, msm_id=msm_id)
+            self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
 
         elif self.last_udpping_params.role == "Server":
             try:
                 command = self.last_udpping_params.get_udpping_command_with_parameters()
-                self.udpping_process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                self.send_udpping_ACK(successed_command = "enable_ntp_service", msm_id = msm_id)
+                self.udpping_process = self.process_supervisor.launch(RESOURCE_OWNER, msm_id, command)
+                self.send_udpping_ACK(successed_command = self.last_arm_command, msm_id = msm_id)
                 print(f"UDPPingController: udpping tool started as Server")
 
                 while(not self.stop_thread_event.is_set()): # "Busy" wait of thread otherwise the udpping tool will be closed
@@ -227,28 +270,40 @@ class UDPPingController:
                 print(f"UDPPingController: udpping tool stopped")
             except Exception as e:
                 print(f"UDPPingController: exception during udpping execution -> {e}")
-                self.send_udpping_NACK(failed_command="enable_ntp_service", error_info=str(e), msm_id=msm_id)
+                self.send_udpping_NACK(failed_command=self.last_arm_command, error_info=str(e), msm_id=msm_id)
             finally:
-                if (self.udpping_process is not None) and (self.udpping_process.returncode != 0) and (self.udpping_process.returncode != -15): # -15 is the SIGTERM signal
-                    stderr_output = self.udpping_process.stderr.read()
-                    stdout_output = self.udpping_process.stdout.read()
+                if (self.udpping_process is not None) and (self.udpping_process.returncode != 0) and (not self.udpping_process.stop_requested):
+                    stderr_output = self.udpping_process.popen.stderr.read()
+                    stdout_output = self.udpping_process.popen.stdout.read()
                     errore_msg = f"UDPPingController: Process finished with error. STDERR: |{stderr_output}| , STDOUT: |{stdout_output}|"
                     print(errore_msg)
                     self.send_udpping_NACK(failed_command="enable_ntp_service", error_info=errore_msg, msm_id=msm_id)
                 
-                self.udpping_process.stdout.close()
-                self.shared_state.set_probe_as_ready()
+                if self.udpping_process is not None:
+                    self.udpping_process.popen.stdout.close()
+                self.shared_state.release_resources(session_owner(RESOURCE_OWNER, msm_id))
 
     def stop_udpping_thread(self) -> str:
-        if (self.udpping_thread is None) or (self.udpping_process is None):
+        if self.udpping_thread is None:
             return "No udpping measure in progress"
         self.stop_thread_event.set()
-        self.udpping_process.terminate()
-        self.udpping_thread.join()
-        self.udpping_process.wait()
+        # A client armed for a scheduled start has no process yet, and it may launch it while stopping: keep terminating
+        while self.udpping_thread.is_alive():
+            self.process_supervisor.stop(RESOURCE_OWNER) # udpClient/udpServer (or ntpdate) of the measurement, reaped
+            self.udpping_thread.join(timeout = 0.5)
         return "OK"
     
 
+    def sync_clock(self, msm_id = None):
+        """
+        Syncs the client clock with the server probe (ntpdate), retrying a few times. Returns the last ntpdate process.
+        """
+        for attempt in range(NTPDATE_ATTEMPTS):
+            result = self.process_supervisor.run(RESOURCE_OWNER, msm_id, ['sudo', 'ntpdate', self.last_probe_ntp_server_ip], text=False)
+            if (result.returncode == 0) or (attempt == NTPDATE_ATTEMPTS - 1) or self.stop_thread_event.wait(NTPDATE_RETRY_SECONDS):
+                return result
+
+
     def stop_ntpsec_service(self):
         stop_command = ["sudo", "systemctl" , "stop" , "ntpsec" ] #[ "sudo systemctl stop ntpsec" ]
         result = subprocess.run(stop_command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
@@ -292,7 +347,7 @@ class UDPPingController:
         self.mqtt_client.publish_command_NACK(handler='udpping', payload = json_nack) 
 
 
-    def compress_and_publish_udpping_result(self, msm_id):
+    def compress_and_publish_udpping_result(self, msm_id, process_usage = None):
         base_path = Path(__file__).parent
         udpping_measurement_file_path = os.path.join(base_path, DEFAULT_UDPPing_MEASUREMENT_FOLDER, msm_id + ".csv")
         
@@ -312,10 +367,11 @@ class UDPPingController:
             "type": "result",
             "payload": {
                 "msm_id": msm_id,
+                "process_usage": process_usage,
                 "c_udpping_b64": c_udpping_b64
              }
         }
-        self.mqtt_client.publish_on_result_topic(result=json.dumps(json_udpping_result))
+        self.mqtt_client.publish_on_result_topic(result=json_udpping_result)
 
         print(f"UDPPingController: compressed and published result of msm -> {msm_id}")
 
@@ -330,6 +386,8 @@ class UDPPingController:
         self.last_probe_server_udpping = None
         self.last_udpping_params = UDPPingParameters()
         self.udpping_process = None
+        self.last_start_at = None
+        self.last_arm_command = None
 
 
     def check_all_parameters(self, payload) -> str:
@@ -0,0 +1,214 @@
+"""
+Pool of warm measurement servers: iperf3 and udpServer processes started in advance on a configured port range
+("warm_pool" section of probe_config.yaml), so that the coordinator can point a client to a free warm port without
+any configuration round trip to this probe. The ports whose server is healthy (running and bound) are announced in the
+ONLINE/UPDATE state messages.
+Each server runs until the "recycle" command sent by the coordinator when its measurement ends, and is then relaunched
+at once: iperf3 -s stays bound between the repetitions and the capacity probes of a measurement.
+"""
+
+import json
+import time
+import threading
+import subprocess
+import psutil
+from mqttModule.mqttClient import ProbeMqttClient
+from shared_resources import SharedState, EXCLUSIVE, NTPSEC_SERVICE, tcp_port, udp_port
+from process_supervisor import ProcessSupervisor
+from udppingModule.udppingController import UDPPingParameters
+
+RESOURCE_OWNER = "warm_pool"
+WARM_TOOLS = ("iperf", "udpping")
+HEALTH_CHECK_SECONDS = 5
+STARTUP_GRACE_SECONDS = 2       # A server not bound after this time is unhealthy, and recycled
+MIN_RUN_SECONDS = 1             # A server exiting sooner (e.g. port bound by another process) is relaunched after a pause
+RELAUNCH_PAUSE_SECONDS = 5
+
+
+class WarmServer:
+    """
+    A warm server of the pool: the tool, its port and the running SupervisedProcess.
+    """
+    def __init__(self, tool, port):
+        self.tool = tool
+        self.port = port
+        self.key = f"{tool}/{port}" # The SharedState owner and the ProcessSupervisor msm_id of the server
+        self.process = None
+        self.launched_at = None
+        self.launches = 0
+        self.thread = None
+
+    def command(self) -> list:
+        if self.tool == "iperf":
+            return ["iperf3", "-s", "-p", str(self.port), "-i", "0"]
+        return UDPPingParameters(role = "Server", listen_port = self.port).get_udpping_command_with_parameters()
+
+    def resources(self) -> dict:
+        return {tcp_port(self.port) if (self.tool == "iperf") else udp_port(self.port): EXCLUSIVE}
+
+
+class WarmPoolController:
+    """
+    Keeps the warm servers running, checks their health and announces the ready ones to the coordinator.
+    """
+    def __init__(self, mqtt_client : ProbeMqttClient, registration_handler_request_function, pool_config = None):
+        """
+        Args:
+            pool_config (dict): {tool: {"first_port", "size"}} for the tools in WARM_TOOLS. None or empty: no warm server.
+        """
+        self.shared_state = SharedState.get_instance()
+        self.process_supervisor = ProcessSupervisor.get_instance()
+        self.mqtt_client = mqtt_client
+        self.stop_event = threading.Event()
+        self.health_thread = None
+        self.advertised = None # The {tool: [ports]} last announced
+        self.servers = []
+        for tool, tool_config in (pool_config or {}).items():
+            if tool not in WARM_TOOLS:
+                print(f"WarmPoolController: unknown tool |{tool}| in the warm pool configuration")
+                continue
+            first_port, size = int(tool_config["first_port"]), int(tool_config.get("size", 1))
+            self.servers += [WarmServer(tool, port) for port in range(first_port, first_port + size)]
+
+        # Requests to commands_demultiplexer
+        registration_response = registration_handler_request_function(
+            interested_command = "warm_pool",
+            handler = self.warm_pool_command_handler)
+        if registration_response != "OK" :
+            print(f"WarmPoolController: registration handler failed. Reason -> {registration_response}")
+
+    def start(self):
+        """
+        Launches the warm servers and the health check. To be called once the capabilities are announced.
+        """
+        if not self.servers:
+            return
+        for server in self.servers:
+            server.thread = threading.Thread(target = self.serve, args = (server,), daemon = True)
+            server.thread.start()
+        self.health_thread = threading.Thread(target = self.health_check_body, daemon = True)
+        self.health_thread.start()
+        print(f"WarmPoolController: started {[server.key for server in self.servers]}")
+
+    def serve(self, server : WarmServer):
+        """
+        Body of the thread of a warm server: it keeps the server running, relaunching it whenever it exits (recycle,
+        crash). The port stays locked in the SharedState while the pool runs.
+        """
+        while not self.stop_event.is_set():
+            if (not self.shared_state.owns_resources(server.key)) and (not self.shared_state.acquire_resources(server.key, server.resources())):
+                self.stop_event.wait(RELAUNCH_PAUSE_SECONDS) # The port is used by a measurement: retry later
+                continue
+            try:
+                server.process = self.process_supervisor.launch(RESOURCE_OWNER, server.key, server.command(),
+                                                                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            except OSError as e:
+                print(f"WarmPoolController: can't launch |{server.key}| -> {e}")
+                self.stop_event.wait(RELAUNCH_PAUSE_SECONDS)
+                continue
+            server.launched_at = time.monotonic()
+            server.launches += 1
+            server.process.wait()
+            self.process_supervisor.forget(server.process)
+            if (time.monotonic() - server.launched_at) < MIN_RUN_SECONDS:
+                self.stop_event.wait(RELAUNCH_PAUSE_SECONDS)
+        self.shared_state.release_resources(server.key)
+
+    def recycle(self, server : WarmServer) -> bool:
+        """
+        Stops the running process of the server: its thread launches a fresh one.
+        """
+        return all(self.process_supervisor.stop_process(process) for process in self.process_supervisor.processes_of(RESOURCE_OWNER, server.key))
+
+    def bound_ports(self) -> dict:
+        """
+        Returns {"tcp": ports listening, "udp": ports bound} on this host.
+        """
+        tcp_ports = {connection.laddr.port for connection in psutil.net_connections(kind = "tcp") if connection.status == psutil.CONN_LISTEN}
+        udp_ports = {connection.laddr.port for connection in psutil.net_connections(kind = "udp")}
+        return {"tcp": tcp_ports, "udp": udp_ports}
+
+    def ready_servers(self) -> dict:
+        """
+        Returns {tool: [ports]} of the healthy servers, recycling the ones launched for a while but not bound.
+        The udpServer ports are not ready while ntpsec is stopped by a UDP-ping client of this probe (the client probe
+        syncs its clock with the server probe).
+        """
+        bound_ports = self.bound_ports()
+        held_resources = self.shared_state.get_held_resources()
+        ntpsec_stopped = any(resources.get(NTPSEC_SERVICE) == EXCLUSIVE for resources in held_resources.values())
+        ready = {}
+        for server in self.servers:
+            process = server.process
+            if (process is None) or (not process.is_running()):
+                continue
+            bound = server.port in bound_ports["tcp" if (server.tool == "iperf") else "udp"]
+            if not bound:
+                if (time.monotonic() - server.launched_at) > STARTUP_GRACE_SECONDS:
+                    print(f"WarmPoolController: |{server.key}| not bound, recycling")
+                    self.recycle(server)
+                continue
+            if (server.tool == "udpping") and ntpsec_stopped:
+                continue
+            ready.setdefault(server.tool, []).append(server.port)
+        return ready
+
+    def health_check_body(self):
+        """
+        Body of the health check thread: announces the ready servers with an UPDATE state, whenever they change.
+        """
+        while not self.stop_event.wait(HEALTH_CHECK_SECONDS):
+            try:
+                ready = self.ready_servers()
+            except Exception as e:
+                print(f"WarmPoolController: health check failed -> {e}")
+                continue
+            if ready != self.advertised:
+                self.advertised = ready
+                self.mqtt_client.warm_servers = ready
+                self.mqtt_client.publish_probe_state("UPDATE")
+                print(f"WarmPoolController: announced warm servers -> {ready}")
+
+    def warm_pool_command_handler(self, command : str, payload : json):
+        """
+        Handles the warm_pool commands: "recycle" {tool, port, msm_id} relaunches the server of the port.
+        """
+        msm_id = payload.get("msm_id")
+        match command:
+            case "recycle":
+                server = next((server for server in self.servers
+                               if (server.tool == payload.get("tool")) and (server.port == payload.get("port"))), None)
+                if server is None:
+                    self.send_warm_pool_NACK(failed_command = command, error_info = f"No warm server |{payload.get('tool')}/{payload.get('port')}|", msm_id = msm_id)
+                    return
+                if self.recycle(server):
+                    self.send_warm_pool_ACK(successed_command = command, msm_id = msm_id)
+                else:
+                    self.send_warm_pool_NACK(failed_command = command, error_info = f"Can't stop |{server.key}|", msm_id = msm_id)
+            case _:
+                self.send_warm_pool_NACK(failed_command = command, error_info = "Command not handled", msm_id = msm_id)
+
+    def shutdown(self):
+        """
+        Stops the warm servers (their threads release the ports).
+        """
+        self.stop_event.set()
+        for server in self.servers:
+            self.process_supervisor.stop(RESOURCE_OWNER, server.key)
+
+    def send_warm_pool_ACK(self, successed_command, msm_id = None):
+        json_ack = {
+            "command": successed_command,
+            "msm_id": msm_id
+        }
+        print(f"WarmPoolController: ACK sending -> {json_ack}")
+        self.mqtt_client.publish_command_ACK(handler = 'warm_pool', payload = json_ack)
+
+    def send_warm_pool_NACK(self, failed_command, error_info, msm_id = None):
+        json_nack = {
+            "command": failed_command,
+            "reason": error_info,
+            "msm_id": msm_id
+        }
+        print(f"WarmPoolController: NACK sending -> {json_nack}")
+        self.mqtt_client.publish_command_NACK(handler = 'warm_pool', payload = json_nack)
@@ -0,0 +1,70 @@
+"""
+Replays a MQTT log recorded by the coordinator (coordinator.py -record PATH) into an in-process coordinator,
+and prints a JSON report with throughput, per-handler latency and MongoDB write volume.
+By default the results are written in a scratch database (measurex_replay), not in the production one.
+
+Example: python3 replay_benchmark.py traffic.log.gz --speed 10
+         python3 replay_benchmark.py traffic.log.gz --speed max --mode broker --mqtt-config local_broker.yaml
+"""
+
+import json
+import argparse
+from pathlib import Path
+from modules.configLoader.config_loader import ConfigLoader, MONGO_KEY
+from modules.mqttModule import mqtt_client
+from modules.mqttModule.mqtt_client import Mqtt_Client
+from modules.mongoModule.mongoDB import MongoDB
+from modules.commandsMultiplexer.commands_multiplexer import CommandsMultiplexer
+from modules.replayModule.mqtt_replay import MqttReplay, DIRECT_MODE, BROKER_MODE, MAX_SPEED
+from coordinator import init_measurement_coordinators
+
+DEFAULT_REPLAY_DB_NAME = "measurex_replay"
+
+
+def parse_speed(value) -> float:
+    if value == "max":
+        return MAX_SPEED
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("the speed must be positive, or max")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recorded MQTT log into an in-process coordinator.")
+    parser.add_argument('log', help="Log recorded with coordinator.py -record PATH.")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="Pace multiplier (1, 10x, ...) or max.")
+    parser.add_argument('--mode', choices=[DIRECT_MODE, BROKER_MODE], default=DIRECT_MODE,
+                        help="direct: dispatch in-process, without broker. broker: publish on the broker of --mqtt-config.")
+    parser.add_argument('--mqtt-config', default=None, help="MQTT yaml configuration, as mqttConfig.yaml (use a local broker).")
+    parser.add_argument('--db-name', default=DEFAULT_REPLAY_DB_NAME, help="MongoDB database where the replay writes.")
+    parser.add_argument('--keep-timestamps', action='store_true', help="Don't rebase the result timestamps to the replay time.")
+    parser.add_argument('--drain-timeout', type=float, default=60, help="Broker mode: max seconds to wait for the dispatching.")
+    parser.add_argument('--verbose', action='store_true', help="Print the payload of each dispatched message.")
+    args = parser.parse_args()
+
+    mqtt_client.VERBOSE = args.verbose
+    cl = ConfigLoader(base_path = Path(__file__).parent, file_name="coordinatorConfig.yaml", KEY = MONGO_KEY)
+    cl.config.db_name = args.db_name
+    mongo_db = MongoDB(mongo_config = cl.config)
+
+    commands_multiplexer = CommandsMultiplexer(mongo_db)
+    coordinator_mqtt = Mqtt_Client(
+        status_handler_callback = commands_multiplexer.status_multiplexer,
+        results_handler_callback = commands_multiplexer.result_multiplexer,
+        errors_handler_callback = commands_multiplexer.errors_multiplexer,
+        config_path = args.mqtt_config,
+        connect_to_broker = (args.mode == BROKER_MODE))
+    commands_multiplexer.set_mqtt_client(coordinator_mqtt)
+    init_measurement_coordinators(commands_multiplexer, coordinator_mqtt, mongo_db)
+
+    replay = MqttReplay(log_path = args.log, mqtt_client = coordinator_mqtt, mode = args.mode, speed = args.speed,
+                        rebase_timestamps = not args.keep_timestamps, drain_timeout = args.drain_timeout)
+    report = replay.run()
+    if args.mode == BROKER_MODE:
+        coordinator_mqtt.disconnect()
+    print(json.dumps(report, indent = 2))
+
+
+if __name__ == "__main__":
+    main()